@@ -24,7 +24,8 @@ LOGGER = logging.getLogger(__name__)
 
 from .apikey import (
     issue_new_apikey,
-    verify_apikey
+    verify_apikey,
+    list_revoked_apikeys,
 )
 
 from .admin import (
@@ -37,6 +38,8 @@ from .email import (
     verify_user_email_address,
     send_forgotpass_verification_email,
     authnzerver_send_email,
+    queue_email,
+    send_queued_emails,
 )
 
 from .session import (
@@ -48,6 +51,7 @@ from .session import (
     auth_user_login,
     auth_user_logout,
     auth_kill_old_sessions,
+    auth_reap_expired_sessions,
 )
 
 from .user import (
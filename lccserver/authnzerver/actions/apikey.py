@@ -51,8 +51,6 @@ except Exception as e:
 import secrets
 import multiprocessing as mp
 
-from sqlalchemy import select
-
 from .. import authdb
 from .session import auth_session_exists
 
@@ -243,16 +241,11 @@ def verify_apikey(payload,
             )
         )
 
-    apikeys = currproc.table_meta.tables['apikeys']
-    sel = select([
-        apikeys.c.apikey,
-        apikeys.c.expires,
-    ]).select_from(apikeys).where(
-        apikeys.c.apikey == apikey_dict['tkn']
-    ).where(
-        apikeys.c.user_id == apikey_dict['uid']
+    result = currproc.connection.execute(
+        authdb.APIKEY_VERIFY_SELECT,
+        apikey=apikey_dict['tkn'],
+        user_id=apikey_dict['uid']
     )
-    result = currproc.connection.execute(sel)
     row = result.fetchone()
     result.close()
 
@@ -274,3 +267,63 @@ def verify_apikey(payload,
                 "API key could not be verified."
             )]
         }
+
+
+
+def list_revoked_apikeys(payload,
+                         raiseonfail=False,
+                         override_authdb_path=None):
+    '''This lists the API keys that were revoked before they expired.
+
+    payload is not used and can be empty.
+
+    The frontend uses this list to verify API keys on its own instead of
+    sending each one here. Returns the random token and expiry date in ISO
+    format of each revoked API key that hasn't expired yet.
+
+    '''
+
+    # this checks if the database connection is live
+    currproc = mp.current_process()
+    engine = getattr(currproc, 'engine', None)
+
+    if override_authdb_path:
+        currproc.auth_db_path = override_authdb_path
+
+    if not engine:
+        currproc.engine, currproc.connection, currproc.table_meta = (
+            authdb.get_auth_db(
+                currproc.auth_db_path,
+                echo=raiseonfail
+            )
+        )
+
+    try:
+
+        result = currproc.connection.execute(
+            authdb.REVOKED_APIKEYS_SELECT,
+            now=datetime.utcnow()
+        )
+        revoked = [{'apikey':row['apikey'],
+                    'expires':row['expires'].isoformat()}
+                   for row in result]
+        result.close()
+
+        return {
+            'success':True,
+            'revoked':revoked,
+            'messages':["%s revoked API keys found." % len(revoked)]
+        }
+
+    except Exception as e:
+
+        LOGGER.exception('could not list the revoked API keys')
+
+        if raiseonfail:
+            raise
+
+        return {
+            'success':False,
+            'revoked':None,
+            'messages':["Could not list the revoked API keys."]
+        }
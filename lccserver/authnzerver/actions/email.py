@@ -167,6 +167,66 @@ Thanks,
 '''
 
 
+def make_email_message(sender, subject, text, recipients):
+    '''
+    This makes the MIME message for an email.
+
+    '''
+
+    msg = MIMEText(text)
+    msg['From'] = sender
+    msg['To'] = ', '.join(recipients)
+    msg['Message-Id'] = make_msgid()
+    msg['Subject'] = subject
+    msg['Date'] = formatdate(time.time())
+
+    return msg
+
+
+def smtp_connect(server,
+                 port,
+                 user,
+                 password,
+                 require_tls=True,
+                 timeout=30.0):
+    '''This connects and logs in to an SMTP server.
+
+    The connection is switched to TLS if the server supports it. If it doesn't
+    and require_tls is True, this fails instead of sending the password in the
+    clear. If user is None, the login is skipped.
+
+    Returns the smtplib.SMTP connection. Raises an exception if the connection
+    or the login fails.
+
+    '''
+
+    smtp = smtplib.SMTP(server, port, timeout=timeout)
+
+    try:
+
+        smtp.ehlo()
+
+        if smtp.has_extn('STARTTLS'):
+            smtp.starttls()
+            smtp.ehlo()
+
+        elif require_tls:
+            raise smtplib.SMTPNotSupportedError(
+                'email server: %s does not support TLS, '
+                'will not send an email.' % server
+            )
+
+        if user is not None:
+            smtp.login(user, password)
+
+        return smtp
+
+    except Exception as e:
+
+        smtp.close()
+        raise
+
+
 def authnzerver_send_email(
         sender,
         subject,
@@ -182,67 +242,362 @@ def authnzerver_send_email(
 
     '''
 
-    msg = MIMEText(text)
-    msg['From'] = sender
-    msg['To'] = ', '.join(recipients)
-    msg['Message-Id'] = make_msgid()
-    msg['Subject'] = subject
-    msg['Date'] = formatdate(time.time())
+    msg = make_email_message(sender, subject, text, recipients)
 
     # next, we'll try to login to the SMTP server
     try:
 
-        server = smtplib.SMTP(server, port)
-        server.ehlo()
+        smtp = smtp_connect(server, port, user, password)
 
-        if server.has_extn('STARTTLS'):
+        try:
 
-            try:
+            smtp.sendmail(
+                sender,
+                recipients,
+                msg.as_string()
+            )
+            return True
 
-                server.starttls()
-                server.ehlo()
+        finally:
 
-                server.login(
-                    user,
-                    password
-                )
+            smtp.quit()
 
-                server.sendmail(
-                    sender,
-                    recipients,
-                    msg.as_string()
+    except Exception as e:
+
+        LOGGER.exception(
+            "could not send the email to %s, "
+            "subject: %s because of an exception"
+            % (recipients, subject)
+        )
+        return False
+
+
+
+#################
+## EMAIL QUEUE ##
+#################
+
+def queue_email(
+        sender,
+        subject,
+        text,
+        recipients,
+        server,
+        user,
+        port=587,
+        raiseonfail=False,
+        override_authdb_path=None
+):
+    '''This adds an email to the outbound email queue in the auth DB.
+
+    The authnzerver's email sender sends the queued emails in the background
+    using send_queued_emails below. The SMTP password isn't stored in the auth
+    DB. The email sender keeps it in memory instead and passes it to
+    send_queued_emails.
+
+    Returns the email_id of the queued email or None if it couldn't be queued.
+
+    '''
+
+    # this checks if the database connection is live
+    currproc = mp.current_process()
+    engine = getattr(currproc, 'engine', None)
+
+    if override_authdb_path:
+        currproc.auth_db_path = override_authdb_path
+
+    if not engine:
+        currproc.engine, currproc.connection, currproc.table_meta = (
+            authdb.get_auth_db(
+                currproc.auth_db_path,
+                echo=raiseonfail
+            )
+        )
+
+    email_queue = currproc.table_meta.tables['email_queue']
+
+    try:
+
+        ins = email_queue.insert({
+            'sender':sender,
+            'recipients':recipients,
+            'subject':subject,
+            'text':text,
+            'smtp_server':server,
+            'smtp_port':port,
+            'smtp_user':user,
+        })
+        result = currproc.connection.execute(ins)
+        email_id = result.inserted_primary_key[0]
+        result.close()
+
+        return email_id
+
+    except Exception as e:
+
+        LOGGER.exception('could not queue the email to %s, subject: %s' %
+                         (recipients, subject))
+
+        if raiseonfail:
+            raise
+
+        return None
+
+
+def send_queued_emails(
+        batchsize=50,
+        maxattempts=5,
+        retry_interval=60.0,
+        require_tls=True,
+        credentials=None,
+        max_password_wait=86400.0,
+        raiseonfail=False,
+        override_authdb_path=None
+):
+    '''This sends the queued emails that are due.
+
+    At most batchsize emails are sent in one call. Emails that go to the same
+    SMTP server with the same login are sent over a single connection. Emails
+    that can't be sent are tried again after retry_interval seconds, doubling
+    each time. An email that still can't be sent after maxattempts tries is
+    marked as failed.
+
+    credentials is a dict of SMTP passwords keyed by (server, port, user). If
+    there's no password for an email's SMTP login, e.g. after the authnzerver
+    restarts, the email waits for retry_interval seconds without using up any
+    of its tries. An email that's still waiting for its password
+    max_password_wait seconds after it was queued is marked as failed, so it
+    doesn't wait forever.
+
+    Returns:
+
+    a dict with the number of emails sent, the number that will be retried, the
+    number that failed for good, the number waiting for their SMTP password,
+    and a finished key that's True if fewer than batchsize emails were due.
+
+    '''
+
+    # this checks if the database connection is live
+    currproc = mp.current_process()
+    engine = getattr(currproc, 'engine', None)
+
+    if override_authdb_path:
+        currproc.auth_db_path = override_authdb_path
+
+    if not engine:
+        currproc.engine, currproc.connection, currproc.table_meta = (
+            authdb.get_auth_db(
+                currproc.auth_db_path,
+                echo=raiseonfail
+            )
+        )
+
+    email_queue = currproc.table_meta.tables['email_queue']
+
+    try:
+
+        result = currproc.connection.execute(
+            authdb.QUEUED_EMAILS_SELECT,
+            now=datetime.utcnow(),
+            batchsize=batchsize
+        )
+        emails = result.fetchall()
+        result.close()
+
+    except Exception as e:
+
+        LOGGER.exception('could not get the queued emails')
+
+        if raiseonfail:
+            raise
+
+        return {
+            'success':False,
+            'sent':0,
+            'retrying':0,
+            'failed':0,
+            'waiting':0,
+            'finished':False,
+            'messages':["Could not get the queued emails."]
+        }
+
+    # group the emails by SMTP server and login so each group can be sent over
+    # one connection
+    smtp_groups = {}
+    for email in emails:
+        smtp_groups.setdefault(
+            (email['smtp_server'], email['smtp_port'], email['smtp_user']),
+            []
+        ).append(email)
+
+    if credentials is None:
+        credentials = {}
+
+    sent = 0
+    retrying = 0
+    failed = 0
+    waiting = 0
+
+    for (server, port, user), group in smtp_groups.items():
+
+        if user is not None and (server, port, user) not in credentials:
+
+            wait_cutoff = (datetime.utcnow() -
+                           timedelta(seconds=max_password_wait))
+            stuck = [x['email_id'] for x in group
+                     if x['queued'] < wait_cutoff]
+            group_waiting = [x['email_id'] for x in group
+                             if x['queued'] >= wait_cutoff]
+
+            if len(stuck) > 0:
+
+                LOGGER.error('no SMTP password for %s@%s:%s after %s '
+                             'seconds, marking queued emails: %s as failed' %
+                             (user, server, port, max_password_wait, stuck))
+
+                result = currproc.connection.execute(
+                    email_queue.update().where(
+                        email_queue.c.email_id.in_(stuck)
+                    ).values(
+                        {'status':'failed',
+                         'last_error':(
+                             'no SMTP password for %s@%s:%s after %s seconds' %
+                             (user, server, port, max_password_wait)
+                         )}
+                    )
                 )
+                result.close()
+                failed = failed + len(stuck)
+
+            if len(group_waiting) > 0:
+
+                LOGGER.warning('no SMTP password for %s@%s:%s, %s queued '
+                               'emails will wait for it' %
+                               (user, server, port, len(group_waiting)))
+
+                result = currproc.connection.execute(
+                    email_queue.update().where(
+                        email_queue.c.email_id.in_(group_waiting)
+                    ).values(
+                        {'next_attempt':(datetime.utcnow() +
+                                         timedelta(seconds=retry_interval))}
+                    )
+                )
+                result.close()
+                waiting = waiting + len(group_waiting)
+
+            continue
 
-                server.quit()
-                return True
+        password = credentials.get((server, port, user))
+        smtp = None
+        connect_error = None
+
+        for email in group:
+
+            try:
+
+                # if the SMTP server couldn't be reached for an earlier email
+                # in this group, don't wait on it again for this one
+                if connect_error is not None:
+                    raise connect_error
+
+                # connect if this is the first email in the group or the
+                # server dropped the last connection
+                if smtp is None:
+                    try:
+                        smtp = smtp_connect(server, port, user, password,
+                                            require_tls=require_tls)
+                    except Exception as e:
+                        connect_error = e
+                        raise
+
+                msg = make_email_message(email['sender'],
+                                         email['subject'],
+                                         email['text'],
+                                         email['recipients'])
+                smtp.sendmail(email['sender'],
+                              email['recipients'],
+                              msg.as_string())
+
+                result = currproc.connection.execute(
+                    email_queue.delete().where(
+                        email_queue.c.email_id == email['email_id']
+                    )
+                )
+                result.close()
+                sent = sent + 1
 
             except Exception as e:
 
-                LOGGER.exception(
-                    "could not send the email to %s, "
-                    "subject: %s because of an exception"
-                    % (recipients, subject)
+                LOGGER.error('could not send queued email %s to %s, '
+                             'subject: %s: %r' %
+                             (email['email_id'], email['recipients'],
+                              email['subject'], e))
+
+                attempts = email['attempts'] + 1
+
+                if attempts >= maxattempts:
+                    values = {'attempts':attempts,
+                              'status':'failed',
+                              'last_error':repr(e)}
+                    failed = failed + 1
+                else:
+                    values = {'attempts':attempts,
+                              'next_attempt':(
+                                  datetime.utcnow() +
+                                  timedelta(seconds=(
+                                      retry_interval*2**(attempts - 1)
+                                  ))
+                              ),
+                              'last_error':repr(e)}
+                    retrying = retrying + 1
+
+                result = currproc.connection.execute(
+                    email_queue.update().where(
+                        email_queue.c.email_id == email['email_id']
+                    ).values(values)
                 )
-                server.quit()
-                return False
-        else:
+                result.close()
+
+                # if the server refused just this email, the connection can
+                # still be used for the next one. otherwise, start over with a
+                # new connection.
+                if smtp is not None and not isinstance(
+                        e, (smtplib.SMTPRecipientsRefused,
+                            smtplib.SMTPSenderRefused,
+                            smtplib.SMTPDataError)
+                ):
+                    try:
+                        smtp.close()
+                    except Exception:
+                        pass
+                    smtp = None
+
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
 
-            LOGGER.error('email server: %s does not support TLS, '
-                         'will not send an email.' % server)
-            server.quit()
-            return False
+    if sent > 0 or retrying > 0 or failed > 0:
+        LOGGER.info('sent %s queued emails, %s will be retried, %s failed' %
+                    (sent, retrying, failed))
 
-    except Exception as e:
+    return {
+        'success':True,
+        'sent':sent,
+        'retrying':retrying,
+        'failed':failed,
+        'waiting':waiting,
+        'finished':len(emails) < batchsize,
+        'messages':["%s queued emails sent." % sent]
+    }
 
-        LOGGER.exception(
-            "could not send the email to %s, "
-            "subject: %s because of an exception"
-            % (recipients, subject)
-        )
-        server.quit()
-        return False
 
 
+#########################
+## SENDING AUTH EMAILS ##
+#########################
 
 def send_signup_verification_email(payload,
                                    raiseonfail=False,
@@ -411,8 +766,9 @@ def send_signup_verification_email(payload,
                                 payload['smtp_sender'])
     recipients = [user_info['email']]
 
-    # send the email
-    email_sent = authnzerver_send_email(
+    # queue the email. the authnzerver's email sender sends it in the
+    # background.
+    email_queued = queue_email(
         sender,
         SIGNUP_VERIFICATION_EMAIL_SUBJECT.format(
             server_name=payload['server_name']
@@ -421,16 +777,17 @@ def send_signup_verification_email(payload,
         recipients,
         payload['smtp_server'],
         payload['smtp_user'],
-        payload['smtp_pass'],
-        port=payload['smtp_port']
+        port=payload['smtp_port'],
+        raiseonfail=raiseonfail,
+        override_authdb_path=override_authdb_path
     )
 
-    if email_sent:
+    if email_queued is not None:
 
         emailverify_sent_datetime = datetime.utcnow()
 
         # finally, we'll update the users table with the actual
-        # verifyemail_sent_datetime if sending succeeded.
+        # verifyemail_sent_datetime if queueing succeeded.
         upd = users.update(
         ).where(
             users.c.user_id == payload['created_info']['user_id']
@@ -450,7 +807,7 @@ def send_signup_verification_email(payload,
             'email_address':user_info['email'],
             'verifyemail_sent_datetime':emailverify_sent_datetime,
             'messages':([
-                "Email verification request sent successfully to %s"
+                "Email verification request queued for sending to %s"
                 % recipients
             ])
         }
@@ -733,8 +1090,9 @@ def send_forgotpass_verification_email(payload,
                                 payload['smtp_sender'])
     recipients = [user_info['email']]
 
-    # send the email
-    email_sent = authnzerver_send_email(
+    # queue the email. the authnzerver's email sender sends it in the
+    # background.
+    email_queued = queue_email(
         sender,
         FORGOTPASS_VERIFICATION_EMAIL_SUBJECT.format(
             server_name=payload['server_name']
@@ -743,16 +1101,17 @@ def send_forgotpass_verification_email(payload,
         recipients,
         payload['smtp_server'],
         payload['smtp_user'],
-        payload['smtp_pass'],
-        port=payload['smtp_port']
+        port=payload['smtp_port'],
+        raiseonfail=raiseonfail,
+        override_authdb_path=override_authdb_path
     )
 
-    if email_sent:
+    if email_queued is not None:
 
         emailforgotpass_sent_datetime = datetime.utcnow()
 
         # finally, we'll update the users table with the actual
-        # verifyemail_sent_datetime if sending succeeded.
+        # verifyemail_sent_datetime if queueing succeeded.
         upd = users.update(
         ).where(
             users.c.is_active == True
@@ -770,7 +1129,7 @@ def send_forgotpass_verification_email(payload,
             'email_address':user_info['email'],
             'forgotemail_sent_datetime':emailforgotpass_sent_datetime,
             'messages':([
-                "Password reset request sent successfully to %s"
+                "Password reset request queued for sending to %s"
                 % recipients
             ])
         }
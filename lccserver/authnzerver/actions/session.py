@@ -330,30 +330,11 @@ def auth_session_exists(payload,
                 )
             )
 
-        sessions = currproc.table_meta.tables['sessions']
-        users = currproc.table_meta.tables['users']
-        s = select([
-            users.c.user_id,
-            users.c.full_name,
-            users.c.email,
-            users.c.email_verified,
-            users.c.emailverify_sent_datetime,
-            users.c.is_active,
-            users.c.last_login_try,
-            users.c.last_login_success,
-            users.c.created_on,
-            users.c.user_role,
-            sessions.c.session_token,
-            sessions.c.ip_address,
-            sessions.c.client_header,
-            sessions.c.created,
-            sessions.c.expires,
-            sessions.c.extra_info_json
-        ]).select_from(users.join(sessions)).where(
-            (sessions.c.session_token == session_token) &
-            (sessions.c.expires > datetime.utcnow())
+        result = currproc.connection.execute(
+            authdb.SESSION_INFO_SELECT,
+            session_token=session_token,
+            now=datetime.utcnow()
         )
-        result = currproc.connection.execute(s)
         rows = result.fetchone()
         result.close()
 
@@ -534,6 +515,102 @@ def auth_kill_old_sessions(
 
 
 
+def auth_reap_expired_sessions(
+        batchsize=500,
+        maxbatches=20,
+        raiseonfail=False,
+        override_authdb_path=None
+):
+    '''This deletes expired sessions a few at a time.
+
+    Expired sessions are deleted in batches of batchsize using the index on
+    sessions.expires, so no single delete holds the auth DB's write lock for
+    long. At most maxbatches batches are deleted in one call. Sessions with an
+    unexpired API key are kept. Revoked API keys that have expired are deleted
+    as well.
+
+    Returns:
+
+    a dict with the number of sessions deleted, the number of batches used, and
+    a finished key that's True if there are no expired sessions left.
+
+    '''
+
+    # this checks if the database connection is live
+    currproc = mp.current_process()
+    engine = getattr(currproc, 'engine', None)
+
+    if override_authdb_path:
+        currproc.auth_db_path = override_authdb_path
+
+    if not engine:
+        currproc.engine, currproc.connection, currproc.table_meta = (
+            authdb.get_auth_db(
+                currproc.auth_db_path,
+                echo=raiseonfail
+            )
+        )
+
+    now = datetime.utcnow()
+    deleted = 0
+    batches = 0
+    finished = False
+
+    try:
+
+        while batches < maxbatches:
+
+            result = currproc.connection.execute(
+                authdb.EXPIRED_SESSIONS_DELETE,
+                now=now,
+                batchsize=batchsize
+            )
+            batch_deleted = result.rowcount
+            result.close()
+
+            deleted = deleted + batch_deleted
+            batches = batches + 1
+
+            if batch_deleted < batchsize:
+                finished = True
+                break
+
+        # the revoked API keys that have expired don't need to be kept either
+        result = currproc.connection.execute(
+            authdb.EXPIRED_REVOCATIONS_DELETE,
+            now=now
+        )
+        result.close()
+
+    except Exception as e:
+
+        LOGGER.exception('could not delete expired sessions')
+
+        if raiseonfail:
+            raise
+
+        return {
+            'success':False,
+            'deleted':deleted,
+            'batches':batches,
+            'finished':False,
+            'messages':["Could not delete expired sessions."]
+        }
+
+    if deleted > 0:
+        LOGGER.info('deleted %s expired sessions in %s batches' %
+                    (deleted, batches))
+
+    return {
+        'success':True,
+        'deleted':deleted,
+        'batches':batches,
+        'finished':finished,
+        'messages':["%s expired sessions deleted." % deleted]
+    }
+
+
+
 
 ###################################
 ## USER LOGIN HANDLING FUNCTIONS ##
@@ -610,20 +687,18 @@ def auth_password_check(payload,
         )
 
         # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.connection.execute(dummy_sel)
+        dummy_results = currproc.connection.execute(
+            authdb.USER_PASSWORD_SELECT, user_id=3
+        )
 
         dummy_password = dummy_results.fetchone()['password']
         dummy_results.close()
         authdb.password_context.verify('nope',
                                        dummy_password)
         # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.connection.execute(dummy_sel)
+        dummy_results = currproc.connection.execute(
+            authdb.USER_PASSWORD_SELECT, user_id=3
+        )
         dummy_password = dummy_results.fetchone()['password']
         dummy_results.close()
         authdb.password_context.verify('nope',
@@ -648,19 +723,17 @@ def auth_password_check(payload,
         if not session_info['success']:
 
             # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.connection.execute(dummy_sel)
+            dummy_results = currproc.connection.execute(
+                authdb.USER_PASSWORD_SELECT, user_id=3
+            )
             dummy_password = dummy_results.fetchone()['password']
             dummy_results.close()
             authdb.password_context.verify('nope',
                                            dummy_password)
             # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.connection.execute(dummy_sel)
+            dummy_results = currproc.connection.execute(
+                authdb.USER_PASSWORD_SELECT, user_id=3
+            )
             dummy_password = dummy_results.fetchone()['password']
             dummy_results.close()
             authdb.password_context.verify('nope',
@@ -677,10 +750,9 @@ def auth_password_check(payload,
         else:
 
             # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.connection.execute(dummy_sel)
+            dummy_results = currproc.connection.execute(
+                authdb.USER_PASSWORD_SELECT, user_id=3
+            )
             dummy_password = dummy_results.fetchone()['password']
             dummy_results.close()
             authdb.password_context.verify('nope',
@@ -797,8 +869,6 @@ def auth_user_login(payload,
             )
         )
 
-    users = currproc.table_meta.tables['users']
-
     #
     # check if the request is OK
     #
@@ -814,20 +884,18 @@ def auth_user_login(payload,
         )
 
         # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.connection.execute(dummy_sel)
+        dummy_results = currproc.connection.execute(
+            authdb.USER_PASSWORD_SELECT, user_id=3
+        )
 
         dummy_password = dummy_results.fetchone()['password']
         dummy_results.close()
         authdb.password_context.verify('nope',
                                        dummy_password)
         # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.connection.execute(dummy_sel)
+        dummy_results = currproc.connection.execute(
+            authdb.USER_PASSWORD_SELECT, user_id=3
+        )
         dummy_password = dummy_results.fetchone()['password']
         dummy_results.close()
         authdb.password_context.verify('nope',
@@ -857,19 +925,17 @@ def auth_user_login(payload,
         if not session_info['success']:
 
             # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.connection.execute(dummy_sel)
+            dummy_results = currproc.connection.execute(
+                authdb.USER_PASSWORD_SELECT, user_id=3
+            )
             dummy_password = dummy_results.fetchone()['password']
             dummy_results.close()
             authdb.password_context.verify('nope',
                                            dummy_password)
             # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.connection.execute(dummy_sel)
+            dummy_results = currproc.connection.execute(
+                authdb.USER_PASSWORD_SELECT, user_id=3
+            )
             dummy_password = dummy_results.fetchone()['password']
             dummy_results.close()
             authdb.password_context.verify('nope',
@@ -893,29 +959,19 @@ def auth_user_login(payload,
         else:
 
             # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.connection.execute(dummy_sel)
+            dummy_results = currproc.connection.execute(
+                authdb.USER_PASSWORD_SELECT, user_id=3
+            )
             dummy_password = dummy_results.fetchone()['password']
             dummy_results.close()
             authdb.password_context.verify('nope',
                                            dummy_password)
 
             # look up the provided user
-            user_sel = select([
-                users.c.user_id,
-                users.c.password,
-                users.c.is_active,
-                users.c.user_role,
-            ]).select_from(users).where(
-                users.c.email == payload['email']
-            ).where(
-                users.c.is_active == True
-            ).where(
-                users.c.email_verified == True
+            user_results = currproc.connection.execute(
+                authdb.USER_LOGIN_SELECT,
+                email=payload['email']
             )
-            user_results = currproc.connection.execute(user_sel)
             user_info = user_results.fetchone()
             user_results.close()
 
@@ -15,17 +15,25 @@ from datetime import datetime
 import sqlite3
 import secrets
 import getpass
+import logging
+from functools import lru_cache
+
+import numpy as np
 
 from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from sqlalchemy import (
     Table, Column, Integer, String, Text,
     Boolean, DateTime, ForeignKey, MetaData
 )
+from sqlalchemy import select, bindparam, true, exists
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import LRUCache
 
 from passlib.context import CryptContext
 
+LOGGER = logging.getLogger(__name__)
+
 ##########################
 ## JSON type for SQLite ##
 ##########################
@@ -94,7 +102,7 @@ Sessions = Table(
     # we won't allow them to initiate a session
     Column('client_header', String(length=280), nullable=False),
     Column('user_id', Integer, ForeignKey("users.user_id", ondelete="CASCADE"),
-           nullable=False),
+           nullable=False, index=True),
     Column('created', DateTime(),
            default=datetime.utcnow,
            nullable=False, index=True),
@@ -186,10 +194,162 @@ APIKeys = Table(
     Column('expires', DateTime(), index=True, nullable=False),
     Column('user_id', Integer(),
            ForeignKey('users.user_id', ondelete="CASCADE"),
-           nullable=False),
+           nullable=False, index=True),
     Column('session_token', Text(),
            ForeignKey('sessions.session_token', ondelete="CASCADE"),
-           nullable=False)
+           nullable=False, index=True)
+)
+
+
+# API keys that were deleted before they expired. the frontend keeps a copy of
+# this so it can verify API keys without asking the authnzerver. rows are added
+# by the SQLITE_APIKEY_REVOKE_TRIGGER below whenever an unexpired API key is
+# deleted, including when its session or user is deleted.
+APIKeysRevoked = Table(
+    'apikeys_revoked',
+    AUTHDB_META,
+    Column('apikey', Text(), primary_key=True, nullable=False),
+    Column('revoked', DateTime(), nullable=False, default=datetime.utcnow),
+    Column('expires', DateTime(), index=True, nullable=False),
+    Column('user_id', Integer(), nullable=False)
+)
+
+
+# emails waiting to be sent. the actions that send emails add them here and
+# return right away. the authnzerver's email sender sends them in the
+# background, trying again later if the SMTP server can't be reached. emails are
+# deleted once they're sent. the ones that still can't be sent after a few
+# tries are kept with status = 'failed' so they can be looked at later.
+EmailQueue = Table(
+    'email_queue',
+    AUTHDB_META,
+    Column('email_id', Integer(), primary_key=True, nullable=False),
+    Column('queued', DateTime(), nullable=False, default=datetime.utcnow),
+    Column('status', String(length=10), nullable=False, default='queued'),
+    Column('attempts', Integer(), nullable=False, default=0),
+    Column('next_attempt', DateTime(), index=True,
+           nullable=False, default=datetime.utcnow),
+    Column('last_error', Text()),
+    Column('sender', Text(), nullable=False),
+    Column('recipients', JSONEncodedDict(), nullable=False),
+    Column('subject', Text(), nullable=False),
+    Column('text', Text(), nullable=False),
+    Column('smtp_server', Text(), nullable=False),
+    Column('smtp_port', Integer(), nullable=False),
+    Column('smtp_user', Text())
+)
+
+
+############################
+## PRECOMPILED STATEMENTS ##
+############################
+
+# these are the lookups done for nearly every auth request. they're built once
+# here and the compiled forms are kept in the compiled statement cache of each
+# connection returned by get_auth_db, so they aren't compiled again every time
+# they're run.
+
+# the session info for a session token that hasn't expired yet
+# params: session_token, now
+SESSION_INFO_SELECT = select([
+    Users.c.user_id,
+    Users.c.full_name,
+    Users.c.email,
+    Users.c.email_verified,
+    Users.c.emailverify_sent_datetime,
+    Users.c.is_active,
+    Users.c.last_login_try,
+    Users.c.last_login_success,
+    Users.c.created_on,
+    Users.c.user_role,
+    Sessions.c.session_token,
+    Sessions.c.ip_address,
+    Sessions.c.client_header,
+    Sessions.c.created,
+    Sessions.c.expires,
+    Sessions.c.extra_info_json
+]).select_from(Users.join(Sessions)).where(
+    (Sessions.c.session_token == bindparam('session_token')) &
+    (Sessions.c.expires > bindparam('now'))
+)
+
+# the password hash of a user
+# params: user_id
+USER_PASSWORD_SELECT = select([
+    Users.c.password
+]).select_from(Users).where(Users.c.user_id == bindparam('user_id'))
+
+# the login info for an active user with a verified email address
+# params: email
+USER_LOGIN_SELECT = select([
+    Users.c.user_id,
+    Users.c.password,
+    Users.c.is_active,
+    Users.c.user_role,
+]).select_from(Users).where(
+    Users.c.email == bindparam('email')
+).where(
+    Users.c.is_active == true()
+).where(
+    Users.c.email_verified == true()
+)
+
+# this deletes a batch of expired sessions. sessions that still have an
+# unexpired API key aren't deleted because that would delete the API key as well.
+# params: now, batchsize
+EXPIRED_SESSIONS_DELETE = Sessions.delete().where(
+    Sessions.c.session_token.in_(
+        select([
+            Sessions.c.session_token
+        ]).select_from(Sessions).where(
+            Sessions.c.expires < bindparam('now')
+        ).where(
+            ~exists().where(
+                APIKeys.c.session_token == Sessions.c.session_token
+            ).where(
+                APIKeys.c.expires > bindparam('now')
+            )
+        ).limit(bindparam('batchsize')).correlate(None)
+    )
+)
+
+# an API key issued to a user
+# params: apikey, user_id
+APIKEY_VERIFY_SELECT = select([
+    APIKeys.c.apikey,
+    APIKeys.c.expires,
+]).select_from(APIKeys).where(
+    APIKeys.c.apikey == bindparam('apikey')
+).where(
+    APIKeys.c.user_id == bindparam('user_id')
+)
+
+# the revoked API keys that haven't expired yet
+# params: now
+REVOKED_APIKEYS_SELECT = select([
+    APIKeysRevoked.c.apikey,
+    APIKeysRevoked.c.expires,
+]).select_from(APIKeysRevoked).where(
+    APIKeysRevoked.c.expires > bindparam('now')
+)
+
+# the queued emails that are due to be sent, oldest first
+# params: now, batchsize
+QUEUED_EMAILS_SELECT = select([
+    EmailQueue
+]).select_from(EmailQueue).where(
+    EmailQueue.c.status == 'queued'
+).where(
+    EmailQueue.c.next_attempt <= bindparam('now')
+).order_by(
+    EmailQueue.c.email_id
+).limit(bindparam('batchsize'))
+
+# this deletes the revoked API keys that have expired since, because they can't
+# be used anymore anyway
+# params: now
+EXPIRED_REVOCATIONS_DELETE = APIKeysRevoked.delete().where(
+    APIKeysRevoked.c.expires < bindparam('now')
 )
 
 
@@ -471,14 +631,17 @@ ITEM_PERMISSIONS = {
 }
 
 
-def get_item_permissions(role_name,
-                         target_name,
-                         target_visibility,
-                         target_scope,
-                         debug=False):
-    '''Returns the possible permissions for a target given a role and target
+def compute_item_permissions(role_name,
+                             target_name,
+                             target_visibility,
+                             target_scope,
+                             debug=False):
+    '''Works out the possible permissions for a target given a role and target
     status.
 
+    This is used to fill in the ITEM_PERMISSION_TABLE below. Use
+    get_item_permissions to look up permissions.
+
     role is one of {superuser, authenticated, anonymous, locked}
 
     target_name is one of {object, dataset, collection, users,
@@ -557,6 +720,76 @@ def get_item_permissions(role_name,
         return set({})
 
 
+# this is a table of the permissions for every combination of (role, target,
+# visibility, scope). these never change while the server runs, so they're all
+# worked out here once instead of for every item checked.
+ITEM_PERMISSION_TABLE = {
+    (role_name, target_name, target_visibility, target_scope):frozenset(
+        compute_item_permissions(role_name,
+                                 target_name,
+                                 target_visibility,
+                                 target_scope)
+    )
+    for role_name in ROLE_PERMISSIONS
+    for target_name in ITEM_PERMISSIONS
+    for target_visibility in ('public', 'unlisted', 'private', 'shared')
+    for target_scope in ('for_owned', 'for_others')
+}
+
+
+def get_item_permissions(role_name,
+                         target_name,
+                         target_visibility,
+                         target_scope,
+                         debug=False):
+    '''Returns the possible permissions for a target given a role and target
+    status.
+
+    role is one of {superuser, authenticated, anonymous, locked}
+
+    target_name is one of {object, dataset, collection, users,
+                           apikeys, preferences, sessions}
+
+    target_visibility is one of {public, private, shared}
+
+    target_scope is one of {for_owned, for_others}
+
+    Returns a frozenset from the ITEM_PERMISSION_TABLE. If the permissions don't
+    make sense, returns an empty set, in which case access MUST be denied.
+
+    '''
+
+    if debug:
+        return frozenset(compute_item_permissions(role_name,
+                                                  target_name,
+                                                  target_visibility,
+                                                  target_scope,
+                                                  debug=debug))
+
+    try:
+        return ITEM_PERMISSION_TABLE.get(
+            (role_name, target_name, target_visibility, target_scope),
+            frozenset()
+        )
+    except TypeError:
+        return frozenset()
+
+
+@lru_cache(maxsize=4096)
+def parse_sharedwith(target_sharedwith):
+    '''This turns a comma-separated string of user IDs into a frozenset.
+
+    Returns None if the string can't be parsed. The results are cached because
+    the same few sharedwith strings turn up over and over again.
+
+    '''
+
+    try:
+        return frozenset(int(x) for x in target_sharedwith.split(','))
+    except Exception as e:
+        return None
+
+
 def check_user_access(userid=2,
                       role='anonymous',
                       action='view',
@@ -587,8 +820,7 @@ def check_user_access(userid=2,
 
             if target_sharedwith and target_sharedwith != '':
 
-                sharedwith_userids = target_sharedwith.split(',')
-                sharedwith_userids = [int(x) for x in sharedwith_userids]
+                sharedwith_userids = parse_sharedwith(target_sharedwith)
                 if debug:
                     print('sharedwith_userids = %s' % sharedwith_userids)
                 shared_or_owned_ok = (
@@ -660,6 +892,116 @@ def check_user_access(userid=2,
     return ((action in perms) and shared_or_owned_ok)
 
 
+def check_user_access_mask(userid=2,
+                           role='anonymous',
+                           action='view',
+                           target_name='collection',
+                           target_owners=None,
+                           target_visibilities=None,
+                           target_sharedwith=None):
+    '''This does check_user_access for many targets at once.
+
+    target_owners, target_visibilities, and target_sharedwith are arrays (or
+    lists) with the owner, visibility, and sharedwith string of each target.
+
+    Returns a boolean array that's True for the targets that userid with role
+    can do action on. The permissions are only looked up once for each
+    visibility and distinct sharedwith string, and the rest of the work is done
+    with array operations.
+
+    '''
+
+    owners = np.asarray(target_owners)
+    nitems = owners.size
+
+    if nitems == 0:
+        return np.zeros(0, dtype=bool)
+
+    owned = np.asarray(owners == userid, dtype=bool)
+    visibilities = np.asarray(target_visibilities).astype('U')
+
+    target_may_be_owned_by_role = (
+        target_name in ROLE_PERMISSIONS[role]['can_own']
+    )
+    check_shared_or_owned = role not in ('superuser', 'staff')
+
+    perms_ok = np.zeros(nitems, dtype=bool)
+    shared_or_owned_ok = np.full(nitems, not check_shared_or_owned)
+
+    # targets with any other visibility get no permissions
+    for vis in ('public', 'unlisted', 'private', 'shared'):
+
+        owned_perms_ok = (
+            target_may_be_owned_by_role and
+            action in get_item_permissions(role, target_name, vis, 'for_owned')
+        )
+        others_perms_ok = (
+            action in get_item_permissions(role, target_name, vis, 'for_others')
+        )
+
+        if not (owned_perms_ok or others_perms_ok):
+            continue
+
+        is_vis = visibilities == vis
+        if not is_vis.any():
+            continue
+
+        if owned_perms_ok and others_perms_ok:
+            perms_ok |= is_vis
+        elif owned_perms_ok:
+            perms_ok |= is_vis & owned
+        else:
+            perms_ok |= is_vis & ~owned
+
+        if not check_shared_or_owned:
+            continue
+
+        # unlisted and public targets are OK to view, private targets only if
+        # they're owned by the user
+        if vis in ('public', 'unlisted'):
+
+            shared_or_owned_ok |= is_vis
+
+        elif vis == 'private':
+
+            shared_or_owned_ok |= is_vis & owned
+
+        else:
+
+            sharedwith = np.asarray(target_sharedwith, dtype=object)[is_vis]
+            sharedwith = np.where(np.equal(sharedwith, None), '', sharedwith)
+            sw_keys, sw_codes = np.unique(sharedwith.astype('U'),
+                                          return_inverse=True)
+            sw_codes = sw_codes.ravel()
+
+            # for each distinct sharedwith string, this is if the target is
+            # shared with the user and if the owner is allowed
+            sw_shared_ok = np.zeros(sw_keys.size, dtype=bool)
+            sw_owner_ok = np.zeros(sw_keys.size, dtype=bool)
+
+            for ind, sw_key in enumerate(sw_keys):
+
+                if sw_key == '':
+                    sw_owner_ok[ind] = True
+                    continue
+
+                sharedwith_userids = parse_sharedwith(str(sw_key))
+
+                if sharedwith_userids is not None:
+                    sw_owner_ok[ind] = True
+                    # anything shared with anonymous users is effectively
+                    # shared for everyone
+                    sw_shared_ok[ind] = (userid in sharedwith_userids or
+                                         2 in sharedwith_userids)
+
+            shared_or_owned_ok[is_vis] = (
+                sw_shared_ok[sw_codes] |
+                (sw_owner_ok[sw_codes] & owned[is_vis])
+            )
+
+    return perms_ok & shared_or_owned_ok
+
+
 
 def check_role_limits(role,
                       rows=None,
@@ -699,6 +1041,7 @@ def create_sqlite_auth_db(
     engine = create_engine('sqlite:///%s' % os.path.abspath(auth_db_path),
                            echo=echo)
     AUTHDB_META.create_all(engine)
+    ensure_sqlite_apikey_revocations(engine)
 
     if returnconn:
         return engine, AUTHDB_META
@@ -719,9 +1062,115 @@ def create_sqlite_auth_db(
 
 
 
-def get_auth_db(auth_db_path, echo=False):
+# these are set on every new connection to an SQLite auth DB. WAL mode lets
+# readers go on while a session is being written. it's set when the auth DB is
+# created, but setting it again here also converts older auth DBs.
+SQLITE_CONNECTION_PRAGMAS = (
+    "pragma foreign_keys = ON",
+    "pragma journal_mode = 'wal'",
+    "pragma synchronous = NORMAL",
+)
+
+# this is how long an SQLite connection waits for a lock before giving up
+AUTHDB_BUSY_TIMEOUT = 10.0
+
+# these are the connection pool settings for SQLite auth DBs
+AUTHDB_POOL_SIZE = 4
+AUTHDB_POOL_OVERFLOW = 4
+
+# this is the number of compiled statements each process keeps
+AUTHDB_COMPILED_CACHE_SIZE = 500
+
+# these indexes are made by create_all for new auth DBs. they're also made here
+# for auth DBs created before the indexes were added to the tables above.
+SQLITE_AUTHDB_INDEXES = (
+    ('sessions', 'expires'),
+    ('sessions', 'user_id'),
+    ('apikeys', 'expires'),
+    ('apikeys', 'user_id'),
+    ('apikeys', 'session_token'),
+)
+
+
+# this records unexpired API keys in the apikeys_revoked table when they're
+# deleted. SQLite runs this for the rows deleted by the ON DELETE CASCADE of the
+# sessions and users tables as well. the timestamps are written in the same
+# format as the DateTime columns.
+SQLITE_APIKEY_REVOKE_TRIGGER = '''\
+create trigger if not exists apikeys_revoke after delete on apikeys
+when old.expires > strftime('%Y-%m-%d %H:%M:%f000', 'now')
+begin
+  insert or replace into apikeys_revoked (apikey, revoked, expires, user_id)
+  values (old.apikey, strftime('%Y-%m-%d %H:%M:%f000', 'now'),
+          old.expires, old.user_id);
+end
+'''
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    '''
+    This sets up each new connection to an SQLite auth DB.
+
+    '''
+
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_CONNECTION_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.execute("pragma busy_timeout = %i" % int(AUTHDB_BUSY_TIMEOUT*1000))
+    cursor.close()
+
+
+def ensure_sqlite_indexes(engine):
+    '''
+    This adds any missing indexes to an existing SQLite auth DB.
+
+    '''
+
+    with engine.begin() as conn:
+        for table, column in SQLITE_AUTHDB_INDEXES:
+            conn.execute(
+                'create index if not exists ix_{table}_{column} '
+                'on {table} ({column})'.format(table=table, column=column)
+            )
+
+
+def ensure_sqlite_apikey_revocations(engine):
+    '''
+    This adds the API key revocation table and trigger to an SQLite auth DB.
+
+    '''
+
+    APIKeysRevoked.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(SQLITE_APIKEY_REVOKE_TRIGGER)
+
+
+def missing_sqlite_schema(engine):
+    '''This returns the tables and triggers missing from an SQLite auth DB.
+
+    Returns a list of their names.
+
     '''
-    This just gets a connection to the auth DB.
+
+    with engine.connect() as conn:
+        result = conn.execute(
+            "select name from sqlite_master where type in ('table', 'trigger')"
+        )
+        present = {x[0] for x in result}
+        result.close()
+
+    return sorted(
+        (set(AUTHDB_META.tables) | {'apikeys_revoke'}) - present
+    )
+
+
+def get_auth_db(auth_db_path, echo=False):
+    '''This just gets a connection to the auth DB.
+
+    For SQLite auth DBs, the connections are pooled, use WAL mode, and wait up
+    to AUTHDB_BUSY_TIMEOUT seconds for locks. The returned connection keeps
+    compiled statements in a cache, so the precompiled statements above are
+    only compiled once per process.
 
     '''
 
@@ -736,15 +1185,44 @@ def get_auth_db(auth_db_path, echo=False):
         if not (fileperm == '0100600' or fileperm == '0o100600'):
             raise IOError('incorrect permissions on auth DB, will not load it')
 
-        @event.listens_for(Engine, "connect")
-        def set_sqlite_pragma(dbapi_connection, connection_record):
-            cursor = dbapi_connection.cursor()
-            cursor.execute("PRAGMA foreign_keys=ON")
-            cursor.close()
+        engine = create_engine(
+            auth_db_path,
+            echo=echo,
+            poolclass=QueuePool,
+            pool_size=AUTHDB_POOL_SIZE,
+            max_overflow=AUTHDB_POOL_OVERFLOW,
+            connect_args={'timeout':AUTHDB_BUSY_TIMEOUT,
+                          'check_same_thread':False}
+        )
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+
+        # this adds the tables, indexes, and triggers that were added after the
+        # auth DB was created
+        try:
+            AUTHDB_META.create_all(engine)
+            ensure_sqlite_indexes(engine)
+            ensure_sqlite_apikey_revocations(engine)
+        except Exception:
+            LOGGER.exception('could not add missing tables, indexes, or '
+                             'triggers to the auth DB at: %s' % auth_db_path)
+
+            # another process may have added these at the same time, so this
+            # is only an error if they're still missing
+            missing = missing_sqlite_schema(engine)
+            if missing:
+                LOGGER.error('the auth DB at: %s is missing: %s' %
+                             (auth_db_path, ', '.join(missing)))
+                engine.dispose()
+                raise
+
+    else:
+
+        engine = create_engine(auth_db_path, echo=echo)
 
-    engine = create_engine(auth_db_path, echo=echo)
     AUTHDB_META.bind = engine
-    conn = engine.connect()
+    conn = engine.connect().execution_options(
+        compiled_cache=LRUCache(AUTHDB_COMPILED_CACHE_SIZE)
+    )
 
     return engine, conn, AUTHDB_META
 
@@ -53,12 +53,15 @@ json._default_encoder = FrontendEncoder()
 
 import ipaddress
 import base64
+from functools import partial
 
 import multiprocessing as mp
 
 
 import tornado.web
 import tornado.ioloop
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
 
 from cryptography.fernet import Fernet, InvalidToken
 
@@ -66,6 +69,7 @@ from sqlalchemy.sql import select
 
 from . import authdb
 from . import actions
+from .transport import encrypt_frame, decrypt_frame, read_frame
 
 
 #########################
@@ -156,6 +160,83 @@ def auth_echo(payload):
     return payload
 
 
+def auth_batch(payload):
+    '''This runs several auth requests one after the other.
+
+    Request payload keys required:
+
+    requests: a list of {'request': request type, 'body': request body} dicts
+
+    Each request dict can also have a use_previous key, which is a dict of
+    {body key: response key}. The body keys are set to the values of the
+    response keys in the response of the previous request before the request
+    is run. This lets a request use e.g. the session token made by the request
+    before it.
+
+    If stop_on_failure is True in the payload (the default), the requests after
+    the first one that fails are skipped.
+
+    Returns:
+
+    a dict with a success key that's True if all of the requests succeeded, a
+    responses key with the response of each request (None if it was skipped),
+    and all of their messages.
+
+    '''
+
+    if 'requests' not in payload or not isinstance(payload['requests'], list):
+
+        return {
+            'success':False,
+            'responses':[],
+            'messages':["No requests provided."],
+        }
+
+    stop_on_failure = payload.get('stop_on_failure', True)
+
+    responses = []
+    messages = []
+    previous = None
+    failed = False
+
+    for item in payload['requests']:
+
+        if failed and stop_on_failure:
+            responses.append(None)
+            continue
+
+        request_type = item.get('request')
+
+        if request_type in ('batch', 'echo') or (request_type not in
+                                                 request_functions):
+            LOGGER.error('invalid request in batch: %s' % request_type)
+            responses.append(None)
+            messages.append("Invalid request: %s." % request_type)
+            failed = True
+            continue
+
+        body = dict(item.get('body', {}))
+
+        for body_key, response_key in item.get('use_previous', {}).items():
+            if previous is not None and response_key in previous:
+                body[body_key] = previous[response_key]
+
+        response = request_functions[request_type](body)
+
+        responses.append(response)
+        messages.extend(response.get('messages') or [])
+        previous = response
+
+        if not response['success']:
+            failed = True
+
+    return {
+        'success':not failed,
+        'responses':responses,
+        'messages':messages,
+    }
+
+
 #
 # this maps request types -> request functions to execute
 #
@@ -182,9 +263,519 @@ request_functions = {
     # apikey actions
     'apikey-new':actions.issue_new_apikey,
     'apikey-verify':actions.verify_apikey,
+    'apikey-revoked':actions.list_revoked_apikeys,
+    # run several of the above in one request
+    'batch':auth_batch,
+}
+
+
+############################
+## EXPIRED SESSION REAPER ##
+############################
+
+class SessionReaper(object):
+    '''This deletes expired sessions from the auth DB every so often.
+
+    An instance of this is called by a PeriodicCallback on the authnzerver
+    IOLoop. Each run calls actions.auth_reap_expired_sessions in the executor
+    and adds the number of sessions it deleted to the running counts.
+
+    '''
+
+    def __init__(self,
+                 executor,
+                 batchsize=500,
+                 maxbatches=20):
+        '''
+        This sets up the reaper.
+
+        '''
+
+        self.executor = executor
+        self.batchsize = batchsize
+        self.maxbatches = maxbatches
+
+        self.running = False
+        self.runs = 0
+        self.total_deleted = 0
+        self.last_deleted = 0
+        self.last_run = None
+        self.last_finished = None
+
+
+    def __call__(self):
+        '''
+        This starts a reaper run on the IOLoop.
+
+        '''
+
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+
+    async def run(self):
+        '''
+        This runs the reaper once unless it's still running.
+
+        '''
+
+        if self.running:
+            return
+
+        self.running = True
+
+        try:
+
+            loop = tornado.ioloop.IOLoop.current()
+            result = await loop.run_in_executor(
+                self.executor,
+                partial(actions.auth_reap_expired_sessions,
+                        batchsize=self.batchsize,
+                        maxbatches=self.maxbatches)
+            )
+
+            self.runs = self.runs + 1
+            self.last_run = datetime.utcnow()
+            self.last_deleted = result['deleted']
+            self.total_deleted = self.total_deleted + result['deleted']
+            self.last_finished = result['finished']
+
+        except Exception as e:
+
+            LOGGER.exception('expired session reaper failed')
+
+        finally:
+
+            self.running = False
+
+
+    def stats(self):
+        '''
+        This returns the reaper's counts.
+
+        '''
+
+        return {
+            'runs':self.runs,
+            'total_deleted':self.total_deleted,
+            'last_deleted':self.last_deleted,
+            'last_run':self.last_run,
+            'last_finished':self.last_finished,
+        }
+
+
+# this is set to the SessionReaper by main() if the reaper is running
+SESSION_REAPER = None
+
+
+def auth_session_reaper_stats(payload):
+    '''
+    This returns the counts kept by the expired session reaper.
+
+    '''
+
+    if SESSION_REAPER is None:
+        return {
+            'success':False,
+            'reaper_stats':None,
+            'messages':["The expired session reaper isn't running."],
+        }
+
+    return {
+        'success':True,
+        'reaper_stats':SESSION_REAPER.stats(),
+        'messages':["Session reaper stats retrieved."],
+    }
+
+
+##################
+## EMAIL SENDER ##
+##################
+
+# these requests add emails to the outbound email queue. the email sender is
+# started right after they succeed, so the emails go out without waiting for
+# the next periodic run.
+EMAIL_QUEUEING_REQUESTS = {
+    'user-signup-email',
+    'user-forgotpass-email',
 }
 
 
+def is_email_queueing_request(payload):
+    '''
+    This returns True if the request can add emails to the email queue.
+
+    '''
+
+    if payload['request'] == 'batch':
+        return any(item.get('request') in EMAIL_QUEUEING_REQUESTS
+                   for item in payload['body'].get('requests', []))
+
+    return payload['request'] in EMAIL_QUEUEING_REQUESTS
+
+
+class EmailSender(object):
+    '''This sends the emails in the outbound email queue in the background.
+
+    An instance of this is called by a PeriodicCallback on the authnzerver
+    IOLoop to send the emails that are due to be retried, and right after a
+    request queues a new email. Each run calls actions.send_queued_emails in the
+    executor until there are no more emails due. Only one run happens at a
+    time. If the sender is called during a run, it goes around again when the
+    run finishes.
+
+    The SMTP passwords for the queued emails are only kept in memory here,
+    keyed by (server, port, user). They're taken from the requests that queue
+    emails before those run. Emails still waiting for their password
+    max_password_wait seconds after they were queued are marked as failed.
+
+    '''
+
+    def __init__(self,
+                 executor,
+                 batchsize=50,
+                 maxattempts=5,
+                 retry_interval=60.0,
+                 require_tls=True,
+                 max_password_wait=86400.0):
+        '''
+        This sets up the sender.
+
+        '''
+
+        self.executor = executor
+        self.batchsize = batchsize
+        self.maxattempts = maxattempts
+        self.retry_interval = retry_interval
+        self.require_tls = require_tls
+        self.max_password_wait = max_password_wait
+
+        # these are the SMTP passwords keyed by (server, port, user)
+        self.credentials = {}
+
+        self.running = False
+        self.run_again = False
+        self.runs = 0
+        self.total_sent = 0
+        self.total_retried = 0
+        self.total_failed = 0
+        self.last_run = None
+
+
+    def add_credentials(self, payload):
+        '''
+        This keeps the SMTP logins from a request that queues emails.
+
+        '''
+
+        if payload['request'] == 'batch':
+            items = payload['body'].get('requests', [])
+        else:
+            items = [payload]
+
+        for item in items:
+
+            body = item.get('body', {})
+
+            if (item.get('request') in EMAIL_QUEUEING_REQUESTS and
+                body.get('smtp_user') is not None):
+
+                self.credentials[(body.get('smtp_server'),
+                                  body.get('smtp_port'),
+                                  body['smtp_user'])] = body.get('smtp_pass')
+
+
+    def __call__(self):
+        '''
+        This starts a sender run on the IOLoop.
+
+        '''
+
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+
+    async def run(self):
+        '''
+        This sends the queued emails unless the sender is already running.
+
+        '''
+
+        if self.running:
+            self.run_again = True
+            return
+
+        self.running = True
+
+        try:
+
+            loop = tornado.ioloop.IOLoop.current()
+
+            while True:
+
+                self.run_again = False
+
+                result = await loop.run_in_executor(
+                    self.executor,
+                    partial(actions.send_queued_emails,
+                            batchsize=self.batchsize,
+                            maxattempts=self.maxattempts,
+                            retry_interval=self.retry_interval,
+                            require_tls=self.require_tls,
+                            credentials=dict(self.credentials),
+                            max_password_wait=self.max_password_wait)
+                )
+
+                self.runs = self.runs + 1
+                self.last_run = datetime.utcnow()
+
+                if not result['success']:
+                    break
+
+                self.total_sent = self.total_sent + result['sent']
+                self.total_retried = self.total_retried + result['retrying']
+                self.total_failed = self.total_failed + result['failed']
+
+                if result['finished'] and not self.run_again:
+                    break
+
+        except Exception as e:
+
+            LOGGER.exception('email sender failed')
+
+        finally:
+
+            self.running = False
+
+
+    def stats(self):
+        '''
+        This returns the sender's counts.
+
+        '''
+
+        return {
+            'runs':self.runs,
+            'total_sent':self.total_sent,
+            'total_retried':self.total_retried,
+            'total_failed':self.total_failed,
+            'last_run':self.last_run,
+        }
+
+
+# this is set to the EmailSender by main()
+EMAIL_SENDER = None
+
+
+def auth_email_sender_stats(payload):
+    '''
+    This returns the counts kept by the email sender.
+
+    '''
+
+    if EMAIL_SENDER is None:
+        return {
+            'success':False,
+            'sender_stats':None,
+            'messages':["The email sender isn't running."],
+        }
+
+    return {
+        'success':True,
+        'sender_stats':EMAIL_SENDER.stats(),
+        'messages':["Email sender stats retrieved."],
+    }
+
+
+#
+# these requests are answered by the authnzerver process itself instead of the
+# executor because they only read its state
+#
+local_request_functions = {
+    'session-reaper-stats':auth_session_reaper_stats,
+    'email-sender-stats':auth_email_sender_stats,
+}
+
+
+###########################
+## PASSWORD HASHING POOL ##
+###########################
+
+# these requests hash or verify passwords. they're slow on purpose, so they run
+# in their own executor instead of the one used for session lookups.
+HASHING_REQUESTS = {
+    'user-login',
+    'user-passcheck',
+    'user-new',
+    'user-changepass',
+    'user-delete',
+    'user-resetpass',
+}
+
+
+def is_hashing_request(payload):
+    '''
+    This returns True if the request will hash or verify a password.
+
+    '''
+
+    if payload['request'] == 'batch':
+        return any(item.get('request') in HASHING_REQUESTS
+                   for item in payload['body'].get('requests', []))
+
+    return payload['request'] in HASHING_REQUESTS
+
+
+class PasswordHashingPool(object):
+    '''This runs the password hashing requests in their own executor.
+
+    At most max_pending hashing requests can be running or waiting at once, and
+    at most max_per_ip of them can be from the same IP address. Requests over
+    these limits fail right away instead of waiting, so a burst of logins can't
+    hold up the other auth requests or pile up in the queue.
+
+    The methods of this class must be called from the IOLoop thread.
+
+    '''
+
+    def __init__(self,
+                 executor,
+                 max_pending=32,
+                 max_per_ip=2):
+        '''
+        This sets up the pool.
+
+        '''
+
+        self.executor = executor
+        self.max_pending = max_pending
+        self.max_per_ip = max_per_ip
+
+        self.pending = 0
+        self.pending_by_ip = {}
+        self.rejected = 0
+
+
+    async def run(self, request_function, request_body):
+        '''This runs request_function in the hashing executor if there's room.
+
+        The IP address limit uses the ip_address key in request_body (or in the
+        bodies of a batch request) if there is one. Returns the response of the
+        request function, or a failed response if the limits are reached.
+
+        '''
+
+        ip_address = request_body.get('ip_address')
+        if ip_address is None:
+            for item in request_body.get('requests', []):
+                ip_address = item.get('body', {}).get('ip_address')
+                if ip_address is not None:
+                    break
+
+        if self.pending >= self.max_pending:
+
+            LOGGER.error('password hashing queue is full with %s requests, '
+                         'rejecting request' % self.pending)
+            self.rejected = self.rejected + 1
+            return {
+                'success':False,
+                'user_id':None,
+                'messages':["The server is busy right now. "
+                            "Please try again in a little while."]
+            }
+
+        if (ip_address is not None and
+            self.pending_by_ip.get(ip_address, 0) >= self.max_per_ip):
+
+            LOGGER.error('too many password hashing requests in progress '
+                         'from %s, rejecting request' % ip_address)
+            self.rejected = self.rejected + 1
+            return {
+                'success':False,
+                'user_id':None,
+                'messages':["Too many sign in attempts are in progress. "
+                            "Please try again in a little while."]
+            }
+
+        self.pending = self.pending + 1
+        if ip_address is not None:
+            self.pending_by_ip[ip_address] = (
+                self.pending_by_ip.get(ip_address, 0) + 1
+            )
+
+        try:
+
+            loop = tornado.ioloop.IOLoop.current()
+            return await loop.run_in_executor(
+                self.executor,
+                request_function,
+                request_body
+            )
+
+        finally:
+
+            self.pending = self.pending - 1
+            if ip_address is not None:
+                self.pending_by_ip[ip_address] = (
+                    self.pending_by_ip[ip_address] - 1
+                )
+                if self.pending_by_ip[ip_address] <= 0:
+                    del self.pending_by_ip[ip_address]
+
+
+async def process_auth_request(payload, executor, hashing_pool=None):
+    '''This runs the request function for a decrypted auth request.
+
+    The request function runs in the executor, or in the hashing_pool if it's
+    provided and the request hashes or verifies passwords. Returns the response
+    dict that goes back to the frontend. Raises an exception if the request is
+    invalid.
+
+    '''
+
+    # get the request ID
+    # this is an integer
+    reqid = payload['reqid']
+    if reqid is None or reqid == 0:
+        raise ValueError("no request ID provided")
+
+    # the email sender needs the SMTP logins of any emails this request queues
+    if EMAIL_SENDER is not None and is_email_queueing_request(payload):
+        EMAIL_SENDER.add_credentials(payload)
+
+    # run the function associated with the request type
+    if payload['request'] in local_request_functions:
+
+        response = local_request_functions[payload['request']](
+            payload['body']
+        )
+
+    elif hashing_pool is not None and is_hashing_request(payload):
+
+        response = await hashing_pool.run(
+            request_functions[payload['request']],
+            payload['body']
+        )
+
+    else:
+
+        loop = tornado.ioloop.IOLoop.current()
+        response = await loop.run_in_executor(
+            executor,
+            request_functions[payload['request']],
+            payload['body']
+        )
+
+    # send any emails this request queued
+    if (EMAIL_SENDER is not None and
+        response['success'] and
+        is_email_queueing_request(payload)):
+        EMAIL_SENDER()
+
+    return {"success": response['success'],
+            "reqid": reqid,
+            "response":response,
+            "message": response['messages']}
+
+
 #############
 ## HANDLER ##
 #############
@@ -272,7 +863,8 @@ class AuthHandler(tornado.web.RequestHandler):
     def initialize(self,
                    authdb,
                    fernet_secret,
-                   executor):
+                   executor,
+                   hashing_pool=None):
         '''
         This sets up stuff.
 
@@ -281,6 +873,7 @@ class AuthHandler(tornado.web.RequestHandler):
         self.authdb = authdb
         self.fernet_secret = fernet_secret
         self.executor = executor
+        self.hashing_pool = hashing_pool
 
 
     async def post(self):
@@ -306,25 +899,12 @@ class AuthHandler(tornado.web.RequestHandler):
         # process the request
         try:
 
-            # get the request ID
-            # this is an integer
-            reqid = payload['reqid']
-            if reqid is None or reqid == 0:
-                raise ValueError("no request ID provided")
-
-            # run the function associated with the request type
-            loop = tornado.ioloop.IOLoop.current()
-            response = await loop.run_in_executor(
+            response_dict = await process_auth_request(
+                payload,
                 self.executor,
-                request_functions[payload['request']],
-                payload['body']
+                hashing_pool=self.hashing_pool
             )
 
-            response_dict = {"success": response['success'],
-                             "reqid": reqid,
-                             "response":response,
-                             "message": response['messages']}
-
             encrypted_base64 = encrypt_response(
                 response_dict,
                 self.fernet_secret
@@ -338,3 +918,108 @@ class AuthHandler(tornado.web.RequestHandler):
 
             LOGGER.exception('failed to understand request')
             raise tornado.web.HTTPError(status_code=400)
+
+
+
+###################
+## STREAM SERVER ##
+###################
+
+class AuthStreamServer(TCPServer):
+    '''This handles auth requests sent over the framed stream transport.
+
+    See transport.py for the framing. Requests on a connection are processed
+    concurrently and each response goes back with the reqid of its request.
+    Connections over TCP are only accepted from 127.0.0.1.
+
+    '''
+
+    def __init__(self,
+                 authdb,
+                 fernet_secret,
+                 executor,
+                 hashing_pool=None,
+                 **kwargs):
+        '''
+        This sets up stuff.
+
+        '''
+
+        super(AuthStreamServer, self).__init__(**kwargs)
+
+        self.authdb = authdb
+        self.fernet_secret = fernet_secret
+        self.fernet = Fernet(fernet_secret)
+        self.executor = executor
+        self.hashing_pool = hashing_pool
+
+
+    async def handle_stream(self, stream, address):
+        '''
+        This reads the requests on a new connection.
+
+        '''
+
+        # connections over Unix sockets have an empty address
+        if address:
+
+            if not check_host(address[0]):
+                LOGGER.error('refusing stream connection from %s' %
+                             (address,))
+                stream.close()
+                return
+
+            stream.set_nodelay(True)
+
+        loop = tornado.ioloop.IOLoop.current()
+
+        try:
+
+            while True:
+
+                frame = await read_frame(stream)
+                payload = decrypt_frame(frame, self.fernet)
+
+                if not isinstance(payload, dict):
+                    LOGGER.error('closing stream connection after '
+                                 'an invalid request')
+                    stream.close()
+                    return
+
+                loop.spawn_callback(self.respond, stream, payload)
+
+        except StreamClosedError:
+            pass
+
+
+    async def respond(self, stream, payload):
+        '''
+        This processes a request and writes its response to the stream.
+
+        '''
+
+        try:
+
+            if payload['request'] == 'echo':
+                raise ValueError("this handler can't echo things.")
+
+            response_dict = await process_auth_request(
+                payload,
+                self.executor,
+                hashing_pool=self.hashing_pool
+            )
+
+        except Exception as e:
+
+            LOGGER.exception('failed to understand request')
+            response_dict = {"success":False,
+                             "reqid":payload.get('reqid'),
+                             "response":None,
+                             "message":None,
+                             "failed":True}
+
+        try:
+            stream.write(encrypt_frame(response_dict, self.fernet))
+        except StreamClosedError:
+            LOGGER.error('stream closed before the response to request %s '
+                         'could be sent' % response_dict['reqid'])
@@ -58,6 +58,7 @@ import tornado.ioloop
 import tornado.httpserver
 import tornado.web
 import tornado.options
+import tornado.netutil
 from tornado.options import define, options
 import multiprocessing as mp
 
@@ -94,6 +95,28 @@ define('backgroundworkers',
        help=('number of background workers to use '),
        type=int)
 
+# number of background workers used only for password hashing
+define('hashworkers',
+       default=2,
+       help=('number of background workers to use for password hashing. '
+             'These are separate from the other background workers so '
+             'a burst of logins does not slow down session lookups.'),
+       type=int)
+
+# the most password hashing requests that can be running or waiting at once
+define('hashqueuedepth',
+       default=32,
+       help=('The most password hashing requests that can be running or '
+             'waiting at once. Requests over this limit fail immediately.'),
+       type=int)
+
+# the most password hashing requests that can be in progress from one IP
+define('hashesperip',
+       default=2,
+       help=('The most login and other password hashing requests that can be '
+             'in progress at once from the same IP address.'),
+       type=int)
+
 # basedir is the directory at the root where all LCC collections are stored this
 # contains subdirs for each collection and a lcc-collections.sqlite file that
 # contains info on all collections.
@@ -125,6 +148,46 @@ define('sessionexpiry',
        help=('This tells the lcc-server the session-expiry time in days.'),
        type=int)
 
+define('sessionreapinterval',
+       default=300,
+       help=('How often in seconds to delete expired sessions from the '
+             'auth DB. Set this to 0 to turn off the expired session reaper.'),
+       type=int)
+
+define('emailretryinterval',
+       default=60,
+       help=('How often in seconds to check the outbound email queue for '
+             'emails to send again. Emails that could not be sent are '
+             'retried after this long, doubling after each failed try.'),
+       type=int)
+
+define('emailmaxattempts',
+       default=5,
+       help=('How many times to try sending an email before giving up.'),
+       type=int)
+
+define('emailmaxpasswordwait',
+       default=86400,
+       help=('How long in seconds a queued email waits for its SMTP password '
+             'after the authnzerver restarts before it is marked as failed.'),
+       type=int)
+
+# the Unix socket to serve the framed stream transport on
+define('unixsocket',
+       default=None,
+       help=('Path to a Unix domain socket to also serve auth requests on '
+             'using the framed stream transport. The lcc-server can then '
+             'use --authnzerver=unix:///path/to/socket.'),
+       type=str)
+
+# the port to serve the framed stream transport on
+define('streamport',
+       default=None,
+       help=('Port on 127.0.0.1 to also serve auth requests on using the '
+             'framed stream transport. The lcc-server can then use '
+             '--authnzerver=tcp://127.0.0.1:port.'),
+       type=int)
+
 
 #######################
 ## UTILITY FUNCTIONS ##
@@ -198,7 +261,9 @@ def main():
     ## HANDLERS ##
     ##############
 
-    from .handlers import AuthHandler, EchoHandler
+    from .handlers import AuthHandler, EchoHandler, AuthStreamServer
+    from .handlers import SessionReaper, PasswordHashingPool, EmailSender
+    from . import handlers as authhandlers
     from . import authdb
     from . import cache
     from . import actions
@@ -241,12 +306,42 @@ def main():
                                       FERNETSECRET),
                             finalizer=close_authentication_database)
 
+    #
+    # this is the executor used for password hashing. it's kept separate so
+    # logins can't tie up the workers used for the other requests.
+    #
+    hash_executor = ProcExecutor(max_workers=options.hashworkers,
+                                 initializer=setup_auth_worker,
+                                 initargs=(AUTHDB_PATH,
+                                           FERNETSECRET),
+                                 finalizer=close_authentication_database)
+    hashing_pool = PasswordHashingPool(hash_executor,
+                                       max_pending=options.hashqueuedepth,
+                                       max_per_ip=options.hashesperip)
+
+    #
+    # this is the executor used to send queued emails. a slow SMTP server only
+    # holds up this worker instead of the ones answering auth requests.
+    #
+    email_executor = ProcExecutor(max_workers=1,
+                                  initializer=setup_auth_worker,
+                                  initargs=(AUTHDB_PATH,
+                                            FERNETSECRET),
+                                  finalizer=close_authentication_database)
+    authhandlers.EMAIL_SENDER = EmailSender(
+        email_executor,
+        maxattempts=options.emailmaxattempts,
+        retry_interval=options.emailretryinterval,
+        max_password_wait=options.emailmaxpasswordwait
+    )
+
     # we only have one actual endpoint, the other one is for testing
     handlers = [
         (r'/', AuthHandler,
          {'authdb':AUTHDB_PATH,
           'fernet_secret':FERNETSECRET,
-          'executor':executor}),
+          'executor':executor,
+          'hashing_pool':hashing_pool}),
     ]
 
     if DEBUG:
@@ -322,8 +417,30 @@ def main():
 
     LOGGER.info('Started authnzerver. listening on http://%s:%s' %
                 (options.serve, serverport))
-    LOGGER.info('Background worker processes: %s. IOLoop in use: %s' %
-                (MAXWORKERS, IOLOOP_SPEC))
+
+    # start up the stream server if we're asked to
+    if options.unixsocket or options.streamport:
+
+        stream_server = AuthStreamServer(AUTHDB_PATH,
+                                         FERNETSECRET,
+                                         executor,
+                                         hashing_pool=hashing_pool)
+
+        if options.unixsocket:
+            stream_server.add_socket(
+                tornado.netutil.bind_unix_socket(options.unixsocket,
+                                                 mode=0o600)
+            )
+            LOGGER.info('listening for stream connections on unix://%s' %
+                        os.path.abspath(options.unixsocket))
+
+        if options.streamport:
+            stream_server.listen(options.streamport, '127.0.0.1')
+            LOGGER.info('listening for stream connections on '
+                        'tcp://127.0.0.1:%s' % options.streamport)
+    LOGGER.info('Background worker processes: %s, '
+                'password hashing worker processes: %s. IOLoop in use: %s' %
+                (MAXWORKERS, options.hashworkers, IOLOOP_SPEC))
     LOGGER.info('Base directory is: %s' % os.path.abspath(options.basedir))
 
 
@@ -332,8 +449,37 @@ def main():
 
         loop = tornado.ioloop.IOLoop.current()
 
-        # add our periodic callback for the session-killer
-        # runs daily
+        # add our periodic callback for the expired session reaper. this
+        # deletes a few batches of expired sessions at a time so the sessions
+        # table doesn't grow between restarts.
+        if options.sessionreapinterval > 0:
+
+            authhandlers.SESSION_REAPER = SessionReaper(executor)
+            periodic_session_reap = tornado.ioloop.PeriodicCallback(
+                authhandlers.SESSION_REAPER,
+                options.sessionreapinterval*1000.0,
+                jitter=0.1,
+            )
+            periodic_session_reap.start()
+
+            LOGGER.info('Deleting expired sessions every %s seconds.' %
+                        options.sessionreapinterval)
+
+        # send the emails that were queued before a restart, then check for
+        # emails to retry every so often
+        authhandlers.EMAIL_SENDER()
+
+        if options.emailretryinterval > 0:
+
+            periodic_email_send = tornado.ioloop.PeriodicCallback(
+                authhandlers.EMAIL_SENDER,
+                options.emailretryinterval*1000.0,
+                jitter=0.1,
+            )
+            periodic_email_send.start()
+
+        # the session-killer still runs daily to get rid of the sessions left
+        # behind by the reaper because they had unexpired API keys
         periodic_session_kill = tornado.ioloop.PeriodicCallback(
             session_killer,
             86400000.0,
@@ -348,8 +494,10 @@ def main():
 
         LOGGER.info('Received Ctrl-C: shutting down...')
 
-        # close down the processpool
+        # close down the processpools
         executor.shutdown()
+        hash_executor.shutdown()
+        email_executor.shutdown()
         time.sleep(2)
 
         tornado.ioloop.IOLoop.instance().stop()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''transport.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This contains the framed stream transport between the frontend and the
+authnzerver.
+
+Instead of a new HTTP request for each auth request, the frontend keeps a
+single connection open to the authnzerver over a Unix domain socket or a TCP
+socket on localhost. Each message on the connection is a frame made of a
+4-byte big-endian length followed by the Fernet-encrypted JSON of the request
+or response. The reqid of each request is sent back with its response, so many
+requests can be in flight on the same connection at once and their responses
+can come back in any order.
+
+The authnzerver's side of this is the AuthStreamServer in handlers.py.
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+
+# get a logger
+LOGGER = logging.getLogger(__name__)
+
+
+#############
+## IMPORTS ##
+#############
+
+import json
+import socket
+import struct
+from datetime import timedelta
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.ioloop import IOLoop
+from tornado.locks import Lock
+from tornado.tcpclient import TCPClient
+
+
+# this is the frame length header: a 4-byte big-endian unsigned int
+FRAME_HEADER = struct.Struct('>I')
+
+# frames larger than this are refused
+MAX_FRAME_SIZE = 16*1024*1024
+
+
+#############
+## FRAMING ##
+#############
+
+def encrypt_frame(message_dict, fernet):
+    '''This turns a request or response dict into a frame.
+
+    fernet is a cryptography.fernet.Fernet instance. Returns the frame as bytes.
+
+    '''
+
+    json_bytes = json.dumps(message_dict).encode()
+    encrypted = fernet.encrypt(json_bytes)
+    return FRAME_HEADER.pack(len(encrypted)) + encrypted
+
+
+def decrypt_frame(frame, fernet):
+    '''This turns the body of a frame back into a dict.
+
+    Returns None if the frame can't be decrypted or isn't JSON.
+
+    '''
+
+    try:
+
+        decrypted = fernet.decrypt(frame)
+        return json.loads(decrypted)
+
+    except InvalidToken:
+
+        LOGGER.error('invalid frame could not be decrypted')
+        return None
+
+    except Exception:
+
+        LOGGER.exception('could not understand incoming frame')
+        return None
+
+
+async def read_frame(stream):
+    '''This reads the next frame from a stream and returns its body.
+
+    Raises StreamClosedError if the stream closes or the frame is too large.
+
+    '''
+
+    header = await stream.read_bytes(FRAME_HEADER.size)
+    frame_length = FRAME_HEADER.unpack(header)[0]
+
+    if frame_length > MAX_FRAME_SIZE:
+        LOGGER.error('frame of %s bytes is too large, closing stream' %
+                     frame_length)
+        stream.close()
+        raise StreamClosedError()
+
+    return await stream.read_bytes(frame_length)
+
+
+def parse_address(address):
+    '''This parses a stream transport address.
+
+    address is either unix:///path/to/socket or tcp://host:port. Returns a
+    tuple of (socket family, address), where address is the socket path or a
+    (host, port) tuple. Returns None if this isn't a stream transport address.
+
+    '''
+
+    if address.startswith('unix://'):
+        return socket.AF_UNIX, address[len('unix://'):]
+
+    elif address.startswith('tcp://'):
+        host, port = address[len('tcp://'):].rstrip('/').rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+
+    else:
+        return None
+
+
+############
+## CLIENT ##
+############
+
+class AuthnzerverClient(object):
+    '''This is the frontend's persistent connection to the authnzerver.
+
+    The connection is opened on the first request and opened again on the next
+    request if it closes. Requests waiting for a response when the connection
+    closes fail.
+
+    The methods of this class must be called from the IOLoop thread.
+
+    '''
+
+    def __init__(self, address, fernet_secret, timeout=10.0):
+        '''
+        This sets up the client.
+
+        '''
+
+        self.address = address
+        self.family, self.sockaddr = parse_address(address)
+        self.fernet = Fernet(fernet_secret)
+        self.timeout = timeout
+
+        self.stream = None
+        self.reqid = 0
+
+        # these are futures for the responses keyed by reqid for the current
+        # connection
+        self.pending = {}
+        self.connect_lock = Lock()
+
+    async def connect(self):
+        '''
+        This returns the open stream, connecting to the authnzerver if needed.
+
+        '''
+
+        async with self.connect_lock:
+
+            if self.stream is not None and not self.stream.closed():
+                return self.stream
+
+            if self.family == socket.AF_UNIX:
+                stream = IOStream(socket.socket(socket.AF_UNIX,
+                                                socket.SOCK_STREAM))
+                await stream.connect(self.sockaddr)
+            else:
+                stream = await TCPClient().connect(*self.sockaddr)
+                stream.set_nodelay(True)
+
+            self.stream = stream
+            self.pending = {}
+            IOLoop.current().spawn_callback(self.read_responses,
+                                            stream,
+                                            self.pending)
+
+            LOGGER.info('connected to authnzerver at %s' % self.address)
+            return stream
+
+    async def read_responses(self, stream, pending):
+        '''
+        This reads responses from the stream and hands them to their requests.
+
+        '''
+
+        try:
+
+            while True:
+
+                frame = await read_frame(stream)
+                respdict = decrypt_frame(frame, self.fernet)
+
+                if respdict is None:
+                    break
+
+                response_future = pending.pop(respdict.get('reqid'), None)
+                if response_future is not None and not response_future.done():
+                    response_future.set_result(respdict)
+
+        except StreamClosedError:
+            pass
+
+        finally:
+
+            stream.close()
+            if self.stream is stream:
+                self.stream = None
+
+            for response_future in pending.values():
+                if not response_future.done():
+                    response_future.set_exception(StreamClosedError())
+            pending.clear()
+
+    async def request(self, request_type, request_body):
+        '''This sends a request to the authnzerver and waits for its response.
+
+        Returns a tuple of (success, response, messages) like
+        BaseHandler.authnzerver_request. If the request fails, returns (False,
+        None, None).
+
+        '''
+
+        try:
+            stream = await self.connect()
+        except Exception:
+            LOGGER.exception('could not connect to authnzerver at %s' %
+                             self.address)
+            return False, None, None
+
+        # the reqid is never 0 because the authnzerver refuses those
+        self.reqid = self.reqid % 2147483647 + 1
+        reqid = self.reqid
+
+        pending = self.pending
+        response_future = Future()
+        pending[reqid] = response_future
+
+        try:
+
+            await stream.write(encrypt_frame({'request':request_type,
+                                              'body':request_body,
+                                              'reqid':reqid},
+                                             self.fernet))
+            respdict = await gen.with_timeout(
+                timedelta(seconds=self.timeout),
+                response_future
+            )
+
+        except gen.TimeoutError:
+
+            LOGGER.error('authnzerver request %s: %s timed out' %
+                         (reqid, request_type))
+            pending.pop(reqid, None)
+            return False, None, None
+
+        except StreamClosedError:
+
+            LOGGER.error('authnzerver connection closed during request '
+                         '%s: %s' % (reqid, request_type))
+            pending.pop(reqid, None)
+            return False, None, None
+
+        if respdict.get('failed'):
+            return False, None, None
+
+        success = respdict['success']
+        response = respdict['response']
+        messages = respdict['response']['messages']
+
+        return success, response, messages
+
+    def close(self):
+        '''
+        This closes the connection.
+
+        '''
+
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+# these are the clients used by the frontend keyed by (address, fernet secret)
+_CLIENTS = {}
+
+
+def get_client(address, fernet_secret):
+    '''This returns the client for the authnzerver at address.
+
+    The client is made the first time it's asked for and reused after that.
+
+    '''
+
+    key = (address, fernet_secret)
+    client = _CLIENTS.get(key)
+
+    if client is None:
+        client = AuthnzerverClient(address, fernet_secret)
+        _CLIENTS[key] = client
+
+    return client
@@ -48,6 +48,7 @@ import sys
 import os
 import importlib
 import glob
+import secrets
 from functools import reduce
 from operator import getitem
 from textwrap import indent, dedent
@@ -1184,6 +1185,93 @@ def get_lcformat_description(descpath):
     return returndict
 
 
+# this is the number of LC lines written to the gzip file at a time
+CSVLC_WRITE_BLOCK_LINES = 10000
+
+
+def _csvlc_column_values(column):
+    '''This returns the values of an LC column as a list.
+
+    float64, integer, bool, and string ndarrays are turned into lists of Python
+    scalars all at once, which format the same way as their NumPy scalars but
+    much faster. Other ndarrays (e.g. float32) are kept as NumPy scalars, since
+    their str() forms differ from the equivalent Python floats.
+
+    '''
+
+    if isinstance(column, np.ndarray):
+
+        if (column.dtype.kind in 'iubUSO' or
+            column.dtype == np.float64):
+            return column.tolist()
+        else:
+            return list(column)
+
+    else:
+        return list(column)
+
+
+def _csvlc_format_column(values, formatter):
+    '''This formats all the values of an LC column using formatter.
+
+    If any value conflicts with the specified formatter, it's turned into a
+    string with str() instead. This usually comes up if nan is provided as a
+    value to %i.
+
+    '''
+
+    try:
+        return [formatter % x for x in values]
+
+    except Exception:
+
+        outvals = []
+
+        for x in values:
+            try:
+                outvals.append(formatter % x)
+            except Exception:
+                outvals.append(str(x))
+
+        return outvals
+
+
+def csvlc_format_lines(columns, formatters, column_separator=','):
+    '''This yields the lines of the CSV LC in blocks.
+
+    columns is a list of column value lists and formatters is the list of their
+    %-format strings. Each yielded block is a string of up to
+    CSVLC_WRITE_BLOCK_LINES lines, each ending in a newline.
+
+    The lines are formatted with a single format string for all columns where
+    possible. If any value in a block conflicts with its column's formatter,
+    the block is formatted column by column instead.
+
+    '''
+
+    if len(columns) == 0:
+        return
+
+    line_formstr = column_separator.join(formatters)
+    nlines = min(len(x) for x in columns)
+
+    for blockstart in range(0, nlines, CSVLC_WRITE_BLOCK_LINES):
+
+        blockend = min(blockstart + CSVLC_WRITE_BLOCK_LINES, nlines)
+        blockcols = [x[blockstart:blockend] for x in columns]
+
+        try:
+            lines = [line_formstr % x for x in zip(*blockcols)]
+
+        except Exception:
+
+            strcols = [_csvlc_format_column(x, f)
+                       for x, f in zip(blockcols, formatters)]
+            lines = [column_separator.join(x) for x in zip(*strcols)]
+
+        yield '%s\n' % '\n'.join(lines)
+
+
 def convert_to_csvlc(lcfile,
                      objectid,
                      lcformat_dict,
@@ -1191,7 +1279,8 @@ def convert_to_csvlc(lcfile,
                      csvlc_version=1,
                      comment_char='#',
                      column_separator=',',
-                     skip_converted=False):
+                     skip_converted=False,
+                     gzip_compresslevel=9):
     '''This converts any readable LC to a common-format CSV LC.
 
     The first 3 lines of the file are always:
@@ -1211,6 +1300,10 @@ def convert_to_csvlc(lcfile,
     lcformat-description.json file if normalize_lc is True. If this is False,
     will leave the light curve alone.
 
+    The LC columns are each looked up in the lcdict once and written to the
+    output gzip file in blocks of formatted lines. gzip_compresslevel sets the
+    compression level for the output file.
+
     '''
 
     # use the lcformat_dict to get the reader and normalization functions
@@ -1291,12 +1384,13 @@ def convert_to_csvlc(lcfile,
     line_formstr = []
 
     available_keys = []
+    available_columns = []
     ki = 0
 
     for key in lcformat_dict['colkeys']:
 
         try:
-            dict_get(lcdict, key.split('.'))
+            thiscol = dict_get(lcdict, key.split('.'))
 
             thiscolinfo = lcformat_dict['columns'][key]
 
@@ -1308,6 +1402,7 @@ def convert_to_csvlc(lcfile,
                 'desc':thiscolinfo['desc']
             }
             available_keys.append(key)
+            available_columns.append(thiscol)
             ki = ki + 1
 
         except Exception:
@@ -1317,51 +1412,55 @@ def convert_to_csvlc(lcfile,
     metajson = indent(json.dumps(meta, indent=2), '%s ' % comment_char)
     coljson = indent(json.dumps(columns, indent=2), '%s ' % comment_char)
 
-    # now, put together everything
-    with gzip.open(outpath, 'wb') as outfd:
+    # now, put together everything. this is written to a temporary file first
+    # and moved into place, so the CSV LC is never modified in place. the LC
+    # bundle cache may share its data (see datasets._store_lcbundle_blob).
+    tmp_outpath = '%s.tmp-%s' % (outpath, secrets.token_hex(4))
 
-        # first, write the format spec
-        outfd.write(('LCC-CSVLC-V%s\n' % csvlc_version).encode())
-        outfd.write(('%s\n' % comment_char).encode())
-        outfd.write(('%s\n' % column_separator).encode())
+    try:
 
-        # second, write the metadata JSON
-        outfd.write(('%s OBJECT METADATA\n' % comment_char).encode())
-        outfd.write(('%s\n' % metajson).encode())
-        outfd.write(('%s\n' % (comment_char,)).encode())
+        # the gzip header has the name of the CSV LC, not the temporary file
+        with open(tmp_outpath, 'wb') as rawfd, \
+             gzip.GzipFile(filename=outpath,
+                           mode='wb',
+                           compresslevel=gzip_compresslevel,
+                           fileobj=rawfd) as outfd:
 
-        # third, write the column JSON
-        outfd.write(('%s COLUMN DEFINITIONS\n' % comment_char).encode())
-        outfd.write(('%s\n' % coljson).encode())
+            # first, write the format spec
+            outfd.write(('LCC-CSVLC-V%s\n' % csvlc_version).encode())
+            outfd.write(('%s\n' % comment_char).encode())
+            outfd.write(('%s\n' % column_separator).encode())
 
-        # finally, prepare to write the LC columns
-        outfd.write(('%s\n' % (comment_char,)).encode())
-        outfd.write(('%s LIGHTCURVE\n' % comment_char).encode())
+            # second, write the metadata JSON
+            outfd.write(('%s OBJECT METADATA\n' % comment_char).encode())
+            outfd.write(('%s\n' % metajson).encode())
+            outfd.write(('%s\n' % (comment_char,)).encode())
 
-        # last, write the columns themselves
-        nlines = len(lcdict[lcformat_dict['colkeys'][0]])
+            # third, write the column JSON
+            outfd.write(('%s COLUMN DEFINITIONS\n' % comment_char).encode())
+            outfd.write(('%s\n' % coljson).encode())
 
-        for lineind in range(nlines):
+            # finally, prepare to write the LC columns
+            outfd.write(('%s\n' % (comment_char,)).encode())
+            outfd.write(('%s LIGHTCURVE\n' % comment_char).encode())
 
-            thisline = []
-            for x in available_keys:
+            # last, write the columns themselves
+            nlines = len(lcdict[lcformat_dict['colkeys'][0]])
 
-                # we need to check if any col vals conflict with the specified
-                # formatter. in this case, we'll turn the formatter into %s so
-                # we don't fail here. this usually comes up if nan is provided
-                # as a value to %i
-                try:
-                    thisline.append(
-                        lcformat_dict['columns'][x]['format'] %
-                        dict_get(lcdict, x.split('.'))[lineind]
-                    )
-                except Exception:
-                    thisline.append(
-                        str(dict_get(lcdict, x.split('.'))[lineind])
-                    )
+            for block in csvlc_format_lines(
+                    [_csvlc_column_values(x)[:nlines]
+                     for x in available_columns],
+                    line_formstr,
+                    column_separator=column_separator
+            ):
+                outfd.write(block.encode())
+
+        os.replace(tmp_outpath, outpath)
+
+    finally:
 
-            formline = '%s\n' % ('%s' % column_separator).join(thisline)
-            outfd.write(formline.encode())
+        if os.path.exists(tmp_outpath):
+            os.remove(tmp_outpath)
 
     return outpath
 
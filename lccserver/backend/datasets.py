@@ -42,22 +42,35 @@ import sqlite3
 import pickle
 import secrets
 import gzip
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
 import json
 from multiprocessing import Pool
 from textwrap import indent
 from functools import reduce, partial
 import hashlib
-from datetime import datetime
+import glob
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from random import sample
 import re
 import unicodedata
+from inspect import signature
+
+import numpy as np
+from astropy.io import fits
 
 from tornado.escape import xhtml_unescape
 import bleach
 
 from . import abcat
-from ..authnzerver.authdb import check_user_access, check_role_limits
+from . import dbsearch
+from ..authnzerver.authdb import (
+    check_user_access,
+    check_user_access_mask,
+    check_role_limits
+)
 
 #########################################
 ## INITIALIZING A DATASET INDEX SQLITE ##
@@ -171,6 +184,8 @@ def sqlite_make_lcc_datasets_db(basedir):
     cur = db.cursor()
 
     cur.executescript(SQLITE_DATASET_CREATE)
+    cur.executescript(SQLITE_DATASET_USAGE_CREATE)
+    cur.executescript(SQLITE_LCBUNDLE_CREATE)
     db.commit()
 
     db.close()
@@ -284,6 +299,146 @@ def results_random_sample(rows, sample_count=None):
         return rows
 
 
+# these are the same operators the frontend uses for search filters
+RESULT_FILTER_OPERATORS = ('gt','lt','ge','le','eq','ne','ct')
+
+
+def results_null_masks(rows, columns):
+    '''This returns a dict of boolean arrays marking None items per column.
+
+    '''
+
+    return {c:np.array([x[c] is None for x in rows], dtype=np.bool_)
+            for c in columns}
+
+
+def results_filter_mask(colarrays, nullmasks, filters=()):
+    '''This returns a boolean mask of the rows passing all of the filters.
+
+    colarrays is a dict of numpy arrays per column as returned by
+    dataset_to_arrays and nullmasks is a dict of arrays marking the None items
+    per column as returned by results_null_masks.
+
+    filters is a list of lists like so:
+
+    [['column', 'gt|lt|ge|le|eq|ne|ct', value], ...]
+
+    The filters are ANDed together. Like SQL, rows with None in a filtered
+    column never pass that filter. 'ct' is a case-insensitive substring match
+    for string columns.
+
+    Raises ValueError if a filter is invalid.
+
+    '''
+
+    nrows = len(next(iter(colarrays.values()))) if len(colarrays) > 0 else 0
+    mask = np.full(nrows, True, dtype=np.bool_)
+
+    for f in filters:
+
+        try:
+            col, op, value = f
+        except Exception:
+            raise ValueError('filter %r is not a [column, operator, value] '
+                             'item' % (f,))
+
+        if col not in colarrays:
+            raise ValueError('unknown filter column: %s' % col)
+        if op not in RESULT_FILTER_OPERATORS:
+            raise ValueError('unknown filter operator: %s' % op)
+
+        arr = colarrays[col]
+
+        if arr.dtype.kind in ('f','i','u','b'):
+
+            if op == 'ct':
+                raise ValueError('operator ct is only valid '
+                                 'for string columns')
+            value = float(value)
+
+        else:
+
+            value = str(value)
+            if op == 'ct':
+                colmask = np.char.find(np.char.lower(arr), value.lower()) > -1
+                mask = mask & colmask & ~nullmasks[col]
+                continue
+
+        if op == 'gt':
+            colmask = arr > value
+        elif op == 'lt':
+            colmask = arr < value
+        elif op == 'ge':
+            colmask = arr >= value
+        elif op == 'le':
+            colmask = arr <= value
+        elif op == 'eq':
+            colmask = arr == value
+        elif op == 'ne':
+            colmask = arr != value
+
+        mask = mask & colmask & ~nullmasks[col]
+
+    return mask
+
+
+def results_argsort(colarrays, nullmasks, sorts=(), indices=None):
+    '''This returns the row indices in the order given by the sorts.
+
+    sorts is a list of lists like so:
+
+    [['column', 'asc|desc'], ...]
+
+    The sorts are applied in order of their appearance in the list, and None
+    items always go to the end, as in results_sort_by_keys. The sort is stable
+    so rows that compare equal keep their stored order.
+
+    indices is an optional array of row indices to sort, e.g. the rows passing
+    a filter mask. If None, all rows are sorted.
+
+    Raises ValueError if a sort is invalid.
+
+    '''
+
+    if indices is None:
+        nrows = len(next(iter(colarrays.values()))) if len(colarrays) else 0
+        indices = np.arange(nrows)
+
+    if not sorts or indices.size == 0:
+        return indices
+
+    # np.lexsort sorts by the last key first, so we go backwards through the
+    # sorts, and put each column's null mask after its values so it takes
+    # precedence over them
+    sortkeys = []
+
+    for s in sorts[::-1]:
+
+        try:
+            col, order = s
+        except Exception:
+            raise ValueError('sort %r is not a [column, order] item' % (s,))
+
+        if col not in colarrays:
+            raise ValueError('unknown sort column: %s' % col)
+        if order not in ('asc','desc'):
+            raise ValueError('unknown sort order: %s' % order)
+
+        arr = colarrays[col][indices]
+
+        if order == 'desc':
+            if arr.dtype.kind in ('f','i'):
+                arr = -arr
+            else:
+                # strings can't be negated, so sort on their negated ranks
+                arr = -np.unique(arr, return_inverse=True)[1]
+
+        sortkeys.append(arr)
+        sortkeys.append(nullmasks[col][indices])
+
+    return indices[np.lexsort(sortkeys)]
+
+
 ########################################
 ## FUNCTIONS THAT OPERATE ON DATASETS ##
 ########################################
@@ -356,6 +511,56 @@ def sqlite_prepare_dataset(basedir,
     return setid, creationdt
 
 
+def collect_dataset_row_lc(entry,
+                           basedir,
+                           lcformatdescs,
+                           all_original_lcs,
+                           csvlcs_to_generate):
+    '''This adds a dataset row's original LC to the lists of LCs to convert.
+
+    The row's LC filename is replaced with the URL of its CSV LC.
+
+    '''
+
+    all_original_lcs.append(entry['db_lcfname'])
+
+    csvlc = '%s-csvlc.gz' % entry['db_oid']
+    csvlc_path = os.path.join(os.path.abspath(basedir),
+                              'csvlcs',
+                              entry['collection'].replace('_','-'),
+                              csvlc)
+
+    if 'db_lcfname' in entry:
+
+        csvlcs_to_generate.append(
+            (entry['db_lcfname'],
+             entry['db_oid'],
+             lcformatdescs[entry['collection']],
+             entry['collection'],
+             csvlc_path)
+        )
+
+        entry['db_lcfname'] = '/l/%s/%s' % (
+            entry['collection'].replace('_','-'),
+            csvlc
+        )
+
+    elif 'lcfname' in entry:
+
+        csvlcs_to_generate.append(
+            (entry['lcfname'],
+             entry['db_oid'],
+             lcformatdescs[entry['collection']],
+             entry['collection'],
+             csvlc_path)
+        )
+
+        entry['lcfname'] = '/l/%s/%s' % (
+            entry['collection'].replace('_','-'),
+            csvlc
+        )
+
+
 def process_dataset_pgrow(
         entry,
         basedir,
@@ -376,43 +581,11 @@ def process_dataset_pgrow(
     if ( (all_original_lcs is not None) and
          (csvlcs_to_generate is not None) ):
 
-        all_original_lcs.append(entry['db_lcfname'])
-
-        csvlc = '%s-csvlc.gz' % entry['db_oid']
-        csvlc_path = os.path.join(os.path.abspath(basedir),
-                                  'csvlcs',
-                                  entry['collection'].replace('_','-'),
-                                  csvlc)
-
-        if 'db_lcfname' in entry:
-
-            csvlcs_to_generate.append(
-                (entry['db_lcfname'],
-                 entry['db_oid'],
-                 lcformatdescs[entry['collection']],
-                 entry['collection'],
-                 csvlc_path)
-            )
-
-            entry['db_lcfname'] = '/l/%s/%s' % (
-                entry['collection'].replace('_','-'),
-                csvlc
-            )
-
-        elif 'lcfname' in entry:
-
-            csvlcs_to_generate.append(
-                (entry['lcfname'],
-                 entry['db_oid'],
-                 lcformatdescs[entry['collection']],
-                 entry['collection'],
-                 csvlc_path)
-            )
-
-            entry['lcfname'] = '/l/%s/%s' % (
-                entry['collection'].replace('_','-'),
-                csvlc
-            )
+        collect_dataset_row_lc(entry,
+                               basedir,
+                               lcformatdescs,
+                               all_original_lcs,
+                               csvlcs_to_generate)
 
     # generate the the normal data table row and append it to the output rows
     outrow = [entry[c] for c in columnlist]
@@ -711,15 +884,99 @@ def sqlite_new_dataset(basedir,
         'lczipfpath':lczip_fpath,
     }
 
-    # generate the JSON header for the CSV
-    csvheader = json.dumps(dataset, indent=2)
-    csvheader = indent(csvheader, '# ')
-
     #
     # add in the rows to turn the header into the complete dataset pickle
     #
     dataset['result'] = rows
 
+    # write the CSV, pickles, and first page, and collect the LCs to convert
+    csvlcs_to_generate, all_original_lcs = _write_dataset_products(
+        basedir,
+        dataset,
+        incoming_session_token=incoming_session_token,
+        render_first_page=render_first_page,
+        collect_lcs=True
+    )
+
+    actual_nrows = dataset['actual_nrows']
+    del dataset
+
+    # return the setid
+    return (
+        setid,
+        csvlcs_to_generate,
+        sorted(all_original_lcs),
+        actual_nrows,
+        npages
+    )
+
+
+def write_dataset_csv(basedir,
+                      dataset,
+                      all_original_lcs=None,
+                      csvlcs_to_generate=None):
+    '''This writes the dataset's rows to its CSV.
+
+    The CSV has the dataset header as JSON in its commented first lines,
+    followed by the '|' separated string formatted rows.
+
+    If all_original_lcs and csvlcs_to_generate are lists, the rows' LCs are
+    collected into them using collect_dataset_row_lc.
+
+    '''
+
+    # generate the JSON header for the CSV
+    csvheader = json.dumps(
+        {k:dataset[k] for k in dataset if k != 'result'},
+        indent=2
+    )
+    csvheader = indent(csvheader, '# ')
+
+    dataset_csv = dataset['dataset_csv']
+
+    with open(dataset_csv,'wb') as csvfd:
+
+        # write the header to the CSV file
+        csvfd.write(('%s\n' % csvheader).encode())
+
+        # run through the rows and generate the CSV
+        for entry in dataset['result']:
+
+            process_dataset_pgrow(
+                entry,
+                basedir,
+                dataset['lcformatdescs'],
+                dataset['columns'],
+                dataset['coldesc'],
+                csvfd=csvfd,
+                all_original_lcs=all_original_lcs,
+                csvlcs_to_generate=csvlcs_to_generate,
+            )
+
+    LOGINFO('wrote CSV: %s for setid: %s' % (dataset_csv, dataset['setid']))
+    return dataset_csv
+
+
+def _write_dataset_products(basedir,
+                            dataset,
+                            incoming_session_token=None,
+                            render_first_page=True,
+                            collect_lcs=True):
+    '''This writes a dataset's DB entry, CSV, pickles, and first page.
+
+    dataset is the complete dataset dict, including the 'result' rows. Its DB
+    entry is set to 'in progress' until the LC ZIP is made.
+
+    If collect_lcs is True, the rows' LC filenames are replaced by their CSV LC
+    URLs and the lists of CSV LCs to generate and original LCs are returned
+    for use by sqlite_make_dataset_lczip. Otherwise, both lists are empty.
+
+    '''
+
+    setid = dataset['setid']
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+    dataset_fpath = dataset['dataset_pickle']
+
     # open the datasets database
     datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
     db = sqlite3.connect(
@@ -747,18 +1004,18 @@ def sqlite_new_dataset(basedir,
     )
 
     params = (
-        setname,
-        setdesc,
-        last_updated,
+        dataset['name'],
+        dataset['desc'],
+        dataset['updated'],
         dataset['actual_nrows'],
         dataset['owner'],
         dataset['visibility'],
         dataset['sharedwith'],
         incoming_session_token,
         'in progress',
-        ', '.join(collections),
-        searchtype,
-        json.dumps(searchargs),
+        ', '.join(dataset['collections']),
+        dataset['searchtype'],
+        json.dumps(dataset['searchargs']),
         setid
     )
     cur.execute(query, params)
@@ -766,37 +1023,21 @@ def sqlite_new_dataset(basedir,
     db.close()
 
     LOGINFO('updated DB entry for setid: %s, total nmatches: %s' %
-            (setid, total_nmatches))
+            (setid, dataset['total_nmatches']))
 
-    csvfd = open(dataset_csv,'wb')
-
-    # write the header to the CSV file
-    csvfd.write(('%s\n' % csvheader).encode())
-
-    all_original_lcs = []
-    csvlcs_to_generate = []
+    if collect_lcs:
+        all_original_lcs = []
+        csvlcs_to_generate = []
+    else:
+        all_original_lcs = None
+        csvlcs_to_generate = None
 
     LOGINFO('writing dataset rows to CSV and main pickle...')
 
-    # run through the rows and generate the CSV
-    for entry in dataset['result']:
-
-        process_dataset_pgrow(
-            entry,
-            basedir,
-            lcformatdescs,
-            dataset['columns'],
-            dataset['coldesc'],
-            csvfd=csvfd,
-            all_original_lcs=all_original_lcs,
-            csvlcs_to_generate=csvlcs_to_generate,
-        )
-
-    #
-    # finish up the CSV when we're done with all of the rows
-    #
-    csvfd.close()
-    LOGINFO('wrote CSV: %s for setid: %s' % (dataset_csv, setid))
+    write_dataset_csv(basedir,
+                      dataset,
+                      all_original_lcs=all_original_lcs,
+                      csvlcs_to_generate=csvlcs_to_generate)
 
     #
     # next, write the pickle to the datasets directory
@@ -819,8 +1060,6 @@ def sqlite_new_dataset(basedir,
     LOGINFO('wrote dataset header pickle: %s for dataset setid: %s' %
             (dataset_header_pkl, setid))
 
-    actual_nrows = dataset['actual_nrows']
-
     if render_first_page:
 
         process_dataset_page(
@@ -828,19 +1067,13 @@ def sqlite_new_dataset(basedir,
             datasetdir,
             dataset,
             0,
-            [0,rows_per_page]
+            [0,dataset['rows_per_page']]
         )
 
-    del dataset
-
-    # return the setid
-    return (
-        setid,
-        csvlcs_to_generate,
-        sorted(all_original_lcs),
-        actual_nrows,
-        npages
-    )
+    if collect_lcs:
+        return csvlcs_to_generate, all_original_lcs
+    else:
+        return [], []
 
 
 def sqlite_render_dataset_page(basedir,
@@ -892,288 +1125,2763 @@ def sqlite_render_dataset_page(basedir,
         return None, None
 
 
-############################################
-## FUNCTIONS THAT DEAL WITH LC COLLECTION ##
-############################################
+############################
+## BINARY DATASET EXPORTS ##
+############################
 
-def csvlc_convert_worker(task):
-    '''
-    This is a worker for the function below.
+DATASET_EXPORT_FORMATS = ('fits', 'npz')
 
-    '''
 
-    lcfile, objectid, formatjson, convertin_opts = task
-    convertopts = convertin_opts.copy()
-    formatdict = abcat.get_lcformat_description(formatjson)
+def _dataset_column_to_array(values, dtype):
+    '''This converts a list of row values for a column to a numpy array.
 
-    try:
-        csvlc = abcat.convert_to_csvlc(lcfile,
-                                       objectid,
-                                       formatdict,
-                                       **convertopts)
-        LOGINFO('converted %s -> %s ok' % (lcfile, csvlc))
-        return csvlc
+    dtype is the numpy dtype string from the dataset's coldesc. SQL NULLs
+    (Nones) are converted to NaN for float columns and -9999 for integer
+    columns, the same sentinels used for the dataset CSV. String columns get
+    sized to their longest value instead of the dtype's declared width.
 
+    '''
+
+    try:
+        npdtype = np.dtype(dtype)
     except Exception:
+        npdtype = np.dtype('U')
 
-        return '%s conversion to CSVLC failed' % os.path.basename(lcfile)
+    if npdtype.kind == 'f':
+        return np.array([np.nan if x is None else x for x in values],
+                        dtype=npdtype)
 
+    elif npdtype.kind in ('i','u'):
+        return np.array([-9999 if x is None else x for x in values],
+                        dtype=npdtype)
 
-def generate_lczip_cachekey(lczip_lclist):
-    '''
-    This generates the cache key for an LCZIP based on its LC list.
+    elif npdtype.kind == 'b':
+        return np.array([False if x is None else x for x in values],
+                        dtype=npdtype)
 
-    '''
+    # everything else gets turned into a string
+    else:
+        return np.array(['' if x is None else str(x) for x in values],
+                        dtype='U')
 
-    sorted_lclist_json = json.dumps(lczip_lclist)
-    cachekey = hashlib.sha256(sorted_lclist_json.encode()).hexdigest()
 
-    return cachekey
+def dataset_to_arrays(dataset):
+    '''This turns the dataset's result rows into a dict of numpy arrays.
 
+    dataset is the dict loaded from the full dataset pickle. The arrays are
+    keyed by column name and use the dtypes in dataset['coldesc'].
 
-def sqlite_make_dataset_lczip(basedir,
-                              setid,
-                              dataset_csvlcs_to_generate,
-                              dataset_all_original_lcs,
-                              converter_processes=4,
-                              converter_csvlc_version=1,
-                              converter_comment_char='#',
-                              converter_column_separator=',',
-                              converter_skip_converted=True,
-                              override_lcdir=None,
-                              force_collection=False,
-                              max_dataset_lcs=2500):
     '''
-    This makes a zip file for the light curves in the dataset.
 
-    '''
+    columns = {}
 
-    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
-    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    for col in dataset['columns']:
+        columns[col] = _dataset_column_to_array(
+            [x[col] for x in dataset['result']],
+            dataset['coldesc'][col]['dtype']
+        )
 
-    # look in the datasetdir for the dataset pickle
-    dataset_fpath = os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid)
+    return columns
 
-    if os.path.exists(dataset_fpath):
 
-        with gzip.open(dataset_fpath,'rb') as infd:
-            dataset = pickle.load(infd)
+def _dataset_export_header(dataset):
+    '''This returns the bits of the dataset header to put into exports.
 
-        # 1. use the provided list of original LCs to generate a cache key.
-        dataset_lczip_cachekey = generate_lczip_cachekey(
-            dataset_all_original_lcs
-        )
+    '''
 
-        # check the cachekey against the database to see if a dataset with
-        # identical LCs has already been collected
-        db = sqlite3.connect(
-            datasets_dbf,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-        )
-        cur = db.cursor()
+    return {
+        'setid':dataset['setid'],
+        'name':dataset['name'],
+        'desc':dataset['desc'],
+        'citation':dataset.get('citation', None),
+        'created':dataset['created'],
+        'updated':dataset['updated'],
+        'searchtype':dataset['searchtype'],
+        'collections':dataset['collections'],
+        'actual_nrows':dataset['actual_nrows'],
+        'columns':dataset['columns'],
+        'coldesc':dataset['coldesc'],
+    }
 
-        # this will fetch the original set LC zip if there are multiple links to
-        # it for many datasets
-        cur.execute("select setid, lczip_cachekey from lcc_datasets where "
-                    "lczip_cachekey = ? order by last_updated asc limit 1",
-                    (dataset_lczip_cachekey,))
 
-        row = cur.fetchone()
-        db.close()
+def _fits_header_str(value):
+    '''FITS headers can only hold printable ASCII, so replace everything else.
 
-        # if LCs corresponding to the ones included in this dataset are found in
-        # another dataset, then we'll symlink that dataset's LC ZIP to
-        # products/lightcurves-[this setid].zip, and call it a day
-        skip_lc_collection = False
+    '''
 
-        if row and len(row) > 0:
+    if value is None:
+        return ''
 
-            other_setid, other_dataset_cachekey = row
-            other_lczip = os.path.join(basedir,
-                                       'products',
-                                       'lightcurves-%s.zip' % other_setid)
+    return ''.join(x if 32 <= ord(x) < 127 else '?' for x in str(value))
 
-            if os.path.exists(other_lczip):
 
-                # we'll remove the current dataset LC zip in favor of the other
-                # one every time
-                if os.path.exists(dataset['lczipfpath']):
-                    LOGWARNING('overwriting existing symlink %s, '
-                               'which points to actual file: %s' %
-                               (dataset['lczipfpath'],
-                                os.path.abspath(other_lczip)))
-                    os.remove(dataset['lczipfpath'])
+def write_dataset_fits(dataset, outfile):
+    '''This writes the dataset's data table to a FITS binary table.
 
-                os.symlink(os.path.abspath(other_lczip),
-                           dataset['lczipfpath'])
-                skip_lc_collection = True
+    The primary HDU header contains the setid, name, creation and update
+    times. The binary table is in the 'DATASET' extension and has the column
+    titles in the TTYPE comments. String columns are written as UTF-8 bytes.
 
-            else:
+    '''
 
-                skip_lc_collection = False
+    arrays = dataset_to_arrays(dataset)
 
-        # only collect LCs if we have to, we'll use the already generated link
-        # if we have the same LCs collected already somewhere else
-        if not skip_lc_collection or force_collection is True:
+    fitscols = []
+    for col in dataset['columns']:
 
-            LOGINFO('no cached LC zip found for dataset: %s, regenerating...' %
-                    setid)
+        colarr = arrays[col]
+        if colarr.dtype.kind == 'U':
+            colarr = np.char.encode(colarr, 'utf-8')
+            if colarr.dtype.itemsize == 0:
+                colarr = colarr.astype('S1')
+        fitscols.append(colarr)
 
-            convertopts = {'csvlc_version':converter_csvlc_version,
+    table = np.rec.fromarrays(fitscols, names=dataset['columns'])
+    tablehdu = fits.BinTableHDU(data=table, name='DATASET')
+
+    for ind, col in enumerate(dataset['columns']):
+        tablehdu.header.comments['TTYPE%s' % (ind + 1)] = (
+            _fits_header_str(dataset['coldesc'][col]['title'])
+        )
+
+    primaryhdu = fits.PrimaryHDU()
+    primaryhdu.header['SETID'] = (dataset['setid'], 'LCC-Server dataset ID')
+    primaryhdu.header['CREATED'] = (dataset['created'], 'UTC creation time')
+    primaryhdu.header['UPDATED'] = (dataset['updated'], 'UTC last update time')
+    primaryhdu.header['NROWS'] = (dataset['actual_nrows'],
+                                  'number of objects in dataset')
+    primaryhdu.header['SETNAME'] = _fits_header_str(dataset['name'])
+    primaryhdu.header['SEARCH'] = dataset['searchtype']
+    primaryhdu.header['COLLS'] = ', '.join(dataset['collections'])
+
+    hdulist = fits.HDUList([primaryhdu, tablehdu])
+    hdulist.writeto(outfile, overwrite=True)
+    hdulist.close()
+
+    return outfile
+
+
+def write_dataset_npz(dataset, outfile):
+    '''This writes the dataset's data table to a NumPy .npz file.
+
+    Each column is stored under its column name. The dataset header (setid,
+    name, column descriptions, etc.) is stored as a JSON string under the
+    'header_json' key, so the file can be loaded without allow_pickle=True.
+
+    '''
+
+    arrays = dataset_to_arrays(dataset)
+    arrays['header_json'] = np.array(
+        json.dumps(_dataset_export_header(dataset))
+    )
+
+    with open(outfile,'wb') as outfd:
+        np.savez_compressed(outfd, **arrays)
+
+    return outfile
+
+
+def sqlite_export_dataset(basedir,
+                          setid,
+                          exportformat,
+                          incoming_userid=2,
+                          incoming_role='anonymous'):
+    '''This gets a binary export of the dataset, generating it if needed.
+
+    exportformat is one of:
+
+    'fits' -> basedir/datasets/dataset-<setid>.fits
+    'npz'  -> basedir/datasets/dataset-<setid>.npz
+
+    Exports are generated on first request from the full dataset pickle and
+    cached next to it. They're regenerated if the dataset pickle has been
+    written to since the export was made.
+
+    Returns the path to the export file or None if the dataset doesn't exist
+    or isn't accessible by the user.
+
+    '''
+
+    if exportformat not in DATASET_EXPORT_FORMATS:
+        LOGERROR('unknown dataset export format: %s' % exportformat)
+        return None
+
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+    dataset_fpath = os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid)
+    export_fpath = os.path.join(datasetdir,
+                                'dataset-%s.%s' % (setid, exportformat))
+
+    if not os.path.exists(dataset_fpath):
+        LOGERROR('could not find dataset with setid: %s' % setid)
+        return None
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    db.row_factory = sqlite3.Row
+
+    dataset_accessible = sqlite_check_dataset_access(
+        setid,
+        'view',
+        incoming_userid=incoming_userid,
+        incoming_role=incoming_role,
+        database=db
+    )
+    db.close()
+
+    if not dataset_accessible:
+        LOGERROR('dataset: %s is not accessible by userid: %s, role: %s' %
+                 (setid, incoming_userid, incoming_role))
+        return None
+
+    # return the cached export if it's up to date
+    if (os.path.exists(export_fpath) and
+        os.stat(export_fpath).st_mtime >= os.stat(dataset_fpath).st_mtime):
+        return export_fpath
+
+    with gzip.open(dataset_fpath,'rb') as infd:
+        dataset = pickle.load(infd)
+
+    # write to a temporary file first so concurrent requests for the same
+    # export never see a partially written file
+    tmp_fpath = '%s.tmp-%s' % (export_fpath, secrets.token_hex(4))
+
+    try:
+
+        if exportformat == 'fits':
+            write_dataset_fits(dataset, tmp_fpath)
+        elif exportformat == 'npz':
+            write_dataset_npz(dataset, tmp_fpath)
+
+        os.replace(tmp_fpath, export_fpath)
+
+        LOGINFO('wrote %s export: %s for setid: %s' %
+                (exportformat, export_fpath, setid))
+        return export_fpath
+
+    except Exception:
+
+        LOGEXCEPTION('could not write %s export for setid: %s' %
+                     (exportformat, setid))
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        return None
+
+
+#######################
+## DERIVING DATASETS ##
+#######################
+
+def sqlite_derive_dataset(basedir,
+                          setid,
+                          sortspec=None,
+                          filterspec=None,
+                          incoming_userid=2,
+                          incoming_role='anonymous',
+                          incoming_session_token=None,
+                          dataset_visibility='unlisted',
+                          dataset_sharedwith=None,
+                          rows_per_page=None,
+                          render_first_page=True):
+    '''This makes a new dataset by re-sorting and/or filtering an existing one.
+
+    This works directly on the stored rows of the dataset with setid, so none
+    of the collections are queried again.
+
+    sortspec is a list of [column, 'asc|desc'] items, see results_argsort.
+
+    filterspec is a list of [column, operator, value] items, see
+    results_filter_mask.
+
+    Both can use any column in the dataset's coldesc. The original dataset
+    must be complete and viewable by the incoming user, who becomes the owner
+    of the new dataset.
+
+    The CSV LCs generated for the original dataset are used for the LC ZIP of
+    the new dataset, so the returned items can be passed straight to
+    sqlite_make_dataset_lczip.
+
+    Returns the same tuple as sqlite_new_dataset:
+
+    (new setid, csvlcs_to_generate, all_original_lcs, actual_nrows, npages)
+
+    or None if the dataset can't be derived.
+
+    '''
+
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+    productdir = os.path.abspath(os.path.join(basedir, 'products'))
+    dataset_fpath = os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid)
+
+    if not os.path.exists(dataset_fpath):
+        LOGERROR('could not find dataset with setid: %s' % setid)
+        return None
+
+    if not sortspec and not filterspec:
+        LOGERROR('no sortspec or filterspec provided to '
+                 'derive a new dataset from setid: %s' % setid)
+        return None
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    db.row_factory = sqlite3.Row
+    cur = db.cursor()
+    cur.execute("select status from lcc_datasets where setid = ?", (setid,))
+    row = cur.fetchone()
+
+    dataset_accessible = sqlite_check_dataset_access(
+        setid,
+        'view',
+        incoming_userid=incoming_userid,
+        incoming_role=incoming_role,
+        database=db
+    )
+    db.close()
+
+    if not dataset_accessible:
+        LOGERROR('dataset: %s is not accessible by userid: %s, role: %s' %
+                 (setid, incoming_userid, incoming_role))
+        return None
+
+    if not row or row['status'] != 'complete':
+        LOGERROR('dataset %s is not complete, '
+                 'cannot derive a new dataset from it' % setid)
+        return None
+
+    with gzip.open(dataset_fpath,'rb') as infd:
+        parent = pickle.load(infd)
+
+    rows = parent['result']
+    columns = parent['columns']
+
+    colarrays = dataset_to_arrays(parent)
+    nullmasks = results_null_masks(rows, columns)
+
+    # reform special case of single sortspec
+    if (isinstance(sortspec, (tuple, list)) and
+        len(sortspec) == 2 and
+        isinstance(sortspec[0], str) and
+        isinstance(sortspec[1], str)):
+        sortspec = [sortspec]
+
+    try:
+
+        if filterspec:
+            mask = results_filter_mask(colarrays, nullmasks, filters=filterspec)
+        else:
+            mask = np.full(len(rows), True, dtype=np.bool_)
+
+        indices = results_argsort(colarrays,
+                                  nullmasks,
+                                  sorts=sortspec if sortspec else (),
+                                  indices=np.flatnonzero(mask))
+
+    except (ValueError, TypeError) as e:
+
+        LOGERROR('could not derive a new dataset from setid: %s, '
+                 'sortspec: %r, filterspec: %r: %s' %
+                 (setid, sortspec, filterspec, e))
+        return None
+
+    rows = [rows[x] for x in indices]
+    rows = results_limit_rows(rows,
+                              incoming_userid=incoming_userid,
+                              incoming_role=incoming_role)
+
+    new_setid, creationdt = sqlite_prepare_dataset(
+        basedir,
+        dataset_owner=incoming_userid,
+        dataset_visibility=dataset_visibility,
+        dataset_sharedwith=dataset_sharedwith
+    )
+
+    if rows_per_page is None:
+        rows_per_page = parent['rows_per_page']
+
+    npages = len(rows) // rows_per_page
+    if len(rows) % rows_per_page:
+        npages = npages + 1
+
+    page_slices = [[x*rows_per_page, x*rows_per_page+rows_per_page]
+                   for x in range(npages)]
+
+    searchargs = parent['searchargs'].copy()
+    searchargs['derived_from'] = setid
+    searchargs['sortspec'] = sortspec
+    searchargs['filterspec'] = filterspec
+    searchargs['visibility'] = dataset_visibility
+    searchargs['sharedwith'] = dataset_sharedwith
+
+    nmatches = {x:0 for x in parent['collections']}
+    for x in rows:
+        nmatches[x['collection']] = nmatches.get(x['collection'], 0) + 1
+
+    dataset_fname = 'dataset-%s.pkl.gz' % new_setid
+    new_dataset_fpath = os.path.join(datasetdir, dataset_fname)
+
+    dataset = {
+        'setid': new_setid,
+        'name': 'New dataset derived from dataset: %s' % setid,
+        'desc': ('Created at %s UTC, from dataset: %s, using sort: %r, '
+                 'filters: %r' % (creationdt, setid, sortspec, filterspec)),
+        'citation': None,
+        'created': creationdt,
+        'updated': datetime.utcnow().isoformat(),
+        'owner': incoming_userid,
+        'visibility': dataset_visibility,
+        'sharedwith': dataset_sharedwith,
+        'searchtype': parent['searchtype'],
+        'searchargs': searchargs,
+        'collections': parent['collections'],
+        'lcmagcols': parent['lcmagcols'],
+        'lcformatdescs': parent['lcformatdescs'],
+        'coll_dirs': parent['coll_dirs'],
+        'npages': npages,
+        'rows_per_page': rows_per_page,
+        'page_slices': page_slices,
+        'nmatches_by_collection': nmatches,
+        'total_nmatches': len(rows),
+        'actual_nrows': len(rows),
+        'columns': columns,
+        'coldesc': parent['coldesc'],
+        'dataset_csv': new_dataset_fpath.replace('.pkl.gz','.csv'),
+        'dataset_pickle': new_dataset_fpath,
+        'lczipfpath': os.path.join(productdir,
+                                   'lightcurves-%s.zip' % new_setid),
+        'result': rows,
+    }
+
+    # the rows already have their LC filenames pointing to the CSV LCs made
+    # for the original dataset, so we don't collect LCs here
+    _write_dataset_products(
+        basedir,
+        dataset,
+        incoming_session_token=incoming_session_token,
+        render_first_page=render_first_page,
+        collect_lcs=False
+    )
+
+    # the CSV LCs already exist, so their paths stand in for the original LCs
+    # and conversion will be skipped for them
+    csvlcs_to_generate = []
+    for x, csvlc_path in zip(rows, dataset_csvlc_paths(basedir, rows)):
+
+        csvlcs_to_generate.append(
+            (csvlc_path,
+             x['db_oid'],
+             parent['lcformatdescs'][x['collection']],
+             x['collection'],
+             csvlc_path)
+        )
+
+    LOGINFO('derived dataset: %s with %s rows from dataset: %s' %
+            (new_setid, len(rows), setid))
+
+    return (
+        new_setid,
+        csvlcs_to_generate,
+        sorted(x[0] for x in csvlcs_to_generate),
+        len(rows),
+        npages
+    )
+
+
+############################################
+## FUNCTIONS THAT DEAL WITH LC COLLECTION ##
+############################################
+
+# this caches the parsed LC format descriptions in each conversion worker
+# process, keyed by the format description JSON's path. the parsed description
+# includes the imported LC reader and normalization functions.
+_LCFORMAT_CACHE = {}
+
+
+def get_cached_lcformat_description(formatjson):
+    '''This returns the parsed LC format description for formatjson.
+
+    The description is only parsed again if the format description JSON file
+    has been modified since it was cached.
+
+    '''
+
+    formatjson_mtime = os.stat(formatjson).st_mtime
+    cached = _LCFORMAT_CACHE.get(formatjson)
+
+    if cached is not None and cached[0] == formatjson_mtime:
+        return cached[1]
+
+    formatdict = abcat.get_lcformat_description(formatjson)
+    _LCFORMAT_CACHE[formatjson] = (formatjson_mtime, formatdict)
+
+    return formatdict
+
+
+def csvlc_convert_worker(task):
+    '''
+    This is a worker for the function below.
+
+    '''
+
+    lcfile, objectid, formatjson, convertin_opts = task
+    convertopts = convertin_opts.copy()
+
+    try:
+        formatdict = get_cached_lcformat_description(formatjson)
+    except Exception:
+        LOGEXCEPTION('could not read LC format description: %s' % formatjson)
+        return '%s conversion to CSVLC failed' % os.path.basename(lcfile)
+
+    try:
+        csvlc = abcat.convert_to_csvlc(lcfile,
+                                       objectid,
+                                       formatdict,
+                                       **convertopts)
+        LOGINFO('converted %s -> %s ok' % (lcfile, csvlc))
+        return csvlc
+
+    except Exception:
+
+        return '%s conversion to CSVLC failed' % os.path.basename(lcfile)
+
+
+def csvlc_convert_batch(tasks):
+    '''This converts a batch of LCs in a single worker process.
+
+    tasks is a list of csvlc_convert_worker tasks. Returns the list of their
+    results.
+
+    '''
+
+    return [csvlc_convert_worker(x) for x in tasks]
+
+
+def link_converted_csvlcs(dataset_csvlcs_to_generate, results):
+    '''This symlinks the converted CSV LCs to their dataset output paths.
+
+    results is the list of outputs from csvlc_convert_worker for each item in
+    dataset_csvlcs_to_generate.
+
+    '''
+
+    for item, res in zip(dataset_csvlcs_to_generate, results):
+
+        orig, oid, lcformatdesc, coll, outcsvlc = item
+        if not os.path.exists(outcsvlc) and os.path.exists(res):
+            try:
+                os.makedirs(os.path.dirname(outcsvlc), exist_ok=True)
+                if os.path.lexists(outcsvlc):
+                    os.remove(outcsvlc)
+                os.symlink(os.path.abspath(res), outcsvlc)
+            except Exception:
+                LOGEXCEPTION(
+                    'could not symlink %s -> %s' % (
+                        os.path.abspath(res),
+                        outcsvlc
+                    )
+                )
+
+
+def generate_lczip_cachekey(lczip_lclist):
+    '''
+    This generates the cache key for an LCZIP based on its LC list.
+
+    '''
+
+    sorted_lclist_json = json.dumps(lczip_lclist)
+    cachekey = hashlib.sha256(sorted_lclist_json.encode()).hexdigest()
+
+    return cachekey
+
+
+def lczip_archive_name(lcf):
+    '''This returns the name of a CSV LC in an LC ZIP.
+
+    This is '<collection dir>-<CSV LC filename>'.
+
+    '''
+
+    lcf_collname = os.path.split(os.path.dirname(lcf))[-1]
+    lcf_archivename = os.path.basename(lcf)
+
+    return '%s-%s' % (lcf_collname, lcf_archivename)
+
+
+class _ZipStreamBuffer(object):
+    '''
+    This is a write-only file-like object that holds bytes until drained.
+
+    '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class LCZipStream(object):
+    '''This writes an LC ZIP as a stream of bytes instead of to a file.
+
+    The CSV LCs are gzipped already, so they're stored in the archive without
+    compressing them again. Each method returns or yields the bytes of the
+    archive that are ready to be sent. The archive has the same members and
+    manifest as one written by write_dataset_lczip.
+
+    '''
+
+    def __init__(self, chunksize=1048576):
+        '''
+        This starts a new archive.
+
+        '''
+
+        self.chunksize = chunksize
+        self.buffer = _ZipStreamBuffer()
+        self.zipf = ZipFile(self.buffer,
+                            'w',
+                            compression=ZIP_STORED,
+                            allowZip64=True)
+        self.manifest = []
+
+    def add_lc(self, lcf):
+        '''This adds a CSV LC to the archive.
+
+        Yields the bytes of the archive member as it's read from disk.
+
+        '''
+
+        zinfo = _lczip_member_info(lcf)
+
+        with open(lcf,'rb') as infd, self.zipf.open(zinfo, 'w') as outfd:
+
+            while True:
+
+                chunk = infd.read(self.chunksize)
+                if not chunk:
+                    break
+
+                outfd.write(chunk)
+                yield self.buffer.drain()
+
+        self.manifest.append(lcf)
+        yield self.buffer.drain()
+
+    def add_missing(self, lcf):
+        '''
+        This notes a CSV LC that couldn't be added in the archive's manifest.
+
+        '''
+
+        self.manifest.append('%s missing' % os.path.basename(lcf))
+
+    def close(self):
+        '''This adds the manifest and finishes the archive.
+
+        Returns the last bytes of the archive.
+
+        '''
+
+        self.zipf.writestr(
+            'lczip-manifest.json',
+            json.dumps(
+                [os.path.basename(x) for x in self.manifest],
+                ensure_ascii=True,
+                indent=2
+            )
+        )
+        self.zipf.close()
+
+        return self.buffer.drain()
+
+
+# this is the size of the reads and writes used to copy CSV LCs into LC ZIPs
+LCZIP_COPY_CHUNKSIZE = 4194304
+
+# this is the number of threads used to write members into LC ZIPs
+LCZIP_WRITER_THREADS = 4
+
+
+def _lczip_member_info(lcf, srcf=None):
+    '''This returns a ZipInfo for a CSV LC stored as-is in an LC ZIP.
+
+    The CSV LCs are gzipped already, so they're always stored without
+    compressing them again. If srcf is given, the member's data is read from
+    there instead of from lcf, but it's still named after lcf.
+
+    '''
+
+    zinfo = ZipInfo.from_file(srcf if srcf is not None else lcf,
+                              arcname=lczip_archive_name(lcf))
+    zinfo.compress_type = ZIP_STORED
+    zinfo.compress_size = zinfo.file_size
+    zinfo.CRC = 0
+
+    return zinfo
+
+
+def _copy_lczip_member_data(outfd, srcf, data_offset, nbytes, chunksize):
+    '''This copies a CSV LC whose CRC is already known into an LC ZIP.
+
+    This uses os.copy_file_range where possible so the data doesn't have to
+    pass through this process.
+
+    '''
+
+    with open(srcf,'rb') as infd:
+
+        src_offset = 0
+
+        if hasattr(os, 'copy_file_range'):
+
+            try:
+                while src_offset < nbytes:
+                    ncopied = os.copy_file_range(
+                        infd.fileno(), outfd,
+                        min(chunksize, nbytes - src_offset),
+                        src_offset, data_offset + src_offset
+                    )
+                    if ncopied == 0:
+                        break
+                    src_offset += ncopied
+            except OSError:
+                pass
+
+        while src_offset < nbytes:
+            chunk = os.pread(infd.fileno(), chunksize, src_offset)
+            if not chunk:
+                break
+            os.pwrite(outfd, chunk, data_offset + src_offset)
+            src_offset += len(chunk)
+
+    return src_offset
+
+
+def _write_lczip_member(outfd, member, zinfo, header_nbytes, chunksize):
+    '''This copies a CSV LC into its place in an LC ZIP being built.
+
+    member is a tuple of (LC path, source path, CRC or None). The member's
+    data is written after its local header at zinfo.header_offset, then the
+    header is written once the CRC is known. This uses os.pwrite, so members
+    can be written from several threads at once.
+
+    '''
+
+    lcf, srcf, crc = member
+    data_offset = zinfo.header_offset + header_nbytes
+
+    if crc is not None:
+
+        nwritten = _copy_lczip_member_data(outfd,
+                                           srcf,
+                                           data_offset,
+                                           zinfo.file_size,
+                                           chunksize)
+
+    else:
+
+        crc = 0
+        nwritten = 0
+
+        with open(srcf,'rb') as infd:
+
+            while True:
+
+                chunk = infd.read(chunksize)
+                if not chunk:
+                    break
+
+                crc = zlib.crc32(chunk, crc)
+                os.pwrite(outfd, chunk, data_offset + nwritten)
+                nwritten += len(chunk)
+
+    if nwritten != zinfo.file_size:
+        raise IOError('CSV LC: %s changed size while it was being '
+                      'added to the LC ZIP' % srcf)
+
+    zinfo.CRC = crc
+    os.pwrite(outfd, zinfo.FileHeader(), zinfo.header_offset)
+
+
+def _write_lczip_parallel(outfpath, members, nthreads, chunksize):
+    '''This writes the members of an LC ZIP to outfpath from several threads.
+
+    members is a list of (LC path, source path, CRC or None) tuples. All
+    members are stored, so their sizes are known up front. This lays out the
+    archive first, then each thread copies whole members into their
+    places. Returns the list of ZipInfo for the members and the offset where
+    the members end.
+
+    '''
+
+    zinfos = []
+    offset = 0
+
+    for lcf, srcf, crc in members:
+        zinfo = _lczip_member_info(lcf, srcf=srcf)
+        zinfo.header_offset = offset
+        header_nbytes = len(zinfo.FileHeader())
+        zinfos.append((zinfo, header_nbytes))
+        offset += header_nbytes + zinfo.file_size
+
+    outfd = os.open(outfpath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    try:
+
+        os.ftruncate(outfd, offset)
+
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+
+            futures = [
+                pool.submit(_write_lczip_member,
+                            outfd, member, zinfo, header_nbytes, chunksize)
+                for member, (zinfo, header_nbytes) in zip(members, zinfos)
+            ]
+
+            # raise the first error if any
+            for future in futures:
+                future.result()
+
+    finally:
+        os.close(outfd)
+
+    return [x[0] for x in zinfos], offset
+
+
+def write_dataset_lczip(lczip_fpath,
+                        zipfile_lclist,
+                        nthreads=LCZIP_WRITER_THREADS,
+                        chunksize=LCZIP_COPY_CHUNKSIZE,
+                        member_sources=None):
+    '''This writes the CSV LCs in zipfile_lclist to an LC ZIP file.
+
+    Each LC is put into the archive as '<collection dir>-<CSV LC filename>'. A
+    manifest of the LCs is added as lczip-manifest.json, with missing LCs noted
+    as '<CSV LC filename> missing'.
+
+    The LCs are gzipped already, so they're stored in the archive as-is and
+    copied in chunksize pieces. If nthreads > 1, the members are written by
+    that many threads at once.
+
+    member_sources is an optional dict of LC path -> (source path, CRC) for LCs
+    whose contents should be read from somewhere else, e.g. the LC bundle
+    cache. Their CRCs aren't calculated again.
+
+    Returns the manifest list.
+
+    '''
+
+    if member_sources is None:
+        member_sources = {}
+
+    manifest = list(zipfile_lclist)
+    members = []
+
+    for ind_lcf, lcf in enumerate(manifest):
+
+        srcf, crc = member_sources.get(lcf, (lcf, None))
+
+        if os.path.exists(srcf):
+            members.append((lcf, srcf, crc))
+        else:
+            manifest[ind_lcf] = (
+                '%s missing' % (os.path.basename(lcf))
+            )
+
+    manifest_json = json.dumps(
+        [os.path.basename(x) for x in manifest],
+        ensure_ascii=True,
+        indent=2
+    )
+
+    if nthreads > 1 and len(members) > 1:
+
+        zinfos, members_end = _write_lczip_parallel(lczip_fpath,
+                                                    members,
+                                                    nthreads,
+                                                    chunksize)
+
+        # add the manifest and the central directory after the members
+        with open(lczip_fpath,'r+b') as outfd:
+
+            outfd.seek(members_end)
+
+            with ZipFile(outfd, 'w', allowZip64=True) as outzip:
+                for zinfo in zinfos:
+                    outzip.filelist.append(zinfo)
+                    outzip.NameToInfo[zinfo.filename] = zinfo
+                outzip.writestr('lczip-manifest.json', manifest_json)
+
+    else:
+
+        with ZipFile(lczip_fpath, 'w', allowZip64=True) as outzip:
+
+            for lcf, srcf, crc in members:
+
+                with open(srcf,'rb') as infd, outzip.open(
+                        _lczip_member_info(lcf, srcf=srcf), 'w'
+                ) as outfd:
+                    shutil.copyfileobj(infd, outfd, chunksize)
+
+            outzip.writestr('lczip-manifest.json', manifest_json)
+
+    return manifest
+
+
+def dataset_csvlc_paths(basedir, rows):
+    '''This returns the paths to the CSV LCs for the dataset rows.
+
+    These are under basedir/csvlcs/<collection dir>/<db_oid>-csvlc.gz.
+
+    '''
+
+    return [
+        os.path.join(os.path.abspath(basedir),
+                     'csvlcs',
+                     x['collection'].replace('_','-'),
+                     '%s-csvlc.gz' % x['db_oid'])
+        for x in rows
+    ]
+
+
+#####################
+## LC BUNDLE CACHE ##
+#####################
+
+# this is the cache of converted CSV LCs shared by all datasets. each CSV LC
+# is stored once per collection in basedir/lcbundles/<collection dir> under
+# the SHA256 of its contents. the lcc_lcbundle_members table maps a
+# fingerprint of the original LC and the conversion options to the stored CSV
+# LC, so datasets that overlap with earlier ones only need to convert the LCs
+# that haven't been seen before.
+SQLITE_LCBUNDLE_CREATE = '''\
+create table if not exists lcc_lcbundle_members (
+  source_key text not null,
+  collection text not null,
+  db_oid text not null,
+  blob_sha256 text not null,
+  blob_crc32 integer not null,
+  blob_nbytes integer not null,
+  created datetime,
+  last_hit datetime,
+  primary key (source_key)
+);
+
+create index if not exists lcbundle_collection_idx on
+  lcc_lcbundle_members (collection);
+
+create table if not exists lcc_lcbundle_stats (
+  collection text not null,
+  hits integer default 0,
+  misses integer default 0,
+  primary key (collection)
+);
+'''
+
+
+def _lcbundle_tables(db):
+    '''
+    This makes sure the LC bundle cache tables exist in the datasets DB.
+
+    '''
+
+    db.executescript(SQLITE_LCBUNDLE_CREATE)
+    db.commit()
+
+
+def lcbundle_source_key(orig_lcf, lcformatdesc, convertopts):
+    '''This returns the LC bundle cache key for an original LC.
+
+    The key changes if the original LC is modified, or if it's converted with
+    a different format description or different conversion options.
+
+    Returns None if the original LC doesn't exist.
+
+    '''
+
+    try:
+        lcf_stat = os.stat(orig_lcf)
+    except OSError:
+        return None
+
+    keyopts = {x:convertopts[x] for x in sorted(convertopts)
+               if x != 'skip_converted'}
+
+    return hashlib.sha256(
+        json.dumps(
+            [os.path.realpath(orig_lcf),
+             lcf_stat.st_size,
+             lcf_stat.st_mtime_ns,
+             lcformatdesc,
+             keyopts],
+            sort_keys=True
+        ).encode()
+    ).hexdigest()
+
+
+def lcbundle_blob_path(basedir, collection, blob_sha256):
+    '''
+    This returns the path to a CSV LC stored in the LC bundle cache.
+
+    '''
+
+    return os.path.join(os.path.abspath(basedir),
+                        'lcbundles',
+                        collection.replace('_','-'),
+                        blob_sha256[:2],
+                        '%s-csvlc.gz' % blob_sha256)
+
+
+def _store_lcbundle_blob(basedir, collection, csvlc):
+    '''This adds a converted CSV LC to the LC bundle cache.
+
+    The cached CSV LC is a hard link to the converted one if they're on the
+    same filesystem, so the CSV LC isn't stored twice. Otherwise, it's a copy.
+    Converted CSV LCs are never modified in place (see
+    abcat.convert_to_csvlc), so converting an LC again doesn't change the
+    cached one.
+
+    Returns (SHA256, CRC32, nbytes) of the CSV LC.
+
+    '''
+
+    blob_dir = os.path.join(os.path.abspath(basedir),
+                            'lcbundles',
+                            collection.replace('_','-'))
+    os.makedirs(blob_dir, exist_ok=True)
+
+    tmp_fpath = os.path.join(blob_dir,
+                             'tmp-%s-csvlc.gz' % secrets.token_hex(8))
+
+    sha = hashlib.sha256()
+    crc = 0
+    nbytes = 0
+
+    try:
+
+        try:
+            os.link(csvlc, tmp_fpath)
+            linked = True
+        except OSError:
+            linked = False
+
+        # the checksums are taken from the linked file, so they match it even
+        # if the converted CSV LC is replaced in the meantime
+        with open(tmp_fpath if linked else csvlc,'rb') as infd:
+
+            outfd = None if linked else open(tmp_fpath,'wb')
+
+            try:
+
+                while True:
+
+                    chunk = infd.read(LCZIP_COPY_CHUNKSIZE)
+                    if not chunk:
+                        break
+
+                    sha.update(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    nbytes += len(chunk)
+                    if outfd is not None:
+                        outfd.write(chunk)
+
+            finally:
+                if outfd is not None:
+                    outfd.close()
+
+        blob_sha256 = sha.hexdigest()
+        blob_fpath = lcbundle_blob_path(basedir, collection, blob_sha256)
+        os.makedirs(os.path.dirname(blob_fpath), exist_ok=True)
+
+        # identical CSV LCs end up in the same place, so this is safe even if
+        # the blob already exists
+        os.replace(tmp_fpath, blob_fpath)
+
+    finally:
+
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+
+    return blob_sha256, crc, nbytes
+
+
+def sqlite_lcbundle_lookup(basedir, dataset_csvlcs_to_generate, convertopts):
+    '''This looks up the LCs in dataset_csvlcs_to_generate in the bundle cache.
+
+    Returns a list of the same length with the path to the cached CSV LC for
+    each LC found in the cache and None for the others. The cache hits and
+    misses are added to the per-collection counts.
+
+    '''
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    _lcbundle_tables(db)
+    cur = db.cursor()
+
+    cached = []
+    hit_keys = []
+    collstats = {}
+
+    for orig, oid, lcformatdesc, coll, outcsvlc in dataset_csvlcs_to_generate:
+
+        source_key = lcbundle_source_key(orig, lcformatdesc, convertopts)
+        blob_fpath = None
+
+        if source_key is not None:
+
+            cur.execute("select collection, blob_sha256 "
+                        "from lcc_lcbundle_members where source_key = ?",
+                        (source_key,))
+            row = cur.fetchone()
+
+            if row:
+                blob_fpath = lcbundle_blob_path(basedir, row[0], row[1])
+                if not os.path.exists(blob_fpath):
+                    blob_fpath = None
+
+        if coll not in collstats:
+            collstats[coll] = [0, 0]
+
+        if blob_fpath is not None:
+            hit_keys.append((datetime.utcnow().isoformat(), source_key))
+            collstats[coll][0] += 1
+        else:
+            collstats[coll][1] += 1
+
+        cached.append(blob_fpath)
+
+    cur.executemany("update lcc_lcbundle_members set last_hit = ? "
+                    "where source_key = ?", hit_keys)
+
+    for coll, (nhits, nmisses) in collstats.items():
+        cur.execute("insert or ignore into lcc_lcbundle_stats "
+                    "(collection, hits, misses) values (?, 0, 0)",
+                    (coll,))
+        cur.execute("update lcc_lcbundle_stats set hits = hits + ?, "
+                    "misses = misses + ? where collection = ?",
+                    (nhits, nmisses, coll))
+
+    db.commit()
+    db.close()
+
+    if len(cached) > 0:
+        LOGINFO('LC bundle cache: %s of %s LCs found' %
+                (len(hit_keys), len(cached)))
+
+    return cached
+
+
+def lcbundle_merge_results(cached, converted):
+    '''This puts the results for the LCs that weren't cached into place.
+
+    cached is the output of sqlite_lcbundle_lookup and converted is the list
+    of conversion results for its None items, in order. Returns the list of
+    results for all LCs.
+
+    '''
+
+    converted = iter(converted)
+    return [x if x is not None else next(converted) for x in cached]
+
+
+def sqlite_lcbundle_store(basedir,
+                          dataset_csvlcs_to_generate,
+                          results,
+                          convertopts):
+    '''This adds the converted CSV LCs of a dataset to the LC bundle cache.
+
+    results is the list of conversion results (or cached CSV LC paths) for
+    each item in dataset_csvlcs_to_generate. Returns a list of the same length
+    with (cached CSV LC path, CRC32) for each LC in the cache and None for
+    LCs that couldn't be converted.
+
+    '''
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    _lcbundle_tables(db)
+    cur = db.cursor()
+
+    bundle_dir = os.path.join(os.path.abspath(basedir), 'lcbundles')
+    stored = []
+
+    for item, res in zip(dataset_csvlcs_to_generate, results):
+
+        orig, oid, lcformatdesc, coll, outcsvlc = item
+
+        if not os.path.exists(res):
+            stored.append(None)
+            continue
+
+        # this is already in the cache
+        if os.path.abspath(res).startswith(bundle_dir + os.sep):
+
+            blob_sha256 = os.path.basename(res).split('-')[0]
+            cur.execute("select blob_crc32 from lcc_lcbundle_members "
+                        "where blob_sha256 = ? limit 1",
+                        (blob_sha256,))
+            row = cur.fetchone()
+            stored.append((res, row[0]) if row else None)
+            continue
+
+        source_key = lcbundle_source_key(orig, lcformatdesc, convertopts)
+        if source_key is None:
+            stored.append(None)
+            continue
+
+        try:
+            blob_sha256, blob_crc32, blob_nbytes = _store_lcbundle_blob(
+                basedir, coll, res
+            )
+        except Exception:
+            LOGEXCEPTION('could not add CSV LC: %s to the LC bundle cache' %
+                         res)
+            stored.append(None)
+            continue
+
+        cur.execute(
+            "insert or replace into lcc_lcbundle_members "
+            "(source_key, collection, db_oid, blob_sha256, blob_crc32, "
+            "blob_nbytes, created, last_hit) values (?,?,?,?,?,?,?,?)",
+            (source_key, coll, oid, blob_sha256, blob_crc32, blob_nbytes,
+             datetime.utcnow().isoformat(), None)
+        )
+        stored.append((lcbundle_blob_path(basedir, coll, blob_sha256),
+                       blob_crc32))
+
+    db.commit()
+    db.close()
+
+    return stored
+
+
+def sqlite_lcbundle_stats(basedir):
+    '''This returns the size and hit ratio of the LC bundle cache.
+
+    Returns a dict of the form::
+
+        {'hits', 'misses', 'hit_ratio', 'nmembers', 'nbytes',
+         'by_collection':{collection:{'hits', 'misses', 'hit_ratio',
+                                      'nmembers', 'nbytes'}, ...}}
+
+    hit_ratio is None if there haven't been any lookups.
+
+    '''
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    _lcbundle_tables(db)
+    cur = db.cursor()
+
+    cur.execute("select collection, hits, misses from lcc_lcbundle_stats")
+    statrows = cur.fetchall()
+
+    # identical CSV LCs share a blob, so count each one once
+    cur.execute("select collection, count(*), sum(blob_nbytes) from "
+                "(select distinct collection, blob_sha256, blob_nbytes "
+                "from lcc_lcbundle_members) group by collection")
+    sizerows = cur.fetchall()
+    db.close()
+
+    def hit_ratio(hits, misses):
+        return hits/(hits + misses) if (hits + misses) > 0 else None
+
+    stats = {'hits':0,
+             'misses':0,
+             'nmembers':0,
+             'nbytes':0,
+             'by_collection':{}}
+
+    for coll, hits, misses in statrows:
+        stats['by_collection'][coll] = {'hits':hits,
+                                        'misses':misses,
+                                        'hit_ratio':hit_ratio(hits, misses),
+                                        'nmembers':0,
+                                        'nbytes':0}
+        stats['hits'] += hits
+        stats['misses'] += misses
+
+    for coll, nmembers, nbytes in sizerows:
+        if coll not in stats['by_collection']:
+            stats['by_collection'][coll] = {'hits':0,
+                                            'misses':0,
+                                            'hit_ratio':None,
+                                            'nmembers':0,
+                                            'nbytes':0}
+        stats['by_collection'][coll]['nmembers'] = nmembers
+        stats['by_collection'][coll]['nbytes'] = nbytes
+        stats['nmembers'] += nmembers
+        stats['nbytes'] += nbytes
+
+    stats['hit_ratio'] = hit_ratio(stats['hits'], stats['misses'])
+
+    return stats
+
+
+def bulk_csvlcs_to_generate(basedir, lookup):
+    '''This returns the LCs to convert for the objects in an object ID lookup.
+
+    lookup is the output of dbsearch.sqlite_objectid_lookup. Returns a list of
+    (original LC, db_oid, lcformatdesc, collection, CSV LC path) tuples like
+    the ones made for a dataset's LCs.
+
+    '''
+
+    csvlcs_to_generate = []
+    if lookup is None:
+        return csvlcs_to_generate
+
+    lcformatdescs = {x:lookup[x]['lcformatdesc'] for x in lookup['databases']
+                     if x in lookup}
+    all_original_lcs = []
+
+    for coll in lookup['databases']:
+        if coll in lookup:
+            for row in lookup[coll]['result']:
+                collect_dataset_row_lc(row,
+                                       basedir,
+                                       lcformatdescs,
+                                       all_original_lcs,
+                                       csvlcs_to_generate)
+
+    return csvlcs_to_generate
+
+
+def sqlite_bundle_converted_csvlcs(basedir,
+                                   csvlcs_to_generate,
+                                   results,
+                                   convertopts):
+    '''This adds converted CSV LCs to the bundle cache and links them in place.
+
+    This does the same thing for LCs converted outside of a dataset (e.g. for
+    the bulk LC API) as sqlite_make_dataset_lczip does for a dataset's LCs.
+
+    '''
+
+    bundled = sqlite_lcbundle_store(basedir,
+                                    csvlcs_to_generate,
+                                    results,
+                                    convertopts)
+    link_converted_csvlcs(csvlcs_to_generate, results)
+
+    return bundled
+
+
+def sqlite_make_dataset_lczip(basedir,
+                              setid,
+                              dataset_csvlcs_to_generate,
+                              dataset_all_original_lcs,
+                              converter_processes=4,
+                              converter_csvlc_version=1,
+                              converter_comment_char='#',
+                              converter_column_separator=',',
+                              converter_skip_converted=True,
+                              override_lcdir=None,
+                              force_collection=False,
+                              max_dataset_lcs=2500,
+                              converted_csvlcs=None):
+    '''
+    This makes a zip file for the light curves in the dataset.
+
+    If converted_csvlcs is provided, it's the list of results from converting
+    dataset_csvlcs_to_generate with csvlc_convert_worker elsewhere (e.g. by the
+    indexserver's shared LC conversion pool), with the paths from
+    sqlite_lcbundle_lookup for LCs found in the LC bundle cache. Otherwise, the
+    LCs not in the LC bundle cache are converted using a new pool of
+    converter_processes workers.
+
+    Newly converted LCs are added to the LC bundle cache and the LC ZIP is
+    assembled from the cached CSV LCs.
+
+    '''
+
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+
+    # look in the datasetdir for the dataset pickle
+    dataset_fpath = os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid)
+
+    if os.path.exists(dataset_fpath):
+
+        with gzip.open(dataset_fpath,'rb') as infd:
+            dataset = pickle.load(infd)
+
+        # 1. use the provided list of original LCs to generate a cache key.
+        dataset_lczip_cachekey = generate_lczip_cachekey(
+            dataset_all_original_lcs
+        )
+
+        # check the cachekey against the database to see if a dataset with
+        # identical LCs has already been collected
+        db = sqlite3.connect(
+            datasets_dbf,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+        )
+        cur = db.cursor()
+
+        # this will fetch the original set LC zip if there are multiple links to
+        # it for many datasets
+        cur.execute("select setid, lczip_cachekey from lcc_datasets where "
+                    "lczip_cachekey = ? order by last_updated asc limit 1",
+                    (dataset_lczip_cachekey,))
+
+        row = cur.fetchone()
+        db.close()
+
+        # if LCs corresponding to the ones included in this dataset are found in
+        # another dataset, then we'll symlink that dataset's LC ZIP to
+        # products/lightcurves-[this setid].zip, and call it a day
+        skip_lc_collection = False
+
+        if row and len(row) > 0:
+
+            other_setid, other_dataset_cachekey = row
+            other_lczip = os.path.join(basedir,
+                                       'products',
+                                       'lightcurves-%s.zip' % other_setid)
+
+            if os.path.exists(other_lczip):
+
+                # we'll remove the current dataset LC zip in favor of the other
+                # one every time
+                if os.path.exists(dataset['lczipfpath']):
+                    LOGWARNING('overwriting existing symlink %s, '
+                               'which points to actual file: %s' %
+                               (dataset['lczipfpath'],
+                                os.path.abspath(other_lczip)))
+                    os.remove(dataset['lczipfpath'])
+
+                os.symlink(os.path.abspath(other_lczip),
+                           dataset['lczipfpath'])
+                skip_lc_collection = True
+
+            else:
+
+                skip_lc_collection = False
+
+        # only collect LCs if we have to, we'll use the already generated link
+        # if we have the same LCs collected already somewhere else
+        if not skip_lc_collection or force_collection is True:
+
+            LOGINFO('no cached LC zip found for dataset: %s, regenerating...' %
+                    setid)
+
+            convertopts = {'csvlc_version':converter_csvlc_version,
                            'comment_char':converter_comment_char,
                            'column_separator':converter_column_separator,
                            'skip_converted':converter_skip_converted}
 
-            # these are the light curves to regenerate
-            tasks = [(x[0], x[1], x[2], convertopts)
-                     for x in dataset_csvlcs_to_generate]
+            if converted_csvlcs is not None:
+
+                results = converted_csvlcs
+
+            else:
+
+                # these are the light curves to regenerate, skipping any
+                # already in the LC bundle cache
+                cached = sqlite_lcbundle_lookup(basedir,
+                                                dataset_csvlcs_to_generate,
+                                                convertopts)
+                tasks = [(x[0], x[1], x[2], convertopts)
+                         for x, c in zip(dataset_csvlcs_to_generate, cached)
+                         if c is None]
+
+                # now, we'll convert these light curves in parallel
+                if len(tasks) > 0:
+                    pool = Pool(converter_processes)
+                    converted = pool.map(csvlc_convert_worker, tasks)
+                    pool.close()
+                    pool.join()
+                else:
+                    converted = []
+
+                results = lcbundle_merge_results(cached, converted)
+
+            #
+            # add the newly converted CSV LCs to the LC bundle cache
+            #
+            bundled = sqlite_lcbundle_store(basedir,
+                                            dataset_csvlcs_to_generate,
+                                            results,
+                                            convertopts)
+
+            #
+            # link the generated CSV LCs to the output directory
+            #
+            link_converted_csvlcs(dataset_csvlcs_to_generate, results)
+
+            #
+            # FINALLY, CARRY OUT THE ZIP OPERATION (IF NEEDED)
+            #
+            zipfile_lclist = (
+                [x[-1] for x in dataset_csvlcs_to_generate]
+            )
+
+            # do not generate LCs if their number > max number allowed
+            if len(zipfile_lclist) > max_dataset_lcs:
+
+                LOGERROR('LCs in dataset: %s > max_dataset_lcs: %s, '
+                         ' will not generate a ZIP file.' %
+                         (len(zipfile_lclist), max_dataset_lcs))
+
+                lczip_generated = False
+
+            else:
+
+                # get the expected name of the output zipfile
+                lczip_fpath = dataset['lczipfpath']
+
+                LOGINFO('writing %s LC files to zip file: %s for setid: %s...' %
+                        (len(zipfile_lclist), lczip_fpath, setid))
+
+                # the ZIP is put together from the LC bundle cache, which
+                # already has the CRCs of the CSV LCs
+                member_sources = {
+                    x[-1]:y for x, y in zip(dataset_csvlcs_to_generate,
+                                            bundled)
+                    if y is not None
+                }
+                write_dataset_lczip(lczip_fpath,
+                                    zipfile_lclist,
+                                    member_sources=member_sources)
+
+                LOGINFO('done, zip written successfully.')
+                lczip_generated = True
+
+        # if we don't need to collect LCs, then we can just re-use the other
+        # dataset's LC ZIP
+        else:
+
+            LOGINFO("re-using identical LC collected "
+                    "ZIP from dataset: %s at %s, "
+                    "symlinked to this dataset's LC ZIP: %s" %
+                    (other_setid, other_lczip, dataset['lczipfpath']))
+            lczip_generated = True
+
+        #
+        # done with collecting light curves
+        #
+
+        # generate the entry in the lcc-datasets.sqlite table and commit it
+        # once we get to this point, the dataset is finally considered complete
+        db = sqlite3.connect(
+            datasets_dbf,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+        )
+        cur = db.cursor()
+
+        query = ("update lcc_datasets set status = ?, "
+                 "last_updated = ?, lczip_cachekey = ? where setid = ?")
+
+        params = ('complete',
+                  datetime.utcnow().isoformat(),
+                  dataset_lczip_cachekey,
+                  setid)
+        cur.execute(query, params)
+        db.commit()
+        db.close()
+
+        # update the dataset pickle and dataset header pickle with the LC zip
+        # information and the fact that all LCs have been collected.
+
+        # update the header pickle
+        dataset_header_pkl = os.path.join(datasetdir,
+                                          'dataset-%s-header.pkl' % setid)
+
+        with open(dataset_header_pkl,'rb') as infd:
+            setheader = pickle.load(infd)
+
+        setheader['updated'] = datetime.utcnow().isoformat()
+
+        with open(dataset_header_pkl,'wb') as outfd:
+            pickle.dump(setheader, outfd, pickle.HIGHEST_PROTOCOL)
+
+        # update the full dataset pickle
+        dataset['updated'] = datetime.utcnow().isoformat()
+
+        with gzip.open(dataset_fpath,'wb') as outfd:
+            pickle.dump(dataset, outfd, pickle.HIGHEST_PROTOCOL)
+
+        LOGINFO('updated entry for setid: %s with LC zip cachekey' % setid)
+
+        # record the disk usage of the completed dataset
+        sqlite_update_dataset_usage(basedir, setid)
+
+        return dataset['lczipfpath'], lczip_generated
+
+    else:
+
+        LOGERROR('setid: %s, dataset pickle expected at %s does not exist!' %
+                 (setid, dataset_fpath))
+        return None, False
+
+
+#########################
+## REFRESHING DATASETS ##
+#########################
+
+# these are the search functions that can be re-run to refresh a dataset
+DATASET_SEARCH_FUNCTIONS = {
+    'sqlite_column_search':dbsearch.sqlite_column_search,
+    'sqlite_fulltext_search':dbsearch.sqlite_fulltext_search,
+    'sqlite_kdtree_conesearch':dbsearch.sqlite_kdtree_conesearch,
+    'sqlite_xmatch_search':dbsearch.sqlite_xmatch_search,
+}
+
+# these columns are added to every search result by the search functions, so
+# they're not passed back to them in getcolumns
+DATASET_SEARCH_EXTRA_COLUMNS = ('collection',
+                                'db_oid',
+                                'db_ra',
+                                'db_decl',
+                                'db_lcfname',
+                                'owner',
+                                'visibility',
+                                'sharedwith')
+
+
+def _parse_datetime(dtval):
+    '''This parses the ISO datetimes in the dataset pickles and DBs.
+
+    These may be datetime instances or strings with a 'T' or ' ' separator.
+
+    '''
+
+    if isinstance(dtval, datetime):
+        return dtval
+
+    dtval = str(dtval).strip().replace('T',' ').rstrip('Z')
+    if '.' in dtval:
+        return datetime.strptime(dtval, '%Y-%m-%d %H:%M:%S.%f')
+    else:
+        return datetime.strptime(dtval, '%Y-%m-%d %H:%M:%S')
+
+
+def sqlite_changed_dataset_collections(basedir, dataset):
+    '''This returns the dataset's collections updated since the dataset was.
+
+    Compares the last_updated time of each of the dataset's collections in the
+    lcc-index.sqlite DB with the dataset's 'updated' time.
+
+    '''
+
+    dataset_updated = _parse_datetime(dataset['updated'])
+
+    indexdbf = os.path.join(basedir, 'lcc-index.sqlite')
+    db = sqlite3.connect(
+        indexdbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    cur = db.cursor()
+    cur.execute(
+        "select replace(collection_id,'-','_'), last_updated from lcc_index "
+        "where replace(collection_id,'-','_') in (%s)" %
+        ','.join('?' for x in dataset['collections']),
+        tuple(dataset['collections'])
+    )
+    rows = cur.fetchall()
+    db.close()
+
+    coll_updated = {x[0]:x[1] for x in rows}
+    changed = []
+
+    for coll in dataset['collections']:
+
+        if coll not in coll_updated:
+            LOGWARNING('collection: %s in dataset: %s is no longer in the '
+                       'LCC index, its rows will be left as they are' %
+                       (coll, dataset['setid']))
+        elif (coll_updated[coll] is not None and
+              _parse_datetime(coll_updated[coll]) > dataset_updated):
+            changed.append(coll)
+
+    return changed
+
+
+def sqlite_refresh_dataset(basedir,
+                           setid,
+                           incoming_userid=2,
+                           incoming_role='anonymous',
+                           incoming_session_token=None,
+                           render_first_page=True):
+    '''This refreshes a dataset after some of its collections are updated.
+
+    The dataset's stored searchtype and searchargs are run again, but only
+    against the collections that have been updated since the dataset was (see
+    sqlite_changed_dataset_collections). The rows from these collections are
+    replaced by the new search results, and rows from other collections are
+    kept as they are. If the dataset was made with a samplespec, only the new
+    rows are sampled, to the part of the sample that isn't taken up by the kept
+    rows. If the dataset was derived from another one with a filterspec (see
+    sqlite_derive_dataset), only the new rows that pass its filters are
+    kept. The dataset's sortspec and limitspec are then applied again to all of
+    the rows.
+
+    The search is run as the dataset's owner, so only the dataset's owner can
+    refresh it. Otherwise, a staff member or superuser refreshing someone
+    else's dataset would add the objects only they can see to it.
+
+    Like sqlite_edit_dataset, this needs 'edit' access to a complete dataset
+    and anonymous users can't refresh datasets.
+
+    Returns a tuple:
+
+    (setid, csvlcs_to_generate, refreshed_collections, actual_nrows, npages)
+
+    where csvlcs_to_generate only contains the LCs from the refreshed
+    collections. Pass this and refreshed_collections to
+    sqlite_refresh_dataset_lczip to finish the refresh. If no collections need
+    refreshing, the dataset isn't changed and refreshed_collections is
+    empty. Returns None if the dataset can't be refreshed.
+
+    '''
+
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+    dataset_fpath = os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid)
+
+    if not os.path.exists(dataset_fpath):
+        LOGERROR('could not find dataset with setid: %s' % setid)
+        return None
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    db.row_factory = sqlite3.Row
+    cur = db.cursor()
+    cur.execute("select status, dataset_owner, dataset_sessiontoken "
+                "from lcc_datasets where setid = ?", (setid,))
+    row = cur.fetchone()
+
+    dataset_editable = sqlite_check_dataset_access(
+        setid,
+        'edit',
+        incoming_userid=incoming_userid,
+        incoming_role=incoming_role,
+        database=db
+    )
+    db.close()
+
+    if not row or row['status'] != 'complete':
+        LOGERROR('dataset %s is not complete, it cannot be refreshed' % setid)
+        return None
+
+    if (not dataset_editable or
+        incoming_role == 'anonymous' or
+        incoming_userid != row['dataset_owner']):
+        LOGERROR('dataset %s is not refreshable by user_id = %s, role = %s'
+                 % (setid, incoming_userid, incoming_role))
+        return None
+
+    with gzip.open(dataset_fpath,'rb') as infd:
+        dataset = pickle.load(infd)
+
+    searchfunc = DATASET_SEARCH_FUNCTIONS.get(dataset['searchtype'], None)
+    if searchfunc is None:
+        LOGERROR('dataset %s was made by search: %s, which cannot be re-run' %
+                 (setid, dataset['searchtype']))
+        return None
+
+    searchargs = dataset['searchargs']
+    if 'redacted' in searchargs.values():
+        LOGERROR('the search arguments for dataset %s were redacted, '
+                 'it cannot be refreshed' % setid)
+        return None
+
+    refreshed_collections = sqlite_changed_dataset_collections(basedir,
+                                                               dataset)
+
+    if len(refreshed_collections) == 0:
+        LOGINFO('none of the collections in dataset %s have been updated '
+                'since %s, not refreshing' % (setid, dataset['updated']))
+        return setid, [], [], dataset['actual_nrows'], dataset['npages']
+
+    LOGINFO('refreshing rows from collections: %s in dataset: %s' %
+            (refreshed_collections, setid))
+
+    #
+    # run the search again against the updated collections
+    #
+    funcparams = signature(searchfunc).parameters
+    searchkwargs = {
+        k:searchargs[k] for k in searchargs
+        if (k in funcparams and
+            k not in ('basedir','getcolumns','lcclist'))
+    }
+    searchkwargs['getcolumns'] = [
+        x for x in searchargs['getcolumns']
+        if x not in DATASET_SEARCH_EXTRA_COLUMNS
+    ]
+    searchkwargs['lcclist'] = refreshed_collections
+
+    # this is the dataset's owner, checked above
+    searchkwargs['incoming_userid'] = incoming_userid
+    searchkwargs['incoming_role'] = incoming_role
+
+    searchresult = searchfunc(basedir, **searchkwargs)
+
+    if searchresult is None:
+        LOGERROR('search: %s failed for the updated collections: %s '
+                 'in dataset: %s' %
+                 (dataset['searchtype'], refreshed_collections, setid))
+        return None
+
+    #
+    # merge the new rows with the rows from the other collections
+    #
+    rows = [x for x in dataset['result']
+            if x['collection'] not in refreshed_collections]
+
+    nmatches = dataset['nmatches_by_collection'].copy()
+    newrows_by_collection = {}
+
+    for coll in refreshed_collections:
+
+        if coll in searchresult['databases']:
+
+            # the collection may have lost some columns when it was updated
+            newrows = searchresult[coll]['result']
+            for x in newrows:
+                for c in dataset['columns']:
+                    x.setdefault(c, None)
+
+            newrows_by_collection[coll] = newrows
+            nmatches[coll] = searchresult[coll]['nmatches']
+
+        else:
+            nmatches[coll] = 0
+
+    # the kept rows are already part of the sample, so the rest of the sample
+    # is split between the refreshed collections by their number of new rows
+    samplespec = searchargs.get('samplespec', None)
+    if samplespec is not None:
+
+        nremaining = max(samplespec - len(rows), 0)
+        nnew = sum(len(x) for x in newrows_by_collection.values())
+
+        for coll, newrows in newrows_by_collection.items():
+
+            sample_count = (
+                int(round(nremaining*len(newrows)/nnew)) if nnew > 0 else 0
+            )
+            if sample_count > 0:
+                newrows_by_collection[coll] = results_random_sample(
+                    newrows,
+                    sample_count=sample_count
+                )
+            else:
+                newrows_by_collection[coll] = []
+
+    # a derived dataset only has the rows that pass its filters
+    filterspec = searchargs.get('filterspec', None)
+    if filterspec:
+
+        for coll, newrows in newrows_by_collection.items():
+
+            try:
+                mask = results_filter_mask(
+                    dataset_to_arrays({'columns':dataset['columns'],
+                                       'coldesc':dataset['coldesc'],
+                                       'result':newrows}),
+                    results_null_masks(newrows, dataset['columns']),
+                    filters=filterspec
+                )
+            except (ValueError, TypeError) as e:
+                LOGERROR('could not apply filterspec: %r to the new rows '
+                         'from collection: %s in dataset: %s: %s' %
+                         (filterspec, coll, setid, e))
+                return None
+
+            newrows_by_collection[coll] = [
+                newrows[x] for x in np.flatnonzero(mask)
+            ]
+
+    for coll in refreshed_collections:
+        rows.extend(newrows_by_collection.get(coll, []))
+
+    # apply the rest of the result pipeline again
+    if isinstance(searchargs.get('sortspec', None), (tuple, list)):
+        rows = results_sort_by_keys(rows,
+                                    dataset['coldesc'],
+                                    sorts=searchargs['sortspec'])
+
+    rows = results_limit_rows(rows,
+                              rowlimit=searchargs.get('limitspec', None),
+                              incoming_userid=incoming_userid,
+                              incoming_role=incoming_role)
+
+    # collect the LCs of the new rows only, the others have been converted
+    all_original_lcs = []
+    csvlcs_to_generate = []
+    for x in rows:
+        if x['collection'] in refreshed_collections:
+            collect_dataset_row_lc(x,
+                                   basedir,
+                                   dataset['lcformatdescs'],
+                                   all_original_lcs,
+                                   csvlcs_to_generate)
+
+    rows_per_page = dataset['rows_per_page']
+    npages = len(rows) // rows_per_page
+    if len(rows) % rows_per_page:
+        npages = npages + 1
+
+    dataset['npages'] = npages
+    dataset['page_slices'] = [[x*rows_per_page, x*rows_per_page+rows_per_page]
+                              for x in range(npages)]
+    dataset['nmatches_by_collection'] = nmatches
+    dataset['total_nmatches'] = sum(nmatches.values())
+    dataset['actual_nrows'] = len(rows)
+    dataset['updated'] = datetime.utcnow().isoformat()
+    dataset['result'] = rows
+
+    # remove the old rendered pages. these will be regenerated on demand.
+    page_prefix = 'dataset-%s-rows-page' % setid
+    for pagef in os.listdir(datasetdir):
+        if pagef.startswith(page_prefix):
+            os.remove(os.path.join(datasetdir, pagef))
+
+    _write_dataset_products(
+        basedir,
+        dataset,
+        incoming_session_token=row['dataset_sessiontoken'],
+        render_first_page=render_first_page,
+        collect_lcs=False
+    )
+
+    LOGINFO('refreshed dataset: %s, now has %s rows' % (setid, len(rows)))
+
+    return (
+        setid,
+        csvlcs_to_generate,
+        refreshed_collections,
+        len(rows),
+        npages
+    )
+
+
+def sqlite_refresh_dataset_lczip(basedir,
+                                 setid,
+                                 dataset_csvlcs_to_generate,
+                                 refreshed_collections,
+                                 converter_processes=4,
+                                 converter_csvlc_version=1,
+                                 converter_comment_char='#',
+                                 converter_column_separator=',',
+                                 max_dataset_lcs=2500,
+                                 converted_csvlcs=None):
+    '''This updates the LC ZIP of a dataset after sqlite_refresh_dataset.
+
+    Only the LCs in dataset_csvlcs_to_generate (those from the refreshed
+    collections) are converted again. The LCs from other collections are
+    copied over as-is from the dataset's existing LC ZIP if possible.
+
+    converted_csvlcs is the same as for sqlite_make_dataset_lczip.
+
+    The dataset's lczip_cachekey is cleared, since its LC ZIP no longer
+    corresponds to a list of original LCs at a single point in time. If other
+    datasets shared its LC ZIP, they keep the old file, and their
+    lczip_cachekey is cleared as well.
+
+    '''
+
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    dataset_fpath = os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid)
+
+    if not os.path.exists(dataset_fpath):
+        LOGERROR('setid: %s, dataset pickle expected at %s does not exist!' %
+                 (setid, dataset_fpath))
+        return None, False
+
+    with gzip.open(dataset_fpath,'rb') as infd:
+        dataset = pickle.load(infd)
+
+    #
+    # convert the LCs from the refreshed collections again
+    #
+    convertopts = {'csvlc_version':converter_csvlc_version,
+                   'comment_char':converter_comment_char,
+                   'column_separator':converter_column_separator,
+                   'skip_converted':False}
+
+    tasks = [(x[0], x[1], x[2], convertopts)
+             for x in dataset_csvlcs_to_generate]
+
+    if converted_csvlcs is not None:
+
+        link_converted_csvlcs(dataset_csvlcs_to_generate, converted_csvlcs)
+
+    elif len(tasks) > 0:
+
+        pool = Pool(converter_processes)
+        results = pool.map(csvlc_convert_worker, tasks)
+        pool.close()
+        pool.join()
+
+        link_converted_csvlcs(dataset_csvlcs_to_generate, results)
+
+    zipfile_lclist = dataset_csvlc_paths(basedir, dataset['result'])
+    refreshed_colldirs = {x.replace('_','-') for x in refreshed_collections}
+
+    lczip_fpath = dataset['lczipfpath']
+
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+
+    if len(zipfile_lclist) > max_dataset_lcs:
+
+        LOGERROR('LCs in dataset: %s > max_dataset_lcs: %s, '
+                 ' will not generate a ZIP file.' %
+                 (len(zipfile_lclist), max_dataset_lcs))
+
+        # the old LC ZIP is out of date, so get rid of it
+        sharing_setids = _unshare_dataset_lczip(basedir, setid, db)
+        if os.path.lexists(lczip_fpath):
+            os.remove(lczip_fpath)
+
+        lczip_generated = False
+
+    else:
+
+        if os.path.exists(lczip_fpath):
+            oldzip = ZipFile(lczip_fpath, 'r')
+            oldzip_members = set(oldzip.namelist())
+        else:
+            oldzip = None
+            oldzip_members = set()
+
+        # write to a temporary file and then move it into place. this also
+        # makes sure we don't write through a symlink to another dataset's
+        # LC ZIP
+        tmp_lczip_fpath = '%s.tmp-%s' % (lczip_fpath, secrets.token_hex(4))
+        ncopied = 0
+
+        with ZipFile(tmp_lczip_fpath, 'w', allowZip64=True) as outzip:
+
+            for ind_lcf, lcf in enumerate(zipfile_lclist):
+
+                lcf_collname = os.path.split(os.path.dirname(lcf))[-1]
+                lcf_archivename = '%s-%s' % (lcf_collname,
+                                             os.path.basename(lcf))
+
+                if (lcf_collname not in refreshed_colldirs and
+                    lcf_archivename in oldzip_members):
+
+                    outzip.writestr(oldzip.getinfo(lcf_archivename),
+                                    oldzip.read(lcf_archivename))
+                    ncopied = ncopied + 1
+
+                elif os.path.exists(lcf):
+
+                    outzip.write(lcf, arcname=lcf_archivename)
+
+                else:
+                    zipfile_lclist[ind_lcf] = (
+                        '%s missing' % (os.path.basename(lcf))
+                    )
+
+            # add the manifest to the zipfile
+            outzip.writestr(
+                'lczip-manifest.json',
+                json.dumps(
+                    [os.path.basename(x) for x in zipfile_lclist],
+                    ensure_ascii=True,
+                    indent=2
+                )
+            )
+
+        if oldzip is not None:
+            oldzip.close()
+
+        # the other datasets sharing the old LC ZIP keep it
+        sharing_setids = _unshare_dataset_lczip(basedir, setid, db)
+        os.replace(tmp_lczip_fpath, lczip_fpath)
+
+        LOGINFO('refreshed LC zip: %s for setid: %s, '
+                'copied %s of %s LCs from the old zip' %
+                (lczip_fpath, setid, ncopied, len(zipfile_lclist)))
+        lczip_generated = True
+
+    #
+    # mark the dataset as complete again
+    #
+    cur = db.cursor()
+    cur.execute("update lcc_datasets set status = ?, last_updated = ?, "
+                "lczip_cachekey = ? where setid = ?",
+                ('complete', datetime.utcnow().isoformat(), None, setid))
+
+    # the datasets that shared the old LC ZIP can't be told apart from this
+    # one by their cache key anymore
+    for other_setid in sharing_setids:
+        cur.execute("update lcc_datasets set lczip_cachekey = ? "
+                    "where setid = ?", (None, other_setid))
+
+    db.commit()
+    db.close()
+
+    dataset_header_pkl = os.path.join(datasetdir,
+                                      'dataset-%s-header.pkl' % setid)
+
+    with open(dataset_header_pkl,'rb') as infd:
+        setheader = pickle.load(infd)
+
+    setheader['updated'] = datetime.utcnow().isoformat()
+
+    with open(dataset_header_pkl,'wb') as outfd:
+        pickle.dump(setheader, outfd, pickle.HIGHEST_PROTOCOL)
+
+    dataset['updated'] = datetime.utcnow().isoformat()
+
+    with gzip.open(dataset_fpath,'wb') as outfd:
+        pickle.dump(dataset, outfd, pickle.HIGHEST_PROTOCOL)
+
+    sqlite_update_dataset_usage(basedir, setid)
+
+    return lczip_fpath, lczip_generated
+
+
+#######################
+## DATASET RETENTION ##
+#######################
+
+# this tracks the disk usage and last access time of each dataset. new datasets
+# DBs get it in sqlite_make_lcc_datasets_db, older DBs get it the first time
+# it's needed.
+SQLITE_DATASET_USAGE_CREATE = '''\
+create table if not exists lcc_dataset_usage (
+  setid text not null,
+  core_nbytes integer default 0,
+  products_nbytes integer default 0,
+  last_accessed datetime,
+  evicted_on datetime,
+  evicted_products text,
+  primary key (setid)
+);
+
+create index if not exists usage_access_idx on
+  lcc_dataset_usage (last_accessed asc);
+'''
+
+# these are the products that can be evicted and then regenerated on access
+DATASET_EVICTABLE_PRODUCTS = ('csv', 'pages', 'exports', 'lczip')
+
+
+def _dataset_usage_table(db):
+    '''
+    This makes sure the lcc_dataset_usage table exists in the datasets DB.
+
+    '''
+
+    db.executescript(SQLITE_DATASET_USAGE_CREATE)
+    db.commit()
+
+
+def _dataset_product_files(basedir, setid):
+    '''This returns the dataset's files on disk as a dict keyed by product.
+
+    'core' is the dataset pickle and header pickle. These are never evicted
+    since all the other products are regenerated from them.
+
+    '''
+
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+
+    products = {
+        'core':[os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid),
+                os.path.join(datasetdir, 'dataset-%s-header.pkl' % setid)],
+        'csv':[os.path.join(datasetdir, 'dataset-%s.csv' % setid)],
+        'pages':sorted(
+            glob.glob(os.path.join(datasetdir,
+                                   'dataset-%s-rows-page*.pkl' % setid))
+        ),
+        'exports':[os.path.join(datasetdir, 'dataset-%s.%s' % (setid, x))
+                   for x in DATASET_EXPORT_FORMATS],
+        'lczip':[os.path.join(os.path.abspath(basedir),
+                              'products',
+                              'lightcurves-%s.zip' % setid)],
+    }
+
+    return products
+
+
+def _files_nbytes(fpaths):
+    '''This returns the total size of the files in fpaths.
+
+    Symlinks are counted as the links themselves, so LC ZIPs shared between
+    datasets are only counted once.
+
+    '''
+
+    nbytes = 0
+
+    for fpath in fpaths:
+        try:
+            nbytes += os.lstat(fpath).st_size
+        except OSError:
+            pass
+
+    return nbytes
+
+
+def sqlite_update_dataset_usage(basedir, setid, database=None):
+    '''This updates the disk usage of the dataset in the datasets DB.
+
+    Returns a dict with the dataset's core_nbytes and products_nbytes.
+
+    '''
+
+    products = _dataset_product_files(basedir, setid)
+    core_nbytes = _files_nbytes(products['core'])
+    products_nbytes = sum(
+        _files_nbytes(products[x]) for x in DATASET_EVICTABLE_PRODUCTS
+    )
+
+    if database is None:
+        datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+        db = sqlite3.connect(
+            datasets_dbf,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+        )
+    else:
+        db = database
+
+    _dataset_usage_table(db)
+
+    cur = db.cursor()
+    cur.execute("insert or ignore into lcc_dataset_usage (setid) values (?)",
+                (setid,))
+    cur.execute("update lcc_dataset_usage set core_nbytes = ?, "
+                "products_nbytes = ? where setid = ?",
+                (core_nbytes, products_nbytes, setid))
+    db.commit()
+
+    if database is None:
+        db.close()
+
+    return {'core_nbytes':core_nbytes,
+            'products_nbytes':products_nbytes}
+
+
+def sqlite_touch_dataset(basedir, setid, database=None):
+    '''This records an access of the dataset for LRU eviction.
+
+    Returns the list of the dataset's products that have been evicted and will
+    need to be regenerated.
+
+    '''
+
+    if database is None:
+        datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+        db = sqlite3.connect(
+            datasets_dbf,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+        )
+    else:
+        db = database
+
+    cur = db.cursor()
+
+    try:
+        cur.execute("insert or ignore into lcc_dataset_usage (setid) "
+                    "values (?)", (setid,))
+    except sqlite3.OperationalError:
+        _dataset_usage_table(db)
+        cur.execute("insert or ignore into lcc_dataset_usage (setid) "
+                    "values (?)", (setid,))
+
+    cur.execute("update lcc_dataset_usage set last_accessed = ? "
+                "where setid = ?",
+                (datetime.utcnow().isoformat(), setid))
+    cur.execute("select evicted_products from lcc_dataset_usage "
+                "where setid = ?", (setid,))
+    row = cur.fetchone()
+    db.commit()
 
-            # now, we'll convert these light curves in parallel
-            pool = Pool(converter_processes)
-            results = pool.map(csvlc_convert_worker, tasks)
-            pool.close()
-            pool.join()
+    if database is None:
+        db.close()
 
-            #
-            # link the generated CSV LCs to the output directory
-            #
+    if row and row[0]:
+        return json.loads(row[0])
+    else:
+        return []
 
-            for item, res in zip(dataset_csvlcs_to_generate, results):
-
-                orig, oid, lcformatdesc, coll, outcsvlc = item
-                if not os.path.exists(outcsvlc):
-                    try:
-                        os.symlink(os.path.abspath(res), outcsvlc)
-                    except Exception:
-                        LOGEXCEPTION(
-                            'could not symlink %s -> %s' % (
-                                os.path.abspath(res),
-                                outcsvlc
-                            )
-                        )
 
-            #
-            # FINALLY, CARRY OUT THE ZIP OPERATION (IF NEEDED)
-            #
-            zipfile_lclist = (
-                [x[-1] for x in dataset_csvlcs_to_generate]
-            )
+def sqlite_dataset_usage(basedir):
+    '''This returns the total and per-owner disk usage of all datasets.
 
-            # do not generate LCs if their number > max number allowed
-            if len(zipfile_lclist) > max_dataset_lcs:
+    Returns a dict of the form::
 
-                LOGERROR('LCs in dataset: %s > max_dataset_lcs: %s, '
-                         ' will not generate a ZIP file.' %
-                         (len(zipfile_lclist), max_dataset_lcs))
+        {'total_nbytes', 'core_nbytes', 'products_nbytes', 'ndatasets',
+         'nevicted', 'by_owner':{owner:{'total_nbytes', 'ndatasets'}, ...}}
 
-                lczip_generated = False
+    '''
 
-            else:
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    _dataset_usage_table(db)
+    cur = db.cursor()
 
-                # get the expected name of the output zipfile
-                lczip_fpath = dataset['lczipfpath']
+    cur.execute(
+        "select a.dataset_owner, count(*), "
+        "sum(coalesce(b.core_nbytes, 0)), "
+        "sum(coalesce(b.products_nbytes, 0)), "
+        "sum(b.evicted_on is not null) "
+        "from lcc_datasets a left join lcc_dataset_usage b "
+        "on a.setid = b.setid "
+        "group by a.dataset_owner"
+    )
+    rows = cur.fetchall()
+    db.close()
 
-                LOGINFO('writing %s LC files to zip file: %s for setid: %s...' %
-                        (len(zipfile_lclist), lczip_fpath, setid))
+    usage = {'total_nbytes':0,
+             'core_nbytes':0,
+             'products_nbytes':0,
+             'ndatasets':0,
+             'nevicted':0,
+             'by_owner':{}}
 
-                # set up the zipfile
-                with ZipFile(lczip_fpath, 'w', allowZip64=True) as outzip:
+    for owner, ndatasets, core_nbytes, products_nbytes, nevicted in rows:
 
-                    for ind_lcf, lcf in enumerate(zipfile_lclist):
+        usage['by_owner'][owner] = {
+            'total_nbytes':core_nbytes + products_nbytes,
+            'ndatasets':ndatasets
+        }
+        usage['total_nbytes'] += core_nbytes + products_nbytes
+        usage['core_nbytes'] += core_nbytes
+        usage['products_nbytes'] += products_nbytes
+        usage['ndatasets'] += ndatasets
+        usage['nevicted'] += nevicted or 0
 
-                        if os.path.exists(lcf):
+    return usage
 
-                            lcf_collname = os.path.split(
-                                os.path.dirname(lcf)
-                            )[-1]
-                            lcf_archivename = os.path.basename(lcf)
 
-                            outzip.write(
-                                lcf,
-                                arcname='%s-%s' % (lcf_collname,
-                                                   lcf_archivename)
-                            )
-                        else:
-                            zipfile_lclist[ind_lcf] = (
-                                '%s missing' % (os.path.basename(lcf))
-                            )
+def _lczip_sharing_setids(basedir, setid, database):
+    '''This returns the other datasets whose LC ZIPs are the same file.
 
-                    # add the manifest to the zipfile
-                    outzip.writestr(
-                        'lczip-manifest.json',
-                        json.dumps(
-                            [os.path.basename(x) for x in zipfile_lclist],
-                            ensure_ascii=True,
-                            indent=2
-                        )
-                    )
+    Datasets with the same LCs share an LC ZIP. The first one to collect the
+    LCs has the actual file, and the rest have symlinks to it (see
+    sqlite_make_dataset_lczip), so these all have the same
+    lczip_cachekey.
 
-                LOGINFO('done, zip written successfully.')
-                lczip_generated = True
+    '''
 
-        # if we don't need to collect LCs, then we can just re-use the other
-        # dataset's LC ZIP
-        else:
+    lczip = os.path.join(os.path.abspath(basedir),
+                         'products',
+                         'lightcurves-%s.zip' % setid)
 
-            LOGINFO("re-using identical LC collected "
-                    "ZIP from dataset: %s at %s, "
-                    "symlinked to this dataset's LC ZIP: %s" %
-                    (other_setid, other_lczip, dataset['lczipfpath']))
-            lczip_generated = True
+    if not os.path.exists(lczip):
+        return []
 
-        #
-        # done with collecting light curves
-        #
+    cur = database.cursor()
+    cur.execute("select b.setid from lcc_datasets a join lcc_datasets b "
+                "on a.lczip_cachekey = b.lczip_cachekey "
+                "where a.setid = ? and b.setid != ?",
+                (setid, setid))
+    rows = cur.fetchall()
 
-        # generate the entry in the lcc-datasets.sqlite table and commit it
-        # once we get to this point, the dataset is finally considered complete
-        db = sqlite3.connect(
-            datasets_dbf,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-        )
-        cur = db.cursor()
+    sharing = []
 
-        query = ("update lcc_datasets set status = ?, "
-                 "last_updated = ?, lczip_cachekey = ? where setid = ?")
+    for (other_setid,) in rows:
 
-        params = ('complete',
-                  datetime.utcnow().isoformat(),
-                  dataset_lczip_cachekey,
-                  setid)
-        cur.execute(query, params)
+        other_lczip = os.path.join(os.path.abspath(basedir),
+                                   'products',
+                                   'lightcurves-%s.zip' % other_setid)
+
+        if (os.path.exists(other_lczip) and
+            os.path.samefile(other_lczip, lczip)):
+            sharing.append(other_setid)
+
+    return sharing
+
+
+def _lczip_linked_setids(basedir, setid, database):
+    '''
+    This returns the other datasets whose LC ZIPs link to this one's.
+
+    '''
+
+    lczip = os.path.join(os.path.abspath(basedir),
+                         'products',
+                         'lightcurves-%s.zip' % setid)
+
+    if os.path.islink(lczip):
+        return []
+
+    return _lczip_sharing_setids(basedir, setid, database)
+
+
+def _unshare_dataset_lczip(basedir, setid, database):
+    '''This stops other datasets from sharing this dataset's LC ZIP file.
+
+    This is used before the LC ZIP is replaced or removed. If this dataset has
+    the actual file and other datasets link to it, the file is moved to the
+    first of those and the rest are linked to it there instead. If this
+    dataset's LC ZIP is a symlink, nothing needs to be moved, since replacing
+    or removing it only affects the symlink.
+
+    Returns the setids of the datasets that shared the file.
+
+    '''
+
+    productdir = os.path.join(os.path.abspath(basedir), 'products')
+    lczip = os.path.join(productdir, 'lightcurves-%s.zip' % setid)
+
+    sharing = _lczip_sharing_setids(basedir, setid, database)
+
+    if sharing and not os.path.islink(lczip):
+
+        new_lczip = os.path.join(productdir,
+                                 'lightcurves-%s.zip' % sharing[0])
+        os.replace(lczip, new_lczip)
+
+        for other_setid in sharing[1:]:
+
+            other_lczip = os.path.join(productdir,
+                                       'lightcurves-%s.zip' % other_setid)
+            tmp_link = '%s.tmp-%s' % (other_lczip, secrets.token_hex(4))
+            os.symlink(new_lczip, tmp_link)
+            os.replace(tmp_link, other_lczip)
+
+        LOGINFO('moved LC zip for dataset: %s to dataset: %s, '
+                'which it was shared with' % (setid, sharing[0]))
+
+    return sharing
+
+
+def sqlite_evict_dataset_products(basedir,
+                                  setid,
+                                  products=DATASET_EVICTABLE_PRODUCTS):
+    '''This removes the dataset's regenerable products from disk.
+
+    The dataset pickle and header pickle are kept so the products can be
+    regenerated on the next access. The evicted products are recorded in the
+    datasets DB.
+
+    An LC ZIP that other datasets' LC ZIPs are symlinked to is not evicted,
+    since those datasets would otherwise lose their LCs.
+
+    Returns the number of bytes freed.
+
+    '''
+
+    product_files = _dataset_product_files(basedir, setid)
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    _dataset_usage_table(db)
+    cur = db.cursor()
+
+    freed_nbytes = 0
+    evicted = []
+
+    for product in products:
+
+        if product not in DATASET_EVICTABLE_PRODUCTS:
+            LOGERROR('not evicting unknown product: %s for dataset: %s' %
+                     (product, setid))
+            continue
+
+        if product == 'lczip':
+
+            linked_setids = _lczip_linked_setids(basedir, setid, db)
+
+            if linked_setids:
+                LOGWARNING('not evicting LC ZIP for dataset: %s, '
+                           'the LC ZIPs of datasets: %s link to it' %
+                           (setid, linked_setids))
+                continue
+
+        for fpath in product_files[product]:
+
+            if os.path.lexists(fpath):
+
+                freed_nbytes += _files_nbytes([fpath])
+                os.remove(fpath)
+
+                if product not in evicted:
+                    evicted.append(product)
+
+    cur.execute("select evicted_products from lcc_dataset_usage "
+                "where setid = ?", (setid,))
+    row = cur.fetchone()
+
+    if row and row[0]:
+        evicted = sorted(set(json.loads(row[0])) | set(evicted))
+
+    db.commit()
+    sqlite_update_dataset_usage(basedir, setid, database=db)
+
+    if evicted:
+        cur.execute("update lcc_dataset_usage set evicted_on = ?, "
+                    "evicted_products = ? where setid = ?",
+                    (datetime.utcnow().isoformat(),
+                     json.dumps(evicted),
+                     setid))
         db.commit()
-        db.close()
 
-        # update the dataset pickle and dataset header pickle with the LC zip
-        # information and the fact that all LCs have been collected.
+    db.close()
 
-        # update the header pickle
-        dataset_header_pkl = os.path.join(datasetdir,
-                                          'dataset-%s-header.pkl' % setid)
+    LOGINFO('evicted products: %s for dataset: %s, freed %s bytes' %
+            (evicted, setid, freed_nbytes))
 
-        with open(dataset_header_pkl,'rb') as infd:
-            setheader = pickle.load(infd)
+    return freed_nbytes
 
-        setheader['updated'] = datetime.utcnow().isoformat()
 
-        with open(dataset_header_pkl,'wb') as outfd:
-            pickle.dump(setheader, outfd, pickle.HIGHEST_PROTOCOL)
+def sqlite_restore_dataset_products(basedir,
+                                    setid,
+                                    products=('csv', 'lczip'),
+                                    max_dataset_lcs=2500):
+    '''This regenerates the dataset's evicted products.
 
-        # update the full dataset pickle
-        dataset['updated'] = datetime.utcnow().isoformat()
+    The CSV is rewritten from the dataset pickle. The LC ZIP is rewritten from
+    the dataset's CSV LCs if the dataset has at most max_dataset_lcs
+    rows. Dataset pages and binary exports are regenerated when they're
+    requested, so they don't need to be restored here.
 
-        with gzip.open(dataset_fpath,'wb') as outfd:
-            pickle.dump(dataset, outfd, pickle.HIGHEST_PROTOCOL)
+    Returns the list of products that were restored.
 
-        LOGINFO('updated entry for setid: %s with LC zip cachekey' % setid)
+    '''
 
-        return dataset['lczipfpath'], lczip_generated
+    datasetdir = os.path.abspath(os.path.join(basedir, 'datasets'))
+    dataset_fpath = os.path.join(datasetdir, 'dataset-%s.pkl.gz' % setid)
+
+    if not os.path.exists(dataset_fpath):
+        LOGERROR('no dataset pickle found for dataset: %s, '
+                 'cannot restore its products' % setid)
+        return []
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    _dataset_usage_table(db)
+    cur = db.cursor()
+    cur.execute("select evicted_products from lcc_dataset_usage "
+                "where setid = ?", (setid,))
+    row = cur.fetchone()
 
+    if row and row[0]:
+        evicted = json.loads(row[0])
     else:
+        evicted = []
 
-        LOGERROR('setid: %s, dataset pickle expected at %s does not exist!' %
-                 (setid, dataset_fpath))
-        return None, False
+    with gzip.open(dataset_fpath,'rb') as infd:
+        dataset = pickle.load(infd)
+
+    restored = []
+
+    if 'csv' in products and not os.path.exists(dataset['dataset_csv']):
+
+        write_dataset_csv(basedir, dataset)
+        restored.append('csv')
+
+    # an LC ZIP symlinked to another dataset's evicted ZIP is also rewritten
+    if ('lczip' in products and
+        not os.path.exists(dataset['lczipfpath']) and
+        'lczip' in evicted):
+
+        if len(dataset['result']) > max_dataset_lcs:
+
+            LOGERROR('LCs in dataset: %s > max_dataset_lcs: %s, '
+                     'will not restore its ZIP file.' %
+                     (len(dataset['result']), max_dataset_lcs))
+
+        else:
+
+            # write to a temporary file first so requests for the LC ZIP never
+            # see a partially written file. this replaces any dangling
+            # symlink to an evicted LC ZIP.
+            tmp_lczip_fpath = '%s.tmp-%s' % (dataset['lczipfpath'],
+                                             secrets.token_hex(4))
+
+            try:
+
+                write_dataset_lczip(
+                    tmp_lczip_fpath,
+                    dataset_csvlc_paths(basedir, dataset['result'])
+                )
+                os.replace(tmp_lczip_fpath, dataset['lczipfpath'])
+                restored.append('lczip')
+
+            except Exception:
+
+                LOGEXCEPTION('could not restore the LC ZIP '
+                             'for dataset: %s' % setid)
+                if os.path.exists(tmp_lczip_fpath):
+                    os.remove(tmp_lczip_fpath)
+
+    # these are regenerated on request, so they're no longer evicted
+    restored_or_ondemand = set(restored) | {'pages', 'exports'}
+    evicted = [x for x in evicted if x not in restored_or_ondemand]
+
+    if evicted:
+        cur.execute("update lcc_dataset_usage set evicted_products = ? "
+                    "where setid = ?", (json.dumps(evicted), setid))
+    else:
+        cur.execute("update lcc_dataset_usage set evicted_products = null, "
+                    "evicted_on = null where setid = ?", (setid,))
+    db.commit()
+
+    sqlite_update_dataset_usage(basedir, setid, database=db)
+    db.close()
+
+    LOGINFO('restored products: %s for dataset: %s' % (restored, setid))
+    return restored
+
+
+def sqlite_apply_dataset_retention(basedir,
+                                   total_quota_bytes=None,
+                                   owner_quota_bytes=None,
+                                   min_idle_hours=1.0):
+    '''This evicts dataset products to keep disk usage under the quotas.
+
+    Only complete datasets that are unlisted or owned by the anonymous user
+    are eligible for eviction. These are evicted in order of least-recent
+    access until the total disk usage is under total_quota_bytes and each
+    owner's disk usage is under owner_quota_bytes. Datasets accessed within
+    the last min_idle_hours are not evicted.
+
+    basedir/csvlcs/ isn't managed here. It only has symlinks to the converted
+    CSV LCs (see link_converted_csvlcs), which take up almost no space, and
+    restoring an evicted LC ZIP needs them. basedir/lcbundles/ isn't managed
+    either, since its CSV LCs are hard links to the converted ones where
+    possible. Its size and hit ratio from sqlite_lcbundle_stats are logged
+    and returned.
+
+    Returns a dict with the list of evicted setids, the bytes freed, and the
+    LC bundle cache stats.
+
+    '''
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    _dataset_usage_table(db)
+    cur = db.cursor()
+
+    # refresh the disk usage of all the datasets first
+    cur.execute("select setid from lcc_datasets")
+    for (setid,) in cur.fetchall():
+        sqlite_update_dataset_usage(basedir, setid, database=db)
+
+    db.close()
+
+    usage = sqlite_dataset_usage(basedir)
+    total_nbytes = usage['total_nbytes']
+    owner_nbytes = {k:usage['by_owner'][k]['total_nbytes']
+                    for k in usage['by_owner']}
+
+    evicted_setids = []
+    freed_nbytes = 0
+
+    total_over = (total_quota_bytes is not None and
+                  total_nbytes > total_quota_bytes)
+    owners_over = (
+        owner_quota_bytes is not None and
+        any(owner_nbytes[k] > owner_quota_bytes for k in owner_nbytes)
+    )
+
+    lcbundle_stats = sqlite_lcbundle_stats(basedir)
+    LOGINFO('LC bundle cache: %s CSV LCs, %s bytes, hit ratio: %s' %
+            (lcbundle_stats['nmembers'],
+             lcbundle_stats['nbytes'],
+             lcbundle_stats['hit_ratio']))
+
+    if not total_over and not owners_over:
+        LOGINFO('dataset disk usage: %s bytes is within quotas' %
+                total_nbytes)
+        return {'evicted':evicted_setids,
+                'freed_nbytes':freed_nbytes,
+                'total_nbytes':total_nbytes,
+                'lcbundle':lcbundle_stats}
+
+    idle_cutoff = (
+        datetime.utcnow() - timedelta(hours=min_idle_hours)
+    ).isoformat()
+
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    cur = db.cursor()
+
+    # these are the eviction candidates in LRU order
+    cur.execute(
+        "select a.setid, a.dataset_owner, b.products_nbytes "
+        "from lcc_datasets a join lcc_dataset_usage b "
+        "on a.setid = b.setid "
+        "where a.status = 'complete' and "
+        "(a.dataset_visibility = 'unlisted' or a.dataset_owner = 2) and "
+        "b.products_nbytes > 0 and "
+        "replace(coalesce(b.last_accessed, a.last_updated), ' ', 'T') < ? "
+        "order by replace(coalesce(b.last_accessed, a.last_updated), "
+        "' ', 'T') asc",
+        (idle_cutoff,)
+    )
+    candidates = cur.fetchall()
+    db.close()
+
+    for setid, owner, products_nbytes in candidates:
+
+        total_over = (total_quota_bytes is not None and
+                      total_nbytes > total_quota_bytes)
+        owner_over = (owner_quota_bytes is not None and
+                      owner_nbytes[owner] > owner_quota_bytes)
+
+        if not total_over and not owner_over:
+            continue
+
+        freed = sqlite_evict_dataset_products(basedir, setid)
+
+        total_nbytes -= freed
+        owner_nbytes[owner] -= freed
+        freed_nbytes += freed
+        evicted_setids.append(setid)
+
+    LOGINFO('evicted products of %s datasets, freed %s bytes, '
+            'dataset disk usage is now %s bytes' %
+            (len(evicted_setids), freed_nbytes, total_nbytes))
+
+    return {'evicted':evicted_setids,
+            'freed_nbytes':freed_nbytes,
+            'total_nbytes':total_nbytes,
+            'lcbundle':lcbundle_stats}
 
 
 ######################################
@@ -1276,6 +3984,47 @@ def sqlite_check_dataset_access(
         return False
 
 
+def sqlite_get_dataset_status(basedir,
+                              setid,
+                              incoming_userid=2,
+                              incoming_role='anonymous'):
+    '''This gets only the status of a dataset.
+
+    Unlike sqlite_get_dataset, this doesn't record the access for the retention
+    manager, so it can be used to poll a dataset while it's being made.
+
+    Returns the status or None if the dataset doesn't exist or the user can't
+    view it.
+
+    '''
+
+    datasets_dbf = os.path.join(basedir, 'lcc-datasets.sqlite')
+    db = sqlite3.connect(
+        datasets_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    db.row_factory = sqlite3.Row
+
+    try:
+
+        if not sqlite_check_dataset_access(setid,
+                                           'view',
+                                           incoming_userid=incoming_userid,
+                                           incoming_role=incoming_role,
+                                           database=db):
+            return None
+
+        cur = db.cursor()
+        cur.execute("select status from lcc_datasets where setid = ?",
+                    (setid,))
+        row = cur.fetchone()
+
+        return row['status'] if row else None
+
+    finally:
+        db.close()
+
+
 def sqlite_list_datasets(basedir,
                          setfilter=None,
                          useronly=False,
@@ -1430,16 +4179,17 @@ def sqlite_list_datasets(basedir,
     if xrows and len(xrows) > 0:
 
         # filter the rows depending on check_user_access
+        permitted = check_user_access_mask(
+            userid=incoming_userid,
+            role=incoming_role,
+            action='list',
+            target_name='dataset',
+            target_owners=[x['dataset_owner'] for x in xrows],
+            target_visibilities=[x['dataset_visibility'] for x in xrows],
+            target_sharedwith=[x['dataset_sharedwith'] for x in xrows]
+        )
         rows = [
-            dict(x) for x in xrows if check_user_access(
-                userid=incoming_userid,
-                role=incoming_role,
-                action='list',
-                target_name='dataset',
-                target_owner=x['dataset_owner'],
-                target_visibility=x['dataset_visibility'],
-                target_sharedwith=x['dataset_sharedwith']
-            )
+            dict(x) for x, x_permitted in zip(xrows, permitted) if x_permitted
         ]
 
         # we'll generate fpaths for the various products
@@ -1548,6 +4298,11 @@ def sqlite_get_dataset(
         # check if we can access this dataset
         if dataset_accessible:
 
+            # record this access for the retention manager
+            products_evicted = sqlite_touch_dataset(basedir,
+                                                    setid,
+                                                    database=db)
+
             # check what we want to return
             if returnspec == 'pickle':
 
@@ -1558,6 +4313,7 @@ def sqlite_get_dataset(
 
                 db.close()
                 outdict['status'] = dataset_status
+                outdict['products_evicted'] = products_evicted
                 outdict['session_token'] = row['dataset_sessiontoken']
                 if 'citation' not in outdict:
                     outdict['citation'] = None
@@ -1572,6 +4328,7 @@ def sqlite_get_dataset(
 
                 db.close()
                 header['status'] = dataset_status
+                header['products_evicted'] = products_evicted
                 header['session_token'] = row['dataset_sessiontoken']
                 header['currpage'] = 1
                 if 'citation' not in header:
@@ -1588,6 +4345,13 @@ def sqlite_get_dataset(
                 with open(getpath1,'rb') as infd:
                     header = pickle.load(infd)
 
+                # the first page may have been evicted, regenerate it if so
+                if not os.path.exists(getpath2):
+                    LOGWARNING('requested page: %s for dataset: %s '
+                               'does not exist, attempting to generate...'
+                               % (1, setid))
+                    sqlite_render_dataset_page(basedir, setid, 1)
+
                 if os.path.exists(getpath2):
                     with open(getpath2, 'rb') as infd:
                         table_preview = pickle.load(infd)
@@ -1598,6 +4362,7 @@ def sqlite_get_dataset(
 
                 header['rows'] = table_preview
                 header['status'] = dataset_status
+                header['products_evicted'] = products_evicted
                 header['currpage'] = 1
                 header['session_token'] = row['dataset_sessiontoken']
                 if 'citation' not in header:
@@ -1615,6 +4380,13 @@ def sqlite_get_dataset(
                                         setid)
                 with open(getpath1,'rb') as infd:
                     header = pickle.load(infd)
+                # the first page may have been evicted, regenerate it if so
+                if not os.path.exists(getpath2):
+                    LOGWARNING('requested page: %s for dataset: %s '
+                               'does not exist, attempting to generate...'
+                               % (1, setid))
+                    sqlite_render_dataset_page(basedir, setid, 1)
+
                 if os.path.exists(getpath2):
                     with open(getpath2, 'rb') as infd:
                         table_preview = pickle.load(infd)
@@ -1625,6 +4397,7 @@ def sqlite_get_dataset(
 
                 header['rows'] = table_preview
                 header['status'] = dataset_status
+                header['products_evicted'] = products_evicted
                 header['currpage'] = 1
                 header['session_token'] = row['dataset_sessiontoken']
                 if 'citation' not in header:
@@ -1680,8 +4453,6 @@ def sqlite_get_dataset(
                             )
                             setrows = []
 
-                        setrows = []
-
                 else:
                     LOGERROR(
                         'page requested: %s is out of bounds '
@@ -1692,6 +4463,7 @@ def sqlite_get_dataset(
 
                 header['rows'] = setrows
                 header['status'] = dataset_status
+                header['products_evicted'] = products_evicted
                 header['currpage'] = page_to_get
                 header['session_token'] = row['dataset_sessiontoken']
                 if 'citation' not in header:
@@ -1735,7 +4507,7 @@ def sqlite_get_dataset(
 
                         if strpkl and os.path.exists(strpkl):
 
-                            with open(pkl, 'rb') as infd:
+                            with open(strpkl, 'rb') as infd:
                                 setrows = pickle.load(infd)
 
                         else:
@@ -1747,8 +4519,6 @@ def sqlite_get_dataset(
                             )
                             setrows = []
 
-                        setrows = []
-
                 else:
                     LOGERROR(
                         'page requested: %s is out of bounds '
@@ -1759,6 +4529,7 @@ def sqlite_get_dataset(
 
                 header['rows'] = setrows
                 header['status'] = dataset_status
+                header['products_evicted'] = products_evicted
                 header['currpage'] = int(page_to_get)
                 header['session_token'] = row['dataset_sessiontoken']
                 if 'citation' not in header:
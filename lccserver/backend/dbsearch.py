@@ -56,6 +56,8 @@ import os.path
 import sqlite3
 import pickle
 import json
+import time
+import threading
 from functools import reduce, partial
 import re
 from urllib.parse import quote_plus
@@ -84,7 +86,7 @@ except Exception:
         _read_checkplot_picklefile, _write_checkplot_picklefile
     )
 
-from ..authnzerver.authdb import check_user_access
+from ..authnzerver.authdb import check_user_access, check_user_access_mask
 
 
 ###########################
@@ -1619,6 +1621,46 @@ def add_collection_info(row, collection):
     return row
 
 
+# this is the number of rows fetched from the database cursor at a time
+FETCH_BATCH_ROWS = 5000
+
+
+def iter_permitted_rows(cur,
+                        collection,
+                        incoming_userid=2,
+                        incoming_role='anonymous',
+                        action='list',
+                        batchsize=FETCH_BATCH_ROWS):
+    '''This yields the rows from an executed query that the user can access.
+
+    The rows are fetched from the cursor in batches of batchsize, so only the
+    permitted rows (converted to dicts with their collection ID added) are kept
+    in memory instead of every row returned by the database.
+
+    '''
+
+    while True:
+
+        batch = cur.fetchmany(batchsize)
+        if not batch:
+            break
+
+        # check access for the whole batch at once
+        permitted = check_user_access_mask(
+            userid=incoming_userid,
+            role=incoming_role,
+            action=action,
+            target_name='object',
+            target_owners=[x['owner'] for x in batch],
+            target_visibilities=[x['visibility'] for x in batch],
+            target_sharedwith=[x['sharedwith'] for x in batch]
+        )
+
+        for x, x_permitted in zip(batch, permitted):
+            if x_permitted:
+                yield add_collection_info(x, collection)
+
+
 def sqlite_namewrap_fulltext_search(
         basedir,
         ftsquerystr,
@@ -1996,34 +2038,23 @@ def sqlite_fulltext_search(
                 # execute the query
                 LOGINFO('query = %s' % thisq.replace('?',"'%s'" % ftsquerystr))
                 cur.execute(thisq, (ftsquerystr,))
-                rows = cur.fetchall()
-            except Exception:
-                LOGEXCEPTION('query failed, probably a syntax error')
-                rows = None
-
-            if rows and len(rows) > 0:
 
                 # check each object's permissions before adding it to the result
                 # rows. this is fairly fast since we have the permissions model
                 # entirely in memory from authdb
-                rows = [
-                    add_collection_info(x, lcc) for x in rows if
-                    check_user_access(
-                        userid=incoming_userid,
-                        role=incoming_role,
-                        action=(
-                            'list' if not override_action
-                            else override_action
-                        ),
-                        target_name='object',
-                        target_owner=x['owner'],
-                        target_visibility=x['visibility'],
-                        target_sharedwith=x['sharedwith']
+                rows = list(iter_permitted_rows(
+                    cur,
+                    lcc,
+                    incoming_userid=incoming_userid,
+                    incoming_role=incoming_role,
+                    action=(
+                        'list' if not override_action
+                        else override_action
                     )
-                ]
-
-            else:
+                ))
 
+            except Exception:
+                LOGEXCEPTION('query failed, probably a syntax error')
                 rows = []
 
             # put the results into the right place
@@ -2342,29 +2373,17 @@ def sqlite_column_search(
 
             LOGINFO('query = %s' % thisq)
             cur.execute(thisq)
-            rows = cur.fetchall()
-
-            if rows and len(rows) > 0:
-
-                # check permissions for each object before accepting it
-                rows = [
-                    add_collection_info(x, lcc) for x in rows if
-                    check_user_access(
-                        userid=incoming_userid,
-                        role=incoming_role,
-                        action=(
-                            'list' if not override_action else override_action
-                        ),
-                        target_name='object',
-                        target_owner=x['owner'],
-                        target_visibility=x['visibility'],
-                        target_sharedwith=x['sharedwith']
-                    )
-                ]
-
-            else:
 
-                rows = []
+            # check permissions for each object before accepting it
+            rows = list(iter_permitted_rows(
+                cur,
+                lcc,
+                incoming_userid=incoming_userid,
+                incoming_role=incoming_role,
+                action=(
+                    'list' if not override_action else override_action
+                )
+            ))
 
             # put the results into the right place
             results[lcc] = {'result':rows,
@@ -2423,6 +2442,303 @@ def sqlite_column_search(
     return results
 
 
+# this is the max number of object IDs bound in a single 'objectid in (...)'
+# query. SQLite limits the number of parameters in a query to 999 by default.
+OBJECTID_LOOKUP_BATCH = 500
+
+
+def sqlite_objectid_lookup(
+        basedir,
+        objects,
+        incoming_userid=2,
+        incoming_role='anonymous',
+        override_action='view',
+        batchsize=OBJECTID_LOOKUP_BATCH,
+):
+    '''This looks up a list of objects by their object IDs.
+
+    objects is a list of (collection, objectid) tuples. The object IDs in each
+    collection are looked up with a single 'objectid in (...)' query for every
+    batchsize objects instead of a full-text search for each object, and only
+    the objects the user is allowed to access with override_action are
+    returned.
+
+    Returns a dict keyed by collection like the one from sqlite_column_search,
+    with the db_oid, db_ra, db_decl, db_lcfname, owner, visibility, and
+    sharedwith columns for each permitted object in its 'result' list. Returns
+    None if none of the collections can be accessed by the user.
+
+    '''
+
+    lcclist = sorted({x[0].replace('-','_') for x in objects})
+    if not lcclist:
+        return None
+
+    try:
+
+        dbinfo = sqlite_get_collections(basedir,
+                                        lcclist=lcclist,
+                                        incoming_userid=incoming_userid,
+                                        incoming_role=incoming_role,
+                                        return_connection=False)
+
+    except Exception:
+
+        LOGEXCEPTION(
+            "could not fetch available LC collections for "
+            "userid: %s, role: %s. "
+            "likely no collections matching this user's access level" %
+            (incoming_userid, incoming_role)
+        )
+        return None
+
+    dbfiles = dbinfo['info']['object_catalog_path']
+    available_lcc = dbinfo['databases']
+
+    uselcc = [x for x in lcclist if x in available_lcc]
+    if not uselcc:
+        LOGERROR("none of the specified input LC collections are valid")
+        return None
+
+    q = ("select a.objectid as db_oid, a.ra as db_ra, "
+         "a.decl as db_decl, a.lcfname as db_lcfname, "
+         "a.object_owner as owner, "
+         "a.object_visibility as visibility, "
+         "a.object_sharedwith as sharedwith "
+         "from {collection_id}.object_catalog a "
+         "where a.objectid in ({placeholders})")
+
+    results = {}
+
+    for lcc in uselcc:
+
+        objectids = sorted({x[1] for x in objects
+                            if x[0].replace('-','_') == lcc})
+
+        dbindex = available_lcc.index(lcc)
+        db, cur = sqlite3_to_memory(dbfiles[dbindex], lcc)
+
+        rows = []
+
+        try:
+
+            for ind in range(0, len(objectids), batchsize):
+
+                batch = objectids[ind:ind+batchsize]
+                cur.execute(
+                    q.format(collection_id=lcc,
+                             placeholders=', '.join(['?']*len(batch))),
+                    batch
+                )
+
+                rows.extend(iter_permitted_rows(
+                    cur,
+                    lcc,
+                    incoming_userid=incoming_userid,
+                    incoming_role=incoming_role,
+                    action=override_action
+                ))
+
+            msg = ('looked up %s objects in collection: %s, '
+                   'permitted nrows: %s' % (len(objectids), lcc, len(rows)))
+            LOGINFO(msg)
+            results[lcc] = {'result':rows,
+                            'nmatches':len(rows),
+                            'message':msg,
+                            'success':True}
+
+        except Exception as e:
+
+            msg = ('failed to look up objects in '
+                   'collection: %s, exception: %s' % (lcc, e))
+            LOGEXCEPTION(msg)
+            results[lcc] = {'result':[],
+                            'nmatches':0,
+                            'message':msg,
+                            'success':False}
+
+        finally:
+            db.close()
+
+        results[lcc]['lcformatkey'] = dbinfo['info']['lcformatkey'][dbindex]
+        results[lcc]['lcformatdesc'] = dbinfo['info']['lcformatdesc'][dbindex]
+        results[lcc]['collid'] = dbinfo['info']['collection_id'][dbindex]
+
+    results['databases'] = available_lcc
+    results['search'] = 'sqlite_objectid_lookup'
+
+    return results
+
+
+# these are the cached decisions of sqlite_check_object_access, keyed by
+# (collection, objectid, userid, role, action). each item is a tuple of
+# (decision, generation, expiry time).
+_OBJECT_ACCESS_CACHE = {}
+_OBJECT_ACCESS_LOCK = threading.Lock()
+
+# this is how long an object access decision is kept in the cache in seconds
+OBJECT_ACCESS_CACHE_TTL = 300.0
+
+# this is the max number of object access decisions kept in the cache
+OBJECT_ACCESS_CACHE_MAXITEMS = 100000
+
+
+def object_access_generation(basedir, collection):
+    '''This returns the current generation of a collection's access info.
+
+    This is made from the modification times and sizes of the LCC index DB and
+    the collection's object catalog DB and their WAL files, so any change to
+    the collection or object visibility, owners, or sharing makes the cached
+    access decisions for the collection stale.
+
+    '''
+
+    dbfiles = (
+        os.path.join(basedir, 'lcc-index.sqlite'),
+        os.path.join(basedir,
+                     collection.replace('_','-'),
+                     'catalog-objectinfo.sqlite'),
+    )
+
+    generation = []
+
+    for dbf in dbfiles:
+        for fpath in (dbf, '%s-wal' % dbf):
+            try:
+                fstat = os.stat(fpath)
+                generation.append((fstat.st_mtime_ns, fstat.st_size))
+            except OSError:
+                generation.append(None)
+
+    return tuple(generation)
+
+
+def get_cached_object_access(basedir,
+                             collection,
+                             objectid,
+                             incoming_userid=2,
+                             incoming_role='anonymous',
+                             action='view'):
+    '''This returns a cached object access decision.
+
+    Returns True or False if there's a current decision in the cache and None
+    if the access check needs to be done with sqlite_check_object_access.
+
+    '''
+
+    collection = collection.replace('-','_')
+    cachekey = (collection, objectid, incoming_userid, incoming_role, action)
+
+    with _OBJECT_ACCESS_LOCK:
+        cached = _OBJECT_ACCESS_CACHE.get(cachekey)
+
+    if cached is None:
+        return None
+
+    decision, generation, expires = cached
+
+    if (time.monotonic() > expires or
+        generation != object_access_generation(basedir, collection)):
+
+        with _OBJECT_ACCESS_LOCK:
+            _OBJECT_ACCESS_CACHE.pop(cachekey, None)
+        return None
+
+    return decision
+
+
+def cache_object_access(basedir,
+                        collection,
+                        objectid,
+                        decision,
+                        generation,
+                        incoming_userid=2,
+                        incoming_role='anonymous',
+                        action='view',
+                        ttl=OBJECT_ACCESS_CACHE_TTL):
+    '''This adds an object access decision to this process's cache.
+
+    generation is the collection's access generation from
+    object_access_generation, taken before the decision was made. The
+    frontend's executor runs sqlite_check_object_access in worker processes,
+    so the handlers use this to keep the decisions it returns in the IOLoop
+    process's cache too.
+
+    '''
+
+    collection = collection.replace('-','_')
+    cachekey = (collection, objectid, incoming_userid, incoming_role, action)
+
+    with _OBJECT_ACCESS_LOCK:
+
+        # drop the oldest decisions if the cache is full
+        if len(_OBJECT_ACCESS_CACHE) >= OBJECT_ACCESS_CACHE_MAXITEMS:
+            for key in list(_OBJECT_ACCESS_CACHE)[
+                    :OBJECT_ACCESS_CACHE_MAXITEMS//10
+            ]:
+                del _OBJECT_ACCESS_CACHE[key]
+
+        _OBJECT_ACCESS_CACHE[cachekey] = (decision,
+                                          generation,
+                                          time.monotonic() + ttl)
+
+
+def sqlite_check_object_access(basedir,
+                               collection,
+                               objectid,
+                               incoming_userid=2,
+                               incoming_role='anonymous',
+                               action='view',
+                               ttl=OBJECT_ACCESS_CACHE_TTL):
+    '''This checks if a user can access an object.
+
+    The object is looked up by its object ID with sqlite_objectid_lookup
+    instead of a full-text search. The decision is cached for ttl seconds or
+    until the collection's DBs change, whichever comes first.
+
+    Returns True if the user can access the object with action, False
+    otherwise.
+
+    '''
+
+    collection = collection.replace('-','_')
+
+    decision = get_cached_object_access(basedir,
+                                        collection,
+                                        objectid,
+                                        incoming_userid=incoming_userid,
+                                        incoming_role=incoming_role,
+                                        action=action)
+    if decision is not None:
+        return decision
+
+    # get the generation before the lookup so any change made while it's
+    # running makes this decision stale
+    generation = object_access_generation(basedir, collection)
+
+    lookup = sqlite_objectid_lookup(basedir,
+                                    [(collection, objectid)],
+                                    incoming_userid=incoming_userid,
+                                    incoming_role=incoming_role,
+                                    override_action=action)
+
+    decision = (lookup is not None and
+                collection in lookup and
+                lookup[collection]['nmatches'] > 0)
+
+    cache_object_access(basedir,
+                        collection,
+                        objectid,
+                        decision,
+                        generation,
+                        incoming_userid=incoming_userid,
+                        incoming_role=incoming_role,
+                        action=action,
+                        ttl=ttl)
+
+    return decision
+
+
 def sqlite_sql_search(basedir,
                       sqlstatement,
                       lcclist=None,
@@ -2829,20 +3145,16 @@ def sqlite_kdtree_conesearch(basedir,
                 cur.execute(thisq)
 
                 # get the results and filter by permitted objects
-                rows = [
-                    add_collection_info(x, lcc) for x in cur.fetchall() if
-                    check_user_access(
-                        userid=incoming_userid,
-                        role=incoming_role,
-                        action=(
-                            'list' if not override_action else override_action
-                        ),
-                        target_name='object',
-                        target_owner=x['owner'],
-                        target_visibility=x['visibility'],
-                        target_sharedwith=x['sharedwith']
+                rows = list(iter_permitted_rows(
+                    cur,
+                    lcc,
+                    incoming_userid=incoming_userid,
+                    incoming_role=incoming_role,
+                    action=(
+                        'list' if not override_action
+                        else override_action
                     )
-                ]
+                ))
 
             except Exception:
                 LOGEXCEPTION('query failed, probably an SQL error')
@@ -3453,21 +3765,16 @@ def sqlite_xmatch_search(basedir,
 
                 try:
                     cur.execute(thisq, tuple(matching_lcc_objectids))
-                    rows = [
-                        add_collection_info(x, lcc) for x in cur.fetchall() if
-                        check_user_access(
-                            userid=incoming_userid,
-                            role=incoming_role,
-                            action=(
-                                'list' if not override_action
-                                else override_action
-                            ),
-                            target_name='object',
-                            target_owner=x['owner'],
-                            target_visibility=x['visibility'],
-                            target_sharedwith=x['sharedwith']
+                    rows = list(iter_permitted_rows(
+                        cur,
+                        lcc,
+                        incoming_userid=incoming_userid,
+                        incoming_role=incoming_role,
+                        action=(
+                            'list' if not override_action
+                            else override_action
                         )
-                    ]
+                    ))
                 except Exception:
                     LOGEXCEPTION(
                         'xmatch object lookup for input object '
@@ -3766,21 +4073,16 @@ def sqlite_xmatch_search(basedir,
 
                 cur.execute(thisq)
 
-                rows = [
-                    add_collection_info(x, lcc) for x in cur.fetchall() if
-                    check_user_access(
-                        userid=incoming_userid,
-                        role=incoming_role,
-                        action=(
-                            'list' if not override_action
-                            else override_action
-                        ),
-                        target_name='object',
-                        target_owner=x['owner'],
-                        target_visibility=x['visibility'],
-                        target_sharedwith=x['sharedwith']
+                rows = list(iter_permitted_rows(
+                    cur,
+                    lcc,
+                    incoming_userid=incoming_userid,
+                    incoming_role=incoming_role,
+                    action=(
+                        'list' if not override_action
+                        else override_action
                     )
-                ]
+                ))
 
                 # put the results into the right place
                 results[lcc] = {
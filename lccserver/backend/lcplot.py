@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''lcplot.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This contains functions to plot unphased and phased light curves from the LC
+store of a collection on demand.
+
+Rendered plots are cached in the cache directory, keyed by the object, the plot
+parameters and the modification time of the LC store, so a plot is only
+rendered again if it's asked for with different parameters or the LC store has
+been rebuilt.
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+from lccserver import log_sub, log_fmt, log_date_fmt
+
+DEBUG = False
+if DEBUG:
+    level = logging.DEBUG
+else:
+    level = logging.INFO
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(
+    level=level,
+    style=log_sub,
+    format=log_fmt,
+    datefmt=log_date_fmt,
+)
+
+LOGDEBUG = LOGGER.debug
+LOGINFO = LOGGER.info
+LOGWARNING = LOGGER.warning
+LOGERROR = LOGGER.error
+LOGEXCEPTION = LOGGER.exception
+
+
+#############
+## IMPORTS ##
+#############
+
+import os
+import os.path
+import json
+import hashlib
+import secrets
+from io import BytesIO
+
+import numpy as np
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from . import lcstore
+
+
+##################
+## PLOT CACHING ##
+##################
+
+# these are the output formats for LC plots and their content types
+LCPLOT_FORMATS = {'png':'image/png',
+                  'svg':'image/svg+xml'}
+
+
+def lcplot_params(magcol,
+                  timecol=None,
+                  errcol=None,
+                  period=None,
+                  epoch=None,
+                  binsize=None,
+                  timerange=None,
+                  outformat='png'):
+    '''
+    This returns the dict of plot parameters used in the plot cache key.
+
+    '''
+
+    return {'magcol':magcol,
+            'timecol':timecol,
+            'errcol':errcol,
+            'period':period,
+            'epoch':epoch,
+            'binsize':binsize,
+            'timerange':list(timerange) if timerange else None,
+            'outformat':outformat}
+
+
+def lcplot_cache_path(basedir, cachedir, collection, objectid, plotparams):
+    '''This returns the path to the cached plot for an object's LC.
+
+    plotparams is the output of lcplot_params for the plot. Returns None if
+    the collection doesn't have an LC store.
+
+    '''
+
+    infojson = os.path.join(basedir,
+                            collection,
+                            lcstore.LCSTORE_DIRNAME,
+                            'lcstore-info.json')
+
+    try:
+        store_mtime = os.stat(infojson).st_mtime_ns
+    except OSError:
+        return None
+
+    cachekey = hashlib.sha256(
+        json.dumps([collection, objectid, plotparams, store_mtime],
+                   sort_keys=True).encode()
+    ).hexdigest()
+
+    return os.path.join(cachedir,
+                        'lcplots',
+                        cachekey[:2],
+                        '%s.%s' % (cachekey, plotparams['outformat']))
+
+
+def get_cached_lcplot(basedir, cachedir, collection, objectid, plotparams):
+    '''This returns a cached LC plot.
+
+    Returns the plot as bytes or None if it hasn't been cached yet.
+
+    '''
+
+    cachepath = lcplot_cache_path(basedir,
+                                  cachedir,
+                                  collection,
+                                  objectid,
+                                  plotparams)
+
+    if cachepath is None:
+        return None
+
+    try:
+        with open(cachepath,'rb') as infd:
+            return infd.read()
+    except OSError:
+        return None
+
+
+##############
+## PLOTTING ##
+##############
+
+# this is the most bins per point in the LC that bin_lc will use. smaller
+# binsizes are widened so a tiny binsize can't make huge bin arrays.
+LCPLOT_MAX_BINS_PER_POINT = 4
+
+
+def bin_lc(xvals, yvals, binsize, xmin=None, xmax=None):
+    '''This bins an LC in bins of binsize.
+
+    binsize must be > 0. If it would make more than LCPLOT_MAX_BINS_PER_POINT
+    bins per point in the LC, the bins are widened to that many bins.
+
+    Returns the centers of the bins and the mean of yvals in each bin for the
+    bins that have points in them.
+
+    '''
+
+    if not binsize > 0.0:
+        raise ValueError('binsize must be > 0, not %r' % binsize)
+
+    if xmin is None:
+        xmin = xvals.min()
+    if xmax is None:
+        xmax = xvals.max()
+
+    maxbins = max(1, LCPLOT_MAX_BINS_PER_POINT*xvals.size)
+    nbins = (xmax - xmin)/binsize
+
+    if nbins > maxbins:
+        nbins = maxbins
+        binsize = (xmax - xmin)/maxbins
+    else:
+        nbins = max(1, int(np.ceil(nbins)))
+    binind = np.clip(((xvals - xmin)/binsize).astype(np.int64), 0, nbins - 1)
+
+    bincounts = np.bincount(binind, minlength=nbins)
+    binsums = np.bincount(binind, weights=yvals, minlength=nbins)
+
+    hasvals = bincounts > 0
+    bincenters = xmin + (np.arange(nbins) + 0.5)*binsize
+
+    return bincenters[hasvals], binsums[hasvals]/bincounts[hasvals]
+
+
+def render_lcplot(basedir,
+                  cachedir,
+                  collection,
+                  objectid,
+                  magcol,
+                  timecol=None,
+                  errcol=None,
+                  period=None,
+                  epoch=None,
+                  binsize=None,
+                  timerange=None,
+                  outformat='png'):
+    '''This plots an object's LC from its collection's LC store.
+
+    If period is given, the LC is phased at period using epoch (or the first
+    time in the LC if epoch is None). binsize is the width of the bins in
+    units of time for unphased LCs and in units of phase for phased LCs; the
+    LC is plotted without binning if it's None. timerange is a (min, max)
+    tuple to plot only part of the LC.
+
+    The plot is written to the cache and returned as bytes. Returns None if the
+    object isn't in the LC store or has no finite values in magcol.
+
+    '''
+
+    plotparams = lcplot_params(magcol,
+                               timecol=timecol,
+                               errcol=errcol,
+                               period=period,
+                               epoch=epoch,
+                               binsize=binsize,
+                               timerange=timerange,
+                               outformat=outformat)
+
+    store = lcstore.get_lcstore(basedir, collection)
+    if store is None:
+        return None
+
+    columns = [x for x in (timecol or store.timecol, magcol, errcol) if x]
+    lcslice = store.get_slice(objectid,
+                              columns=columns,
+                              timerange=timerange,
+                              timecol=timecol)
+
+    if (lcslice is None or
+        (timecol or store.timecol) not in lcslice['columns'] or
+        magcol not in lcslice['columns']):
+        return None
+
+    times = np.asarray(lcslice['columns'][timecol or store.timecol],
+                       dtype=np.float64)
+    mags = np.asarray(lcslice['columns'][magcol], dtype=np.float64)
+
+    if errcol and errcol in lcslice['columns']:
+        errs = np.asarray(lcslice['columns'][errcol], dtype=np.float64)
+    else:
+        errs = None
+
+    finite = np.isfinite(times) & np.isfinite(mags)
+    if errs is not None:
+        finite &= np.isfinite(errs)
+        errs = errs[finite]
+    times, mags = times[finite], mags[finite]
+
+    if times.size == 0:
+        return None
+
+    fig = Figure(figsize=(8.0, 4.8), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    if period is not None and period > 0.0:
+
+        if epoch is None:
+            epoch = times.min()
+
+        xvals = np.mod((times - epoch)/period, 1.0)
+        xlabel = 'phase (period = %.6f, epoch = %.6f)' % (period, epoch)
+        binrange = (0.0, 1.0)
+
+    else:
+
+        xvals = times
+        xlabel = timecol or store.timecol
+        binrange = (None, None)
+
+    if binsize is not None and binsize > 0.0:
+        pointcolor = '#cccccc'
+    else:
+        pointcolor = 'k'
+
+    if errs is not None:
+        ax.errorbar(xvals, mags, yerr=errs,
+                    fmt='none', ecolor=pointcolor, elinewidth=0.5)
+    ax.scatter(xvals, mags, s=2.0, c=pointcolor, rasterized=True)
+
+    if binsize is not None and binsize > 0.0:
+        binx, biny = bin_lc(xvals, mags, binsize,
+                            xmin=binrange[0], xmax=binrange[1])
+        ax.scatter(binx, biny, s=8.0, c='#1f77b4')
+
+    if not store.info.get('magsarefluxes', False):
+        ax.invert_yaxis()
+
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(magcol)
+    ax.set_title('%s - %s' % (objectid, collection), fontsize='medium')
+    fig.tight_layout()
+
+    outbuf = BytesIO()
+    fig.savefig(outbuf, format=outformat)
+    plotbytes = outbuf.getvalue()
+
+    # write the plot to the cache
+    cachepath = lcplot_cache_path(basedir,
+                                  cachedir,
+                                  collection,
+                                  objectid,
+                                  plotparams)
+
+    if cachepath is not None:
+
+        try:
+
+            os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+            tmppath = '%s.tmp-%s' % (cachepath, secrets.token_hex(4))
+
+            with open(tmppath,'wb') as outfd:
+                outfd.write(plotbytes)
+            os.replace(tmppath, cachepath)
+
+        except OSError:
+            LOGEXCEPTION('could not write LC plot for %s to the cache' %
+                         objectid)
+
+    return plotbytes
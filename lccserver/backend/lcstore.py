@@ -0,0 +1,665 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''lcstore.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This contains functions to make and read a binary light curve store for an LC
+collection.
+
+The store for a collection lives in basedir/<collection>/lcstore. Each LC
+column is kept in its own .npy file holding the column for all objects one
+after the other, and an index DB holds the row offset and number of rows for
+each object. The .npy files are opened as memory maps, so slicing an object's
+LC only reads the parts of the files that are needed and doesn't parse any
+text.
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+from lccserver import log_sub, log_fmt, log_date_fmt
+
+DEBUG = False
+if DEBUG:
+    level = logging.DEBUG
+else:
+    level = logging.INFO
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(
+    level=level,
+    style=log_sub,
+    format=log_fmt,
+    datefmt=log_date_fmt,
+)
+
+LOGDEBUG = LOGGER.debug
+LOGINFO = LOGGER.info
+LOGWARNING = LOGGER.warning
+LOGERROR = LOGGER.error
+LOGEXCEPTION = LOGGER.exception
+
+
+#############
+## IMPORTS ##
+#############
+
+import os
+import os.path
+import re
+import json
+import glob
+import sqlite3
+import secrets
+import shutil
+from io import BytesIO
+from datetime import datetime
+from multiprocessing import Pool
+
+import numpy as np
+
+from . import abcat
+from .datasets import get_cached_lcformat_description
+
+
+#####################
+## LC STORE LAYOUT ##
+#####################
+
+# this is the name of the LC store directory in each collection's directory
+LCSTORE_DIRNAME = 'lcstore'
+
+# this is the index of objects in an LC store
+SQLITE_LCSTORE_CREATE = '''\
+create table lcstore_index (
+  objectid text not null,
+  lcfile text,
+  row_start integer not null,
+  nrows integer not null,
+  columns text not null,
+  time_sorted integer not null,
+  primary key (objectid)
+);
+'''
+
+# this is the number of rows copied at a time when finishing the .npy files
+LCSTORE_COPY_ROWS = 1048576
+
+
+def _lcstore_column_fname(colkey):
+    '''
+    This returns the name of the .npy file for an LC column.
+
+    '''
+
+    return 'col-%s.npy' % re.sub(r'[^A-Za-z0-9_.-]', '_', colkey)
+
+
+def _lcstore_fill_value(dtype):
+    '''
+    This returns the value used for a column that's missing from an object.
+
+    '''
+
+    if dtype.kind == 'f':
+        return np.nan
+    elif dtype.kind in ('U', 'S'):
+        return ''
+    else:
+        return 0
+
+
+######################
+## MAKING LC STORES ##
+######################
+
+def write_lcstore(storedir,
+                  lcdicts,
+                  colkeys,
+                  coldtypes,
+                  coldescs=None,
+                  timecol=None,
+                  collection=None,
+                  magsarefluxes=False):
+    '''This writes an LC store to storedir.
+
+    lcdicts is an iterable of (objectid, LC file path, {colkey:array}) tuples.
+    colkeys is the list of columns to store, coldtypes is a dict of colkey ->
+    numpy dtype string, and coldescs is a dict of colkey -> column
+    description. Columns missing from an object are filled with NaN, '' or 0
+    depending on their dtype. timecol is the column used for time-range
+    slices; this is the first of colkeys by default. magsarefluxes is recorded
+    in the store's info for plotting.
+
+    Returns the path to storedir.
+
+    '''
+
+    if timecol is None:
+        timecol = colkeys[0]
+    if coldescs is None:
+        coldescs = {}
+
+    dtypes = {x:np.dtype(coldtypes[x]) for x in colkeys}
+
+    os.makedirs(storedir)
+
+    index_db = sqlite3.connect(os.path.join(storedir, 'lcstore-index.sqlite'))
+    index_db.executescript(SQLITE_LCSTORE_CREATE)
+
+    # the columns are written to raw files first because the .npy headers need
+    # the total number of rows
+    rawfds = {x:open(os.path.join(storedir, 'raw-%s' %
+                                  _lcstore_column_fname(x)), 'wb')
+              for x in colkeys}
+
+    nobjects = 0
+    row_start = 0
+
+    try:
+
+        for objectid, lcfile, columns in lcdicts:
+
+            # the number of rows is taken from the time column if possible
+            available = [x for x in colkeys
+                         if x in columns and columns[x] is not None]
+            if len(available) == 0:
+                LOGWARNING('no columns found for object: %s, skipping' %
+                           objectid)
+                continue
+
+            nrows = (np.size(columns[timecol]) if timecol in available
+                     else np.size(columns[available[0]]))
+            available = [x for x in available
+                         if np.size(columns[x]) == nrows]
+
+            for colkey in colkeys:
+
+                if colkey in available:
+                    colvals = np.asarray(columns[colkey],
+                                         dtype=dtypes[colkey]).ravel()
+                else:
+                    colvals = np.full(nrows,
+                                      _lcstore_fill_value(dtypes[colkey]),
+                                      dtype=dtypes[colkey])
+
+                colvals.tofile(rawfds[colkey])
+
+            if timecol in available and nrows > 1:
+                timevals = np.asarray(columns[timecol], dtype=np.float64)
+                time_sorted = bool(np.all(np.diff(timevals) >= 0.0))
+            else:
+                time_sorted = True
+
+            index_db.execute(
+                "insert or replace into lcstore_index "
+                "(objectid, lcfile, row_start, nrows, columns, time_sorted) "
+                "values (?,?,?,?,?,?)",
+                (objectid, lcfile, row_start, nrows,
+                 json.dumps(available), time_sorted)
+            )
+
+            row_start = row_start + nrows
+            nobjects = nobjects + 1
+
+    finally:
+
+        for fd in rawfds.values():
+            fd.close()
+
+        index_db.commit()
+        index_db.close()
+
+    # now turn the raw column files into .npy files
+    for colkey in colkeys:
+
+        rawfpath = os.path.join(storedir,
+                                'raw-%s' % _lcstore_column_fname(colkey))
+        npyfpath = os.path.join(storedir, _lcstore_column_fname(colkey))
+
+        outarr = np.lib.format.open_memmap(npyfpath,
+                                           mode='w+',
+                                           dtype=dtypes[colkey],
+                                           shape=(row_start,))
+
+        if row_start > 0:
+            rawarr = np.memmap(rawfpath,
+                               dtype=dtypes[colkey],
+                               mode='r',
+                               shape=(row_start,))
+            for ind in range(0, row_start, LCSTORE_COPY_ROWS):
+                outarr[ind:ind+LCSTORE_COPY_ROWS] = (
+                    rawarr[ind:ind+LCSTORE_COPY_ROWS]
+                )
+            del rawarr
+
+        outarr.flush()
+        del outarr
+        os.remove(rawfpath)
+
+    storeinfo = {
+        'collection':collection,
+        'created':datetime.utcnow().isoformat(),
+        'nobjects':nobjects,
+        'nrows':row_start,
+        'timecol':timecol,
+        'magsarefluxes':magsarefluxes,
+        'colkeys':list(colkeys),
+        'columns':{x:{'fname':_lcstore_column_fname(x),
+                      'dtype':dtypes[x].str,
+                      'desc':coldescs.get(x)} for x in colkeys},
+    }
+
+    with open(os.path.join(storedir, 'lcstore-info.json'),'w') as outfd:
+        json.dump(storeinfo, outfd, indent=2)
+
+    LOGINFO('wrote LC store for %s objects, %s rows to %s' %
+            (nobjects, row_start, storedir))
+
+    return storedir
+
+
+def lcstore_read_worker(task):
+    '''This reads an original LC for the LC store.
+
+    task is a tuple of (LC file path, lcformat-description.json path). Returns
+    (objectid, LC file path, {colkey:array}) or None if the LC couldn't be
+    read.
+
+    '''
+
+    lcfile, formatjson = task
+
+    try:
+
+        formatdict = get_cached_lcformat_description(formatjson)
+        lcdict = formatdict['readerfunc'](lcfile)
+        if isinstance(lcdict, (tuple, list)) and isinstance(lcdict[0], dict):
+            lcdict = lcdict[0]
+
+        columns = {}
+        for colkey in formatdict['colkeys']:
+            try:
+                columns[colkey] = np.asarray(
+                    abcat.dict_get(lcdict, colkey.split('.'))
+                )
+            except Exception:
+                pass
+
+        return lcdict['objectid'], lcfile, columns
+
+    except Exception:
+
+        LOGEXCEPTION('could not read LC: %s for the LC store' % lcfile)
+        return None
+
+
+def make_lcstore(basedir,
+                 collection_id,
+                 lclist=None,
+                 nworkers=4,
+                 timecol=None):
+    '''This makes the binary LC store for an LC collection.
+
+    The LCs are read using the basedir/collection_id/lcformat-description.json
+    file. If lclist is None, all of the LCs matching the format's fileglob in
+    basedir/collection_id/lightcurves are used.
+
+    The new store is written next to any existing one and then moved into its
+    place at basedir/collection_id/lcstore, so readers never see a partial
+    store.
+
+    Returns the path to the LC store.
+
+    '''
+
+    collection_dir = os.path.join(basedir, collection_id)
+    lcformjson = os.path.abspath(
+        os.path.join(collection_dir, 'lcformat-description.json')
+    )
+    formatdict = abcat.get_lcformat_description(lcformjson)
+
+    if lclist is None:
+        lclist = sorted(
+            glob.glob(os.path.join(collection_dir,
+                                   'lightcurves',
+                                   formatdict['fileglob']))
+        )
+
+    if len(lclist) == 0:
+        LOGERROR('no LCs found to put in the LC store for collection: %s' %
+                 collection_id)
+        return None
+
+    colkeys = formatdict['colkeys']
+    coldtypes = {x:formatdict['columns'][x]['dtype'] for x in colkeys}
+    coldescs = {x:formatdict['columns'][x]['desc'] for x in colkeys}
+
+    storedir = os.path.join(collection_dir, LCSTORE_DIRNAME)
+    tmp_storedir = '%s.tmp-%s' % (storedir, secrets.token_hex(4))
+
+    LOGINFO('reading %s LCs for the LC store of collection: %s...' %
+            (len(lclist), collection_id))
+
+    pool = Pool(nworkers)
+
+    try:
+
+        lcdicts = pool.imap(lcstore_read_worker,
+                            ((x, lcformjson) for x in lclist),
+                            chunksize=16)
+
+        write_lcstore(tmp_storedir,
+                      (x for x in lcdicts if x is not None),
+                      colkeys,
+                      coldtypes,
+                      coldescs=coldescs,
+                      timecol=timecol,
+                      collection=collection_id,
+                      magsarefluxes=formatdict['magsarefluxes'])
+
+    except BaseException:
+
+        pool.terminate()
+        shutil.rmtree(tmp_storedir, ignore_errors=True)
+        raise
+
+    else:
+        pool.close()
+
+    finally:
+        pool.join()
+
+    # swap the new store into place
+    old_storedir = '%s.old-%s' % (storedir, secrets.token_hex(4))
+
+    if os.path.exists(storedir):
+        os.rename(storedir, old_storedir)
+
+    os.rename(tmp_storedir, storedir)
+    shutil.rmtree(old_storedir, ignore_errors=True)
+
+    return storedir
+
+
+#######################
+## READING LC STORES ##
+#######################
+
+class LCStore(object):
+    '''This reads slices of LCs from an LC store.
+
+    The column .npy files are opened as read-only memory maps the first time
+    they're needed. The arrays returned by get_slice are views into these
+    memory maps, so they don't copy any data until they're used.
+
+    '''
+
+    def __init__(self, storedir):
+        '''
+        This opens the LC store in storedir.
+
+        '''
+
+        self.storedir = storedir
+
+        with open(os.path.join(storedir, 'lcstore-info.json'),'r') as infd:
+            self.info = json.load(infd)
+
+        self.colkeys = self.info['colkeys']
+        self.timecol = self.info['timecol']
+        self.columns = {}
+
+        self.index_db = sqlite3.connect(
+            'file:%s?mode=ro' % os.path.join(storedir,
+                                             'lcstore-index.sqlite'),
+            uri=True,
+            check_same_thread=False
+        )
+
+    def column(self, colkey):
+        '''
+        This returns the memory-mapped array for a whole column.
+
+        '''
+
+        if colkey not in self.columns:
+            self.columns[colkey] = np.load(
+                os.path.join(self.storedir,
+                             self.info['columns'][colkey]['fname']),
+                mmap_mode='r'
+            )
+
+        return self.columns[colkey]
+
+    def get_object(self, objectid):
+        '''This returns the index entry for an object.
+
+        Returns a dict with the row offset, number of rows and available
+        columns for the object, or None if it isn't in the store.
+
+        '''
+
+        cur = self.index_db.cursor()
+        cur.execute("select row_start, nrows, columns, time_sorted "
+                    "from lcstore_index where objectid = ?", (objectid,))
+        row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        return {'row_start':row[0],
+                'nrows':row[1],
+                'columns':json.loads(row[2]),
+                'time_sorted':bool(row[3])}
+
+    def get_slice(self,
+                  objectid,
+                  columns=None,
+                  timerange=None,
+                  timecol=None,
+                  decimate=None,
+                  maxrows=None):
+        '''This returns a slice of an object's LC.
+
+        columns is the list of columns to return; all of the object's columns
+        are returned by default. timerange is a (min, max) tuple to select rows
+        with timecol in that range (either may be None). decimate returns every
+        n-th row, and maxrows sets the decimation so at most that many rows are
+        returned.
+
+        Returns a dict of the form::
+
+            {'objectid', 'nrows', 'nrows_total', 'decimate',
+             'columns':{colkey:array, ...}}
+
+        or None if the object isn't in the store. Unknown columns are left out.
+
+        '''
+
+        entry = self.get_object(objectid)
+        if entry is None:
+            return None
+
+        if columns is None:
+            columns = entry['columns']
+        else:
+            columns = [x for x in columns if x in entry['columns']]
+
+        if timecol is None:
+            timecol = self.timecol
+
+        start = entry['row_start']
+        end = start + entry['nrows']
+
+        rowmask = None
+
+        if (timerange is not None and
+            timecol in entry['columns'] and
+            (timerange[0] is not None or timerange[1] is not None)):
+
+            timevals = self.column(timecol)[start:end]
+
+            if entry['time_sorted']:
+
+                if timerange[0] is not None:
+                    start = start + int(np.searchsorted(timevals,
+                                                        timerange[0],
+                                                        side='left'))
+                if timerange[1] is not None:
+                    end = (entry['row_start'] +
+                           int(np.searchsorted(timevals,
+                                               timerange[1],
+                                               side='right')))
+                end = max(start, end)
+
+            else:
+
+                rowmask = np.ones(timevals.size, dtype=np.bool_)
+                if timerange[0] is not None:
+                    rowmask &= timevals >= timerange[0]
+                if timerange[1] is not None:
+                    rowmask &= timevals <= timerange[1]
+
+        nrows = int(rowmask.sum()) if rowmask is not None else end - start
+
+        if maxrows is not None and maxrows > 0 and nrows > maxrows:
+            decimate = max(decimate or 1, -(-nrows // maxrows))
+
+        if decimate is None or decimate < 1:
+            decimate = 1
+
+        slices = {}
+
+        for colkey in columns:
+
+            colvals = self.column(colkey)[start:end]
+
+            # slices of sorted LCs are views into the memory map, masks make
+            # a copy of the selected rows
+            if rowmask is not None:
+                colvals = colvals[rowmask]
+
+            slices[colkey] = colvals[::decimate]
+
+        return {'objectid':objectid,
+                'nrows':-(-nrows // decimate),
+                'nrows_total':entry['nrows'],
+                'decimate':decimate,
+                'columns':slices}
+
+    def close(self):
+        '''
+        This closes the LC store.
+
+        '''
+
+        self.columns = {}
+        self.index_db.close()
+
+
+# this holds open LC stores in each process, keyed by store directory
+_LCSTORE_CACHE = {}
+
+
+def get_lcstore(basedir, collection):
+    '''This returns the open LCStore for a collection.
+
+    collection is the name of the collection's directory in basedir. The store
+    is opened again if it's been rebuilt since it was last opened. Returns
+    None if the collection doesn't have an LC store.
+
+    '''
+
+    storedir = os.path.abspath(os.path.join(basedir,
+                                            collection,
+                                            LCSTORE_DIRNAME))
+    infojson = os.path.join(storedir, 'lcstore-info.json')
+
+    try:
+        info_mtime = os.stat(infojson).st_mtime_ns
+    except OSError:
+        return None
+
+    cached = _LCSTORE_CACHE.get(storedir)
+
+    if cached is not None and cached[0] == info_mtime:
+        return cached[1]
+
+    if cached is not None:
+        cached[1].close()
+
+    lcstore = LCStore(storedir)
+    _LCSTORE_CACHE[storedir] = (info_mtime, lcstore)
+
+    return lcstore
+
+
+def _jsonable_column(colvals):
+    '''
+    This turns an LC column into a list with NaNs and infs replaced by None.
+
+    '''
+
+    if colvals.dtype.kind == 'f':
+        colvals = np.where(np.isfinite(colvals), colvals, None)
+
+    return colvals.tolist()
+
+
+def get_lc_slice(basedir,
+                 collection,
+                 objectid,
+                 columns=None,
+                 timerange=None,
+                 timecol=None,
+                 decimate=None,
+                 maxrows=None,
+                 outformat='json'):
+    '''This gets a slice of an object's LC from its collection's LC store.
+
+    The slice arguments are the same as for LCStore.get_slice. If outformat is
+    'json', the columns in the returned dict are lists that can be sent as
+    JSON. If outformat is 'npz', the returned dict has the columns as an NPZ
+    file in its 'npz' key instead.
+
+    Returns None if the collection has no LC store or the object isn't in it.
+
+    '''
+
+    lcstore = get_lcstore(basedir, collection)
+    if lcstore is None:
+        return None
+
+    lcslice = lcstore.get_slice(objectid,
+                                columns=columns,
+                                timerange=timerange,
+                                timecol=timecol,
+                                decimate=decimate,
+                                maxrows=maxrows)
+    if lcslice is None:
+        return None
+
+    lcslice['collection'] = collection
+    lcslice['coldesc'] = {
+        x:{'dtype':lcstore.info['columns'][x]['dtype'],
+           'desc':lcstore.info['columns'][x]['desc']}
+        for x in lcslice['columns']
+    }
+
+    if outformat == 'npz':
+
+        outbuf = BytesIO()
+        np.savez(outbuf, **lcslice['columns'])
+        lcslice['npz'] = outbuf.getvalue()
+        del lcslice['columns']
+
+    else:
+
+        lcslice['columns'] = {x:_jsonable_column(y)
+                              for x, y in lcslice['columns'].items()}
+
+    return lcslice
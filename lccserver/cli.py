@@ -79,6 +79,8 @@ import glob
 import sqlite3
 import tempfile
 import subprocess
+import hashlib
+import time
 from concurrent.futures import ProcessPoolExecutor
 import asyncio
 from functools import partial
@@ -273,7 +275,12 @@ def prepare_basedir(basedir,
             "query_timeout_sec": 30.0,
             "lczip_timeout_sec": 30.0,
             "lczip_max_nrows": 500,
-            "dataset_rows_per_page": 500
+            "dataset_rows_per_page": 500,
+            "dataset_quota_total_gb": None,
+            "dataset_quota_per_owner_gb": None,
+            "dataset_retention_interval_min": 60,
+            "lcslice_max_nrows": 100000,
+            "bulklc_max_objects": 1000
         }
 
         # check if the site institution logo file is not None and exists
@@ -601,6 +608,107 @@ def new_collection_directories(basedir,
         return os.path.join(basedir, collection_id)
 
 
+#############################
+## CONVERTING ORIGINAL LCS ##
+#############################
+
+# this tracks which original LCs in a collection have been converted to CSV
+# LCs. it's used to resume an interrupted conversion and to convert only the
+# LCs that are new or have changed since the last conversion.
+SQLITE_CSVLC_MANIFEST_CREATE = '''\
+pragma journal_mode = wal;
+
+create table if not exists csvlc_manifest (
+  lcfile text not null,
+  lc_nbytes integer not null,
+  lc_mtime_ns integer not null,
+  convert_key text not null,
+  csvlc text,
+  status text not null,
+  converted_on datetime,
+  primary key (lcfile)
+);
+'''
+
+# this is the name of the manifest DB in each collection's directory
+CSVLC_MANIFEST_FNAME = 'csvlc-manifest.sqlite'
+
+
+def csvlc_conversion_key(lcformjson, converter_options):
+    '''This returns a key for the LC format description and CSV LC options.
+
+    LCs converted with a different format description or options than the
+    current ones are converted again.
+
+    '''
+
+    with open(lcformjson,'rb') as infd:
+        lcformat_contents = infd.read()
+
+    keyopts = {x:converter_options[x] for x in sorted(converter_options)
+               if x != 'skip_converted'}
+
+    keyhash = hashlib.sha256(lcformat_contents)
+    keyhash.update(json.dumps(keyopts, sort_keys=True).encode())
+
+    return keyhash.hexdigest()
+
+
+def get_csvlc_manifest(basedir, collection_id):
+    '''This opens the CSV LC conversion manifest DB for a collection.
+
+    The DB is made if it doesn't exist. Returns the sqlite3 connection.
+
+    '''
+
+    manifest_dbf = os.path.join(basedir, collection_id, CSVLC_MANIFEST_FNAME)
+
+    db = sqlite3.connect(
+        manifest_dbf,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    )
+    db.executescript(SQLITE_CSVLC_MANIFEST_CREATE)
+    db.commit()
+
+    return db
+
+
+def _update_csvlc_manifest(db, converted, convert_key):
+    '''This records a batch of converted LCs in the manifest DB.
+
+    converted is a list of (LC path, os.stat result, conversion result)
+    tuples. The batch is committed at once so an interrupted conversion can
+    resume from the last batch.
+
+    '''
+
+    now = datetime.utcnow().isoformat()
+    rows = []
+
+    for lcfile, lcstat, result in converted:
+
+        if result is not None and os.path.exists(result):
+            status = 'converted'
+        else:
+            status = 'failed'
+
+        rows.append((lcfile,
+                     lcstat.st_size,
+                     lcstat.st_mtime_ns,
+                     convert_key,
+                     result,
+                     status,
+                     now))
+
+    db.executemany(
+        "insert or replace into csvlc_manifest "
+        "(lcfile, lc_nbytes, lc_mtime_ns, convert_key, "
+        "csvlc, status, converted_on) values (?,?,?,?,?,?,?)",
+        rows
+    )
+    db.commit()
+
+
 def convert_original_lightcurves(basedir,
                                  collection_id,
                                  original_lcdir=None,
@@ -610,7 +718,9 @@ def convert_original_lightcurves(basedir,
                                  comment_char='#',
                                  column_separator=',',
                                  skip_converted=True,
-                                 max_lcs=None):
+                                 max_lcs=None,
+                                 batch_size=1000,
+                                 retry_failed=False):
     '''This converts original format light curves to the common LCC CSV format.
 
     This is optional since the LCC-Server can do this conversion on-the-fly if
@@ -637,6 +747,17 @@ def convert_original_lightcurves(basedir,
     csvlc_version, comment_char, column_separator, skip_converted control the
     CSV LC output and are passed directly to abcat.convert_to_csvlc.
 
+    The size and modification time of each converted LC are recorded in the
+    basedir/collection_id/csvlc-manifest.sqlite file every batch_size LCs. LCs
+    that haven't changed since they were last converted with the same LC
+    format description and options are skipped, so running this again after
+    an interruption or after adding new LCs only converts the LCs that
+    need it. LCs that failed to convert are tried again only if they've
+    changed or if retry_failed is True.
+
+    Returns a list of the CSV LC paths (or conversion failure messages) for
+    each original LC.
+
     '''
 
     from .backend import abcat
@@ -701,37 +822,149 @@ def convert_original_lightcurves(basedir,
                              'comment_char':comment_char,
                              'column_separator':column_separator,
                              'skip_converted':skip_converted}
+        convert_key = csvlc_conversion_key(lcformjson, converter_options)
+
+        #
+        # find the LCs that are new or have changed since they were last
+        # converted using the collection's conversion manifest
+        #
+        manifest = get_csvlc_manifest(basedir, collection_id)
+        cur = manifest.cursor()
+        cur.execute("select lcfile, lc_nbytes, lc_mtime_ns, convert_key, "
+                    "csvlc, status from csvlc_manifest")
+        manifest_entries = {x[0]:x[1:] for x in cur}
+
+        results = {}
+        tasks = []
+        task_stats = []
+
+        for lcfile in input_lclist:
+
+            lcfile = os.path.abspath(lcfile)
+            lcstat = os.stat(lcfile)
+            entry = manifest_entries.get(lcfile)
+
+            unchanged = (
+                entry is not None and
+                entry[0] == lcstat.st_size and
+                entry[1] == lcstat.st_mtime_ns and
+                entry[2] == convert_key
+            )
+
+            if (unchanged and
+                (entry[4] == 'converted' and os.path.exists(entry[3]) or
+                 entry[4] == 'failed' and not retry_failed)):
+                results[lcfile] = entry[3]
+                continue
 
-        tasks = [(x, y, lcformjson, converter_options) for x, y in
-                 zip(input_lclist, (None for x in input_lclist))]
+            # LCs that have changed must be converted again even if their
+            # CSV LCs exist
+            if entry is not None:
+                task_options = dict(converter_options, skip_converted=False)
+            else:
+                task_options = converter_options
+
+            tasks.append((lcfile, None, lcformjson, task_options))
+            task_stats.append(lcstat)
+
+        LOGINFO('%s of %s light curves are new or have changed '
+                'since they were last converted' %
+                (len(tasks), len(input_lclist)))
+
+        #
+        # do the conversion. the results are recorded in the manifest every
+        # batch_size LCs, so this can pick up from there if it's interrupted.
+        #
+        if len(tasks) > 0:
+
+            LOGINFO('converting light curves...')
+
+            start_time = time.monotonic()
+            nfailed = 0
+            batch = []
+
+            pool = mp.Pool(convert_workers)
+
+            try:
+
+                converted = pool.imap(
+                    datasets.csvlc_convert_worker,
+                    tasks,
+                    chunksize=max(1, min(100, batch_size//convert_workers))
+                )
+
+                for ind, (task, lcstat, result) in enumerate(
+                        zip(tasks, task_stats, converted)
+                ):
+
+                    if result is None or not os.path.exists(result):
+                        nfailed = nfailed + 1
+
+                    results[task[0]] = result
+                    batch.append((task[0], lcstat, result))
+
+                    if len(batch) == batch_size or ind == len(tasks) - 1:
+
+                        _update_csvlc_manifest(manifest, batch, convert_key)
+                        batch = []
+
+                        elapsed = time.monotonic() - start_time
+                        rate = (ind + 1)/elapsed if elapsed > 0 else 0.0
+                        LOGINFO(
+                            'converted %s/%s LCs (%.1f%%), %s failed, '
+                            '%.1f LCs/sec, ~%.0f sec remaining' %
+                            (ind + 1, len(tasks),
+                             100.0*(ind + 1)/len(tasks),
+                             nfailed,
+                             rate,
+                             (len(tasks) - ind - 1)/rate if rate > 0 else 0.0)
+                        )
+
+            except BaseException:
 
-        # do the conversion
-        LOGINFO('converting light curves...')
-        pool = mp.Pool(convert_workers)
-        results = pool.map(datasets.csvlc_convert_worker, tasks)
-        pool.close()
-        pool.join()
-        LOGINFO('LC conversion complete.')
+                # record the LCs converted so far before stopping
+                if len(batch) > 0:
+                    _update_csvlc_manifest(manifest, batch, convert_key)
+                pool.terminate()
+                raise
+
+            else:
+                pool.close()
+
+            finally:
+                pool.join()
+                manifest.close()
+
+            LOGINFO('LC conversion complete.')
+
+        else:
+
+            manifest.close()
+            LOGINFO('no light curves need to be converted.')
+
+        results = [results[os.path.abspath(x)] for x in input_lclist]
 
         # if the original_lcdir != basedir/collection_id/lightcurves, then
         # symlink the output CSVs to that directory
+        collection_lcdir = os.path.join(basedir, collection_id, 'lightcurves')
+
         if (original_lcdir and
-            os.path.abspath(original_lcdir) != os.path.abspath(basedir,
-                                                               collection_id,
-                                                               'lightcurves')):
+            os.path.abspath(original_lcdir) !=
+            os.path.abspath(collection_lcdir)):
 
             LOGINFO(
                 'symlinking output light curves to '
-                'collection lightcurves dir: %s...' %
-                os.path.join(basedir, collection_id, 'lightcurves')
+                'collection lightcurves dir: %s...' % collection_lcdir
             )
 
             for lc in results:
-                os.symlink(os.path.abspath(lc),
-                           os.path.join(basedir,
-                                        collection_id,
-                                        'lightcurves',
-                                        os.path.basename(lc)))
+
+                if lc is None or not os.path.exists(lc):
+                    continue
+
+                outlink = os.path.join(collection_lcdir, os.path.basename(lc))
+                if not os.path.lexists(outlink):
+                    os.symlink(os.path.abspath(lc), outlink)
 
             LOGINFO('symlinking complete.')
 
@@ -1725,6 +1958,24 @@ def main():
 
             print("Skipping conversion. ")
 
+        # ask if we should build the binary LC store for this collection
+        buildstore = input(
+            "Build a binary LC store for this collection? This lets users "
+            "fetch LC slices quickly using the /api/lcslice service. [y/N] "
+        )
+
+        if buildstore and buildstore.strip().lower() == 'y':
+
+            from .backend import lcstore
+
+            print('Building the LC store. This might take a while...')
+            lcstore.make_lcstore(args.basedir, collection_id, nworkers=NCPUS)
+            print('Done with the LC store.')
+
+        else:
+
+            print("Skipping the LC store. ")
+
         #
         # next, we'll set up the lclist.pkl file
         #
@@ -176,7 +176,8 @@ class LoginHandler(BaseHandler):
         reqbody = {
             'session_token': current_user['session_token'],
             'email':email,
-            'password':password
+            'password':password,
+            'ip_address':self.request.remote_ip
         }
 
         ok, resp, msgs = yield self.authnzerver_request(
@@ -242,15 +243,11 @@ class LogoutHandler(BaseHandler):
         if (current_user and current_user['user_id'] not in (2,3) and
             current_user['is_active'] and current_user['email_verified']):
 
-            # tell the authnzerver to delete this session
-            ok, resp, msgs = yield self.authnzerver_request(
-                'session-delete',
-                {'session_token':current_user['session_token']}
-            )
-
+            # tell the authnzerver to delete this session and make a new one
             yield self.new_session_token(
                 user_id=2,
-                expires_days=self.session_expiry
+                expires_days=self.session_expiry,
+                delete_session=current_user['session_token']
             )
             self.save_flash_messages(
                 'You have signed out of your account. Have a great day!',
@@ -536,7 +533,8 @@ class VerifyUserHandler(BaseHandler):
                     'user-login',
                     {'session_token':current_user['session_token'],
                      'email':email,
-                     'password':password}
+                     'password':password,
+                     'ip_address':self.request.remote_ip}
                 )
 
                 if login_ok:
@@ -1428,22 +1426,20 @@ class DeleteUserHandler(BaseHandler):
 
                 else:
 
-                    delete_ok, resp, msgs = yield self.authnzerver_request(
-                        'user-delete',
-                        {'user_id':self.current_user['user_id'],
-                         'email': email_address,
-                         'password': password},
+                    # if the user is deleted, make double-sure the current
+                    # session is dead as well
+                    delete_ok, responses, msgs = yield self.authnzerver_batch(
+                        [{'request':'user-delete',
+                          'body':{'user_id':self.current_user['user_id'],
+                                  'email': email_address,
+                                  'password': password}},
+                         {'request':'session-delete',
+                          'body':{'session_token':(
+                              self.current_user['session_token']
+                          )}}]
                     )
 
-                    if delete_ok:
-
-                        # make double-sure the current session is dead
-                        sessdel_ok, resp, msgs = yield self.authnzerver_request(
-                            'session-delete',
-                            {'session_token':(
-                                self.current_user['session_token']
-                            )},
-                        )
+                    if responses[0] is not None and responses[0]['success']:
 
                         self.save_flash_messages(
                             "Your account has been deleted successfully.",
@@ -16,6 +16,7 @@ import logging
 import numpy as np
 from datetime import datetime, timedelta
 import random
+import time
 from textwrap import dedent as twd
 import threading
 from base64 import b64encode, b64decode
@@ -97,8 +98,137 @@ from lccserver import __version__
 from lccserver.external.cookies import cookies
 from lccserver.backend import dbsearch, datasets
 from lccserver.authnzerver.actions import authnzerver_send_email
-from lccserver.authnzerver.authdb import check_role_limits
-from lccserver.authnzerver import cache
+from lccserver.authnzerver import transport
+from lccserver.frontend.sessioncache import SessionCache
+from lccserver.frontend.ratelimit import RateLimiter
+from lccserver.frontend.revocations import RevocationList
+
+
+####################################
+## SESSION CACHE AND RATE LIMITER ##
+####################################
+
+# this is the cache of session info shared by all handlers. indexserver sets
+# its TTL from the --sessioncachettl option.
+SESSION_CACHE = SessionCache()
+
+# this is the request rate limiter shared by all handlers
+RATE_LIMITER = RateLimiter()
+
+# this is the list of revoked API keys shared by all handlers. indexserver sets
+# its max_age from the --apikeyrevocationsync option and keeps it up to date.
+# while it's current, API keys are verified with it instead of the authnzerver.
+APIKEY_REVOCATIONS = RevocationList()
+
+# these authnzerver requests can delete API keys. the revocation list isn't used
+# while these are in progress and until it's been updated after they finish.
+APIKEY_REVOKING_REQUESTS = {
+    'session-delete',
+    'user-logout',
+    'user-delete',
+}
+
+# these authnzerver requests change a session or the user it belongs to. the
+# cached sessions for the session token (or the user with the user ID or email
+# address) in the request body are dropped when these are made.
+SESSION_CACHE_INVALIDATING_REQUESTS = {
+    'session-delete':'session_token',
+    'user-login':'session_token',
+    'user-verify-email':'email',
+    'user-changepass':'user_id',
+    'user-resetpass':'email_address',
+    'user-changeemail':'user_id',
+    'user-verifyemailchange':'user_id',
+    'user-delete':'user_id',
+    'user-edit':'target_userid',
+}
+
+
+def invalidate_cached_sessions(request_type, request_body):
+    '''
+    This drops the cached sessions affected by an authnzerver request.
+
+    '''
+
+    # the requests in a batch request are checked one by one
+    if request_type == 'batch':
+        for item in request_body.get('requests', []):
+            invalidate_cached_sessions(item.get('request'),
+                                       item.get('body', {}))
+        return
+
+    bodykey = SESSION_CACHE_INVALIDATING_REQUESTS.get(request_type)
+    if bodykey is None or bodykey not in request_body:
+        return
+
+    if bodykey == 'session_token':
+        SESSION_CACHE.invalidate(request_body[bodykey])
+    elif bodykey in ('email', 'email_address'):
+        SESSION_CACHE.invalidate_user(email=request_body[bodykey])
+    else:
+        SESSION_CACHE.invalidate_user(user_id=request_body[bodykey])
+
+
+def revokes_apikeys(request_type, request_body):
+    '''
+    This returns True if an authnzerver request can delete API keys.
+
+    '''
+
+    if request_type == 'batch':
+        return any(revokes_apikeys(item.get('request'), item.get('body', {}))
+                   for item in request_body.get('requests', []))
+
+    return request_type in APIKEY_REVOKING_REQUESTS
+
+
+@gen.coroutine
+def sync_apikey_revocations(authnzerver, fernetkey):
+    '''This updates the revocation list from the authnzerver.
+
+    indexserver runs this periodically. If the authnzerver can't be reached,
+    the list goes stale after its max_age and API keys are verified by the
+    authnzerver again.
+
+    '''
+
+    started = time.monotonic()
+    ok, resp, msgs = yield send_authnzerver_request(
+        authnzerver,
+        fernetkey,
+        'apikey-revoked',
+        {}
+    )
+
+    if ok:
+        APIKEY_REVOCATIONS.update(resp['revoked'], started=started)
+        return len(resp['revoked'])
+
+    LOGGER.error('could not get the revoked API keys from the authnzerver: %s'
+                 % msgs)
+    return None
+
+
+def expire_session_state():
+    '''This drops expired sessions and idle rate limits from the frontend.
+
+    The rate-limit buckets for the cached sessions that have expired are dropped
+    along with them. The authnzerver deletes expired sessions from the auth DB
+    on its own. indexserver runs this periodically.
+
+    '''
+
+    expired_sessions = SESSION_CACHE.expire()
+    for session_token in expired_sessions:
+        RATE_LIMITER.reset(session_token)
+
+    idle_buckets = RATE_LIMITER.expire()
+
+    if expired_sessions or idle_buckets:
+        LOGGER.info('dropped %s expired sessions and %s idle rate limits' %
+                    (len(expired_sessions), idle_buckets))
+
+    return len(expired_sessions), idle_buckets
 
 
 #######################
@@ -143,6 +273,66 @@ def encrypt_request(request_dict, fernetkey):
     return request_base64
 
 
+@gen.coroutine
+def send_authnzerver_request(authnzerver,
+                             fernetkey,
+                             request_type,
+                             request_body,
+                             httpclient=None):
+    '''This sends a request to the authnzerver.
+
+    authnzerver is the address of the authnzerver: an http:// URL, or a
+    unix:// or tcp:// address for its persistent stream connection.
+
+    Returns a tuple of (success, response, messages).
+
+    '''
+
+    # use the persistent connection if the authnzerver has one
+    if authnzerver.startswith(('unix://', 'tcp://')):
+
+        client = transport.get_client(authnzerver, fernetkey)
+        success, response, messages = yield client.request(
+            request_type,
+            request_body
+        )
+        return success, response, messages
+
+    if httpclient is None:
+        httpclient = AsyncHTTPClient()
+
+    reqid = random.randint(0,10000)
+
+    req = {'request':request_type,
+           'body':request_body,
+           'reqid':reqid}
+
+    # these are small enough to encrypt and decrypt without the executor
+    encrypted_req = encrypt_request(req, fernetkey)
+    auth_req = HTTPRequest(
+        authnzerver,
+        method='POST',
+        body=encrypted_req
+    )
+    encrypted_resp = yield httpclient.fetch(
+        auth_req, raise_error=False
+    )
+
+    if encrypted_resp.code != 200:
+
+        return False, None, None
+
+    else:
+
+        respdict = decrypt_response(encrypted_resp.body, fernetkey)
+
+        success = respdict['success']
+        response = respdict['response']
+        messages = respdict['response']['messages']
+
+        return success, response, messages
+
+
 ########################
 ## BASE HANDLER CLASS ##
 ########################
@@ -464,70 +654,159 @@ class BaseHandler(tornado.web.RequestHandler):
 
         '''
 
-        reqid = random.randint(0,10000)
+        # drop any cached sessions that this request will change. this is done
+        # before the request so a request for the session made while this one
+        # is running doesn't get the old session info from the cache, and
+        # again after it so session info fetched while it was running isn't
+        # kept either.
+        invalidate_cached_sessions(request_type, request_body)
 
-        req = {'request':request_type,
-               'body':request_body,
-               'reqid':reqid}
+        # API keys deleted by this request shouldn't be accepted using a
+        # revocation list fetched before the request finished
+        revoking = revokes_apikeys(request_type, request_body)
+        if revoking:
+            APIKEY_REVOCATIONS.mark_stale()
 
-        encrypted_req = yield self.executor.submit(
-            encrypt_request,
-            req,
-            self.fernetkey
-        )
-        auth_req = HTTPRequest(
+        success, response, messages = yield send_authnzerver_request(
             self.authnzerver,
-            method='POST',
-            body=encrypted_req
+            self.fernetkey,
+            request_type,
+            request_body,
+            httpclient=self.httpclient
         )
-        encrypted_resp = yield self.httpclient.fetch(
-            auth_req, raise_error=False
+
+        invalidate_cached_sessions(request_type, request_body)
+
+        if revoking:
+            APIKEY_REVOCATIONS.mark_stale()
+
+        return success, response, messages
+
+    @gen.coroutine
+    def authnzerver_batch(self,
+                          requests,
+                          stop_on_failure=True):
+        '''This sends several requests to the authnzerver in one go.
+
+        requests is a list of {'request': request type, 'body': request body}
+        dicts, which can also have a use_previous key to fill in their body from
+        the response of the request before them (see
+        authnzerver.handlers.auth_batch). The requests run in order. If
+        stop_on_failure is True, the requests after the first one that fails
+        are skipped.
+
+        Returns a tuple of (success, responses, messages), where success is True
+        only if all the requests succeeded and responses is a list of the
+        response of each request, or None for the ones that were skipped.
+
+        '''
+
+        ok, resp, msgs = yield self.authnzerver_request(
+            'batch',
+            {'requests':requests,
+             'stop_on_failure':stop_on_failure}
         )
 
-        if encrypted_resp.code != 200:
+        if resp is None:
+            return False, [None for x in requests], msgs
 
-            return False, None, None
+        return ok, resp['responses'], msgs
 
-        else:
+    @gen.coroutine
+    def get_session_info(self, session_token):
+        '''This returns the session info for session_token.
 
-            respdict = yield self.executor.submit(
-                decrypt_response,
-                encrypted_resp.body,
-                self.fernetkey
-            )
+        The session info is taken from the session cache if it's there,
+        otherwise it's requested from the authnzerver and added to the cache.
+
+        Returns the session info dict or None if the session doesn't exist.
+
+        '''
+
+        session_info = SESSION_CACHE.get(session_token)
+        if session_info is not None:
+            return session_info
+
+        generation = SESSION_CACHE.generation
+        ok, resp, msgs = yield self.authnzerver_request(
+            'session-exists',
+            {'session_token': session_token}
+        )
 
-            success = respdict['success']
-            response = respdict['response']
-            messages = respdict['response']['messages']
+        if ok:
+            SESSION_CACHE.set(session_token,
+                              resp['session_info'],
+                              generation=generation)
+            return resp['session_info']
 
-            return success, response, messages
+        return None
 
     @gen.coroutine
     def new_session_token(self,
                           user_id=2,
                           expires_days=7,
-                          extra_info=None):
+                          extra_info=None,
+                          delete_session=None,
+                          return_info=False):
         '''
         This is a shortcut function to request a new session token.
 
         Also sets the lccserver_session cookie.
 
+        If delete_session is a session token, that session is deleted first. If
+        return_info is True, the session info for the new session is fetched as
+        well and this returns a tuple of (session token, session info). All of
+        these are sent to the authnzerver as a single batch request.
+
         '''
 
         user_agent = self.request.headers.get('User-Agent')
         if not user_agent:
             user_agent = 'no-user-agent'
 
+        session_new_body = {
+            'ip_address': self.request.remote_ip,
+            'client_header': user_agent,
+            'user_id': user_id,
+            'expires': (datetime.utcnow() +
+                        timedelta(days=expires_days)),
+            'extra_info_json':extra_info
+        }
+
         # ask authnzerver for a session cookie
-        ok, resp, msgs = yield self.authnzerver_request(
-            'session-new',
-            {'ip_address': self.request.remote_ip,
-             'client_header': user_agent,
-             'user_id': user_id,
-             'expires': (datetime.utcnow() +
-                         timedelta(days=expires_days)),
-             'extra_info_json':extra_info}
-        )
+        if delete_session is None and not return_info:
+
+            ok, resp, msgs = yield self.authnzerver_request(
+                'session-new',
+                session_new_body
+            )
+
+        else:
+
+            requests = [{'request':'session-new',
+                         'body':session_new_body}]
+
+            if delete_session is not None:
+                requests.insert(0, {'request':'session-delete',
+                                    'body':{'session_token':delete_session}})
+            if return_info:
+                requests.append({'request':'session-exists',
+                                 'body':{},
+                                 'use_previous':{
+                                     'session_token':'session_token'
+                                 }})
+
+            # the new session is made even if the old one couldn't be deleted
+            generation = SESSION_CACHE.generation
+            batch_ok, responses, msgs = yield self.authnzerver_batch(
+                requests,
+                stop_on_failure=False
+            )
+            if delete_session is not None:
+                responses = responses[1:]
+
+            resp = responses[0]
+            ok = resp is not None and resp['success']
 
         if ok:
 
@@ -555,6 +834,17 @@ class BaseHandler(tornado.web.RequestHandler):
                 samesite='lax',
             )
 
+            if return_info:
+
+                session_info = None
+                if responses[1] is not None and responses[1]['success']:
+                    session_info = responses[1]['session_info']
+                    SESSION_CACHE.set(resp['session_token'],
+                                      session_info,
+                                      generation=generation)
+
+                return resp['session_token'], session_info
+
             return resp['session_token']
 
         else:
@@ -634,13 +924,22 @@ class BaseHandler(tornado.web.RequestHandler):
                 )
                 apiversion_ok = self.apiversion == apikey_dict['ver']
 
-                # pass dict to the backend
+                # if the revocation list is up to date, the API key can be
+                # verified here. otherwise, pass dict to the backend
                 if ipaddr_ok and apiversion_ok:
 
-                    verify_ok, resp, msgs = yield self.authnzerver_request(
-                        'apikey-verify',
-                        {'apikey_dict':apikey_dict}
-                    )
+                    if APIKEY_REVOCATIONS.is_current():
+
+                        verify_ok, msgs = APIKEY_REVOCATIONS.verify(
+                            apikey_dict
+                        )
+
+                    else:
+
+                        verify_ok, resp, msgs = yield self.authnzerver_request(
+                            'apikey-verify',
+                            {'apikey_dict':apikey_dict}
+                        )
 
                     # check if backend agrees it's OK
                     if verify_ok:
@@ -881,69 +1180,22 @@ class BaseHandler(tornado.web.RequestHandler):
             # belongs to
             if session_token is not None:
 
-                ok, resp, msgs = yield self.authnzerver_request(
-                    'session-exists',
-                    {'session_token': session_token}
-                )
+                session_info = yield self.get_session_info(session_token)
 
                 # if we found the session successfully, set the current_user
                 # attribute for this request
-                if ok:
+                if session_info is not None:
 
-                    self.current_user = resp['session_info']
+                    self.current_user = session_info
                     self.user_id = self.current_user['user_id']
                     self.user_role = self.current_user['user_role']
 
                     if self.ratelimit:
 
-                        # increment the rate counter for this session token
-                        reqcount = yield self.executor.submit(
-                            cache.cache_increment,
-                            session_token,
-                            cache_dirname=self.cachedir
-
-                        )
-
-                        # rate limit only after 25 requests have been counted
-                        if reqcount > 25:
-
-                            # check the rate for this session token
-                            request_rate, keycount, time_zero = (
-                                yield self.executor.submit(
-                                    cache.cache_getrate,
-                                    session_token,
-                                    cache_dirname=self.cachedir
-                                )
-                            )
-                            rate_ok = check_role_limits(self.user_role,
-                                                        rate_60sec=request_rate)
-                            self.request_rate_60sec = request_rate
-
-                        else:
-                            rate_ok = True
-                            self.request_rate_60sec = reqcount
-
-                        if not rate_ok:
-
-                            LOGGER.error(
-                                'session token: %s: current rate = %s exceeds '
-                                'their allowed rate for their role = %s'
-                                % (session_token,
-                                   request_rate,
-                                   self.user_role)
-                            )
-                            self.set_status(429)
-                            self.set_header('Retry-After','120')
-                            self.write({
-                                'status':'failed',
-                                'result':{
-                                    'rate':self.request_rate_60sec,
-                                },
-                                'message':(
-                                    'You have exceeded your API request rate.'
-                                )
-                            })
-                            raise tornado.web.Finish()
+                        # count this request and check the rate for this
+                        # session token
+                        self.check_request_rate(session_token,
+                                                'session token')
 
                 else:
 
@@ -966,38 +1218,29 @@ class BaseHandler(tornado.web.RequestHandler):
             # if the session token is not set, then create a new session
             else:
 
-                session_token = yield self.new_session_token(
-                    user_id=2,
-                    expires_days=self.session_expiry,
-                    extra_info={}
-                )
-
                 # immediately get back the session object for the current user
                 # so we don't have to redirect to get the session info from the
                 # cookie
-                ok, resp, msgs = yield self.authnzerver_request(
-                    'session-exists',
-                    {'session_token': session_token}
+                session_token, session_info = yield self.new_session_token(
+                    user_id=2,
+                    expires_days=self.session_expiry,
+                    extra_info={},
+                    return_info=True
                 )
 
                 # if we found the session successfully, set the current_user
                 # attribute for this request
-                if ok:
+                if session_info is not None:
 
-                    self.current_user = resp['session_info']
+                    self.current_user = session_info
                     self.user_id = self.current_user['user_id']
                     self.user_role = self.current_user['user_role']
 
                     if self.ratelimit:
 
-                        # increment the rate counter for this session token. we
-                        # just increase the count to 1 since this is the first
-                        # time we've seen this user.
-                        yield self.executor.submit(
-                            cache.cache_increment,
-                            session_token,
-                            cache_dirname=self.cachedir
-                        )
+                        # count the first request for this session token
+                        self.check_request_rate(session_token,
+                                                'session token')
 
                 else:
 
@@ -1088,57 +1331,89 @@ class BaseHandler(tornado.web.RequestHandler):
 
                 if self.ratelimit:
 
-                    # increment the rate counter for this session token
-                    reqcount = yield self.executor.submit(
-                        cache.cache_increment,
-                        self.apikey_dict['tkn'],
-                        cache_dirname=self.cachedir
+                    # count this request and check the rate for
+                    # this API key
+                    self.check_request_rate(self.apikey_dict['tkn'],
+                                            'API key')
 
-                    )
+    def check_request_rate(self, key, keytype):
+        '''This counts a request for a session token or API key.
 
-                    # rate limit only after 25 requests have been counted
-                    if reqcount > 25:
+        If the request rate for key is more than the current user's role
+        allows, writes a 429 response and finishes the request.
 
-                        # check the rate for this session token
-                        request_rate, keycount, time_zero = (
-                            yield self.executor.submit(
-                                cache.cache_getrate,
-                                self.apikey_dict['tkn'],
-                                cache_dirname=self.cachedir
-                            )
-                        )
-                        rate_ok = check_role_limits(self.user_role,
-                                                    rate_60sec=request_rate)
+        '''
 
-                        self.request_rate_60sec = request_rate
+        rate_ok, request_rate = RATE_LIMITER.check(key, self.user_role)
+        self.request_rate_60sec = request_rate
 
-                    else:
-                        rate_ok = True
-                        self.request_rate_60sec = reqcount
-
-                    if not rate_ok:
-
-                        LOGGER.error(
-                            'API key: %s: current rate = %s exceeds '
-                            'their allowed rate for their role = %s. '
-                            'total reqs = %s, time_zero = %s'
-                            % (self.apikey_dict['tkn'],
-                               request_rate,
-                               self.user_role,
-                               keycount, time_zero)
-                        )
-                        self.set_status(429)
-                        self.set_header('Retry-After','120')
-                        self.write({
-                            'status':'failed',
-                            'result':{
-                                'rate':self.request_rate_60sec,
-                            },
-                            'message':(
-                                'You have exceeded your API request rate.'
-                            )
-                        })
-                        raise tornado.web.Finish()
+        if not rate_ok:
+
+            LOGGER.error(
+                '%s: %s: current rate = %s exceeds '
+                'their allowed rate for their role = %s'
+                % (keytype, key, request_rate, self.user_role)
+            )
+            self.set_status(429)
+            self.set_header('Retry-After','120')
+            self.write({
+                'status':'failed',
+                'result':{
+                    'rate':self.request_rate_60sec,
+                },
+                'message':(
+                    'You have exceeded your API request rate.'
+                )
+            })
+            raise tornado.web.Finish()
+
+    def dataset_file_access_ok(self, ds):
+        '''This checks if the current user can download a dataset's files.
+
+        ds is the dataset header from datasets.sqlite_get_dataset. Sets
+        ds['owned'] as well.
+
+        '''
+
+        # check if the current user is anonymous or not
+        if (self.current_user['user_id'] not in (2,3) and
+            self.current_user['user_id'] == ds['owner']):
+
+            ds['owned'] = True
+            access_ok = True
+
+        # otherwise, if the current user's session_token matches the
+        # session_token used to create the dataset, they're the
+        # owner.
+        elif ( (self.current_user['user_id'] == 2) and
+               (self.current_user['session_token'] ==
+                ds['session_token']) ):
+
+            ds['owned'] = True
+            access_ok = True
+
+        # if the current user is anonymous and the session tokens don't
+        # match, check if the dataset is public or unlisted
+        elif ( (self.current_user['user_id'] == 2) and
+               (self.current_user['session_token'] !=
+                ds['session_token']) ):
+
+            ds['owned'] = False
+            if ds['visibility'] in ('public', 'unlisted'):
+                access_ok = True
+            else:
+                access_ok = False
+
+        # otherwise, this is a dataset not owned by the current user
+        else:
+
+            ds['owned'] = False
+            if ds['visibility'] in ('public', 'unlisted', 'shared'):
+                access_ok = True
+            else:
+                access_ok = False
+
+        return access_ok
 
     def on_finish(self):
         '''
@@ -1278,6 +1553,56 @@ class AuthEnabledStaticHandler(BaseHandler):
     def head(self, path):
         return self.get(path, include_body=False)
 
+    @gen.coroutine
+    def object_access_ok(self, collection, objectid):
+        '''This checks if the current user can view an object's CSV LC.
+
+        Uses the cached access decision for this object and user if there's
+        one in this process, otherwise looks up the object by its objectid in
+        the executor and caches the decision here.
+
+        '''
+
+        object_access_check = dbsearch.get_cached_object_access(
+            self.basedir,
+            collection,
+            objectid,
+            incoming_userid=self.current_user['user_id'],
+            incoming_role=self.current_user['user_role'],
+            action='view',
+        )
+
+        if object_access_check is not None:
+            return object_access_check
+
+        # get the generation before the lookup so any change made while it's
+        # running makes this decision stale
+        generation = dbsearch.object_access_generation(self.basedir,
+                                                       collection)
+
+        object_access_check = yield self.executor.submit(
+            dbsearch.sqlite_check_object_access,
+            self.basedir,
+            collection,
+            objectid,
+            incoming_userid=self.current_user['user_id'],
+            incoming_role=self.current_user['user_role'],
+            action='view',
+        )
+
+        dbsearch.cache_object_access(
+            self.basedir,
+            collection,
+            objectid,
+            object_access_check,
+            generation,
+            incoming_userid=self.current_user['user_id'],
+            incoming_role=self.current_user['user_role'],
+            action='view',
+        )
+
+        return object_access_check
+
     @gen.coroutine
     def get(self, path, include_body=True):
 
@@ -1301,17 +1626,9 @@ class AuthEnabledStaticHandler(BaseHandler):
             objectid = os.path.basename(path).replace('-csvlc.gz','')
             collection = os.path.dirname(path).replace('-','_')
 
-            object_lookup = yield self.executor.submit(
-                dbsearch.sqlite_fulltext_search,
-                self.basedir,
-                '"%s"' % objectid,
-                lcclist=[collection],
-                incoming_userid=self.current_user['user_id'],
-                incoming_role=self.current_user['user_role'],
-                override_action='view',
-            )
+            object_access_check = yield self.object_access_ok(collection,
+                                                              objectid)
 
-            object_access_check = len(object_lookup[collection]['result']) > 0
             LOGGER.info('object_access_check = %s' % object_access_check)
 
             if not object_access_check:
@@ -1349,43 +1666,7 @@ class AuthEnabledStaticHandler(BaseHandler):
             # next, check if the user is anonymous and that their session token
             # matches with the dataset. if the session token doesn't match and
             # the dataset is private, don't allow access.
-            # check if the current user is anonymous or not
-            if (self.current_user['user_id'] not in (2,3) and
-                self.current_user['user_id'] == ds['owner']):
-
-                ds['owned'] = True
-                access_ok = True
-
-            # otherwise, if the current user's session_token matches the
-            # session_token used to create the dataset, they're the
-            # owner.
-            elif ( (self.current_user['user_id'] == 2) and
-                   (self.current_user['session_token'] ==
-                    ds['session_token']) ):
-
-                ds['owned'] = True
-                access_ok = True
-
-            # if the current user is anonymous and the session tokens don't
-            # match, check if the dataset is public or unlisted
-            elif ( (self.current_user['user_id'] == 2) and
-                   (self.current_user['session_token'] !=
-                    ds['session_token']) ):
-
-                ds['owned'] = False
-                if ds['visibility'] in ('public', 'unlisted'):
-                    access_ok = True
-                else:
-                    access_ok = False
-
-            # otherwise, this is a dataset not owned by the current user
-            else:
-
-                ds['owned'] = False
-                if ds['visibility'] in ('public', 'unlisted', 'shared'):
-                    access_ok = True
-                else:
-                    access_ok = False
+            access_ok = self.dataset_file_access_ok(ds)
 
             LOGGER.info('dataset visible = %s, dataset access_ok = %s' %
                         (ds is not None, access_ok))
@@ -1396,6 +1677,17 @@ class AuthEnabledStaticHandler(BaseHandler):
                     path
                 )
 
+            # regenerate the LC ZIP if it was evicted by the retention manager
+            if 'lczip' in ds.get('products_evicted', []):
+
+                yield self.executor.submit(
+                    datasets.sqlite_restore_dataset_products,
+                    self.basedir,
+                    setid,
+                    products=('lczip',),
+                    max_dataset_lcs=self.siteinfo['lczip_max_nrows'],
+                )
+
         #
         # if the path includes 'dataset', check the ownership of the dataset
         #
@@ -1403,7 +1695,15 @@ class AuthEnabledStaticHandler(BaseHandler):
 
             setid = os.path.basename(
                 path
-            ).split('-')[1].replace('.pkl.gz','').replace('.csv','')
+            ).split('-')[1].replace(
+                '.pkl.gz',''
+            ).replace(
+                '.csv',''
+            ).replace(
+                '.fits',''
+            ).replace(
+                '.npz',''
+            )
 
             # get the dataset
             ds = yield self.executor.submit(
@@ -1425,43 +1725,7 @@ class AuthEnabledStaticHandler(BaseHandler):
             # next, check if the user is anonymous and that their session token
             # matches with the dataset. if the session token doesn't match and
             # the dataset is private, don't allow access.
-            # check if the current user is anonymous or not
-            if (self.current_user['user_id'] not in (2,3) and
-                self.current_user['user_id'] == ds['owner']):
-
-                ds['owned'] = True
-                access_ok = True
-
-            # otherwise, if the current user's session_token matches the
-            # session_token used to create the dataset, they're the
-            # owner.
-            elif ( (self.current_user['user_id'] == 2) and
-                   (self.current_user['session_token'] ==
-                    ds['session_token']) ):
-
-                ds['owned'] = True
-                access_ok = True
-
-            # if the current user is anonymous and the session tokens don't
-            # match, check if the dataset is public or unlisted
-            elif ( (self.current_user['user_id'] == 2) and
-                   (self.current_user['session_token'] !=
-                    ds['session_token']) ):
-
-                ds['owned'] = False
-                if ds['visibility'] in ('public', 'unlisted'):
-                    access_ok = True
-                else:
-                    access_ok = False
-
-            # otherwise, this is a dataset not owned by the current user
-            else:
-
-                ds['owned'] = False
-                if ds['visibility'] in ('public', 'unlisted', 'shared'):
-                    access_ok = True
-                else:
-                    access_ok = False
+            access_ok = self.dataset_file_access_ok(ds)
 
             LOGGER.info('dataset visible = %s, dataset access_ok = %s' %
                         (ds is not None, access_ok))
@@ -1472,6 +1736,35 @@ class AuthEnabledStaticHandler(BaseHandler):
                     path
                 )
 
+            # regenerate the CSV if it was evicted by the retention manager
+            if (path.endswith('.csv') and
+                'csv' in ds.get('products_evicted', [])):
+
+                yield self.executor.submit(
+                    datasets.sqlite_restore_dataset_products,
+                    self.basedir,
+                    setid,
+                    products=('csv',),
+                )
+
+            # binary exports of the dataset are generated on first request
+            exportformat = os.path.splitext(path)[-1].lstrip('.')
+            if exportformat in datasets.DATASET_EXPORT_FORMATS:
+
+                export_fpath = yield self.executor.submit(
+                    datasets.sqlite_export_dataset,
+                    self.basedir,
+                    setid,
+                    exportformat,
+                    incoming_userid=self.current_user['user_id'],
+                    incoming_role=self.current_user['user_role']
+                )
+
+                if export_fpath is None:
+                    raise HTTPError(
+                        404, "Could not generate the file: %s" % path
+                    )
+
         else:
 
             raise HTTPError(
@@ -70,6 +70,8 @@ LOGGER = logging.getLogger(__name__)
 import tornado.ioloop
 import tornado.httpserver
 import tornado.web
+import tornado.iostream
+import tornado.queues
 
 from tornado.escape import xhtml_escape
 from tornado.httpclient import AsyncHTTPClient
@@ -82,6 +84,7 @@ from tornado import gen
 
 from .. import __version__
 from ..backend import datasets
+from ..backend import dbsearch
 
 from .basehandler import BaseHandler
 
@@ -108,7 +111,8 @@ class DatasetHandler(BaseHandler):
                    session_expiry,
                    fernetkey,
                    ratelimit,
-                   cachedir):
+                   cachedir,
+                   lcconverter):
         '''
         handles initial setup.
 
@@ -128,6 +132,7 @@ class DatasetHandler(BaseHandler):
         self.httpclient = AsyncHTTPClient(force_instance=True)
         self.ratelimit = ratelimit
         self.cachedir = cachedir
+        self.lcconverter = lcconverter
 
     @gen.coroutine
     def get(self, setid):
@@ -330,9 +335,11 @@ class DatasetHandler(BaseHandler):
             dataset_pickle = '/d/dataset-%s.pkl.gz' % setid
             ds['dataset_pickle'] = dataset_pickle
 
-            if os.path.exists(os.path.join(self.basedir,
-                                           'datasets',
-                                           'dataset-%s.csv' % setid)):
+            # evicted products are regenerated when they're downloaded
+            if (os.path.exists(os.path.join(self.basedir,
+                                            'datasets',
+                                            'dataset-%s.csv' % setid)) or
+                'csv' in ds.get('products_evicted', [])):
                 dataset_csv = '/d/dataset-%s.csv' % setid
                 ds['dataset_csv'] = dataset_csv
 
@@ -340,7 +347,12 @@ class DatasetHandler(BaseHandler):
                 dataset_csv = None
                 ds['dataset_csv'] = None
 
-            if os.path.exists(ds['lczipfpath']):
+            # binary exports are only available once the dataset is complete
+            ds['dataset_fits'] = None
+            ds['dataset_npz'] = None
+
+            if (os.path.exists(ds['lczipfpath']) or
+                'lczip' in ds.get('products_evicted', [])):
 
                 dataset_lczip = ds['lczipfpath'].replace(
                     os.path.join(self.basedir, 'products'),
@@ -647,9 +659,11 @@ class DatasetHandler(BaseHandler):
             dataset_pickle = '/d/dataset-%s.pkl.gz' % setid
             ds['dataset_pickle'] = dataset_pickle
 
-            if os.path.exists(os.path.join(self.basedir,
-                                           'datasets',
-                                           'dataset-%s.csv' % setid)):
+            # evicted products are regenerated when they're downloaded
+            if (os.path.exists(os.path.join(self.basedir,
+                                            'datasets',
+                                            'dataset-%s.csv' % setid)) or
+                'csv' in ds.get('products_evicted', [])):
                 dataset_csv = '/d/dataset-%s.csv' % setid
                 ds['dataset_csv'] = dataset_csv
 
@@ -657,7 +671,12 @@ class DatasetHandler(BaseHandler):
                 dataset_csv = None
                 ds['dataset_csv'] = None
 
-            if os.path.exists(ds['lczipfpath']):
+            # these are generated on first download by the static handler
+            ds['dataset_fits'] = '/d/dataset-%s.fits' % setid
+            ds['dataset_npz'] = '/d/dataset-%s.npz' % setid
+
+            if (os.path.exists(ds['lczipfpath']) or
+                'lczip' in ds.get('products_evicted', [])):
 
                 dataset_lczip = ds['lczipfpath'].replace(
                     os.path.join(self.basedir, 'products'),
@@ -1000,6 +1019,19 @@ class DatasetHandler(BaseHandler):
 
         - 'delete' the dataset
 
+        anyone who can view a complete dataset can also 'derive' a new dataset
+        from it by re-sorting and/or filtering its rows. The update payload
+        for this action is:
+
+        {'sortspec': [['column', 'asc|desc'], ...],
+         'filterspec': [['column', 'gt|lt|ge|le|eq|ne|ct', value], ...]}
+
+        authenticated and above can also 'refresh' a complete dataset they can
+        edit. This re-runs its search against any of its collections that have
+        been updated since the dataset was, and replaces those collections'
+        rows and LCs. The update payload for this action is ignored, but must
+        be valid JSON, e.g. {}.
+
         The dataset CSV will not be regenerated because we're lazy.
 
         FIXME: implement dataset sharedwith changes once we figure that out on
@@ -1070,7 +1102,9 @@ class DatasetHandler(BaseHandler):
                           'change_owner',
                           'change_visibility',
                           # 'change_sharedwith',  # FIXME: implement this later
-                          'delete'):
+                          'delete',
+                          'derive',
+                          'refresh'):
 
             message = (
                 "Unknown action specified."
@@ -1352,6 +1386,178 @@ class DatasetHandler(BaseHandler):
                             'message':message})
                 self.finish()
 
+        #
+        # handle making a new dataset by re-sorting or filtering this one
+        #
+        elif action == 'derive':
+
+            ds_derived = None
+
+            try:
+
+                ds_derived = yield self.executor.submit(
+                    datasets.sqlite_derive_dataset,
+                    self.basedir,
+                    setid,
+                    sortspec=payload.get('sortspec', None),
+                    filterspec=payload.get('filterspec', None),
+                    incoming_userid=incoming_userid,
+                    incoming_role=incoming_role,
+                    incoming_session_token=incoming_session_token,
+                    rows_per_page=self.siteinfo['dataset_rows_per_page']
+                )
+
+                if ds_derived:
+
+                    (new_setid, csvlcs_to_generate,
+                     all_original_lcs, ds_nrows, ds_npages) = ds_derived
+
+                    # the CSV LCs exist already, so we'll just zip them up in
+                    # the background. the dataset will be marked complete
+                    # once this is done.
+                    self.lcconverter.make_dataset_lczip(
+                        self.executor,
+                        self.basedir,
+                        new_setid,
+                        csvlcs_to_generate,
+                        all_original_lcs,
+                        max_dataset_lcs=self.siteinfo['lczip_max_nrows'],
+                    )
+
+                    message = (
+                        "New dataset derived successfully."
+                    )
+
+                    self.write({'status':'ok',
+                                'date':datetime.utcnow().isoformat(),
+                                'result':{'setid':new_setid,
+                                          'url':'/set/%s' % new_setid,
+                                          'nrows':ds_nrows,
+                                          'npages':ds_npages},
+                                'message':message})
+                    self.finish()
+
+                else:
+
+                    message = (
+                        "Could not derive a new dataset. "
+                        "Check the sortspec and filterspec."
+                    )
+
+                    self.write({'status':'failed',
+                                'date':datetime.utcnow().isoformat(),
+                                'result':None,
+                                'message':message})
+                    self.finish()
+
+            except Exception:
+
+                LOGGER.exception(
+                    'could not derive a new dataset from: %s, user_id = %s, '
+                    ' role = %s, session_token = %s'
+                    % (setid, incoming_userid,
+                       incoming_role, incoming_session_token)
+                )
+                message = (
+                    "Could not derive a new dataset."
+                )
+
+                self.write({'status':'failed',
+                            'date':datetime.utcnow().isoformat(),
+                            'result':None,
+                            'message':message})
+                self.finish()
+
+        #
+        # handle refreshing the dataset's rows from updated collections
+        #
+        elif action == 'refresh':
+
+            try:
+
+                ds_refreshed = yield self.executor.submit(
+                    datasets.sqlite_refresh_dataset,
+                    self.basedir,
+                    setid,
+                    incoming_userid=incoming_userid,
+                    incoming_role=incoming_role,
+                    incoming_session_token=incoming_session_token,
+                )
+
+                if ds_refreshed:
+
+                    (ds_setid, csvlcs_to_generate,
+                     refreshed_collections, ds_nrows, ds_npages) = ds_refreshed
+
+                    if len(refreshed_collections) > 0:
+
+                        # only the LCs from the updated collections need to be
+                        # converted, so this happens in the background. the
+                        # dataset will be marked complete once this is done.
+                        self.lcconverter.refresh_dataset_lczip(
+                            self.executor,
+                            self.basedir,
+                            setid,
+                            csvlcs_to_generate,
+                            refreshed_collections,
+                            max_dataset_lcs=self.siteinfo['lczip_max_nrows'],
+                        )
+
+                        message = (
+                            "Dataset refreshed using updated collections: %s."
+                            % ', '.join(refreshed_collections)
+                        )
+
+                    else:
+
+                        message = (
+                            "Dataset is already up to date."
+                        )
+
+                    self.write({'status':'ok',
+                                'date':datetime.utcnow().isoformat(),
+                                'result':{
+                                    'setid':setid,
+                                    'refreshed_collections':(
+                                        refreshed_collections
+                                    ),
+                                    'nrows':ds_nrows,
+                                    'npages':ds_npages
+                                },
+                                'message':message})
+                    self.finish()
+
+                else:
+
+                    message = (
+                        "Dataset refresh failed. Only the owner of a "
+                        "complete dataset can refresh it."
+                    )
+
+                    self.write({'status':'failed',
+                                'date':datetime.utcnow().isoformat(),
+                                'result':None,
+                                'message':message})
+                    self.finish()
+
+            except Exception:
+
+                LOGGER.exception(
+                    'could not refresh dataset: %s, user_id = %s, '
+                    ' role = %s, session_token = %s'
+                    % (setid, incoming_userid,
+                       incoming_role, incoming_session_token)
+                )
+                message = (
+                    "Dataset refresh failed."
+                )
+
+                self.write({'status':'failed',
+                            'date':datetime.utcnow().isoformat(),
+                            'result':None,
+                            'message':message})
+                self.finish()
+
         #
         # any other action is an automatic fail
         #
@@ -1368,6 +1574,432 @@ class DatasetHandler(BaseHandler):
             self.finish()
 
 
+######################################
+## DATASET LC ZIP STREAMING HANDLER ##
+######################################
+
+def _next_lczip_chunk(members, cachefd=None):
+    '''This gets the next chunk of an LC ZIP member from LCZipStream.add_lc.
+
+    This reads the CSV LC and computes its CRC, so it runs in a thread instead
+    of on the IOLoop. The chunk is also written to cachefd if it's given.
+    Returns None once the member has been added.
+
+    '''
+
+    chunk = next(members, None)
+
+    if chunk and cachefd is not None:
+        cachefd.write(chunk)
+
+    return chunk
+
+
+@gen.coroutine
+def stream_lczip_lc(handler, lczip, lcf, cachefd=None):
+    '''This adds a CSV LC to an LCZipStream and sends it to the client.
+
+    The CSV LC is read in chunks in a thread, and each chunk is flushed to the
+    client before the next one is read.
+
+    '''
+
+    members = lczip.add_lc(lcf)
+
+    while True:
+
+        chunk = yield tornado.ioloop.IOLoop.current().run_in_executor(
+            None,
+            _next_lczip_chunk,
+            members,
+            cachefd
+        )
+        if chunk is None:
+            break
+
+        if chunk:
+            handler.write(chunk)
+            yield handler.flush()
+
+
+class DatasetLCZipHandler(BaseHandler):
+    '''This streams a dataset's LCs to the user as a ZIP file.
+
+    The ZIP is written directly to the response as each CSV LC becomes
+    available, so the download starts right away even if the dataset's LCs are
+    still being converted.
+
+    '''
+
+    def initialize(self,
+                   currentdir,
+                   apiversion,
+                   templatepath,
+                   assetpath,
+                   executor,
+                   basedir,
+                   siteinfo,
+                   authnzerver,
+                   session_expiry,
+                   fernetkey,
+                   ratelimit,
+                   cachedir):
+        '''
+        handles initial setup.
+
+        '''
+
+        self.currentdir = currentdir
+        self.apiversion = apiversion
+        self.templatepath = templatepath
+        self.assetpath = assetpath
+        self.executor = executor
+        self.basedir = basedir
+        self.siteinfo = siteinfo
+        self.authnzerver = authnzerver
+        self.session_expiry = session_expiry
+        self.fernetkey = fernetkey
+        self.ferneter = Fernet(fernetkey)
+        self.httpclient = AsyncHTTPClient(force_instance=True)
+        self.ratelimit = ratelimit
+        self.cachedir = cachedir
+
+    @gen.coroutine
+    def get(self, setid):
+        '''This streams the LC ZIP for the dataset.
+
+        If the dataset's LC ZIP has been made already, redirects to it.
+
+        ?cache=1 -> also write the streamed ZIP to the dataset's LC ZIP file in
+                    the products directory if the dataset is complete.
+
+        '''
+
+        if not self.current_user:
+            raise tornado.web.HTTPError(
+                403,
+                "No session_token or API key provided to access the dataset."
+            )
+
+        ds = yield self.executor.submit(
+            datasets.sqlite_get_dataset,
+            self.basedir,
+            setid,
+            'pickle',
+            incoming_userid=self.current_user['user_id'],
+            incoming_role=self.current_user['user_role']
+        )
+
+        if ds is None or not self.dataset_file_access_ok(ds):
+            raise tornado.web.HTTPError(
+                401, "You are not authorized to access this dataset."
+            )
+
+        # if the LC ZIP exists already, the static handler can serve it
+        if ds['status'] == 'complete' and os.path.exists(ds['lczipfpath']):
+            self.redirect('/p/%s' % os.path.basename(ds['lczipfpath']))
+            return
+
+        lczip_max_nrows = self.siteinfo['lczip_max_nrows']
+        if len(ds['result']) > lczip_max_nrows:
+            raise tornado.web.HTTPError(
+                400,
+                "This dataset has more than %s light curves, "
+                "so they can't be collected into a ZIP file." %
+                lczip_max_nrows
+            )
+
+        try:
+            cache_zip = xhtml_escape(self.get_argument('cache', default='0'))
+            cache_zip = (cache_zip == '1' and ds['status'] == 'complete')
+        except Exception:
+            cache_zip = False
+
+        lclist = datasets.dataset_csvlc_paths(self.basedir, ds['result'])
+        setid = ds['setid']
+        del ds
+
+        self.set_header('Content-Type', 'application/zip')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="lightcurves-%s.zip"' % setid)
+
+        if cache_zip:
+            lczip_fpath = os.path.join(self.basedir,
+                                       'products',
+                                       'lightcurves-%s.zip' % setid)
+            cache_fpath = '%s.tmp-%s-%s' % (lczip_fpath,
+                                            os.getpid(),
+                                            id(self))
+            cachefd = open(cache_fpath, 'wb')
+        else:
+            cachefd = None
+
+        # we'll stop waiting for the rest of the LCs if none of them show up
+        # for this long
+        lczip_timeout = self.siteinfo['lczip_timeout_sec']
+        lczip = datasets.LCZipStream()
+        waiting = lclist
+        waited = 0.0
+
+        try:
+
+            # we'll send whichever CSV LCs are available, then wait for the
+            # rest while the dataset's LCs are being converted
+            while True:
+
+                pending = []
+
+                for lcf in waiting:
+
+                    if os.path.exists(lcf):
+                        yield stream_lczip_lc(self, lczip, lcf, cachefd)
+                    else:
+                        pending.append(lcf)
+
+                if len(pending) < len(waiting):
+                    waited = 0.0
+
+                waiting = pending
+                if not waiting or waited >= lczip_timeout:
+                    break
+
+                # this doesn't record an access for the retention manager
+                # every time we poll
+                ds_status = yield self.executor.submit(
+                    datasets.sqlite_get_dataset_status,
+                    self.basedir,
+                    setid,
+                    incoming_userid=self.current_user['user_id'],
+                    incoming_role=self.current_user['user_role']
+                )
+                if ds_status != 'in progress':
+                    break
+
+                yield gen.sleep(1.0)
+                waited = waited + 1.0
+
+            for lcf in waiting:
+                lczip.add_missing(lcf)
+
+            chunk = lczip.close()
+            self.write(chunk)
+            if cachefd is not None:
+                cachefd.write(chunk)
+                cachefd.close()
+                cachefd = None
+                os.replace(cache_fpath, lczip_fpath)
+
+            LOGGER.info('streamed LC ZIP for dataset: %s, %s LCs missing' %
+                        (setid, len(waiting)))
+            self.finish()
+
+        except tornado.iostream.StreamClosedError:
+
+            LOGGER.warning('client closed the connection while '
+                           'streaming the LC ZIP for dataset: %s' % setid)
+
+        finally:
+
+            if cachefd is not None:
+                cachefd.close()
+                os.remove(cache_fpath)
+
+
+##################################
+## BULK LIGHT CURVE ZIP HANDLER ##
+##################################
+
+class BulkLCHandler(BaseHandler):
+    '''This streams the LCs of a list of objects to the user as a ZIP file.
+
+    The objects are looked up in each collection with a single batched query
+    that also checks the user's access to them, instead of one full-text
+    search per object like the /l/ static file handler does.
+
+    '''
+
+    def initialize(self,
+                   currentdir,
+                   apiversion,
+                   templatepath,
+                   assetpath,
+                   executor,
+                   basedir,
+                   siteinfo,
+                   authnzerver,
+                   session_expiry,
+                   fernetkey,
+                   ratelimit,
+                   cachedir,
+                   lcconverter):
+        '''
+        handles initial setup.
+
+        '''
+
+        self.currentdir = currentdir
+        self.apiversion = apiversion
+        self.templatepath = templatepath
+        self.assetpath = assetpath
+        self.executor = executor
+        self.basedir = basedir
+        self.siteinfo = siteinfo
+        self.authnzerver = authnzerver
+        self.session_expiry = session_expiry
+        self.fernetkey = fernetkey
+        self.ferneter = Fernet(fernetkey)
+        self.httpclient = AsyncHTTPClient(force_instance=True)
+        self.ratelimit = ratelimit
+        self.cachedir = cachedir
+        self.lcconverter = lcconverter
+
+    def fail(self, status, message):
+        '''
+        This writes a failure message and finishes the request.
+
+        '''
+
+        self.set_status(status)
+        self.write({'status':'failed',
+                    'result':None,
+                    'message':message})
+        raise tornado.web.Finish()
+
+    @gen.coroutine
+    def post(self):
+        '''This streams the LCs for the requested objects as a ZIP file.
+
+        The objects are given as a JSON list of [collection, objectid] pairs,
+        either in the 'objects' argument or as the 'objects' key of a JSON
+        request body. At most the site's bulklc_max_objects objects can be
+        requested at once.
+
+        Each CSV LC is streamed as soon as it's available, so objects that
+        haven't been converted yet are sent as their conversions finish.
+        Objects that don't exist or that the user can't access, or whose LCs
+        couldn't be converted, are noted as missing in the ZIP's manifest.
+
+        '''
+
+        if not self.keycheck['status'] == 'ok':
+            self.fail(401, self.keycheck['message'])
+
+        if not self.current_user:
+            self.fail(403, "No session_token or API key provided "
+                      "to access these light curves.")
+
+        try:
+
+            content_type = self.request.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                objects = json.loads(self.request.body)['objects']
+            else:
+                objects = json.loads(self.get_argument('objects'))
+
+            requested = []
+            for coll, objectid in objects:
+
+                item = (xhtml_escape(str(coll)).strip().replace('-','_'),
+                        xhtml_escape(str(objectid)).strip())
+                if item[0] and item[1] and item not in requested:
+                    requested.append(item)
+
+        except Exception:
+            self.fail(400, "Could not parse the list of objects. "
+                      "This should be a JSON list of "
+                      "[collection, objectid] pairs.")
+
+        if len(requested) == 0:
+            self.fail(400, "No objects were provided.")
+
+        max_objects = self.siteinfo.get('bulklc_max_objects', 1000)
+        if len(requested) > max_objects:
+            self.fail(400, "At most %s objects can be requested at once."
+                      % max_objects)
+
+        lookup = yield self.executor.submit(
+            dbsearch.sqlite_objectid_lookup,
+            self.basedir,
+            requested,
+            incoming_userid=self.current_user['user_id'],
+            incoming_role=self.current_user['user_role'],
+            override_action='view',
+        )
+
+        csvlcs_to_generate = datasets.bulk_csvlcs_to_generate(self.basedir,
+                                                              lookup)
+
+        if len(csvlcs_to_generate) == 0:
+            self.fail(401, "None of the requested objects were found or "
+                      "you are not authorized to access them.")
+
+        found = {(x[3], x[1]) for x in csvlcs_to_generate}
+        notfound = [x for x in requested if x not in found]
+
+        LOGGER.info('bulk LC request: %s objects requested, %s found' %
+                    (len(requested), len(found)))
+
+        self.set_header('Content-Type', 'application/zip')
+        self.set_header(
+            'Content-Disposition',
+            'attachment; filename="lightcurves-bulk-%s.zip"' %
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        )
+
+        lczip = datasets.LCZipStream()
+
+        # the CSV LCs are put in this queue as they become available. a None
+        # is put in it when the conversion is done.
+        ready = tornado.queues.Queue()
+
+        conversion = self.lcconverter.convert_object_lcs(
+            self.executor,
+            self.basedir,
+            'bulk-lcs-%s' % self.current_user['user_id'],
+            csvlcs_to_generate,
+            ready=ready
+        )
+        conversion.add_done_callback(lambda x: ready.put_nowait(None))
+
+        try:
+
+            sent = set()
+
+            while True:
+
+                lcf = yield ready.get()
+                if lcf is None:
+                    break
+
+                if os.path.exists(lcf):
+                    yield stream_lczip_lc(self, lczip, lcf)
+                else:
+                    lczip.add_missing(lcf)
+                sent.add(lcf)
+
+            try:
+                yield conversion
+            except Exception:
+                LOGGER.exception('could not convert all of the LCs '
+                                 'for a bulk LC ZIP')
+
+            for lcf in [x[-1] for x in csvlcs_to_generate]:
+                if lcf not in sent:
+                    lczip.add_missing(lcf)
+                    sent.add(lcf)
+
+            for coll, objectid in notfound:
+                lczip.add_missing('%s-csvlc.gz' % objectid)
+
+            self.write(lczip.close())
+            self.finish()
+
+        except tornado.iostream.StreamClosedError:
+
+            LOGGER.warning('client closed the connection while '
+                           'streaming a bulk LC ZIP')
+
+
 #############################
 ## DATASET LISTING HANDLER ##
 #############################
@@ -23,6 +23,7 @@ import time
 import sys
 import socket
 import json
+from functools import partial
 
 
 # setup signal trapping on SIGINT
@@ -88,6 +89,12 @@ define('backgroundworkers',
        help=('number of background workers to use '),
        type=int)
 
+define('lcworkers',
+       default=4,
+       help=('number of worker processes in the shared pool that '
+             'converts LCs for dataset LC ZIPs'),
+       type=int)
+
 # the template path
 define('templatepath',
        default=os.path.abspath(os.path.join(modpath,'templates')),
@@ -130,7 +137,10 @@ define('cpaddr',
 define('authnzerver',
        default='http://127.0.0.1:12600',
        help=('This tells the lcc-server the address of '
-             'the local authentication and authorization server.'),
+             'the local authentication and authorization server. '
+             'Use unix:///path/to/socket or tcp://127.0.0.1:port to talk '
+             'to it over a persistent connection if it was started with '
+             '--unixsocket or --streamport.'),
        type=str)
 
 ## this tells the testserver about the default session expiry time in days
@@ -140,6 +150,27 @@ define('sessionexpiry',
        type=int)
 
 
+## this tells the indexserver how long to cache session info for
+define('sessioncachettl',
+       default=60.0,
+       help=('This tells the lcc-server how long in seconds to keep '
+             'session info from the authnzerver in its session cache. '
+             'Set this to 0 to turn off the session cache.'),
+       type=float)
+
+
+## this tells the indexserver how often to fetch the revoked API keys
+define('apikeyrevocationsync',
+       default=0.0,
+       help=('This tells the lcc-server how often in seconds to fetch the '
+             'list of revoked API keys from the authnzerver. If this is '
+             'more than 0, API keys are verified by the lcc-server itself '
+             'using this list instead of by the authnzerver. A revoked API '
+             'key may keep working for up to three times this long. '
+             'Set this to 0 to verify every API key with the authnzerver.'),
+       type=float)
+
+
 #
 # worker set up for the pool
 #
@@ -182,8 +213,12 @@ def main():
     from . import objectserver_handlers as oh
     from . import auth_handlers as ah
     from . import admin_handlers as admin
-    from .basehandler import AuthEnabledStaticHandler
+    from .basehandler import AuthEnabledStaticHandler, SESSION_CACHE
+    from .basehandler import expire_session_state
+    from .basehandler import APIKEY_REVOCATIONS, sync_apikey_revocations
+    from .lcconverter import LCConversionPool
     from ..authnzerver import authdb
+    from ..backend import datasets
 
     from ..utils import ProcExecutor
 
@@ -353,6 +388,11 @@ def main():
     #
     AUTHNZERVER = options.authnzerver
     SESSION_EXPIRY = options.sessionexpiry
+    SESSION_CACHE.ttl = options.sessioncachettl
+
+    # the revocation list is used until it misses two updates in a row
+    APIKEY_REVOCATION_SYNC = options.apikeyrevocationsync
+    APIKEY_REVOCATIONS.max_age = 3.0*APIKEY_REVOCATION_SYNC
 
     #
     # rate limit options
@@ -386,6 +426,11 @@ def main():
                             initializer=setup_worker,
                             initargs=())
 
+    # this is the shared pool used to convert LCs for all dataset LC ZIPs
+    LCCONVERTER = LCConversionPool(max_workers=options.lcworkers,
+                                   initializer=setup_worker,
+                                   initargs=())
+
     ##################
     ## URL HANDLERS ##
     ##################
@@ -744,7 +789,8 @@ def main():
           'session_expiry':SESSION_EXPIRY,
           'fernetkey':FERNETSECRET,
           'ratelimit':RATELIMIT,
-          'cachedir':CACHEDIR}),
+          'cachedir':CACHEDIR,
+          'lcconverter':LCCONVERTER}),
 
         # this is the cone search API endpoint
         (r'/api/conesearch',
@@ -761,7 +807,8 @@ def main():
           'session_expiry':SESSION_EXPIRY,
           'fernetkey':FERNETSECRET,
           'ratelimit':RATELIMIT,
-          'cachedir':CACHEDIR}),
+          'cachedir':CACHEDIR,
+          'lcconverter':LCCONVERTER}),
 
         # this is the FTS search API endpoint
         (r'/api/ftsquery',
@@ -778,7 +825,8 @@ def main():
           'session_expiry':SESSION_EXPIRY,
           'fernetkey':FERNETSECRET,
           'ratelimit':RATELIMIT,
-          'cachedir':CACHEDIR}),
+          'cachedir':CACHEDIR,
+          'lcconverter':LCCONVERTER}),
 
         # this is the xmatch search API endpoint
         (r'/api/xmatch',
@@ -795,7 +843,8 @@ def main():
           'session_expiry':SESSION_EXPIRY,
           'fernetkey':FERNETSECRET,
           'ratelimit':RATELIMIT,
-          'cachedir':CACHEDIR}),
+          'cachedir':CACHEDIR,
+          'lcconverter':LCCONVERTER}),
 
         ##############################################
         ## DATASET DISPLAY AND LIVE-UPDATE HANDLERS ##
@@ -804,6 +853,23 @@ def main():
         # this is the dataset display API for a single dataset
         (r'/set/(\w+)/?\S*',
          dh.DatasetHandler,
+         {'currentdir':CURRENTDIR,
+          'apiversion':APIVERSION,
+          'templatepath':TEMPLATEPATH,
+          'assetpath':ASSETPATH,
+          'executor':EXECUTOR,
+          'basedir':BASEDIR,
+          'siteinfo':SITEINFO,
+          'authnzerver':AUTHNZERVER,
+          'session_expiry':SESSION_EXPIRY,
+          'fernetkey':FERNETSECRET,
+          'ratelimit':RATELIMIT,
+          'cachedir':CACHEDIR,
+          'lcconverter':LCCONVERTER}),
+
+        # this streams a dataset's LCs as a ZIP file
+        (r'/api/lczip/(\w+)',
+         dh.DatasetLCZipHandler,
          {'currentdir':CURRENTDIR,
           'apiversion':APIVERSION,
           'templatepath':TEMPLATEPATH,
@@ -817,6 +883,23 @@ def main():
           'ratelimit':RATELIMIT,
           'cachedir':CACHEDIR}),
 
+        # this streams the LCs of a list of objects as a ZIP file
+        (r'/api/bulklc',
+         dh.BulkLCHandler,
+         {'currentdir':CURRENTDIR,
+          'apiversion':APIVERSION,
+          'templatepath':TEMPLATEPATH,
+          'assetpath':ASSETPATH,
+          'executor':EXECUTOR,
+          'basedir':BASEDIR,
+          'siteinfo':SITEINFO,
+          'authnzerver':AUTHNZERVER,
+          'session_expiry':SESSION_EXPIRY,
+          'fernetkey':FERNETSECRET,
+          'ratelimit':RATELIMIT,
+          'cachedir':CACHEDIR,
+          'lcconverter':LCCONVERTER}),
+
         # this just shows all datasets in a big table
         (r'/datasets',
          dh.AllDatasetsHandler,
@@ -854,6 +937,38 @@ def main():
           'ratelimit':RATELIMIT,
           'cachedir':CACHEDIR}),
 
+        # returns slices of an object's LC from its collection's LC store
+        (r'/api/lcslice',
+         oh.LCSliceHandler,
+         {'currentdir':CURRENTDIR,
+          'apiversion':APIVERSION,
+          'templatepath':TEMPLATEPATH,
+          'assetpath':ASSETPATH,
+          'executor':EXECUTOR,
+          'basedir':BASEDIR,
+          'siteinfo':SITEINFO,
+          'authnzerver':AUTHNZERVER,
+          'session_expiry':SESSION_EXPIRY,
+          'fernetkey':FERNETSECRET,
+          'ratelimit':RATELIMIT,
+          'cachedir':CACHEDIR}),
+
+        # plots an object's LC from its collection's LC store
+        (r'/api/lcplot',
+         oh.LCPlotHandler,
+         {'currentdir':CURRENTDIR,
+          'apiversion':APIVERSION,
+          'templatepath':TEMPLATEPATH,
+          'assetpath':ASSETPATH,
+          'executor':EXECUTOR,
+          'basedir':BASEDIR,
+          'siteinfo':SITEINFO,
+          'authnzerver':AUTHNZERVER,
+          'session_expiry':SESSION_EXPIRY,
+          'fernetkey':FERNETSECRET,
+          'ratelimit':RATELIMIT,
+          'cachedir':CACHEDIR}),
+
         # renders objectinfo from API above to an HTML page for easy viewing
         (r'/obj/(\S+)/(\S+)',
          oh.ObjectInfoPageHandler,
@@ -934,6 +1049,78 @@ def main():
                 (MAXWORKERS, IOLOOP_SPEC))
     LOGGER.info('The current base directory is: %s' % os.path.abspath(BASEDIR))
 
+    #
+    # set up the dataset retention manager if any disk quotas are set
+    #
+    dataset_quota_total_gb = SITEINFO.get('dataset_quota_total_gb')
+    dataset_quota_per_owner_gb = SITEINFO.get('dataset_quota_per_owner_gb')
+
+    if (dataset_quota_total_gb is not None or
+        dataset_quota_per_owner_gb is not None):
+
+        retention_func = partial(
+            EXECUTOR.submit,
+            datasets.sqlite_apply_dataset_retention,
+            BASEDIR,
+            total_quota_bytes=(
+                int(dataset_quota_total_gb*1024**3)
+                if dataset_quota_total_gb is not None else None
+            ),
+            owner_quota_bytes=(
+                int(dataset_quota_per_owner_gb*1024**3)
+                if dataset_quota_per_owner_gb is not None else None
+            ),
+        )
+        retention_interval_min = SITEINFO.get(
+            'dataset_retention_interval_min', 60
+        )
+        retention_callback = tornado.ioloop.PeriodicCallback(
+            retention_func,
+            retention_interval_min*60*1000.0,
+            jitter=0.1
+        )
+        retention_callback.start()
+
+        LOGGER.info('Dataset retention: total quota = %s GB, '
+                    'per-owner quota = %s GB, checked every %s min.' %
+                    (dataset_quota_total_gb,
+                     dataset_quota_per_owner_gb,
+                     retention_interval_min))
+
+    #
+    # drop expired sessions and idle rate limits every minute
+    #
+    session_state_callback = tornado.ioloop.PeriodicCallback(
+        expire_session_state,
+        60000.0,
+        jitter=0.1
+    )
+    session_state_callback.start()
+
+    #
+    # keep the revoked API key list up to date if API keys are verified here
+    #
+    if APIKEY_REVOCATION_SYNC > 0.0:
+
+        revocation_sync_func = partial(
+            tornado.ioloop.IOLoop.current().spawn_callback,
+            sync_apikey_revocations,
+            AUTHNZERVER,
+            FERNETSECRET
+        )
+        revocation_sync_func()
+
+        revocation_callback = tornado.ioloop.PeriodicCallback(
+            revocation_sync_func,
+            APIKEY_REVOCATION_SYNC*1000.0,
+            jitter=0.1
+        )
+        revocation_callback.start()
+
+        LOGGER.info('API keys will be verified locally, revoked API keys '
+                    'are fetched from the authnzerver every %.1f sec.' %
+                    APIKEY_REVOCATION_SYNC)
+
     # register the signal callbacks
     signal.signal(signal.SIGINT,_recv_sigint)
     signal.signal(signal.SIGTERM,_recv_sigint)
@@ -950,6 +1137,7 @@ def main():
         # close down the processpool
 
     EXECUTOR.shutdown()
+    LCCONVERTER.shutdown()
     time.sleep(2)
 
 
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''lcconverter.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This contains the long-lived light curve conversion pool used by the
+indexserver to convert original LCs to CSV LCs for dataset LC ZIPs.
+
+'''
+
+####################
+## SYSTEM IMPORTS ##
+####################
+
+import logging
+import os.path
+from collections import deque
+from functools import partial
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+###################
+## LOCAL IMPORTS ##
+###################
+
+from ..backend import datasets
+from ..utils import ProcExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+
+#####################
+## CONVERSION POOL ##
+#####################
+
+class LCConversionPool(object):
+    '''This is a pool of worker processes shared by all dataset LC jobs.
+
+    The workers are started once by the indexserver and keep their parsed LC
+    format descriptions and reader functions cached between jobs.
+
+    Each job's LCs are split into batches of batch_size LCs. Batches from all
+    waiting jobs are sent to the workers round-robin, with at most
+    max_inflight batches running at once, so a large dataset doesn't hold up
+    smaller datasets submitted after it. A job's CSV LCs are linked into place
+    as each of its batches finishes, so they can be streamed by the LC ZIP
+    handlers before the whole job is done.
+
+    The methods of this class must be called from the IOLoop thread.
+
+    '''
+
+    def __init__(self,
+                 max_workers=4,
+                 batch_size=25,
+                 max_inflight=None,
+                 initializer=None,
+                 initargs=()):
+        '''
+        This sets up the pool.
+
+        '''
+
+        self.executor = ProcExecutor(max_workers=max_workers,
+                                     initializer=initializer,
+                                     initargs=initargs)
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_inflight = (max_inflight if max_inflight is not None
+                             else max_workers)
+
+        # these are the jobs with batches waiting to be sent to the workers, in
+        # round-robin order
+        self.waiting_jobs = deque()
+        self.jobs = {}
+        self.inflight = 0
+        self.jobcounter = 0
+
+    def _dispatch(self):
+        '''
+        This sends batches to the workers round-robin across waiting jobs.
+
+        '''
+
+        while self.inflight < self.max_inflight and self.waiting_jobs:
+
+            jobid = self.waiting_jobs.popleft()
+            job = self.jobs[jobid]
+            batch_start, batch = job['batches'].popleft()
+
+            # put the job at the back of the line if it has more batches
+            if job['batches']:
+                self.waiting_jobs.append(jobid)
+
+            self.inflight += 1
+            batch_future = self.executor.submit(datasets.csvlc_convert_batch,
+                                                batch)
+            IOLoop.current().add_future(
+                batch_future,
+                partial(self._batch_done, jobid, batch_start, len(batch))
+            )
+
+    def _batch_done(self, jobid, batch_start, batch_len, batch_future):
+        '''
+        This stores the results of a finished batch and dispatches more.
+
+        '''
+
+        self.inflight -= 1
+        job = self.jobs[jobid]
+
+        try:
+            batch_results = batch_future.result()
+        except Exception as e:
+            LOGGER.exception('LC conversion batch for job: %s failed' %
+                             job['name'])
+            if not job['future'].done():
+                job['future'].set_exception(e)
+            batch_results = None
+
+        batch_end = batch_start + batch_len
+
+        if batch_results is not None:
+
+            job['results'][batch_start:batch_end] = batch_results
+
+            # put the batch's CSV LCs into place in a thread, the job is done
+            # when this has been done for all of its batches
+            if job['batch_func'] is not None:
+                func_future = IOLoop.current().run_in_executor(
+                    None,
+                    job['batch_func'],
+                    job['items'][batch_start:batch_end],
+                    batch_results
+                )
+                IOLoop.current().add_future(
+                    func_future,
+                    partial(self._batch_finished,
+                            jobid,
+                            batch_start,
+                            batch_end)
+                )
+            else:
+                self._batch_finished(jobid, batch_start, batch_end)
+
+        else:
+            self._batch_finished(jobid, batch_start, batch_end)
+
+        self._dispatch()
+
+    def _batch_finished(self, jobid, batch_start, batch_end, func_future=None):
+        '''
+        This finishes the job once all of its batches are done.
+
+        '''
+
+        job = self.jobs[jobid]
+
+        if func_future is not None and func_future.exception() is not None:
+            LOGGER.error('could not put the CSV LCs for job: %s in place: %r' %
+                         (job['name'], func_future.exception()))
+
+        if job['ready'] is not None:
+            for item in job['items'][batch_start:batch_end]:
+                job['ready'].put_nowait(item[-1])
+
+        job['pending'] -= 1
+
+        if job['pending'] == 0:
+            del self.jobs[jobid]
+            if not job['future'].done():
+                job['future'].set_result(job['results'])
+
+    def convert(self,
+                name,
+                dataset_csvlcs_to_generate,
+                convertopts,
+                batch_func=None,
+                ready=None):
+        '''This converts the LCs for a dataset.
+
+        name identifies the job in the logs (usually the dataset's setid).
+        dataset_csvlcs_to_generate is the list of LCs to convert as returned by
+        datasets.sqlite_new_dataset and convertopts are the kwargs for
+        abcat.convert_to_csvlc.
+
+        If batch_func is given, it's called in a thread with the items of each
+        batch and their results as the batch finishes, e.g. to link the CSV
+        LCs into place. If ready is a tornado.queues.Queue, the output CSV LC
+        paths of each batch's items are put in it once that's done.
+
+        Returns a Future that resolves to the list of conversion results, in
+        the same order as dataset_csvlcs_to_generate.
+
+        '''
+
+        tasks = [(x[0], x[1], x[2], convertopts)
+                 for x in dataset_csvlcs_to_generate]
+
+        future = Future()
+
+        if len(tasks) == 0:
+            future.set_result([])
+            return future
+
+        self.jobcounter += 1
+        jobid = self.jobcounter
+
+        batches = deque(
+            (ind, tasks[ind:ind+self.batch_size])
+            for ind in range(0, len(tasks), self.batch_size)
+        )
+
+        self.jobs[jobid] = {
+            'name':name,
+            'future':future,
+            'batches':batches,
+            'pending':len(batches),
+            'results':[None]*len(tasks),
+            'items':dataset_csvlcs_to_generate,
+            'batch_func':batch_func,
+            'ready':ready,
+        }
+        self.waiting_jobs.append(jobid)
+
+        LOGGER.info('queued %s LCs in %s batches for conversion, job: %s. '
+                    'jobs waiting: %s, batches in flight: %s' %
+                    (len(tasks), len(batches), name,
+                     len(self.waiting_jobs), self.inflight))
+
+        self._dispatch()
+        return future
+
+    @gen.coroutine
+    def make_dataset_lczip(self,
+                           executor,
+                           basedir,
+                           setid,
+                           dataset_csvlcs_to_generate,
+                           dataset_all_original_lcs,
+                           converter_csvlc_version=1,
+                           converter_comment_char='#',
+                           converter_column_separator=',',
+                           converter_skip_converted=True,
+                           **kwargs):
+        '''This converts a dataset's LCs in the pool and then makes its LC ZIP.
+
+        LCs already in the LC bundle cache aren't converted again. These are
+        linked to the dataset's output paths right away and the converted ones
+        as their batches finish, so DatasetLCZipHandler can stream them while
+        the rest are converted. The LC ZIP is made by
+        datasets.sqlite_make_dataset_lczip running in executor. kwargs are
+        passed on to it.
+
+        '''
+
+        convertopts = {'csvlc_version':converter_csvlc_version,
+                       'comment_char':converter_comment_char,
+                       'column_separator':converter_column_separator,
+                       'skip_converted':converter_skip_converted}
+
+        # only the LCs that aren't in the LC bundle cache are converted
+        cached = yield executor.submit(
+            datasets.sqlite_lcbundle_lookup,
+            basedir,
+            dataset_csvlcs_to_generate,
+            convertopts
+        )
+
+        cached_items = [(x, c) for x, c in zip(dataset_csvlcs_to_generate,
+                                                cached)
+                        if c is not None]
+        if len(cached_items) > 0:
+            yield IOLoop.current().run_in_executor(
+                None,
+                datasets.link_converted_csvlcs,
+                [x[0] for x in cached_items],
+                [x[1] for x in cached_items]
+            )
+
+        converted = yield self.convert(
+            setid,
+            [x for x, c in zip(dataset_csvlcs_to_generate, cached)
+             if c is None],
+            convertopts,
+            batch_func=datasets.link_converted_csvlcs
+        )
+
+        lczip = yield executor.submit(
+            datasets.sqlite_make_dataset_lczip,
+            basedir,
+            setid,
+            dataset_csvlcs_to_generate,
+            dataset_all_original_lcs,
+            converted_csvlcs=datasets.lcbundle_merge_results(cached,
+                                                             converted),
+            **kwargs
+        )
+
+        return lczip
+
+    @gen.coroutine
+    def refresh_dataset_lczip(self,
+                              executor,
+                              basedir,
+                              setid,
+                              dataset_csvlcs_to_generate,
+                              refreshed_collections,
+                              converter_csvlc_version=1,
+                              converter_comment_char='#',
+                              converter_column_separator=',',
+                              **kwargs):
+        '''This converts a refreshed dataset's LCs and then updates its LC ZIP.
+
+        The LC ZIP is updated by datasets.sqlite_refresh_dataset_lczip running
+        in executor. kwargs are passed on to it.
+
+        '''
+
+        # refreshed LCs are always converted again
+        convertopts = {'csvlc_version':converter_csvlc_version,
+                       'comment_char':converter_comment_char,
+                       'column_separator':converter_column_separator,
+                       'skip_converted':False}
+
+        converted = yield self.convert(setid,
+                                       dataset_csvlcs_to_generate,
+                                       convertopts)
+
+        lczip = yield executor.submit(
+            datasets.sqlite_refresh_dataset_lczip,
+            basedir,
+            setid,
+            dataset_csvlcs_to_generate,
+            refreshed_collections,
+            converted_csvlcs=converted,
+            **kwargs
+        )
+
+        return lczip
+
+    @gen.coroutine
+    def convert_object_lcs(self,
+                           executor,
+                           basedir,
+                           name,
+                           csvlcs_to_generate,
+                           converter_csvlc_version=1,
+                           converter_comment_char='#',
+                           converter_column_separator=',',
+                           converter_skip_converted=True,
+                           ready=None):
+        '''This makes sure the CSV LCs in csvlcs_to_generate exist.
+
+        This is used for LCs that aren't part of a dataset. LCs whose CSV LCs
+        exist already are left alone, the others are taken from the LC bundle
+        cache or converted in the pool, added to the cache, and linked into
+        place by datasets.sqlite_bundle_converted_csvlcs. The converted LCs are
+        put into place as each of their batches finishes.
+
+        If ready is a tornado.queues.Queue, the path of each CSV LC is put in
+        it as soon as it's in place (or its conversion has failed), so the LCs
+        can be streamed while the rest are converted.
+
+        Returns the list of CSV LC paths for csvlcs_to_generate.
+
+        '''
+
+        convertopts = {'csvlc_version':converter_csvlc_version,
+                       'comment_char':converter_comment_char,
+                       'column_separator':converter_column_separator,
+                       'skip_converted':converter_skip_converted}
+
+        to_convert = []
+
+        for item in csvlcs_to_generate:
+            if not os.path.exists(item[-1]):
+                to_convert.append(item)
+            elif ready is not None:
+                ready.put_nowait(item[-1])
+
+        if len(to_convert) > 0:
+
+            cached = yield executor.submit(
+                datasets.sqlite_lcbundle_lookup,
+                basedir,
+                to_convert,
+                convertopts
+            )
+
+            cached_items = [(x, c) for x, c in zip(to_convert, cached)
+                            if c is not None]
+
+            if len(cached_items) > 0:
+
+                yield executor.submit(
+                    datasets.sqlite_bundle_converted_csvlcs,
+                    basedir,
+                    [x[0] for x in cached_items],
+                    [x[1] for x in cached_items],
+                    convertopts
+                )
+
+                if ready is not None:
+                    for item, _ in cached_items:
+                        ready.put_nowait(item[-1])
+
+            yield self.convert(
+                name,
+                [x for x, c in zip(to_convert, cached) if c is None],
+                convertopts,
+                batch_func=partial(datasets.sqlite_bundle_converted_csvlcs,
+                                   basedir,
+                                   convertopts=convertopts),
+                ready=ready
+            )
+
+        return [x[-1] for x in csvlcs_to_generate]
+
+    def shutdown(self):
+        '''
+        This shuts down the worker processes.
+
+        '''
+
+        self.executor.shutdown()
@@ -86,6 +86,8 @@ from urllib.parse import urlencode
 from .. import __version__
 from .basehandler import BaseHandler
 from ..backend import dbsearch
+from ..backend import lcstore
+from ..backend import lcplot
 
 
 ###################################################
@@ -815,3 +817,338 @@ class ObjectInfoPageHandler(BaseHandler):
                         siteinfo=self.siteinfo,
                         flash_messages=self.render_flash_messages(),
                         user_account_box=self.render_user_account_box(),)
+
+
+###########################################
+## Handler to get slices of an object LC ##
+###########################################
+
+class LCSliceHandler(BaseHandler):
+    '''
+    This returns slices of an object's LC from its collection's LC store.
+
+    '''
+
+    def initialize(self,
+                   currentdir,
+                   apiversion,
+                   templatepath,
+                   assetpath,
+                   executor,
+                   basedir,
+                   siteinfo,
+                   authnzerver,
+                   session_expiry,
+                   fernetkey,
+                   ratelimit,
+                   cachedir):
+        '''
+        handles initial setup.
+
+        '''
+
+        self.currentdir = currentdir
+        self.apiversion = apiversion
+        self.templatepath = templatepath
+        self.assetpath = assetpath
+        self.executor = executor
+        self.basedir = basedir
+        self.siteinfo = siteinfo
+        self.authnzerver = authnzerver
+        self.session_expiry = session_expiry
+        self.fernetkey = fernetkey
+        self.ferneter = Fernet(fernetkey)
+        self.ratelimit = ratelimit
+        self.cachedir = cachedir
+
+    def fail(self, status, message):
+        '''
+        This writes a failure message and finishes the request.
+
+        '''
+
+        self.set_status(status)
+        self.write({'status':'failed',
+                    'result':None,
+                    'message':message})
+        raise tornado.web.Finish()
+
+    @gen.coroutine
+    def get(self):
+        '''This returns the LC slice.
+
+        /api/lcslice?objectid=<objectid>&collection=<collection>
+
+        Optional arguments:
+
+        columns=<col1>,<col2>,...: the LC columns to return
+        timemin=<t>, timemax=<t>: return only rows with times in this range
+        timecol=<col>: the column to use for timemin and timemax
+        decimate=<n>: return every n-th row
+        maxrows=<n>: decimate so at most n rows are returned
+        format=json|npz: return JSON (the default) or an NPZ file
+
+        <collection> is the name of the collection on disk, as for
+        /api/object. JSON slices are limited to the site's lcslice_max_nrows
+        rows.
+
+        '''
+
+        if not self.current_user:
+            self.fail(401, 'No session found for this request.')
+
+        objectid = self.get_argument('objectid', default=None)
+        collection = self.get_argument('collection', default=None)
+
+        if not objectid or not collection:
+            self.fail(400, 'An object ID and collection are both required.')
+
+        objectid = xhtml_escape(objectid.strip())
+        collection = xhtml_escape(collection.strip())
+
+        columns = self.get_argument('columns', default=None)
+        if columns is not None:
+            columns = [xhtml_escape(x.strip()) for x in columns.split(',')
+                       if len(x.strip()) > 0]
+
+        timecol = self.get_argument('timecol', default=None)
+        if timecol is not None:
+            timecol = xhtml_escape(timecol.strip())
+
+        outformat = self.get_argument('format', default='json')
+        if outformat not in ('json', 'npz'):
+            self.fail(400, 'format must be one of: json, npz.')
+
+        try:
+
+            timemin = self.get_argument('timemin', default=None)
+            timemax = self.get_argument('timemax', default=None)
+            timemin = float(timemin) if timemin else None
+            timemax = float(timemax) if timemax else None
+
+            decimate = self.get_argument('decimate', default=None)
+            decimate = int(decimate) if decimate else None
+
+            maxrows = self.get_argument('maxrows', default=None)
+            maxrows = int(maxrows) if maxrows else None
+
+        except ValueError:
+            self.fail(400, 'Could not parse the LC slice arguments.')
+
+        if outformat == 'json':
+            max_nrows = self.siteinfo.get('lcslice_max_nrows', 100000)
+            if maxrows is None or maxrows <= 0 or maxrows > max_nrows:
+                maxrows = max_nrows
+
+        # check if we actually have access to this object
+        access_check = yield self.executor.submit(
+            dbsearch.sqlite_column_search,
+            self.basedir,
+            getcolumns=['objectid'],
+            conditions="objectid = '%s'" % objectid,
+            lcclist=[collection],
+            incoming_userid=self.current_user['user_id'],
+            incoming_role=self.current_user['user_role'],
+            override_action='view'
+        )
+
+        if (not access_check or
+            collection not in access_check or
+            len(access_check[collection]['result']) == 0):
+
+            LOGGER.error(
+                'incoming user_id = %s, role = %s has no '
+                'access to objectid %s in collection %s' %
+                (self.current_user['user_id'],
+                 self.current_user['user_role'],
+                 objectid, collection)
+            )
+            self.fail(404,
+                      "Sorry, you don't have access to "
+                      "object %s in collection %s" % (objectid, collection))
+
+        lcslice = yield self.executor.submit(
+            lcstore.get_lc_slice,
+            self.basedir,
+            collection,
+            objectid,
+            columns=columns,
+            timerange=(timemin, timemax),
+            timecol=timecol,
+            decimate=decimate,
+            maxrows=maxrows,
+            outformat=outformat
+        )
+
+        if lcslice is None:
+            self.fail(404,
+                      'No LC store entry was found for object %s '
+                      'in collection %s.' % (objectid, collection))
+
+        if outformat == 'npz':
+
+            self.set_header('Content-Type', 'application/octet-stream')
+            self.set_header(
+                'Content-Disposition',
+                'attachment; filename="%s-lcslice.npz"' %
+                objectid.replace(' ','-')
+            )
+            self.write(lcslice['npz'])
+
+        else:
+
+            self.write({'status':'ok',
+                        'message':'LC slice for object %s' % objectid,
+                        'result':lcslice})
+
+        self.finish()
+
+
+####################################
+## Handler to plot an object's LC ##
+####################################
+
+class LCPlotHandler(LCSliceHandler):
+    '''
+    This plots an object's LC from its collection's LC store.
+
+    '''
+
+    @gen.coroutine
+    def get(self):
+        '''This returns the LC plot.
+
+        /api/lcplot?objectid=<objectid>&collection=<collection>&magcol=<col>
+
+        Optional arguments:
+
+        timecol=<col>: the time column to use
+        errcol=<col>: the column to use for error bars
+        period=<p>, epoch=<e>: phase the LC at this period and epoch
+        binsize=<b>: overplot the LC binned in bins of this size, in units of
+                     time for unphased LCs and units of phase for phased LCs
+        timemin=<t>, timemax=<t>: plot only the part of the LC in this range
+        format=png|svg: return a PNG (the default) or an SVG
+
+        Plots are cached, so asking for the same plot again returns the cached
+        one until the LC store is rebuilt.
+
+        '''
+
+        if not self.current_user:
+            self.fail(401, 'No session found for this request.')
+
+        objectid = self.get_argument('objectid', default=None)
+        collection = self.get_argument('collection', default=None)
+        magcol = self.get_argument('magcol', default=None)
+
+        if not objectid or not collection or not magcol:
+            self.fail(400, 'An object ID, collection, and magcol '
+                      'are all required.')
+
+        objectid = xhtml_escape(objectid.strip())
+        collection = xhtml_escape(collection.strip())
+        magcol = xhtml_escape(magcol.strip())
+
+        timecol = self.get_argument('timecol', default=None)
+        timecol = xhtml_escape(timecol.strip()) if timecol else None
+        errcol = self.get_argument('errcol', default=None)
+        errcol = xhtml_escape(errcol.strip()) if errcol else None
+
+        outformat = self.get_argument('format', default='png')
+        if outformat not in lcplot.LCPLOT_FORMATS:
+            self.fail(400, 'format must be one of: png, svg.')
+
+        try:
+
+            plotargs = {}
+            for arg in ('period', 'epoch', 'binsize', 'timemin', 'timemax'):
+                argval = self.get_argument(arg, default=None)
+                argval = float(argval) if argval else None
+                if argval is not None and not np.isfinite(argval):
+                    raise ValueError('%s is not finite' % arg)
+                plotargs[arg] = argval
+
+        except ValueError:
+            self.fail(400, 'Could not parse the LC plot arguments.')
+
+        for arg in ('period', 'binsize'):
+            if plotargs[arg] is not None and plotargs[arg] <= 0.0:
+                self.fail(400, '%s must be > 0.' % arg)
+
+        if plotargs['timemin'] is None and plotargs['timemax'] is None:
+            timerange = None
+        else:
+            timerange = (plotargs['timemin'], plotargs['timemax'])
+
+        # check if we actually have access to this object
+        access_check = yield self.executor.submit(
+            dbsearch.sqlite_column_search,
+            self.basedir,
+            getcolumns=['objectid'],
+            conditions="objectid = '%s'" % objectid,
+            lcclist=[collection],
+            incoming_userid=self.current_user['user_id'],
+            incoming_role=self.current_user['user_role'],
+            override_action='view'
+        )
+
+        if (not access_check or
+            collection not in access_check or
+            len(access_check[collection]['result']) == 0):
+
+            LOGGER.error(
+                'incoming user_id = %s, role = %s has no '
+                'access to objectid %s in collection %s' %
+                (self.current_user['user_id'],
+                 self.current_user['user_role'],
+                 objectid, collection)
+            )
+            self.fail(404,
+                      "Sorry, you don't have access to "
+                      "object %s in collection %s" % (objectid, collection))
+
+        # repeat views of the same plot are served from the cache
+        plotbytes = yield self.executor.submit(
+            lcplot.get_cached_lcplot,
+            self.basedir,
+            self.cachedir,
+            collection,
+            objectid,
+            lcplot.lcplot_params(magcol,
+                                 timecol=timecol,
+                                 errcol=errcol,
+                                 period=plotargs['period'],
+                                 epoch=plotargs['epoch'],
+                                 binsize=plotargs['binsize'],
+                                 timerange=timerange,
+                                 outformat=outformat)
+        )
+
+        if plotbytes is None:
+
+            plotbytes = yield self.executor.submit(
+                lcplot.render_lcplot,
+                self.basedir,
+                self.cachedir,
+                collection,
+                objectid,
+                magcol,
+                timecol=timecol,
+                errcol=errcol,
+                period=plotargs['period'],
+                epoch=plotargs['epoch'],
+                binsize=plotargs['binsize'],
+                timerange=timerange,
+                outformat=outformat
+            )
+
+        if plotbytes is None:
+            self.fail(404,
+                      'Could not plot column %s for object %s '
+                      'in collection %s.' % (magcol, objectid, collection))
+
+        self.set_header('Content-Type', lcplot.LCPLOT_FORMATS[outformat])
+        self.set_header('Cache-Control', 'private, max-age=3600')
+        self.write(plotbytes)
+        self.finish()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''ratelimit.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This contains the in-process request rate limiter used by the indexserver.
+
+Each session token or API key gets a token bucket that holds as many tokens as
+its user's role is allowed requests in 60 seconds (the role's max_reqs_60sec
+limit from authdb.check_role_limits) and is refilled at that rate. A request
+uses up a token, so a client can make at most max_reqs_60sec requests in any
+60-second period, and no more than that in a single burst.
+
+The buckets live in memory for as long as the indexserver runs, so checking the
+rate doesn't need the disk cache or the executor.
+
+'''
+
+####################
+## SYSTEM IMPORTS ##
+####################
+
+import logging
+import time
+
+from ..authnzerver.authdb import check_role_limits
+
+LOGGER = logging.getLogger(__name__)
+
+
+##################
+## RATE LIMITER ##
+##################
+
+class RateLimiter(object):
+    '''This is a set of token buckets keyed by session token or API key.
+
+    Buckets that haven't been used for idle_expiry seconds are dropped when the
+    limiter has maxkeys buckets.
+
+    The methods of this class must be called from the IOLoop thread.
+
+    '''
+
+    def __init__(self, maxkeys=100000, idle_expiry=600.0):
+        '''
+        This sets up the rate limiter.
+
+        '''
+
+        self.maxkeys = maxkeys
+        self.idle_expiry = idle_expiry
+
+        # these are [tokens left, time of last request] lists keyed by session
+        # token or API key
+        self.buckets = {}
+
+    def _prune(self, now):
+        '''
+        This drops idle buckets, and the oldest ones if there are still too many.
+
+        '''
+
+        self.expire(now=now)
+
+        if len(self.buckets) >= self.maxkeys:
+            for key in list(self.buckets)[:max(1, self.maxkeys//10)]:
+                del self.buckets[key]
+
+    def check(self, key, role, now=None):
+        '''This counts a request for key and checks if it's allowed.
+
+        role is the role of the user making the request. Returns a tuple of
+        (rate_ok, request_rate) where request_rate is the number of requests
+        made by key in about the last 60 seconds, including this one.
+
+        '''
+
+        if now is None:
+            now = time.monotonic()
+
+        max_reqs_60sec = check_role_limits(role)['max_reqs_60sec']
+        capacity = float(max_reqs_60sec)
+
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+
+            if len(self.buckets) >= self.maxkeys:
+                self._prune(now)
+
+            bucket = [capacity, now]
+            self.buckets[key] = bucket
+
+        else:
+
+            # refill the bucket for the time since the last request. the role
+            # of the user may have changed since then, so the bucket is capped
+            # at the current capacity.
+            bucket[0] = min(capacity,
+                            bucket[0] + (now - bucket[1])*capacity/60.0)
+            bucket[1] = now
+
+        request_rate = capacity - bucket[0] + 1.0
+        rate_ok = check_role_limits(role, rate_60sec=request_rate)
+
+        if rate_ok:
+            bucket[0] = bucket[0] - 1.0
+
+        return rate_ok, request_rate
+
+    def expire(self, now=None):
+        '''This drops the buckets that haven't been used for idle_expiry seconds.
+
+        A bucket that has been idle this long has refilled completely, so
+        dropping it doesn't change the rate limits. Returns the number of
+        buckets dropped.
+
+        '''
+
+        if now is None:
+            now = time.monotonic()
+
+        idle = [key for key, bucket in self.buckets.items()
+                if (now - bucket[1]) > self.idle_expiry]
+        for key in idle:
+            del self.buckets[key]
+
+        return len(idle)
+
+    def reset(self, key):
+        '''
+        This drops the bucket for key.
+
+        '''
+
+        self.buckets.pop(key, None)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''revocations.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This contains the in-process list of revoked API keys used by the indexserver
+to verify API keys without asking the authnzerver on every API request.
+
+API keys are Fernet tokens made by the indexserver, so their contents (user ID,
+role, random token, and expiry date) can't be changed by the client. Once an API
+key has been decrypted, the only thing the authnzerver knows that the
+indexserver doesn't is whether the API key has been deleted since it was
+issued. The authnzerver keeps a list of these revoked API keys and the
+indexserver fetches it every so often.
+
+'''
+
+####################
+## SYSTEM IMPORTS ##
+####################
+
+import logging
+import time
+from datetime import datetime
+
+LOGGER = logging.getLogger(__name__)
+
+
+###########################
+## API KEY EXPIRY PARSER ##
+###########################
+
+def apikey_expiry_time(expires):
+    '''This returns the expiry time of an API key as a datetime.
+
+    The authnzerver sends this as an ISO format string. Returns None if it
+    can't be parsed.
+
+    '''
+
+    if isinstance(expires, datetime):
+        return expires
+
+    for timeformat in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(expires.replace('Z',''), timeformat)
+        except Exception:
+            pass
+
+    return None
+
+
+#########################
+## API KEY REVOCATIONS ##
+#########################
+
+class RevocationList(object):
+    '''This is the frontend's copy of the authnzerver's revoked API keys.
+
+    The list can only be used to verify API keys for max_age seconds after it
+    was last updated. After that, or if max_age is 0, API keys have to be
+    verified by the authnzerver instead. This means that an API key revoked at
+    the authnzerver can be used for at most max_age seconds afterwards.
+
+    The methods of this class must be called from the IOLoop thread.
+
+    '''
+
+    def __init__(self, max_age=0.0):
+        '''
+        This sets up the list.
+
+        '''
+
+        self.max_age = max_age
+
+        # these are the expiry datetimes of the revoked API keys, keyed by their
+        # random tokens
+        self.revoked = {}
+
+        # this is the time.monotonic() time of the last update
+        self.updated = None
+
+        # this is the time.monotonic() time of the last call to mark_stale
+        self.stale_since = None
+
+    def update(self, revoked, started=None):
+        '''This replaces the list with the one from the authnzerver.
+
+        revoked is a list of {'apikey': random token, 'expires': ISO format
+        expiry date} dicts, as returned by the authnzerver's apikey-revoked
+        request. started is the time.monotonic() time when that request was
+        sent. If the list was marked stale after that, the new list may already
+        be out of date, so it stays marked stale until the next update.
+
+        '''
+
+        self.revoked = {
+            x['apikey']:apikey_expiry_time(x['expires']) for x in revoked
+        }
+
+        if (started is None or
+            self.stale_since is None or
+            started > self.stale_since):
+            self.updated = time.monotonic()
+
+    def is_current(self):
+        '''
+        This returns True if the list can be used to verify API keys.
+
+        '''
+
+        return (self.max_age > 0.0 and
+                self.updated is not None and
+                (time.monotonic() - self.updated) <= self.max_age)
+
+    def mark_stale(self):
+        '''This stops the list from being used until it's updated again.
+
+        This is used before and after a request to the authnzerver that revokes
+        API keys, so they aren't accepted until the list has caught up.
+
+        '''
+
+        self.updated = None
+        self.stale_since = time.monotonic()
+
+    def verify(self, apikey_dict):
+        '''This verifies a decrypted API key dict.
+
+        Returns a tuple of (verified, messages) in the same form as the
+        authnzerver's apikey-verify request.
+
+        '''
+
+        expires = apikey_expiry_time(apikey_dict.get('exp'))
+
+        if (expires is None or
+            expires <= datetime.utcnow() or
+            apikey_dict.get('tkn') in self.revoked):
+
+            return False, ["API key could not be verified."]
+
+        return True, [
+            "API key verified successfully. Expires: %s." % expires.isoformat()
+        ]
+
+    def clear(self):
+        '''
+        This drops all revoked API keys and marks the list as stale.
+
+        '''
+
+        self.revoked.clear()
+        self.updated = None
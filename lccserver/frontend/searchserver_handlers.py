@@ -819,8 +819,8 @@ class BackgroundQueryMixin(object):
                     #
 
                     # this is the LC zipping future
-                    self.lczip_future = self.executor.submit(
-                        datasets.sqlite_make_dataset_lczip,
+                    self.lczip_future = self.lcconverter.make_dataset_lczip(
+                        self.executor,
                         self.basedir,
                         dspkl_setid,
                         csvlcs_to_generate,
@@ -1183,15 +1183,17 @@ class BackgroundQueryMixin(object):
 
                 # Q4. collect light curve ZIP files
                 # this is the LC zipping future
-                lczip, lczip_generated = yield self.executor.submit(
-                    datasets.sqlite_make_dataset_lczip,
-                    self.basedir,
-                    dspkl_setid,
-                    csvlcs_to_generate,
-                    all_original_lcs,
-                    max_dataset_lcs=lczip_max_nrows,
-                    override_lcdir=self.uselcdir  # useful when testing LCC
-                                                  # server
+                lczip, lczip_generated = (
+                    yield self.lcconverter.make_dataset_lczip(
+                        self.executor,
+                        self.basedir,
+                        dspkl_setid,
+                        csvlcs_to_generate,
+                        all_original_lcs,
+                        max_dataset_lcs=lczip_max_nrows,
+                        override_lcdir=self.uselcdir  # useful when testing
+                                                      # LCC server
+                    )
                 )
 
                 # Q5. load the dataset to make sure it looks OK and
@@ -1266,7 +1268,8 @@ class ColumnSearchHandler(BaseHandler, BackgroundQueryMixin):
                    session_expiry,
                    fernetkey,
                    ratelimit,
-                   cachedir):
+                   cachedir,
+                   lcconverter):
         '''
         handles initial setup.
 
@@ -1287,6 +1290,7 @@ class ColumnSearchHandler(BaseHandler, BackgroundQueryMixin):
         self.httpclient = AsyncHTTPClient(force_instance=True)
         self.ratelimit = ratelimit
         self.cachedir = cachedir
+        self.lcconverter = lcconverter
 
     def write_error(self, status_code, **kwargs):
         '''This overrides the usual write_error function so we can return JSON.
@@ -1519,7 +1523,8 @@ class ConeSearchHandler(BaseHandler, BackgroundQueryMixin):
                    session_expiry,
                    fernetkey,
                    ratelimit,
-                   cachedir):
+                   cachedir,
+                   lcconverter):
         '''
         handles initial setup.
 
@@ -1540,6 +1545,7 @@ class ConeSearchHandler(BaseHandler, BackgroundQueryMixin):
         self.httpclient = AsyncHTTPClient(force_instance=True)
         self.ratelimit = ratelimit
         self.cachedir = cachedir
+        self.lcconverter = lcconverter
 
     def write_error(self, status_code, **kwargs):
         '''This overrides the usual write_error function so we can return JSON.
@@ -1804,7 +1810,8 @@ class FTSearchHandler(BaseHandler, BackgroundQueryMixin):
                    session_expiry,
                    fernetkey,
                    ratelimit,
-                   cachedir):
+                   cachedir,
+                   lcconverter):
         '''
         handles initial setup.
 
@@ -1825,6 +1832,7 @@ class FTSearchHandler(BaseHandler, BackgroundQueryMixin):
         self.httpclient = AsyncHTTPClient(force_instance=True)
         self.ratelimit = ratelimit
         self.cachedir = cachedir
+        self.lcconverter = lcconverter
 
     def write_error(self, status_code, **kwargs):
         '''This overrides the usual write_error function so we can return JSON.
@@ -2099,7 +2107,8 @@ class XMatchHandler(BaseHandler, BackgroundQueryMixin):
                    session_expiry,
                    fernetkey,
                    ratelimit,
-                   cachedir):
+                   cachedir,
+                   lcconverter):
         '''
         handles initial setup.
 
@@ -2120,6 +2129,7 @@ class XMatchHandler(BaseHandler, BackgroundQueryMixin):
         self.httpclient = AsyncHTTPClient(force_instance=True)
         self.ratelimit = ratelimit
         self.cachedir = cachedir
+        self.lcconverter = lcconverter
 
     def write_error(self, status_code, **kwargs):
         '''This overrides the usual write_error function so we can return JSON.
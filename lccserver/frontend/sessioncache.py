@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''sessioncache.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This contains the in-process cache of session info used by the indexserver to
+avoid asking the authnzerver about the same session token on every request.
+
+'''
+
+####################
+## SYSTEM IMPORTS ##
+####################
+
+import logging
+import time
+from datetime import datetime
+
+LOGGER = logging.getLogger(__name__)
+
+
+###################
+## SESSION CACHE ##
+###################
+
+def session_expiry_time(session_info):
+    '''This returns the expiry time of a session as a datetime.
+
+    The authnzerver sends this as an ISO format string. Returns None if it
+    can't be parsed.
+
+    '''
+
+    expires = session_info.get('expires')
+
+    if isinstance(expires, datetime):
+        return expires
+
+    try:
+        return datetime.strptime(expires.replace('Z',''),
+                                 '%Y-%m-%dT%H:%M:%S.%f')
+    except Exception:
+        return None
+
+
+def _session_key(session_token):
+    '''
+    This returns the session token as a str for use as a cache key.
+
+    '''
+
+    if isinstance(session_token, bytes):
+        return session_token.decode()
+    return session_token
+
+
+class SessionCache(object):
+    '''This is a TTL-bounded cache of session info keyed by session token.
+
+    Items are kept for at most ttl seconds and never past the expiry time of
+    their session. If the cache has maxitems items, the oldest ones are dropped
+    to make room for new ones.
+
+    Every invalidation increments the cache's generation. Session info fetched
+    from the authnzerver is only added to the cache if its session token (or
+    its user) hasn't been invalidated since the generation the request started
+    at. This keeps a request that was in flight during an invalidation from
+    adding the old session info back.
+
+    The methods of this class must be called from the IOLoop thread.
+
+    '''
+
+    def __init__(self, ttl=60.0, maxitems=10000):
+        '''
+        This sets up the cache.
+
+        '''
+
+        self.ttl = ttl
+        self.maxitems = maxitems
+
+        # these are (session info, cache expiry time, session expiry time)
+        # tuples keyed by session token, in the order they were added
+        self.sessions = {}
+
+        # this is incremented on every invalidation
+        self.generation = 0
+
+        # these are the generations of the last invalidation of each session
+        # token, in the order they were invalidated
+        self.invalidated = {}
+
+        # this is the generation of the last invalidation that wasn't for a
+        # single session token, or of the newest entry dropped from
+        # self.invalidated to keep it under maxitems
+        self.invalidated_all = 0
+
+    def get(self, session_token):
+        '''This returns the cached session info for session_token.
+
+        Returns a copy of the session info dict or None if the session isn't in
+        the cache or its cache entry has expired.
+
+        '''
+
+        session_token = _session_key(session_token)
+        cached = self.sessions.get(session_token)
+        if cached is None:
+            return None
+
+        session_info, expires, session_expires = cached
+
+        if (time.monotonic() > expires or
+            (session_expires is not None and
+             session_expires <= datetime.utcnow())):
+            del self.sessions[session_token]
+            return None
+
+        return dict(session_info)
+
+    def set(self, session_token, session_info, generation=None):
+        '''This adds the session info for session_token to the cache.
+
+        generation is the value of self.generation when the request for the
+        session info was sent. If the session has been invalidated since then,
+        the session info may be out of date, so it isn't added.
+
+        '''
+
+        if self.ttl <= 0.0:
+            return
+
+        session_token = _session_key(session_token)
+
+        if (generation is not None and
+            (generation < self.invalidated_all or
+             generation < self.invalidated.get(session_token, 0))):
+            return
+
+        # drop the oldest sessions if the cache is full
+        if (session_token not in self.sessions and
+            len(self.sessions) >= self.maxitems):
+            for key in list(self.sessions)[:max(1, self.maxitems//10)]:
+                del self.sessions[key]
+
+        self.sessions[session_token] = (dict(session_info),
+                                        time.monotonic() + self.ttl,
+                                        session_expiry_time(session_info))
+
+    def invalidate(self, session_token):
+        '''
+        This drops the cached session info for session_token.
+
+        '''
+
+        session_token = _session_key(session_token)
+        self.sessions.pop(session_token, None)
+
+        self.generation = self.generation + 1
+        self.invalidated.pop(session_token, None)
+        self.invalidated[session_token] = self.generation
+
+        # drop the oldest invalidations if there are too many. requests started
+        # before these are treated as if everything was invalidated.
+        if len(self.invalidated) > self.maxitems:
+            for key in list(self.invalidated)[:max(1, self.maxitems//10)]:
+                self.invalidated_all = max(self.invalidated_all,
+                                           self.invalidated.pop(key))
+
+    def invalidate_user(self, user_id=None, email=None):
+        '''This drops the cached sessions for a user.
+
+        The user is identified by their user_id or their email address. This is
+        used when something about the user changes, e.g. their password, role,
+        or email address.
+
+        '''
+
+        self.generation = self.generation + 1
+        self.invalidated_all = self.generation
+
+        dropped = [
+            key for key, cached in self.sessions.items()
+            if ((user_id is not None and
+                 cached[0].get('user_id') == user_id) or
+                (email is not None and
+                 cached[0].get('email') == email))
+        ]
+
+        for key in dropped:
+            del self.sessions[key]
+
+        if dropped:
+            LOGGER.info('dropped %s cached sessions for user_id: %s, '
+                        'email: %s' % (len(dropped), user_id, email))
+
+    def expire(self):
+        '''This drops the cached sessions that have expired.
+
+        Returns a list of the session tokens of the dropped sessions whose
+        sessions themselves have expired, not just their cache entries.
+
+        '''
+
+        now = time.monotonic()
+        utcnow = datetime.utcnow()
+
+        expired_sessions = []
+        dropped = 0
+
+        for key, cached in list(self.sessions.items()):
+
+            session_expires = cached[2]
+
+            if session_expires is not None and session_expires <= utcnow:
+                expired_sessions.append(key)
+                del self.sessions[key]
+                dropped = dropped + 1
+
+            elif now > cached[1]:
+                del self.sessions[key]
+                dropped = dropped + 1
+
+        if dropped:
+            LOGGER.info('dropped %s expired cached sessions' % dropped)
+
+        return expired_sessions
+
+    def clear(self):
+        '''
+        This drops all cached sessions.
+
+        '''
+
+        self.sessions.clear()
+        self.invalidated.clear()
+        self.generation = self.generation + 1
+        self.invalidated_all = self.generation
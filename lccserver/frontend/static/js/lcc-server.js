@@ -4043,6 +4043,18 @@ var lcc_datasets = {
           .html('<a download rel="nofollow" href="' +
                 data.dataset_csv + '">download file</a>');
 
+        // binary table export URLs
+        if (data.dataset_fits != null) {
+          $('#dataset-setfits')
+            .html('<a download rel="nofollow" href="' +
+                  data.dataset_fits + '">download file</a>');
+        }
+        if (data.dataset_npz != null) {
+          $('#dataset-setnpz')
+            .html('<a download rel="nofollow" href="' +
+                  data.dataset_npz + '">download file</a>');
+        }
+
 
         // nobjects in this dataset
         if ('actual_nrows' in data) {
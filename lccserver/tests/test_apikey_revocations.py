@@ -0,0 +1,207 @@
+'''test_apikey_revocations.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the revoked API key list in the authnzerver and the
+frontend's local API key verification.
+
+'''
+
+from lccserver.authnzerver import authdb, actions
+from lccserver.frontend import basehandler
+from lccserver.frontend.revocations import RevocationList
+import os
+import sqlite3
+import json
+import time
+from datetime import datetime, timedelta
+import multiprocessing as mp
+
+
+def remove_test_authdb():
+    '''
+    This removes the test auth DB.
+
+    '''
+
+    for fname in ('test-revocations.authdb.sqlite',
+                  'test-revocations.authdb.sqlite-shm',
+                  'test-revocations.authdb.sqlite-wal'):
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
+
+
+def make_apikey():
+    '''
+    This makes a new session and an API key for it.
+
+    '''
+
+    session = actions.auth_session_new(
+        {'user_id':2,
+         'client_header':'Mozzarella Killerwhale',
+         'expires':datetime.utcnow()+timedelta(hours=1),
+         'ip_address': '1.1.1.1',
+         'extra_info_json':{}},
+        override_authdb_path='sqlite:///test-revocations.authdb.sqlite'
+    )
+    assert session['success'] is True
+
+    apikey = actions.issue_new_apikey(
+        {'user_id':2,
+         'user_role':'anonymous',
+         'expires_days':1,
+         'ip_address':'1.1.1.1',
+         'client_header':'Mozzarella Killerwhale',
+         'session_token':session['session_token'],
+         'apiversion':1}
+    )
+    assert apikey['success'] is True
+
+    return session['session_token'], json.loads(apikey['apikey'])
+
+
+def test_revoked_apikeys():
+    '''
+    This tests that deleted API keys are added to the revoked API key list.
+
+    '''
+
+    remove_test_authdb()
+
+    authdb.create_sqlite_auth_db('test-revocations.authdb.sqlite')
+    authdb.initial_authdb_inserts('sqlite:///test-revocations.authdb.sqlite')
+
+    # pretend this is an auth DB made before revoked API keys were kept
+    db = sqlite3.connect('test-revocations.authdb.sqlite')
+    cur = db.cursor()
+    cur.execute('drop trigger apikeys_revoke')
+    cur.execute('drop table apikeys_revoked')
+    db.commit()
+    db.close()
+
+    deleted_session, deleted_apikey = make_apikey()
+    kept_session, kept_apikey = make_apikey()
+
+    assert actions.list_revoked_apikeys({})['revoked'] == []
+
+    # deleting the session deletes its API key and revokes it
+    assert actions.auth_session_delete(
+        {'session_token':deleted_session}
+    )['success'] is True
+
+    revoked = actions.list_revoked_apikeys({})
+    assert revoked['success'] is True
+    assert [x['apikey'] for x in revoked['revoked']] == [deleted_apikey['tkn']]
+    assert revoked['revoked'][0]['expires'] == deleted_apikey['exp']
+
+    assert not actions.verify_apikey(
+        {'apikey_dict':deleted_apikey}
+    )['success']
+    assert actions.verify_apikey({'apikey_dict':kept_apikey})['success']
+
+    # API keys that have already expired aren't added to the list
+    currproc = mp.current_process()
+    apikeys = currproc.table_meta.tables['apikeys']
+    apikeys_revoked = currproc.table_meta.tables['apikeys_revoked']
+
+    currproc.connection.execute(apikeys.insert(), {
+        'apikey':'expired-apikey',
+        'expires':datetime.utcnow()-timedelta(hours=1),
+        'user_id':2,
+        'session_token':kept_session,
+    })
+    currproc.connection.execute(
+        apikeys.delete().where(apikeys.c.apikey == 'expired-apikey')
+    )
+    assert len(actions.list_revoked_apikeys({})['revoked']) == 1
+
+    # revoked API keys are dropped by the reaper once they expire
+    currproc.connection.execute(apikeys_revoked.insert(), {
+        'apikey':'old-revoked-apikey',
+        'expires':datetime.utcnow()-timedelta(hours=1),
+        'user_id':2,
+    })
+    assert actions.auth_reap_expired_sessions()['success'] is True
+
+    result = currproc.connection.execute(apikeys_revoked.select())
+    rows = result.fetchall()
+    result.close()
+    assert [x['apikey'] for x in rows] == [deleted_apikey['tkn']]
+
+    if getattr(currproc, 'table_meta', None):
+        del currproc.table_meta
+
+    if getattr(currproc, 'connection', None):
+        currproc.connection.close()
+        del currproc.connection
+
+    if getattr(currproc, 'engine', None):
+        currproc.engine.dispose()
+        del currproc.engine
+
+    remove_test_authdb()
+
+
+def test_revocation_list():
+    '''
+    This tests verifying API keys with the frontend's revocation list.
+
+    '''
+
+    expires = (datetime.utcnow() + timedelta(days=1)).isoformat()
+    apikey_dict = {'uid':4, 'rol':'authenticated', 'tkn':'token-1',
+                   'exp':expires}
+
+    # the list can't be used until it's been updated
+    revocations = RevocationList(max_age=60.0)
+    assert not revocations.is_current()
+
+    revocations.update([{'apikey':'token-2', 'expires':expires}])
+    assert revocations.is_current()
+
+    verified, messages = revocations.verify(apikey_dict)
+    assert verified is True
+    assert messages == ['API key verified successfully. Expires: %s.' %
+                        expires]
+
+    # revoked and expired API keys are refused
+    assert not revocations.verify(dict(apikey_dict, tkn='token-2'))[0]
+    assert not revocations.verify(
+        dict(apikey_dict,
+             exp=(datetime.utcnow() - timedelta(days=1)).isoformat())
+    )[0]
+    assert not revocations.verify(dict(apikey_dict, exp='not-a-date'))[0]
+
+    # an update that started before the list was marked stale doesn't count
+    started = time.monotonic()
+    revocations.mark_stale()
+    assert not revocations.is_current()
+
+    revocations.update([], started=started)
+    assert not revocations.is_current()
+
+    revocations.update([], started=time.monotonic())
+    assert revocations.is_current()
+
+    # the list goes stale after max_age
+    revocations.updated = time.monotonic() - 61.0
+    assert not revocations.is_current()
+
+    # and is never used if max_age is 0
+    revocations = RevocationList()
+    revocations.update([])
+    assert not revocations.is_current()
+
+    # requests that delete sessions mark the list stale
+    assert basehandler.revokes_apikeys('user-logout', {})
+    assert basehandler.revokes_apikeys(
+        'batch',
+        {'requests':[{'request':'user-delete', 'body':{}},
+                     {'request':'session-delete', 'body':{}}]}
+    )
+    assert not basehandler.revokes_apikeys(
+        'batch',
+        {'requests':[{'request':'session-new', 'body':{}}]}
+    )
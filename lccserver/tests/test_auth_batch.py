@@ -0,0 +1,127 @@
+'''test_auth_batch.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT. See the LICENSE file for details.
+
+This contains tests for batch requests in authnzerver.handlers.
+
+'''
+
+from lccserver.authnzerver import authdb, handlers
+import os
+from datetime import datetime, timedelta
+import multiprocessing as mp
+
+
+def get_test_authdb():
+    '''This just makes a new test auth DB for each test function.
+
+    '''
+
+    authdb.create_sqlite_auth_db('test-batch.authdb.sqlite')
+    authdb.initial_authdb_inserts('sqlite:///test-batch.authdb.sqlite')
+
+
+
+def test_batch_requests():
+    '''
+    This tests running several auth requests in a single batch request.
+
+    '''
+
+    for fname in ('test-batch.authdb.sqlite',
+                  'test-batch.authdb.sqlite-shm',
+                  'test-batch.authdb.sqlite-wal'):
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
+
+    get_test_authdb()
+
+    currproc = mp.current_process()
+    currproc.auth_db_path = 'sqlite:///test-batch.authdb.sqlite'
+
+    session_payload = {
+        'user_id':2,
+        'client_header':'Mozzarella Killerwhale',
+        'expires':(datetime.utcnow()+timedelta(hours=1)).isoformat(),
+        'ip_address': '1.1.1.1',
+        'extra_info_json':{'pref_datasets_always_private':True}
+    }
+
+    # make a new session and get its info back in one go
+    batch = handlers.auth_batch(
+        {'requests':[
+            {'request':'session-new',
+             'body':session_payload},
+            {'request':'session-exists',
+             'body':{},
+             'use_previous':{'session_token':'session_token'}},
+        ]}
+    )
+
+    assert batch['success'] is True
+    assert len(batch['responses']) == 2
+
+    session_token = batch['responses'][0]['session_token']
+    assert session_token is not None
+    assert batch['responses'][1]['success'] is True
+    assert (batch['responses'][1]['session_info']['session_token'] ==
+            session_token)
+    assert batch['responses'][1]['session_info']['user_id'] == 2
+
+    # the requests after a failed one are skipped
+    batch = handlers.auth_batch(
+        {'requests':[
+            {'request':'session-exists',
+             'body':{'session_token':'this-is-not-a-session'}},
+            {'request':'session-delete',
+             'body':{'session_token':session_token}},
+        ]}
+    )
+
+    assert batch['success'] is False
+    assert batch['responses'][0]['success'] is False
+    assert batch['responses'][1] is None
+
+    # unless we ask for them to run anyway
+    batch = handlers.auth_batch(
+        {'requests':[
+            {'request':'session-exists',
+             'body':{'session_token':'this-is-not-a-session'}},
+            {'request':'session-delete',
+             'body':{'session_token':session_token}},
+            {'request':'session-exists',
+             'body':{'session_token':session_token}},
+        ],
+         'stop_on_failure':False}
+    )
+
+    assert batch['success'] is False
+    assert batch['responses'][1]['success'] is True
+    assert batch['responses'][2]['success'] is False
+
+    # batches can't be nested
+    batch = handlers.auth_batch(
+        {'requests':[{'request':'batch', 'body':{'requests':[]}}]}
+    )
+    assert batch['success'] is False
+    assert batch['responses'] == [None]
+
+    if getattr(currproc, 'table_meta', None):
+        del currproc.table_meta
+
+    if getattr(currproc, 'connection', None):
+        currproc.connection.close()
+        del currproc.connection
+
+    if getattr(currproc, 'engine', None):
+        currproc.engine.dispose()
+        del currproc.engine
+
+    for fname in ('test-batch.authdb.sqlite',
+                  'test-batch.authdb.sqlite-shm',
+                  'test-batch.authdb.sqlite-wal'):
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
@@ -0,0 +1,145 @@
+'''test_auth_reaper.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the expired session reaper in the authnzerver.
+
+'''
+
+from lccserver.authnzerver import authdb, actions, handlers
+import os
+import asyncio
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+
+
+def remove_test_authdb():
+    '''
+    This removes the test auth DB.
+
+    '''
+
+    for fname in ('test-reaper.authdb.sqlite',
+                  'test-reaper.authdb.sqlite-shm',
+                  'test-reaper.authdb.sqlite-wal'):
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
+
+
+def run_coroutine(coroutine):
+    '''
+    This runs a coroutine on its own event loop.
+
+    '''
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def make_session(expires_hours):
+    '''
+    This makes a new session that expires in expires_hours.
+
+    '''
+
+    session = actions.auth_session_new(
+        {'user_id':2,
+         'client_header':'Mozzarella Killerwhale',
+         'expires':datetime.utcnow()+timedelta(hours=expires_hours),
+         'ip_address': '1.1.1.1',
+         'extra_info_json':{}},
+        override_authdb_path='sqlite:///test-reaper.authdb.sqlite'
+    )
+    assert session['success'] is True
+    return session['session_token']
+
+
+def test_reap_expired_sessions():
+    '''
+    This tests deleting expired sessions in batches.
+
+    '''
+
+    remove_test_authdb()
+
+    authdb.create_sqlite_auth_db('test-reaper.authdb.sqlite')
+    authdb.initial_authdb_inserts('sqlite:///test-reaper.authdb.sqlite')
+
+    expired = [make_session(-1) for x in range(5)]
+    active = [make_session(1) for x in range(3)]
+
+    # this expired session has an API key that hasn't expired yet
+    apikey_session = make_session(-1)
+    currproc = mp.current_process()
+    apikeys = currproc.table_meta.tables['apikeys']
+    currproc.connection.execute(apikeys.insert(), {
+        'apikey':'test-apikey',
+        'expires':datetime.utcnow()+timedelta(days=1),
+        'user_id':2,
+        'session_token':apikey_session,
+    })
+
+    # the reaper stops after maxbatches
+    reaped = actions.auth_reap_expired_sessions(batchsize=2, maxbatches=2)
+    assert reaped['success'] is True
+    assert reaped['deleted'] == 4
+    assert reaped['batches'] == 2
+    assert reaped['finished'] is False
+
+    # and picks up where it left off on the next run
+    reaper = handlers.SessionReaper(ThreadPoolExecutor(max_workers=1),
+                                    batchsize=2,
+                                    maxbatches=2)
+    run_coroutine(reaper.run())
+
+    stats = reaper.stats()
+    assert stats['runs'] == 1
+    assert stats['total_deleted'] == 1
+    assert stats['last_finished'] is True
+
+    for session_token in expired:
+        assert not actions.auth_session_exists(
+            {'session_token':session_token}
+        )['success']
+    for session_token in active:
+        assert actions.auth_session_exists(
+            {'session_token':session_token}
+        )['success']
+
+    sessions = currproc.table_meta.tables['sessions']
+    result = currproc.connection.execute(
+        sessions.select().where(sessions.c.session_token == apikey_session)
+    )
+    assert result.fetchone() is not None
+    result.close()
+
+    # the counts can be asked for without going to the executor
+    handlers.SESSION_REAPER = reaper
+    try:
+        response = run_coroutine(handlers.process_auth_request(
+            {'request':'session-reaper-stats', 'body':{}, 'reqid':1},
+            None
+        ))
+    finally:
+        handlers.SESSION_REAPER = None
+
+    assert response['success'] is True
+    assert response['response']['reaper_stats']['total_deleted'] == 1
+
+    if getattr(currproc, 'table_meta', None):
+        del currproc.table_meta
+
+    if getattr(currproc, 'connection', None):
+        currproc.connection.close()
+        del currproc.connection
+
+    if getattr(currproc, 'engine', None):
+        currproc.engine.dispose()
+        del currproc.engine
+
+    remove_test_authdb()
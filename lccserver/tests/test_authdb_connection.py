@@ -0,0 +1,134 @@
+'''test_authdb_connection.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the auth DB connection set up in authnzerver.authdb.
+
+'''
+
+from lccserver.authnzerver import authdb
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+
+def remove_test_authdb():
+    '''
+    This removes the test auth DB.
+
+    '''
+
+    for fname in ('test-connection.authdb.sqlite',
+                  'test-connection.authdb.sqlite-shm',
+                  'test-connection.authdb.sqlite-wal'):
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
+
+
+def test_authdb_connection():
+    '''
+    This tests the SQLite auth DB connection settings and indexes.
+
+    '''
+
+    remove_test_authdb()
+
+    authdb.create_sqlite_auth_db('test-connection.authdb.sqlite')
+    authdb.initial_authdb_inserts('sqlite:///test-connection.authdb.sqlite')
+
+    # pretend this is an auth DB made before the indexes were added
+    db = sqlite3.connect('test-connection.authdb.sqlite')
+    cur = db.cursor()
+    cur.execute('drop index ix_sessions_user_id')
+    cur.execute('drop index ix_apikeys_session_token')
+    db.commit()
+    db.close()
+
+    engine, conn, meta = authdb.get_auth_db(
+        'sqlite:///test-connection.authdb.sqlite'
+    )
+
+    # check the connection settings
+    assert conn.execute('pragma journal_mode').scalar() == 'wal'
+    assert conn.execute('pragma foreign_keys').scalar() == 1
+    assert conn.execute('pragma busy_timeout').scalar() == 10000
+
+    # check the indexes are back
+    indexes = {x[1] for x in conn.execute(
+        "select type, name from sqlite_master where type = 'index'"
+    )}
+    for table, column in authdb.SQLITE_AUTHDB_INDEXES:
+        assert 'ix_%s_%s' % (table, column) in indexes
+
+    # check the session lookup uses the session token index
+    plan = ' '.join(str(x[-1]) for x in conn.execute(
+        'explain query plan select * from sessions '
+        'where session_token = ? and expires > ?',
+        ('token', datetime.utcnow())
+    ))
+    assert 'sqlite_autoindex_sessions_1' in plan
+
+    # check the precompiled statements work and are only compiled once
+    for ind in range(3):
+        result = conn.execute(authdb.USER_PASSWORD_SELECT, user_id=3)
+        assert result.fetchone()['password'] is not None
+        result.close()
+
+        result = conn.execute(authdb.SESSION_INFO_SELECT,
+                              session_token='nope',
+                              now=datetime.utcnow())
+        assert result.fetchone() is None
+        result.close()
+
+    compiled_cache = conn._execution_options['compiled_cache']
+    cached_statements = [key[1] for key in compiled_cache.keys()]
+    assert cached_statements.count(authdb.USER_PASSWORD_SELECT) == 1
+    assert cached_statements.count(authdb.SESSION_INFO_SELECT) == 1
+
+    conn.close()
+    engine.dispose()
+
+    remove_test_authdb()
+
+
+def test_authdb_migration_errors(monkeypatch):
+    '''
+    This tests that failing to add missing tables or triggers is an error.
+
+    '''
+
+    remove_test_authdb()
+
+    authdb.create_sqlite_auth_db('test-connection.authdb.sqlite')
+
+    def failing_migration(engine):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(authdb,
+                        'ensure_sqlite_apikey_revocations',
+                        failing_migration)
+
+    # the DB already has everything, so this isn't an error
+    engine, conn, meta = authdb.get_auth_db(
+        'sqlite:///test-connection.authdb.sqlite'
+    )
+    conn.close()
+    engine.dispose()
+
+    # an auth DB without the API key revocation trigger can't be used
+    db = sqlite3.connect('test-connection.authdb.sqlite')
+    db.execute('drop trigger apikeys_revoke')
+    db.commit()
+    db.close()
+
+    engine = authdb.create_engine('sqlite:///test-connection.authdb.sqlite')
+    assert authdb.missing_sqlite_schema(engine) == ['apikeys_revoke']
+    engine.dispose()
+
+    with pytest.raises(sqlite3.OperationalError):
+        authdb.get_auth_db('sqlite:///test-connection.authdb.sqlite')
+
+    remove_test_authdb()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_authdb_mask.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the permission table and the vectorized access checks in
+lccserver.authnzerver.authdb.py.
+
+'''
+
+import itertools
+
+import pytest
+import numpy as np
+
+from lccserver.authnzerver import authdb
+
+
+ACTIONS = ('list', 'view', 'create', 'edit', 'delete', 'change_owner',
+           'make_public', 'make_unlisted', 'make_shared', 'make_private')
+
+VISIBILITIES = ('public', 'unlisted', 'private', 'shared', 'weird', None)
+
+SHAREDWITH = ('', None, '4', '5,6', '2', '4,7', 'not,userids')
+
+
+def test_item_permission_table():
+    '''
+    This checks the permission table against the permission rules.
+
+    '''
+
+    for key, perms in authdb.ITEM_PERMISSION_TABLE.items():
+        assert perms == authdb.compute_item_permissions(*key)
+
+    # combinations that don't make sense get no permissions
+    assert authdb.get_item_permissions('anonymous', 'object',
+                                       'nope', 'for_owned') == set()
+    assert authdb.get_item_permissions('nobody', 'object',
+                                       'public', 'for_others') == set()
+    assert authdb.get_item_permissions('anonymous', 'object',
+                                       ['public'], 'for_others') == set()
+
+
+@pytest.mark.parametrize(
+    "role,target_name",
+    list(itertools.product(
+        ('superuser', 'staff', 'authenticated', 'anonymous', 'locked'),
+        ('object', 'dataset', 'collection', 'users', 'sessions',
+         'apikeys', 'preferences')
+    ))
+)
+def test_check_user_access_mask(role, target_name):
+    '''
+    This checks that the vectorized access check matches check_user_access.
+
+    '''
+
+    targets = list(itertools.product((4, 1, 2), VISIBILITIES, SHAREDWITH))
+    owners = [x[0] for x in targets]
+    visibilities = [x[1] for x in targets]
+    sharedwith = [x[2] for x in targets]
+
+    for action in ACTIONS:
+
+        mask = authdb.check_user_access_mask(
+            userid=4,
+            role=role,
+            action=action,
+            target_name=target_name,
+            target_owners=owners,
+            target_visibilities=visibilities,
+            target_sharedwith=sharedwith
+        )
+
+        expected = np.array([
+            authdb.check_user_access(
+                userid=4,
+                role=role,
+                action=action,
+                target_name=target_name,
+                target_owner=owner,
+                target_visibility=visibility,
+                target_sharedwith=target_sharedwith
+            ) for (owner, visibility, target_sharedwith) in targets
+        ])
+
+        assert mask.dtype == np.bool_
+        assert np.array_equal(mask, expected)
+
+    assert authdb.check_user_access_mask(
+        userid=4,
+        role=role,
+        action='view',
+        target_name=target_name,
+        target_owners=[],
+        target_visibilities=[],
+        target_sharedwith=[]
+    ).size == 0
@@ -258,6 +258,35 @@ def test_convert_original_lightcurves():
                               'aep_001',
                               'aep_002']
 
+    # check if the conversions were recorded in the manifest
+    manifest = cli.get_csvlc_manifest(basedir, collection)
+    cur = manifest.cursor()
+    cur.execute("select status, count(*) from csvlc_manifest group by status")
+    assert cur.fetchall() == [('converted', 5)]
+    manifest.close()
+
+    # running the conversion again on more LCs should only convert the new ones
+    csvlc_mtime = os.stat(
+        os.path.join(lightcurves_subdir, 'HAT-215-0001809-csvlc.gz')
+    ).st_mtime_ns
+
+    results = cli.convert_original_lightcurves(basedir,
+                                               collection,
+                                               max_lcs=7,
+                                               skip_converted=False,
+                                               batch_size=2)
+    assert len(results) == 7
+    assert all(os.path.exists(x) for x in results)
+    assert os.stat(
+        os.path.join(lightcurves_subdir, 'HAT-215-0001809-csvlc.gz')
+    ).st_mtime_ns == csvlc_mtime
+
+    manifest = cli.get_csvlc_manifest(basedir, collection)
+    cur = manifest.cursor()
+    cur.execute("select status, count(*) from csvlc_manifest group by status")
+    assert cur.fetchall() == [('converted', 7)]
+    manifest.close()
+
     # remove the test-basedir
     shutil.rmtree('./test-basedir', ignore_errors=True)
 
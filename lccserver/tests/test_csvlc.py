@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_csvlc.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the CSV LC writer in lccserver.backend.abcat.
+
+'''
+
+import os
+import os.path
+import gzip
+import pickle
+import tempfile
+
+import numpy as np
+
+from lccserver import cli
+from lccserver.backend import abcat
+from lccserver.backend import datasets
+
+
+def read_pickle_lc(lcfile):
+    '''
+    This reads a fake LC pickle.
+
+    '''
+
+    with open(lcfile,'rb') as infd:
+        return pickle.load(infd)
+
+
+LCFORMAT_DICT = {
+    'readerfunc':read_pickle_lc,
+    'metadata':{
+        'objectid':{'deref':['objectid'],
+                    'desc':'object ID'},
+    },
+    'colkeys':['rjd', 'mag.aep_000', 'ndet', 'flag', 'ccd'],
+    'columns':{
+        'rjd':{'format':'%.7f', 'dtype':'f8', 'desc':'time'},
+        'mag.aep_000':{'format':'%.5f', 'dtype':'f4', 'desc':'mag'},
+        'ndet':{'format':'%i', 'dtype':'i8', 'desc':'ndet'},
+        'flag':{'format':'%s', 'dtype':'U1', 'desc':'flag'},
+        'ccd':{'format':'%s', 'dtype':'f4', 'desc':'ccd'},
+    },
+}
+
+
+def expected_lines(lcdict):
+    '''
+    This makes the LC lines one cell at a time like the original writer.
+
+    '''
+
+    lines = []
+
+    for lineind in range(len(lcdict['rjd'])):
+
+        thisline = []
+        for x in LCFORMAT_DICT['colkeys']:
+            try:
+                thisline.append(LCFORMAT_DICT['columns'][x]['format'] %
+                                abcat.dict_get(lcdict,
+                                               x.split('.'))[lineind])
+            except Exception:
+                thisline.append(
+                    str(abcat.dict_get(lcdict, x.split('.'))[lineind])
+                )
+
+        lines.append(','.join(thisline))
+
+    return lines
+
+
+def test_convert_to_csvlc():
+    '''
+    This tests that the CSV LC lines are the same as the ones written one cell
+    at a time, including values that don't fit their formatters.
+
+    '''
+
+    nlines = abcat.CSVLC_WRITE_BLOCK_LINES + 123
+
+    ndet = np.arange(nlines, dtype=np.float64)
+    ndet[17] = np.nan
+
+    lcdict = {
+        'objectid':'OBJ-0001',
+        'rjd':np.linspace(56000.0, 56100.0, nlines),
+        'mag':{'aep_000':np.linspace(10.0, 12.0, nlines).astype(np.float32)},
+        'ndet':ndet,
+        'flag':np.array(['G','X']*(nlines//2) + ['G']*(nlines % 2)),
+        'ccd':np.full(nlines, 0.1, dtype=np.float32),
+    }
+
+    with tempfile.TemporaryDirectory() as tempdir:
+
+        lcfile = os.path.join(tempdir, 'OBJ-0001.pkl')
+        with open(lcfile,'wb') as outfd:
+            pickle.dump(lcdict, outfd)
+
+        csvlc = abcat.convert_to_csvlc(lcfile, 'OBJ-0001', LCFORMAT_DICT)
+        assert csvlc == os.path.join(tempdir, 'OBJ-0001-csvlc.gz')
+
+        with gzip.open(csvlc,'rt') as infd:
+            lines = infd.read().splitlines()
+
+        # converting the LC again replaces the CSV LC instead of changing it
+        # in place, so links to the old one keep their contents
+        oldlink = os.path.join(tempdir, 'old-csvlc.gz')
+        os.link(csvlc, oldlink)
+        with open(csvlc,'rb') as infd:
+            old_contents = infd.read()
+
+        lcdict['ndet'] = lcdict['ndet'] + 1.0
+        with open(lcfile,'wb') as outfd:
+            pickle.dump(lcdict, outfd)
+        abcat.convert_to_csvlc(lcfile, 'OBJ-0001', LCFORMAT_DICT)
+
+        assert not os.path.samefile(csvlc, oldlink)
+        with open(oldlink,'rb') as infd:
+            assert infd.read() == old_contents
+        assert sorted(os.listdir(tempdir)) == ['OBJ-0001-csvlc.gz',
+                                               'OBJ-0001.pkl',
+                                               'old-csvlc.gz']
+        lcdict['ndet'] = lcdict['ndet'] - 1.0
+
+    assert lines[0] == 'LCC-CSVLC-V1'
+
+    lcstart = lines.index('# LIGHTCURVE') + 1
+    assert lines[lcstart:] == expected_lines(lcdict)
+    assert lines[lcstart + 17].split(',')[2] == 'nan'
+
+
+def test_convert_original_lightcurves_manifest(monkeypatch):
+    '''
+    This tests that ingest-time LC conversion records its progress in the
+    collection's manifest, resumes after an interruption, and only converts
+    LCs that are new or have changed.
+
+    '''
+
+    class SerialPool(object):
+
+        def __init__(self, nworkers):
+            pass
+
+        def imap(self, func, tasks, chunksize=1):
+            return map(func, tasks)
+
+        def terminate(self):
+            pass
+
+        def close(self):
+            pass
+
+        def join(self):
+            pass
+
+    converted = []
+    failing = set()
+    interrupt_at = [None]
+
+    def fake_convert(task):
+
+        lcfile, objectid, formatjson, convertopts = task
+
+        if len(converted) == interrupt_at[0]:
+            raise KeyboardInterrupt
+
+        converted.append((os.path.basename(lcfile),
+                          convertopts['skip_converted']))
+
+        if os.path.basename(lcfile) in failing:
+            return '%s conversion to CSVLC failed' % os.path.basename(lcfile)
+
+        csvlc = lcfile.replace('.pkl', '-csvlc.gz')
+        with gzip.open(csvlc,'wb') as outfd:
+            outfd.write(b'csvlc for %s' % os.path.basename(lcfile).encode())
+        return csvlc
+
+    monkeypatch.setattr(cli.mp, 'Pool', SerialPool)
+    monkeypatch.setattr(datasets, 'csvlc_convert_worker', fake_convert)
+    monkeypatch.setattr(abcat,
+                        'get_lcformat_description',
+                        lambda x: {'formatkey':'test', 'fileglob':'*.pkl'})
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        lcdir = os.path.join(basedir, 'test-coll', 'lightcurves')
+        os.makedirs(lcdir)
+
+        with open(os.path.join(basedir,
+                               'test-coll',
+                               'lcformat-description.json'),'w') as outfd:
+            outfd.write('{"lc_formatkey":"test"}')
+
+        lcnames = ['OBJ-%s.pkl' % x for x in range(5)]
+        for lcname in lcnames:
+            with open(os.path.join(lcdir, lcname),'wb') as outfd:
+                outfd.write(os.urandom(100))
+
+        def manifest_status():
+            db = cli.get_csvlc_manifest(basedir, 'test-coll')
+            rows = db.execute("select lcfile, status "
+                              "from csvlc_manifest").fetchall()
+            db.close()
+            return {os.path.basename(x[0]):x[1] for x in rows}
+
+        # the first run is interrupted while converting the fourth LC. the
+        # first full batch and the partial batch after it are recorded.
+        interrupt_at[0] = 3
+        try:
+            cli.convert_original_lightcurves(basedir,
+                                             'test-coll',
+                                             convert_workers=1,
+                                             batch_size=2)
+        except KeyboardInterrupt:
+            pass
+        else:
+            raise AssertionError('the conversion should have been interrupted')
+
+        assert manifest_status() == {x:'converted' for x in lcnames[:3]}
+
+        # the second run picks up where the first left off
+        interrupt_at[0] = None
+        del converted[:]
+        failing.add('OBJ-4.pkl')
+
+        results = cli.convert_original_lightcurves(basedir,
+                                                   'test-coll',
+                                                   convert_workers=1,
+                                                   batch_size=2)
+        assert converted == [('OBJ-3.pkl', True), ('OBJ-4.pkl', True)]
+        assert results[:4] == [os.path.join(lcdir,
+                                            x.replace('.pkl', '-csvlc.gz'))
+                               for x in lcnames[:4]]
+        assert results[4] == 'OBJ-4.pkl conversion to CSVLC failed'
+        assert manifest_status()['OBJ-4.pkl'] == 'failed'
+
+        # nothing has changed, so nothing is converted and the failed LC isn't
+        # tried again
+        del converted[:]
+        cli.convert_original_lightcurves(basedir,
+                                         'test-coll',
+                                         convert_workers=1)
+        assert converted == []
+
+        # a changed LC is converted again even though its CSV LC exists, and
+        # failed LCs are tried again if asked
+        with open(os.path.join(lcdir, 'OBJ-0.pkl'),'wb') as outfd:
+            outfd.write(os.urandom(200))
+        failing.clear()
+
+        results = cli.convert_original_lightcurves(basedir,
+                                                   'test-coll',
+                                                   convert_workers=1,
+                                                   retry_failed=True)
+        assert converted == [('OBJ-0.pkl', False), ('OBJ-4.pkl', False)]
+        assert all(os.path.exists(x) for x in results)
+        assert set(manifest_status().values()) == {'converted'}
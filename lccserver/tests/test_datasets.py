@@ -0,0 +1,1359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_datasets.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Aug 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the lccserver.backend.datasets module using a small fake search
+result.
+
+'''
+
+import os
+import os.path
+import json
+import sqlite3
+import tempfile
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
+from astropy.io import fits
+
+from lccserver.backend import datasets
+from lccserver.backend import dbsearch
+from lccserver.frontend import basehandler
+from lccserver.frontend import dataserver_handlers as dh
+
+
+COLUMNSPEC = {
+    'db_oid':{'title':'object ID',
+              'description':'the object ID',
+              'dtype':'<U20',
+              'format':'%s'},
+    'db_ra':{'title':'RA [deg]',
+             'description':'right ascension',
+             'dtype':'<f8',
+             'format':'%.5f'},
+    'db_decl':{'title':'Dec [deg]',
+               'description':'declination',
+               'dtype':'<f8',
+               'format':'%.5f'},
+    'ndet':{'title':'nobs',
+            'description':'number of observations',
+            'dtype':'<i8',
+            'format':'%i'},
+    'db_lcfname':{'title':'LC filename',
+                  'description':'the light curve file',
+                  'dtype':'<U100',
+                  'format':'%s'},
+    'collection':{'title':'collection',
+                  'description':'the collection of the object',
+                  'dtype':'<U20',
+                  'format':'%s'},
+}
+
+
+def make_fake_searchresult(nobjects=20, collection='test_coll'):
+    '''
+    This makes a fake search result in the format the dbsearch functions
+    return.
+
+    '''
+
+    rows = []
+    for ind in range(nobjects):
+        rows.append({
+            'db_oid':'OBJ-%04i' % ind,
+            'db_ra':10.0 + ind*0.1,
+            'db_decl':-20.0 + ind*0.1 if ind != 3 else None,
+            'ndet':100 + ind,
+            'db_lcfname':'/fake/lcs/OBJ-%04i.pkl' % ind,
+            'collection':collection,
+        })
+
+    return {
+        'databases':[collection],
+        'search':'sqlite_column_search',
+        'args':{'getcolumns':['db_oid','db_ra','db_decl','ndet']},
+        collection:{
+            'result':rows,
+            'nmatches':nobjects,
+            'lcformatdesc':'/fake/lcformat.json',
+            'lcmagcols':'mag',
+            'columnspec':COLUMNSPEC,
+            'collid':collection.replace('_','-'),
+        }
+    }
+
+
+def make_fake_dataset(basedir, nobjects=20, searchresult=None, **kwargs):
+    '''This makes a new basedir with a datasets DB and a single dataset in it.
+
+    kwargs are passed on to datasets.sqlite_new_dataset.
+
+    '''
+
+    os.makedirs(os.path.join(basedir, 'datasets'), exist_ok=True)
+    os.makedirs(os.path.join(basedir, 'products'), exist_ok=True)
+    datasets.sqlite_make_lcc_datasets_db(basedir)
+
+    if searchresult is None:
+        searchresult = make_fake_searchresult(nobjects=nobjects)
+
+    setid, creationdt = datasets.sqlite_prepare_dataset(basedir)
+    datasets.sqlite_new_dataset(
+        basedir,
+        setid,
+        creationdt,
+        searchresult,
+        **kwargs
+    )
+    return setid
+
+
+def test_export_npz():
+    '''
+    This tests the .npz dataset export.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+        npzf = datasets.sqlite_export_dataset(basedir, setid, 'npz')
+
+        assert npzf == os.path.join(basedir,
+                                    'datasets',
+                                    'dataset-%s.npz' % setid)
+
+        npz = np.load(npzf)
+        header = json.loads(str(npz['header_json']))
+        assert header['setid'] == setid
+        assert header['actual_nrows'] == 20
+
+        for col in header['columns']:
+            assert npz[col].size == 20
+
+        assert npz['db_ra'].dtype == np.float64
+        assert npz['ndet'].dtype == np.int64
+        assert npz['db_oid'].dtype.kind == 'U'
+        assert np.isnan(npz['db_decl'][3])
+        assert npz['db_oid'][0] == 'OBJ-0000'
+
+
+def test_export_fits():
+    '''
+    This tests the FITS dataset export.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+        fitsf = datasets.sqlite_export_dataset(basedir, setid, 'fits')
+
+        with fits.open(fitsf) as hdul:
+
+            assert hdul[0].header['SETID'] == setid
+            table = hdul['DATASET'].data
+
+            assert len(table) == 20
+            assert table['ndet'][-1] == 119
+            assert np.isnan(table['db_decl'][3])
+            assert table['db_oid'][5] == 'OBJ-0005'
+
+
+def test_export_cached():
+    '''
+    This tests that exports are cached and regenerated when the dataset
+    pickle changes.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+        npzf = datasets.sqlite_export_dataset(basedir, setid, 'npz')
+        mtime1 = os.stat(npzf).st_mtime
+
+        npzf = datasets.sqlite_export_dataset(basedir, setid, 'npz')
+        assert os.stat(npzf).st_mtime == mtime1
+
+        # touch the dataset pickle so the export is out of date
+        pklf = os.path.join(basedir, 'datasets', 'dataset-%s.pkl.gz' % setid)
+        os.utime(pklf, (mtime1 + 10.0, mtime1 + 10.0))
+
+        npzf = datasets.sqlite_export_dataset(basedir, setid, 'npz')
+        assert os.stat(npzf).st_mtime > mtime1
+
+
+def test_export_access():
+    '''
+    This tests that exports follow the dataset's access controls.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+
+        # unknown format
+        assert datasets.sqlite_export_dataset(basedir, setid, 'xls') is None
+
+        # unknown dataset
+        assert datasets.sqlite_export_dataset(basedir, 'nope', 'npz') is None
+
+        # private dataset owned by someone else
+        db = sqlite3.connect(os.path.join(basedir, 'lcc-datasets.sqlite'))
+        db.execute("update lcc_datasets set dataset_owner = 1, "
+                   "dataset_visibility = 'private' where setid = ?",
+                   (setid,))
+        db.commit()
+        db.close()
+
+        assert datasets.sqlite_export_dataset(
+            basedir, setid, 'npz',
+            incoming_userid=4, incoming_role='authenticated'
+        ) is None
+
+
+def mark_dataset_complete(basedir, setid):
+    '''
+    This marks the dataset as complete without collecting its LCs.
+
+    '''
+
+    db = sqlite3.connect(os.path.join(basedir, 'lcc-datasets.sqlite'))
+    db.execute("update lcc_datasets set status = 'complete' where setid = ?",
+               (setid,))
+    db.commit()
+    db.close()
+
+
+def test_derive_dataset_sort():
+    '''
+    This tests re-sorting an existing dataset into a new dataset.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+        mark_dataset_complete(basedir, setid)
+
+        derived = datasets.sqlite_derive_dataset(
+            basedir,
+            setid,
+            sortspec=[['db_decl','desc']],
+        )
+        new_setid, csvlcs, all_lcs, nrows, npages = derived
+
+        assert new_setid != setid
+        assert nrows == 20
+        assert len(csvlcs) == 20
+
+        ds = datasets.sqlite_get_dataset(basedir, new_setid, 'pickle')
+        decls = [x['db_decl'] for x in ds['result']]
+
+        # the None item goes to the end
+        assert decls[-1] is None
+        assert decls[:-1] == sorted(decls[:-1], reverse=True)
+        assert ds['status'] == 'in progress'
+        assert ds['searchargs']['derived_from'] == setid
+
+        # the first page and CSV are there
+        assert os.path.exists(ds['dataset_csv'])
+        assert os.path.exists(
+            os.path.join(basedir,
+                         'datasets',
+                         'dataset-%s-rows-page1.pkl' % new_setid)
+        )
+
+        # the CSV LCs from the original dataset are reused
+        assert csvlcs[0][0] == csvlcs[0][-1]
+        assert csvlcs[0][0].endswith(
+            os.path.join('csvlcs', 'test-coll', '%s-csvlc.gz' % csvlcs[0][1])
+        )
+
+
+def test_derive_dataset_filter():
+    '''
+    This tests filtering and sorting an existing dataset into a new dataset.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+        mark_dataset_complete(basedir, setid)
+
+        derived = datasets.sqlite_derive_dataset(
+            basedir,
+            setid,
+            sortspec=[['ndet','desc'], ['db_oid','asc']],
+            filterspec=[['ndet','ge',105], ['db_decl','lt',-18.5]],
+        )
+        new_setid, csvlcs, all_lcs, nrows, npages = derived
+
+        ds = datasets.sqlite_get_dataset(basedir, new_setid, 'pickle')
+        ndets = [x['ndet'] for x in ds['result']]
+
+        # db_decl < -18.5 -> ind < 15, the None decl row is dropped
+        assert ndets == list(range(114, 104, -1))
+        assert nrows == 10
+
+        derived = datasets.sqlite_derive_dataset(
+            basedir,
+            setid,
+            filterspec=[['db_oid','ct','obj-001']],
+        )
+        ds = datasets.sqlite_get_dataset(basedir, derived[0], 'pickle')
+        assert [x['db_oid'] for x in ds['result']] == [
+            'OBJ-%04i' % x for x in range(10, 20)
+        ]
+
+
+def test_derive_dataset_invalid():
+    '''
+    This tests that bad sorts and filters and incomplete datasets fail.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+
+        # dataset not complete yet
+        assert datasets.sqlite_derive_dataset(
+            basedir, setid, sortspec=[['ndet','asc']]
+        ) is None
+
+        mark_dataset_complete(basedir, setid)
+
+        assert datasets.sqlite_derive_dataset(basedir, setid) is None
+        assert datasets.sqlite_derive_dataset(
+            basedir, setid, sortspec=[['notacolumn','asc']]
+        ) is None
+        assert datasets.sqlite_derive_dataset(
+            basedir, setid, filterspec=[['ndet','drop table',1]]
+        ) is None
+        assert datasets.sqlite_derive_dataset(
+            basedir, setid, filterspec=[['ndet','ct','1']]
+        ) is None
+        assert datasets.sqlite_derive_dataset(
+            basedir, setid, filterspec=[['ndet','gt','abc']]
+        ) is None
+
+
+def make_fake_lcc_index(basedir, last_updated):
+    '''
+    This makes a minimal lcc-index.sqlite with the fake collection in it.
+
+    '''
+
+    db = sqlite3.connect(os.path.join(basedir, 'lcc-index.sqlite'))
+    db.execute("create table lcc_index (collection_id text, "
+               "last_updated datetime)")
+    db.execute("insert into lcc_index values (?, ?)",
+               ('test-coll', last_updated))
+    db.commit()
+    db.close()
+
+
+def test_changed_dataset_collections():
+    '''
+    This tests finding the collections updated after a dataset.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+        ds = datasets.sqlite_get_dataset(basedir, setid, 'pickle')
+
+        make_fake_lcc_index(basedir, '2018-01-01 00:00:00.000000')
+        assert datasets.sqlite_changed_dataset_collections(basedir, ds) == []
+
+        db = sqlite3.connect(os.path.join(basedir, 'lcc-index.sqlite'))
+        db.execute("update lcc_index set last_updated = '2999-01-01T00:00:00'")
+        db.commit()
+        db.close()
+
+        assert datasets.sqlite_changed_dataset_collections(
+            basedir, ds
+        ) == ['test_coll']
+
+
+def test_refresh_dataset_unchanged():
+    '''
+    This tests that refreshing a dataset with no updated collections does
+    nothing and that only the owner can refresh datasets.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir,
+                                  incoming_userid=4,
+                                  incoming_role='authenticated')
+        make_fake_lcc_index(basedir, '2018-01-01 00:00:00.000000')
+
+        # not complete yet
+        assert datasets.sqlite_refresh_dataset(
+            basedir, setid, incoming_userid=4, incoming_role='authenticated'
+        ) is None
+
+        mark_dataset_complete(basedir, setid)
+
+        # anonymous users can't refresh
+        assert datasets.sqlite_refresh_dataset(basedir, setid) is None
+
+        pklf = os.path.join(basedir, 'datasets', 'dataset-%s.pkl.gz' % setid)
+        mtime = os.stat(pklf).st_mtime
+
+        refreshed = datasets.sqlite_refresh_dataset(
+            basedir, setid, incoming_userid=4, incoming_role='authenticated'
+        )
+        assert refreshed == (setid, [], [], 20, 1)
+        assert os.stat(pklf).st_mtime == mtime
+
+
+def make_two_collection_refresh(basedir,
+                                monkeypatch,
+                                searches,
+                                samplespec=10):
+    '''This makes a sampled dataset from two collections, then updates one.
+
+    The dataset is owned by user_id = 4. Only coll_b is updated after the
+    dataset was made. Its search returns 40 new rows. The arguments of each
+    search are added to the searches list.
+
+    '''
+
+    searchresult = make_fake_searchresult(nobjects=10, collection='coll_a')
+    coll_b = make_fake_searchresult(nobjects=10, collection='coll_b')
+    searchresult['databases'].append('coll_b')
+    searchresult['coll_b'] = coll_b['coll_b']
+
+    setid = make_fake_dataset(basedir,
+                              searchresult=searchresult,
+                              results_samplespec=samplespec,
+                              incoming_userid=4,
+                              incoming_role='authenticated',
+                              dataset_visibility='public')
+    mark_dataset_complete(basedir, setid)
+
+    db = sqlite3.connect(os.path.join(basedir, 'lcc-index.sqlite'))
+    db.execute("create table lcc_index (collection_id text, "
+               "last_updated datetime)")
+    db.execute("insert into lcc_index values (?, ?)",
+               ('coll-a', '2018-01-01 00:00:00.000000'))
+    db.execute("insert into lcc_index values (?, ?)",
+               ('coll-b', '2999-01-01 00:00:00.000000'))
+    db.commit()
+    db.close()
+
+    def fake_search(basedir,
+                    getcolumns=None,
+                    lcclist=None,
+                    incoming_userid=2,
+                    incoming_role='anonymous'):
+        searches.append((lcclist, incoming_userid, incoming_role))
+        newresult = make_fake_searchresult(nobjects=40, collection='coll_b')
+        for x in newresult['coll_b']['result']:
+            x['db_oid'] = x['db_oid'].replace('OBJ', 'NEW')
+        return newresult
+
+    monkeypatch.setitem(datasets.DATASET_SEARCH_FUNCTIONS,
+                        'sqlite_column_search',
+                        fake_search)
+
+    return setid
+
+
+def test_refresh_dataset_not_owner(monkeypatch):
+    '''
+    This tests that a superuser can't refresh someone else's dataset.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        searches = []
+        setid = make_two_collection_refresh(basedir, monkeypatch, searches)
+
+        pklf = os.path.join(basedir, 'datasets', 'dataset-%s.pkl.gz' % setid)
+        mtime = os.stat(pklf).st_mtime
+
+        assert datasets.sqlite_refresh_dataset(
+            basedir, setid, incoming_userid=1, incoming_role='superuser'
+        ) is None
+        assert searches == []
+        assert os.stat(pklf).st_mtime == mtime
+
+
+def test_refresh_dataset_sample(monkeypatch):
+    '''
+    This tests that refreshing a sampled dataset only samples the new rows.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        searches = []
+        setid = make_two_collection_refresh(basedir, monkeypatch, searches)
+
+        ds = datasets.sqlite_get_dataset(basedir, setid, 'pickle')
+        kept = sorted(x['db_oid'] for x in ds['result']
+                      if x['collection'] == 'coll_a')
+
+        refreshed = datasets.sqlite_refresh_dataset(
+            basedir, setid, incoming_userid=4, incoming_role='authenticated'
+        )
+        assert refreshed[2] == ['coll_b']
+        assert refreshed[3] == 10
+
+        # the search ran as the dataset's owner
+        assert searches == [(['coll_b'], 4, 'authenticated')]
+
+        # the rows from coll_a are kept as they were and the rest of the
+        # sample is made up of the new rows from coll_b
+        ds = datasets.sqlite_get_dataset(basedir, setid, 'pickle')
+        assert sorted(x['db_oid'] for x in ds['result']
+                      if x['collection'] == 'coll_a') == kept
+
+        newrows = [x['db_oid'] for x in ds['result']
+                   if x['collection'] == 'coll_b']
+        assert len(newrows) == 10 - len(kept)
+        assert all(x.startswith('NEW') for x in newrows)
+
+
+def test_refresh_derived_dataset(monkeypatch):
+    '''
+    This tests that refreshing a derived dataset applies its filters and sort
+    to the new rows.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        searches = []
+        setid = make_two_collection_refresh(basedir,
+                                            monkeypatch,
+                                            searches,
+                                            samplespec=None)
+
+        derived = datasets.sqlite_derive_dataset(
+            basedir,
+            setid,
+            sortspec=[['ndet','desc']],
+            filterspec=[['ndet','lt',105]],
+            incoming_userid=4,
+            incoming_role='authenticated'
+        )
+        derived_setid = derived[0]
+        assert derived[3] == 10
+        mark_dataset_complete(basedir, derived_setid)
+
+        refreshed = datasets.sqlite_refresh_dataset(
+            basedir,
+            derived_setid,
+            incoming_userid=4,
+            incoming_role='authenticated'
+        )
+        assert refreshed[2] == ['coll_b']
+
+        # only the 5 new rows with ndet < 105 are added
+        ds = datasets.sqlite_get_dataset(basedir, derived_setid, 'pickle')
+        assert ds['actual_nrows'] == 10
+        assert all(x['ndet'] < 105 for x in ds['result'])
+        assert len([x for x in ds['result']
+                    if x['db_oid'].startswith('NEW')]) == 5
+
+        ndets = [x['ndet'] for x in ds['result']]
+        assert ndets == sorted(ndets, reverse=True)
+
+
+def test_refresh_dataset_lczip():
+    '''
+    This tests that refreshing an LC ZIP only replaces the LCs from the
+    refreshed collections.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir, nobjects=5)
+        ds = datasets.sqlite_get_dataset(basedir, setid, 'pickle')
+
+        csvlcdir = os.path.join(basedir, 'csvlcs', 'test-coll')
+        os.makedirs(csvlcdir)
+
+        with ZipFile(ds['lczipfpath'],'w') as outzip:
+            for x in ds['result']:
+                outzip.writestr('test-coll-%s-csvlc.gz' % x['db_oid'], 'old')
+
+        for x in ds['result']:
+            with open(os.path.join(csvlcdir,
+                                   '%s-csvlc.gz' % x['db_oid']),'w') as outfd:
+                outfd.write('new')
+
+        # nothing refreshed, so the old LCs are copied over
+        lczip, generated = datasets.sqlite_refresh_dataset_lczip(
+            basedir, setid, [], []
+        )
+        assert generated
+        with ZipFile(lczip,'r') as inzip:
+            assert inzip.read('test-coll-OBJ-0000-csvlc.gz') == b'old'
+            assert len(inzip.namelist()) == 6
+
+        # the collection was refreshed, so the LCs come from the CSV LCs
+        lczip, generated = datasets.sqlite_refresh_dataset_lczip(
+            basedir, setid, [], ['test_coll']
+        )
+        with ZipFile(lczip,'r') as inzip:
+            assert inzip.read('test-coll-OBJ-0000-csvlc.gz') == b'new'
+
+        ds = datasets.sqlite_get_dataset(basedir, setid, 'pickle')
+        assert ds['status'] == 'complete'
+
+
+def test_refresh_dataset_shared_lczip():
+    '''
+    This tests that refreshing a dataset's LC ZIP doesn't change the LC ZIPs of
+    the datasets that shared it.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setids = [make_fake_dataset(basedir, nobjects=5)]
+        for ind in range(2):
+            setid, creationdt = datasets.sqlite_prepare_dataset(basedir)
+            datasets.sqlite_new_dataset(basedir,
+                                        setid,
+                                        creationdt,
+                                        make_fake_searchresult(nobjects=5))
+            setids.append(setid)
+        lczips = [os.path.join(basedir, 'products', 'lightcurves-%s.zip' % x)
+                  for x in setids]
+
+        ds = datasets.sqlite_get_dataset(basedir, setids[0], 'pickle')
+
+        csvlcdir = os.path.join(basedir, 'csvlcs', 'test-coll')
+        os.makedirs(csvlcdir)
+
+        for x in ds['result']:
+            with open(os.path.join(csvlcdir,
+                                   '%s-csvlc.gz' % x['db_oid']),'w') as outfd:
+                outfd.write('new')
+
+        # the first dataset has the actual LC ZIP, the other two link to it
+        with ZipFile(lczips[0],'w') as outzip:
+            for x in ds['result']:
+                outzip.writestr('test-coll-%s-csvlc.gz' % x['db_oid'], 'old')
+        for lczip in lczips[1:]:
+            os.symlink(os.path.abspath(lczips[0]), lczip)
+
+        db = sqlite3.connect(os.path.join(basedir, 'lcc-datasets.sqlite'))
+        db.execute("update lcc_datasets set lczip_cachekey = 'shared-key'")
+        db.commit()
+        db.close()
+
+        lczip, generated = datasets.sqlite_refresh_dataset_lczip(
+            basedir, setids[0], [], ['test_coll']
+        )
+        assert generated
+
+        with ZipFile(lczips[0],'r') as inzip:
+            assert inzip.read('test-coll-OBJ-0000-csvlc.gz') == b'new'
+
+        # the other datasets still have the old LCs in a single shared file
+        for lczip in lczips[1:]:
+            with ZipFile(lczip,'r') as inzip:
+                assert inzip.read('test-coll-OBJ-0000-csvlc.gz') == b'old'
+
+        assert not os.path.islink(lczips[1])
+        assert os.path.samefile(lczips[1], lczips[2])
+        assert not os.path.samefile(lczips[0], lczips[1])
+
+        # none of them can be linked to by new datasets with the old cache key
+        db = sqlite3.connect(os.path.join(basedir, 'lcc-datasets.sqlite'))
+        cachekeys = db.execute(
+            "select lczip_cachekey from lcc_datasets"
+        ).fetchall()
+        db.close()
+        assert cachekeys == [(None,), (None,), (None,)]
+
+
+def test_dataset_eviction_and_restore():
+    '''
+    This tests evicting a dataset's products and regenerating them.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir)
+        mark_dataset_complete(basedir, setid)
+
+        datasetdir = os.path.join(basedir, 'datasets')
+        csvf = os.path.join(datasetdir, 'dataset-%s.csv' % setid)
+        pagef = os.path.join(datasetdir, 'dataset-%s-rows-page1.pkl' % setid)
+        with open(csvf,'rb') as infd:
+            csv_contents = infd.read()
+
+        usage = datasets.sqlite_update_dataset_usage(basedir, setid)
+        assert usage['core_nbytes'] > 0
+        assert usage['products_nbytes'] > 0
+
+        freed = datasets.sqlite_evict_dataset_products(basedir, setid)
+        assert freed == usage['products_nbytes']
+        assert not os.path.exists(csvf)
+        assert not os.path.exists(pagef)
+        assert os.path.exists(os.path.join(datasetdir,
+                                           'dataset-%s.pkl.gz' % setid))
+
+        # the first page is regenerated on access
+        ds = datasets.sqlite_get_dataset(basedir, setid, 'json-preview')
+        assert ds['products_evicted'] == ['csv', 'pages']
+        assert len(ds['rows']) == 20
+        assert os.path.exists(pagef)
+
+        restored = datasets.sqlite_restore_dataset_products(basedir, setid)
+        assert restored == ['csv']
+        with open(csvf,'rb') as infd:
+            assert infd.read() == csv_contents
+
+        ds = datasets.sqlite_get_dataset(basedir, setid, 'json-header')
+        assert ds['products_evicted'] == []
+
+
+def test_dataset_eviction_shared_lczip(monkeypatch):
+    '''
+    This tests that an LC ZIP other datasets link to isn't evicted.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid1 = make_fake_dataset(basedir)
+        setid2, creationdt = datasets.sqlite_prepare_dataset(basedir)
+        datasets.sqlite_new_dataset(basedir,
+                                    setid2,
+                                    creationdt,
+                                    make_fake_searchresult())
+        mark_dataset_complete(basedir, setid1)
+        mark_dataset_complete(basedir, setid2)
+
+        # the second dataset has the same LCs, so its LC ZIP links to the
+        # first dataset's
+        lczip1 = os.path.join(basedir, 'products',
+                              'lightcurves-%s.zip' % setid1)
+        lczip2 = os.path.join(basedir, 'products',
+                              'lightcurves-%s.zip' % setid2)
+        with open(lczip1,'wb') as outfd:
+            outfd.write(b'fake LC zip')
+        os.symlink(os.path.abspath(lczip1), lczip2)
+
+        db = sqlite3.connect(os.path.join(basedir, 'lcc-datasets.sqlite'))
+        db.execute("update lcc_datasets set lczip_cachekey = 'shared-key'")
+        db.commit()
+        db.close()
+
+        datasets.sqlite_evict_dataset_products(basedir, setid1)
+        assert os.path.exists(lczip1)
+        assert os.path.exists(lczip2)
+        assert not os.path.exists(
+            os.path.join(basedir, 'datasets', 'dataset-%s.csv' % setid1)
+        )
+
+        ds = datasets.sqlite_get_dataset(basedir, setid1, 'json-header')
+        assert 'lczip' not in ds['products_evicted']
+
+        # evicting the linked dataset only removes its symlink
+        datasets.sqlite_evict_dataset_products(basedir, setid2)
+        assert os.path.exists(lczip1)
+        assert not os.path.lexists(lczip2)
+
+        ds = datasets.sqlite_get_dataset(basedir, setid2, 'json-header')
+        assert 'lczip' in ds['products_evicted']
+
+        # nothing links to the first dataset's LC ZIP anymore
+        datasets.sqlite_evict_dataset_products(basedir, setid1)
+        assert not os.path.exists(lczip1)
+
+        ds = datasets.sqlite_get_dataset(basedir, setid1, 'json-header')
+        assert 'lczip' in ds['products_evicted']
+
+        # a failed restore doesn't leave a partial LC ZIP behind
+        def failing_write(lczip_fpath, lclist, **kwargs):
+            with open(lczip_fpath,'wb') as outfd:
+                outfd.write(b'partial')
+            raise OSError('disk full')
+
+        with monkeypatch.context() as mpatch:
+            mpatch.setattr(datasets, 'write_dataset_lczip', failing_write)
+            restored = datasets.sqlite_restore_dataset_products(
+                basedir, setid1, products=('lczip',)
+            )
+
+        assert restored == []
+        assert os.listdir(os.path.join(basedir, 'products')) == []
+
+        restored = datasets.sqlite_restore_dataset_products(
+            basedir, setid1, products=('lczip',)
+        )
+        assert restored == ['lczip']
+        assert not os.path.islink(lczip1)
+        with ZipFile(lczip1,'r') as zipf:
+            assert 'lczip-manifest.json' in zipf.namelist()
+        assert os.listdir(os.path.join(basedir, 'products')) == [
+            os.path.basename(lczip1)
+        ]
+
+
+def test_dataset_retention_quota():
+    '''
+    This tests that the retention manager evicts the least-recently accessed
+    datasets until disk usage is under the quota.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid1 = make_fake_dataset(basedir)
+        setid2, creationdt = datasets.sqlite_prepare_dataset(basedir)
+        datasets.sqlite_new_dataset(basedir,
+                                    setid2,
+                                    creationdt,
+                                    make_fake_searchresult())
+        mark_dataset_complete(basedir, setid1)
+        mark_dataset_complete(basedir, setid2)
+
+        # the first dataset was accessed a long time ago
+        for setid in (setid1, setid2):
+            datasets.sqlite_touch_dataset(basedir, setid)
+
+        db = sqlite3.connect(os.path.join(basedir, 'lcc-datasets.sqlite'))
+        db.execute("update lcc_dataset_usage set last_accessed = ? "
+                   "where setid = ?", ('2018-01-01T00:00:00', setid1))
+        db.execute("update lcc_dataset_usage set last_accessed = ? "
+                   "where setid = ?", ('2018-01-02T00:00:00', setid2))
+        db.commit()
+        db.close()
+
+        # no quotas exceeded
+        res = datasets.sqlite_apply_dataset_retention(
+            basedir, total_quota_bytes=1024**3
+        )
+        assert res['evicted'] == []
+        assert res['lcbundle']['nmembers'] == 0
+
+        usage = datasets.sqlite_dataset_usage(basedir)
+        assert usage['ndatasets'] == 2
+        assert usage['by_owner'][2]['ndatasets'] == 2
+
+        # only one of the datasets needs to be evicted to get under the quota
+        res = datasets.sqlite_apply_dataset_retention(
+            basedir, owner_quota_bytes=usage['total_nbytes'] - 1
+        )
+        assert res['evicted'] == [setid1]
+        assert not os.path.exists(
+            os.path.join(basedir, 'datasets', 'dataset-%s.csv' % setid1)
+        )
+        assert os.path.exists(
+            os.path.join(basedir, 'datasets', 'dataset-%s.csv' % setid2)
+        )
+
+        usage = datasets.sqlite_dataset_usage(basedir)
+        assert usage['nevicted'] == 1
+
+
+def test_get_dataset_status():
+    '''
+    This tests that polling a dataset's status doesn't record an access.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        setid = make_fake_dataset(basedir,
+                                  incoming_userid=4,
+                                  incoming_role='authenticated',
+                                  dataset_visibility='private')
+
+        assert datasets.sqlite_get_dataset_status(
+            basedir, setid,
+            incoming_userid=4, incoming_role='authenticated'
+        ) == 'in progress'
+        assert datasets.sqlite_get_dataset_status(basedir, setid) is None
+        assert datasets.sqlite_get_dataset_status(basedir, 'nope') is None
+
+        db = sqlite3.connect(os.path.join(basedir, 'lcc-datasets.sqlite'))
+        try:
+            nused = db.execute("select count(*) from lcc_dataset_usage "
+                               "where last_accessed is not null").fetchone()
+        except sqlite3.OperationalError:
+            nused = (0,)
+        db.close()
+        assert nused == (0,)
+
+
+def test_lczip_stream():
+    '''
+    This tests that a streamed LC ZIP has the same members as one written to
+    disk.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        csvlcdir = os.path.join(basedir, 'csvlcs', 'test-coll')
+        os.makedirs(csvlcdir)
+
+        lclist = []
+        for ind in range(5):
+            lcf = os.path.join(csvlcdir, 'OBJ-%04i-csvlc.gz' % ind)
+            if ind != 2:
+                with open(lcf,'wb') as outfd:
+                    outfd.write(os.urandom(1000 + ind))
+            lclist.append(lcf)
+
+        lczip = datasets.LCZipStream(chunksize=256)
+        chunks = []
+        for lcf in lclist:
+            if os.path.exists(lcf):
+                chunks.extend(lczip.add_lc(lcf))
+            else:
+                lczip.add_missing(lcf)
+        chunks.append(lczip.close())
+
+        # the archive is sent in pieces as it's made
+        assert len([x for x in chunks if x]) > 5
+
+        ondisk = os.path.join(basedir, 'lightcurves.zip')
+        datasets.write_dataset_lczip(ondisk, lclist)
+
+        with ZipFile(BytesIO(b''.join(chunks)),'r') as streamed, \
+             ZipFile(ondisk,'r') as written:
+
+            assert streamed.testzip() is None
+            assert streamed.namelist() == written.namelist()
+            for name in written.namelist():
+                assert streamed.read(name) == written.read(name)
+
+            assert json.loads(streamed.read('lczip-manifest.json'))[2] == (
+                'OBJ-0002-csvlc.gz missing'
+            )
+
+
+def test_stream_lczip_lc():
+    '''
+    This tests that the LC ZIP handlers stream each CSV LC's chunks as they're
+    read in a thread.
+
+    '''
+
+    class FakeHandler(object):
+
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, chunk):
+            self.chunks.append(chunk)
+
+        async def flush(self):
+            pass
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        csvlcdir = os.path.join(basedir, 'csvlcs', 'test-coll')
+        os.makedirs(csvlcdir)
+
+        lclist = []
+        for ind in range(3):
+            lcf = os.path.join(csvlcdir, 'OBJ-%04i-csvlc.gz' % ind)
+            with open(lcf,'wb') as outfd:
+                outfd.write(os.urandom(1000 + ind))
+            lclist.append(lcf)
+
+        handler = FakeHandler()
+        lczip = datasets.LCZipStream(chunksize=256)
+
+        async def stream_lcs():
+            with open(os.path.join(basedir, 'cached.zip'),'wb') as cachefd:
+                for lcf in lclist:
+                    await dh.stream_lczip_lc(handler, lczip, lcf, cachefd)
+                chunk = lczip.close()
+                handler.write(chunk)
+                cachefd.write(chunk)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(stream_lcs())
+        finally:
+            loop.close()
+
+        assert len(handler.chunks) > 3
+
+        with open(os.path.join(basedir, 'cached.zip'),'rb') as infd:
+            assert infd.read() == b''.join(handler.chunks)
+
+        with ZipFile(BytesIO(b''.join(handler.chunks)),'r') as streamed:
+            assert streamed.testzip() is None
+            assert len(streamed.namelist()) == 4
+
+
+def test_write_dataset_lczip_parallel():
+    '''
+    This tests that the parallel LC ZIP builder makes the same archive as the
+    single-threaded one.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        lclist = []
+        for coll in ('coll-a', 'coll-b'):
+            csvlcdir = os.path.join(basedir, 'csvlcs', coll)
+            os.makedirs(csvlcdir)
+            for ind in range(20):
+                lcf = os.path.join(csvlcdir, 'OBJ-%04i-csvlc.gz' % ind)
+                if ind != 7:
+                    with open(lcf,'wb') as outfd:
+                        outfd.write(os.urandom(ind*5000))
+                lclist.append(lcf)
+
+        serial_zip = os.path.join(basedir, 'serial.zip')
+        parallel_zip = os.path.join(basedir, 'parallel.zip')
+
+        serial_manifest = datasets.write_dataset_lczip(serial_zip,
+                                                       lclist,
+                                                       nthreads=1)
+        parallel_manifest = datasets.write_dataset_lczip(parallel_zip,
+                                                         lclist,
+                                                         nthreads=4,
+                                                         chunksize=4096)
+        assert serial_manifest == parallel_manifest
+
+        with ZipFile(serial_zip,'r') as serial, \
+             ZipFile(parallel_zip,'r') as parallel:
+
+            assert parallel.testzip() is None
+            assert parallel.namelist() == serial.namelist()
+            assert len(parallel.namelist()) == 39
+
+            for zinfo in parallel.infolist():
+                assert zinfo.compress_type == ZIP_STORED
+                assert (parallel.read(zinfo.filename) ==
+                        serial.read(zinfo.filename))
+
+
+def test_lcbundle_cache():
+    '''
+    This tests that overlapping datasets reuse the CSV LCs in the LC bundle
+    cache and that the LC ZIP built from it is valid.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        lcdir = os.path.join(basedir, 'lcs')
+        os.makedirs(lcdir)
+        convertopts = {'csvlc_version':1,
+                       'comment_char':'#',
+                       'column_separator':',',
+                       'skip_converted':True}
+
+        def make_tasks(oids):
+            tasks = []
+            for oid in oids:
+                orig = os.path.join(lcdir, '%s.pkl' % oid)
+                if not os.path.exists(orig):
+                    with open(orig,'wb') as outfd:
+                        outfd.write(os.urandom(2000))
+                tasks.append(
+                    (orig, oid, '/fake/lcformat.json', 'test_coll',
+                     os.path.join(basedir, 'csvlcs', 'test-coll',
+                                  '%s-csvlc.gz' % oid))
+                )
+            return tasks
+
+        def fake_convert(task):
+            csvlc = os.path.join(lcdir, '%s-csvlc.gz' % task[1])
+            with open(csvlc,'wb') as outfd:
+                outfd.write(b'csvlc for %s' % task[1].encode())
+            return csvlc
+
+        # the first dataset converts everything
+        tasks = make_tasks(['OBJ-%03i' % x for x in range(10)])
+        cached = datasets.sqlite_lcbundle_lookup(basedir, tasks, convertopts)
+        assert cached == [None]*10
+
+        results = datasets.lcbundle_merge_results(
+            cached,
+            [fake_convert(x) for x, c in zip(tasks, cached) if c is None]
+        )
+        bundled = datasets.sqlite_lcbundle_store(basedir,
+                                                 tasks,
+                                                 results,
+                                                 convertopts)
+        assert all(os.path.exists(x[0]) for x in bundled)
+
+        # the cached CSV LCs are links to the converted ones, not copies
+        assert all(os.path.samefile(x[0], y)
+                   for x, y in zip(bundled, results))
+
+        # the second dataset overlaps with the first for 6 LCs
+        tasks = make_tasks(['OBJ-%03i' % x for x in range(4, 12)])
+        cached = datasets.sqlite_lcbundle_lookup(basedir, tasks, convertopts)
+        assert [x is not None for x in cached] == [True]*6 + [False]*2
+
+        results = datasets.lcbundle_merge_results(
+            cached,
+            [fake_convert(x) for x, c in zip(tasks, cached) if c is None]
+        )
+        bundled = datasets.sqlite_lcbundle_store(basedir,
+                                                 tasks,
+                                                 results,
+                                                 convertopts)
+
+        stats = datasets.sqlite_lcbundle_stats(basedir)
+        assert stats['hits'] == 6
+        assert stats['misses'] == 12
+        assert stats['hit_ratio'] == 6/18
+        assert stats['nmembers'] == 12
+        assert stats['by_collection']['test_coll']['nmembers'] == 12
+
+        # changed conversion options mean the cached CSV LCs can't be used
+        cached = datasets.sqlite_lcbundle_lookup(
+            basedir, tasks, dict(convertopts, column_separator='|')
+        )
+        assert cached == [None]*8
+
+        # the LC ZIP is assembled from the cache using the cached CRCs
+        zipfile_lclist = [x[-1] for x in tasks]
+        member_sources = {x[-1]:y for x, y in zip(tasks, bundled)}
+
+        for nthreads in (1, 4):
+
+            lczip_fpath = os.path.join(basedir, 'lightcurves-%s.zip' % nthreads)
+            datasets.write_dataset_lczip(lczip_fpath,
+                                         zipfile_lclist,
+                                         nthreads=nthreads,
+                                         member_sources=member_sources)
+
+            with ZipFile(lczip_fpath,'r') as lczip:
+                assert lczip.testzip() is None
+                assert lczip.read('test-coll-OBJ-011-csvlc.gz') == (
+                    b'csvlc for OBJ-011'
+                )
+                assert len(lczip.namelist()) == 9
+
+
+
+def make_fake_object_catalog(basedir, monkeypatch):
+    '''
+    This makes a fake object catalog for the 'test-coll' collection.
+
+    dbsearch.sqlite_get_collections is replaced so it returns only this
+    collection. Returns the path to the catalog.
+
+    '''
+
+    catalog = os.path.join(basedir, 'test-coll', 'catalog-objectinfo.sqlite')
+    os.makedirs(os.path.dirname(catalog))
+
+    db = sqlite3.connect(catalog)
+    db.execute("create table object_catalog (objectid text, "
+               "ra real, decl real, lcfname text, object_owner integer, "
+               "object_visibility text, object_sharedwith text)")
+    db.executemany(
+        "insert into object_catalog values (?, ?, ?, ?, ?, ?, ?)",
+        [('OBJ-%03i' % x, 10.0, -10.0, '/lcs/OBJ-%03i.pkl' % x, 1,
+          'private' if x == 3 else 'public', '') for x in range(10)]
+    )
+    db.commit()
+    db.close()
+
+    def fake_get_collections(basedir, **kwargs):
+        return {'databases':['test_coll'],
+                'info':{'object_catalog_path':[catalog],
+                        'lcformatkey':['test'],
+                        'lcformatdesc':['/fake/lcformat.json'],
+                        'collection_id':['test-coll']}}
+
+    monkeypatch.setattr(dbsearch,
+                        'sqlite_get_collections',
+                        fake_get_collections)
+
+    return catalog
+
+
+def test_bulk_lc_lookup(monkeypatch):
+    '''
+    This tests looking up the LCs of a list of objects with a single query for
+    each collection.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        make_fake_object_catalog(basedir, monkeypatch)
+
+        objects = ([('test-coll', 'OBJ-%03i' % x) for x in (0, 3, 6, 9, 11)] +
+                   [('other-coll', 'OBJ-001')])
+
+        lookup = dbsearch.sqlite_objectid_lookup(basedir,
+                                                 objects,
+                                                 batchsize=2)
+
+        # OBJ-003 is private and OBJ-011 doesn't exist
+        assert 'other_coll' not in lookup
+        assert sorted(x['db_oid'] for x in lookup['test_coll']['result']) == [
+            'OBJ-000', 'OBJ-006', 'OBJ-009'
+        ]
+
+        tasks = datasets.bulk_csvlcs_to_generate(basedir, lookup)
+        assert [x[1] for x in tasks] == ['OBJ-000', 'OBJ-006', 'OBJ-009']
+        assert tasks[0][0] == '/lcs/OBJ-000.pkl'
+        assert tasks[0][2] == '/fake/lcformat.json'
+        assert tasks[0][-1] == os.path.join(os.path.abspath(basedir),
+                                            'csvlcs',
+                                            'test-coll',
+                                            'OBJ-000-csvlc.gz')
+
+
+def test_object_access_cache(monkeypatch):
+    '''
+    This tests that object access decisions are cached until they expire or
+    the object catalog changes.
+
+    '''
+
+    monkeypatch.setattr(dbsearch, '_OBJECT_ACCESS_CACHE', {})
+
+    lookups = []
+    orig_lookup = dbsearch.sqlite_objectid_lookup
+
+    def counting_lookup(*args, **kwargs):
+        lookups.append(args[1])
+        return orig_lookup(*args, **kwargs)
+
+    monkeypatch.setattr(dbsearch, 'sqlite_objectid_lookup', counting_lookup)
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        catalog = make_fake_object_catalog(basedir, monkeypatch)
+
+        assert dbsearch.get_cached_object_access(basedir,
+                                                 'test-coll',
+                                                 'OBJ-003') is None
+
+        for _ in range(3):
+            assert dbsearch.sqlite_check_object_access(basedir,
+                                                       'test-coll',
+                                                       'OBJ-003') is False
+            assert dbsearch.sqlite_check_object_access(basedir,
+                                                       'test-coll',
+                                                       'OBJ-004') is True
+        assert len(lookups) == 2
+
+        assert dbsearch.get_cached_object_access(basedir,
+                                                 'test_coll',
+                                                 'OBJ-004') is True
+
+        # a superuser gets their own decision
+        assert dbsearch.sqlite_check_object_access(
+            basedir, 'test-coll', 'OBJ-003',
+            incoming_userid=1, incoming_role='superuser'
+        ) is True
+        assert len(lookups) == 3
+
+        # changing the object's visibility makes the decisions stale
+        db = sqlite3.connect(catalog)
+        db.execute("update object_catalog set object_visibility = 'public' "
+                   "where objectid = 'OBJ-003'")
+        db.commit()
+        db.close()
+        os.utime(catalog, ns=(0, 12345))
+
+        assert dbsearch.get_cached_object_access(basedir,
+                                                 'test-coll',
+                                                 'OBJ-003') is None
+        assert dbsearch.sqlite_check_object_access(basedir,
+                                                   'test-coll',
+                                                   'OBJ-003') is True
+        assert len(lookups) == 4
+
+        # expired decisions are looked up again
+        assert dbsearch.sqlite_check_object_access(basedir,
+                                                   'test-coll',
+                                                   'OBJ-005',
+                                                   ttl=-1.0) is True
+        assert dbsearch.sqlite_check_object_access(basedir,
+                                                   'test-coll',
+                                                   'OBJ-005') is True
+        assert len(lookups) == 6
+
+
+def test_object_access_cache_handler(monkeypatch):
+    '''
+    This tests that the static file handler keeps the object access decisions
+    made in its process pool executor in the IOLoop process's cache.
+
+    '''
+
+    monkeypatch.setattr(dbsearch, '_OBJECT_ACCESS_CACHE', {})
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        make_fake_object_catalog(basedir, monkeypatch)
+
+        submitted = []
+
+        class CountingExecutor(ProcessPoolExecutor):
+
+            def submit(self, fn, *args, **kwargs):
+                submitted.append(args[2])
+                return super().submit(fn, *args, **kwargs)
+
+        executor = CountingExecutor(max_workers=1)
+
+        handler = SimpleNamespace(
+            basedir=basedir,
+            executor=executor,
+            current_user={'user_id':2, 'user_role':'anonymous'}
+        )
+
+        async def object_access_ok(objectid):
+            return await basehandler.AuthEnabledStaticHandler.object_access_ok(
+                handler, 'test_coll', objectid
+            )
+
+        def check_access(objectid):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(object_access_ok(objectid))
+            finally:
+                loop.close()
+
+        try:
+
+            for _ in range(3):
+                assert check_access('OBJ-003') is False
+                assert check_access('OBJ-004') is True
+
+        finally:
+            executor.shutdown()
+
+        # each object is only looked up once in the worker process
+        assert submitted == ['OBJ-003', 'OBJ-004']
+        assert dbsearch.get_cached_object_access(basedir,
+                                                 'test-coll',
+                                                 'OBJ-004') is True
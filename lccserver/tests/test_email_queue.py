@@ -0,0 +1,372 @@
+'''test_email_queue.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the outbound email queue in the authnzerver.
+
+'''
+
+from lccserver.authnzerver import authdb, actions, handlers
+import os
+import asyncio
+import socket
+import socketserver
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    '''
+    This is just enough of an SMTP server to accept emails.
+
+    It doesn't support STARTTLS. Any login is accepted. Recipients with
+    'refused' in their address are refused.
+
+    '''
+
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode())
+
+    def handle(self):
+
+        self.server.connections = self.server.connections + 1
+        self.reply('220 localhost stand-in SMTP server')
+
+        while True:
+
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                break
+
+            elif command in ('EHLO', 'HELO'):
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN')
+
+            elif command == 'AUTH':
+                self.server.logins.append(line)
+                self.reply('235 authentication successful')
+
+            elif command == 'RCPT' and 'refused' in line:
+                self.reply('550 no such user')
+
+            elif command == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    dataline = self.rfile.readline().decode()
+                    if dataline in ('.\r\n', ''):
+                        break
+                    data.append(dataline)
+                self.server.messages.append(''.join(data))
+                self.reply('250 OK')
+
+            else:
+                self.reply('250 OK')
+
+
+def start_smtp_server():
+    '''
+    This starts the stand-in SMTP server in a thread.
+
+    '''
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                             StandInSMTPHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.messages = []
+    server.logins = []
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def get_closed_port():
+    '''
+    This returns a local port that nothing is listening on.
+
+    '''
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def remove_test_authdb():
+    '''
+    This removes the test auth DB.
+
+    '''
+
+    for fname in ('test-emailqueue.authdb.sqlite',
+                  'test-emailqueue.authdb.sqlite-shm',
+                  'test-emailqueue.authdb.sqlite-wal'):
+        try:
+            os.remove(fname)
+        except Exception as e:
+            pass
+
+
+def run_coroutine(coroutine):
+    '''
+    This runs a coroutine on its own event loop.
+
+    '''
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def get_queued_emails():
+    '''
+    This returns the rows in the email queue.
+
+    '''
+
+    currproc = mp.current_process()
+    email_queue = currproc.table_meta.tables['email_queue']
+    result = currproc.connection.execute(
+        email_queue.select().order_by(email_queue.c.email_id)
+    )
+    rows = result.fetchall()
+    result.close()
+    return rows
+
+
+def test_email_queue():
+    '''
+    This tests queueing emails and sending them in the background.
+
+    '''
+
+    remove_test_authdb()
+
+    authdb.create_sqlite_auth_db('test-emailqueue.authdb.sqlite')
+    authdb.initial_authdb_inserts('sqlite:///test-emailqueue.authdb.sqlite')
+
+    smtp_server = start_smtp_server()
+    smtp_port = smtp_server.server_address[1]
+
+    try:
+
+        # queue a few emails. one of them will be refused by the server.
+        for recipient in ('one@test.org', 'refused@test.org',
+                          'two@test.org', 'three@test.org'):
+            email_id = actions.queue_email(
+                'LCC-Server admin <admin@test.org>',
+                'Test email to %s' % recipient,
+                'Hello %s' % recipient,
+                [recipient],
+                '127.0.0.1',
+                None,
+                port=smtp_port,
+                override_authdb_path='sqlite:///test-emailqueue.authdb.sqlite'
+            )
+            assert email_id is not None
+
+        assert len(get_queued_emails()) == 4
+
+        # the stand-in server doesn't do TLS, so nothing is sent unless that's
+        # allowed
+        sent = actions.send_queued_emails()
+        assert sent['success'] is True
+        assert sent['sent'] == 0
+        assert sent['retrying'] == 4
+        assert smtp_server.messages == []
+
+        currproc = mp.current_process()
+        email_queue = currproc.table_meta.tables['email_queue']
+        currproc.connection.execute(
+            email_queue.update().values(
+                {'next_attempt':datetime.utcnow() - timedelta(seconds=1)}
+            )
+        )
+
+        # all of the emails go over the same connection
+        sent = actions.send_queued_emails(maxattempts=3, require_tls=False)
+        assert sent['sent'] == 3
+        assert sent['retrying'] == 1
+        assert sent['failed'] == 0
+        assert sent['finished'] is True
+        assert smtp_server.connections == 2
+        assert len(smtp_server.messages) == 3
+        assert 'Subject: Test email to one@test.org' in smtp_server.messages[0]
+
+        # the refused email is kept and retried later
+        queued = get_queued_emails()
+        assert len(queued) == 1
+        assert queued[0]['recipients'] == ['refused@test.org']
+        assert queued[0]['attempts'] == 2
+        assert queued[0]['next_attempt'] > datetime.utcnow()
+
+        sent = actions.send_queued_emails(maxattempts=3, require_tls=False)
+        assert sent['sent'] == 0 and sent['retrying'] == 0
+
+        # after maxattempts, the email is marked as failed
+        currproc.connection.execute(
+            email_queue.update().values(
+                {'next_attempt':datetime.utcnow() - timedelta(seconds=1)}
+            )
+        )
+        sent = actions.send_queued_emails(maxattempts=3, require_tls=False)
+        assert sent['failed'] == 1
+
+        queued = get_queued_emails()
+        assert queued[0]['status'] == 'failed'
+        assert 'smtp_pass' not in queued[0].keys()
+        assert 'no such user' in queued[0]['last_error']
+
+        # emails to a server that can't be reached are retried later
+        actions.queue_email(
+            'LCC-Server admin <admin@test.org>',
+            'Test email to nowhere',
+            'Hello nowhere',
+            ['nowhere@test.org'],
+            '127.0.0.1',
+            None,
+            port=get_closed_port()
+        )
+        sent = actions.send_queued_emails(require_tls=False)
+        assert sent['retrying'] == 1
+
+        # the email sender runs send_queued_emails in its executor
+        actions.queue_email(
+            'LCC-Server admin <admin@test.org>',
+            'Test email from the sender',
+            'Hello from the sender',
+            ['four@test.org'],
+            '127.0.0.1',
+            None,
+            port=smtp_port
+        )
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            sender = handlers.EmailSender(executor, require_tls=False)
+            run_coroutine(sender.run())
+        finally:
+            executor.shutdown()
+
+        stats = sender.stats()
+        assert stats['runs'] == 1
+        assert stats['total_sent'] == 1
+        assert len(smtp_server.messages) == 4
+
+        # emails that need an SMTP login wait until the sender has its
+        # password, without using up their tries
+        actions.queue_email(
+            'LCC-Server admin <admin@test.org>',
+            'Test email with a login',
+            'Hello from the mailer',
+            ['five@test.org'],
+            '127.0.0.1',
+            'mailer',
+            port=smtp_port
+        )
+        sent = actions.send_queued_emails(require_tls=False)
+        assert sent['waiting'] == 1 and sent['sent'] == 0
+
+        queued = get_queued_emails()
+        assert queued[-1]['attempts'] == 0
+        assert queued[-1]['next_attempt'] > datetime.utcnow()
+
+        currproc.connection.execute(
+            email_queue.update().values(
+                {'next_attempt':datetime.utcnow() - timedelta(seconds=1)}
+            )
+        )
+
+        # the sender takes the passwords from the requests that queue emails
+        sender.add_credentials(
+            {'request':'batch',
+             'body':{'requests':[
+                 {'request':'session-exists',
+                  'body':{'session_token':'nope'}},
+                 {'request':'user-forgotpass-email',
+                  'body':{'smtp_server':'127.0.0.1',
+                          'smtp_port':smtp_port,
+                          'smtp_user':'mailer',
+                          'smtp_pass':'mailer-password'}}
+             ]}}
+        )
+        assert sender.credentials == {
+            ('127.0.0.1', smtp_port, 'mailer'):'mailer-password'
+        }
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            sender.executor = executor
+            run_coroutine(sender.run())
+        finally:
+            executor.shutdown()
+
+        assert len(smtp_server.messages) == 5
+        assert len(smtp_server.logins) == 1
+        assert smtp_server.logins[0].startswith('AUTH PLAIN')
+
+        # emails that have waited too long for their password are marked as
+        # failed instead of waiting forever
+        stuck_id = actions.queue_email(
+            'LCC-Server admin <admin@test.org>',
+            'Test email with a lost login',
+            'Hello from nobody',
+            ['six@test.org'],
+            '127.0.0.1',
+            'lost-mailer',
+            port=smtp_port
+        )
+        currproc.connection.execute(
+            email_queue.update().where(
+                email_queue.c.email_id == stuck_id
+            ).values(
+                {'queued':datetime.utcnow() - timedelta(days=2)}
+            )
+        )
+
+        sent = actions.send_queued_emails(require_tls=False)
+        assert sent['failed'] == 1 and sent['waiting'] == 0
+
+        queued = get_queued_emails()
+        assert queued[-1]['status'] == 'failed'
+        assert queued[-1]['attempts'] == 0
+        assert 'no SMTP password' in queued[-1]['last_error']
+
+        # the sender is started right after a request queues an email
+        assert handlers.is_email_queueing_request(
+            {'request':'user-forgotpass-email', 'body':{}}
+        )
+        assert not handlers.is_email_queueing_request(
+            {'request':'batch',
+             'body':{'requests':[{'request':'session-exists'}]}}
+        )
+
+    finally:
+
+        smtp_server.shutdown()
+        smtp_server.server_close()
+
+        currproc = mp.current_process()
+
+        if getattr(currproc, 'table_meta', None):
+            del currproc.table_meta
+
+        if getattr(currproc, 'connection', None):
+            currproc.connection.close()
+            del currproc.connection
+
+        if getattr(currproc, 'engine', None):
+            currproc.engine.dispose()
+            del currproc.engine
+
+        remove_test_authdb()
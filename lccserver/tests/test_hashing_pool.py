@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_hashing_pool.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the authnzerver's password hashing pool.
+
+'''
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lccserver.authnzerver import handlers
+
+
+def run_coroutine(coroutine):
+    '''
+    This runs a coroutine on its own event loop.
+
+    '''
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def fake_login(payload):
+    '''
+    This pretends to be a slow login.
+
+    '''
+
+    time.sleep(0.2)
+    return {'success':True,
+            'user_id':4,
+            'messages':['Login successful.'],
+            'thread':threading.current_thread().name}
+
+
+def fake_session_exists(payload):
+    '''
+    This pretends to be a fast session lookup.
+
+    '''
+
+    return {'success':True,
+            'session_info':{},
+            'messages':['Session look up successful.'],
+            'thread':threading.current_thread().name}
+
+
+def test_hashing_pool_limits():
+    '''
+    This tests the queue depth and per-IP limits of the hashing pool.
+
+    '''
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    hashing_pool = handlers.PasswordHashingPool(executor,
+                                                max_pending=4,
+                                                max_per_ip=2)
+
+    async def run_logins(ip_addresses):
+        return await asyncio.gather(*[
+            hashing_pool.run(fake_login, {'email':'a@example.com',
+                                          'ip_address':ip_address})
+            for ip_address in ip_addresses
+        ])
+
+    async def run_batches(batch_body, nbatches):
+        return await asyncio.gather(*[
+            hashing_pool.run(fake_login, batch_body) for x in range(nbatches)
+        ])
+
+    try:
+
+        # only two logins at once from the same IP address
+        results = run_coroutine(run_logins(['1.1.1.1']*4))
+        assert [x['success'] for x in results] == [True, True, False, False]
+        assert 'Too many sign in attempts' in results[2]['messages'][0]
+
+        # only four logins at once in total
+        results = run_coroutine(run_logins(['1.1.1.1', '2.2.2.2',
+                                            '3.3.3.3', '4.4.4.4',
+                                            '5.5.5.5']))
+        assert [x['success'] for x in results] == [True]*4 + [False]
+        assert 'The server is busy' in results[4]['messages'][0]
+
+        # the counts are back to zero after the requests finish
+        assert hashing_pool.pending == 0
+        assert hashing_pool.pending_by_ip == {}
+        assert hashing_pool.rejected == 3
+
+        # the IP address in a batch request is used as well
+        batch_body = {'requests':[{'request':'user-login',
+                                   'body':{'ip_address':'6.6.6.6'}}]}
+        results = run_coroutine(run_batches(batch_body, 3))
+        assert [x['success'] for x in results] == [True, True, False]
+
+    finally:
+        executor.shutdown()
+
+
+def test_hashing_requests_use_hashing_pool(monkeypatch):
+    '''
+    This tests that only the password hashing requests go to the hashing pool.
+
+    '''
+
+    monkeypatch.setitem(handlers.request_functions,
+                        'user-login',
+                        fake_login)
+    monkeypatch.setitem(handlers.request_functions,
+                        'session-exists',
+                        fake_session_exists)
+
+    executor = ThreadPoolExecutor(max_workers=2,
+                                  thread_name_prefix='main-worker')
+    hash_executor = ThreadPoolExecutor(max_workers=1,
+                                       thread_name_prefix='hash-worker')
+    hashing_pool = handlers.PasswordHashingPool(hash_executor)
+
+    async def run_requests():
+
+        login = asyncio.ensure_future(handlers.process_auth_request(
+            {'request':'user-login',
+             'body':{'ip_address':'1.1.1.1'},
+             'reqid':1},
+            executor,
+            hashing_pool=hashing_pool
+        ))
+
+        # the session lookup doesn't have to wait for the login
+        start = time.monotonic()
+        session = await handlers.process_auth_request(
+            {'request':'session-exists', 'body':{}, 'reqid':2},
+            executor,
+            hashing_pool=hashing_pool
+        )
+        session_time = time.monotonic() - start
+
+        return await login, session, session_time
+
+    try:
+
+        login, session, session_time = run_coroutine(run_requests())
+
+        assert login['success'] is True
+        assert login['response']['thread'].startswith('hash-worker')
+        assert session['response']['thread'].startswith('main-worker')
+        assert session_time < 0.1
+
+        assert handlers.is_hashing_request(
+            {'request':'batch',
+             'body':{'requests':[{'request':'session-delete'},
+                                 {'request':'user-delete'}]}}
+        )
+        assert not handlers.is_hashing_request(
+            {'request':'batch',
+             'body':{'requests':[{'request':'session-new'},
+                                 {'request':'session-exists'}]}}
+        )
+
+    finally:
+        executor.shutdown()
+        hash_executor.shutdown()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_lcconverter.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the shared LC conversion pool and the LC format description cache.
+
+'''
+
+import os
+import os.path
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+
+from lccserver.backend import abcat
+from lccserver.backend import datasets
+from lccserver.frontend.lcconverter import LCConversionPool
+
+
+def test_lcformat_description_cache(monkeypatch):
+    '''
+    This tests that LC format descriptions are only parsed again if they change.
+
+    '''
+
+    parsed = []
+
+    def fake_get_lcformat_description(descpath):
+        with open(descpath,'r') as infd:
+            desc = json.load(infd)
+        parsed.append(descpath)
+        return desc
+
+    monkeypatch.setattr(abcat,
+                        'get_lcformat_description',
+                        fake_get_lcformat_description)
+    monkeypatch.setattr(datasets, '_LCFORMAT_CACHE', {})
+
+    with tempfile.TemporaryDirectory() as tempdir:
+
+        descpath = os.path.join(tempdir, 'lcformat-description.json')
+        with open(descpath,'w') as outfd:
+            json.dump({'lc_formatkey':'test'}, outfd)
+
+        for _ in range(3):
+            desc = datasets.get_cached_lcformat_description(descpath)
+            assert desc['lc_formatkey'] == 'test'
+
+        assert parsed == [descpath]
+
+        with open(descpath,'w') as outfd:
+            json.dump({'lc_formatkey':'changed'}, outfd)
+        os.utime(descpath, (0, 12345))
+
+        desc = datasets.get_cached_lcformat_description(descpath)
+        assert desc['lc_formatkey'] == 'changed'
+        assert len(parsed) == 2
+
+
+def test_conversion_pool_fair_scheduling():
+    '''
+    This tests that batches from concurrent jobs are interleaved and that each
+    job gets its results back in order.
+
+    '''
+
+    pool = LCConversionPool(max_workers=1, batch_size=2)
+    pool.executor.shutdown()
+    pool.executor = ThreadPoolExecutor(max_workers=1)
+
+    submitted = []
+    orig_submit = pool.executor.submit
+
+    def recording_submit(func, batch):
+        submitted.append(batch[0][1].split('-')[0])
+        return orig_submit(func, batch)
+
+    pool.executor.submit = recording_submit
+
+    def make_lcs(prefix, nlcs):
+        return [('/missing/%s-%s.pkl' % (prefix, x),
+                 '%s-%s' % (prefix, x),
+                 '/missing/lcformat-description.json',
+                 'test_coll',
+                 '/missing/%s-%s-csvlc.gz' % (prefix, x))
+                for x in range(nlcs)]
+
+    async def run_jobs():
+        big = pool.convert('big', make_lcs('big', 10), {})
+        small = pool.convert('small', make_lcs('small', 4), {})
+        return await big, await small
+
+    try:
+        big_results, small_results = IOLoop.current().run_sync(run_jobs)
+    finally:
+        pool.shutdown()
+
+    assert len(big_results) == 10
+    assert len(small_results) == 4
+    assert big_results[3] == 'big-3.pkl conversion to CSVLC failed'
+    assert small_results[1] == 'small-1.pkl conversion to CSVLC failed'
+
+    # the small job's batches are interleaved with the big job's instead of
+    # waiting for all of them to finish
+    assert submitted == ['big', 'big', 'small', 'big', 'small', 'big', 'big']
+
+
+def test_convert_object_lcs(monkeypatch):
+    '''
+    This tests that only the missing CSV LCs of a list of objects are converted
+    and that converted LCs are reused from the LC bundle cache.
+
+    '''
+
+    converted = []
+
+    def fake_convert(task):
+        converted.append(task[1])
+        csvlc = task[0].replace('.pkl', '-csvlc.gz')
+        with open(csvlc,'wb') as outfd:
+            outfd.write(b'csvlc for %s' % task[1].encode())
+        return csvlc
+
+    monkeypatch.setattr(datasets, 'csvlc_convert_worker', fake_convert)
+
+    pool = LCConversionPool(max_workers=1, batch_size=2)
+    pool.executor.shutdown()
+    pool.executor = ThreadPoolExecutor(max_workers=1)
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        lcdir = os.path.join(basedir, 'lcs')
+        csvlcdir = os.path.join(basedir, 'csvlcs', 'test-coll')
+        os.makedirs(lcdir)
+        os.makedirs(csvlcdir)
+
+        tasks = []
+        for oid in ('OBJ-1', 'OBJ-2', 'OBJ-3'):
+            orig = os.path.join(lcdir, '%s.pkl' % oid)
+            with open(orig,'wb') as outfd:
+                outfd.write(os.urandom(1000))
+            tasks.append((orig, oid, '/fake/lcformat.json', 'test_coll',
+                          os.path.join(csvlcdir, '%s-csvlc.gz' % oid)))
+
+        # this one has been converted already
+        with open(tasks[0][-1],'wb') as outfd:
+            outfd.write(b'already converted')
+
+        ready = Queue()
+
+        async def run_job():
+            return await pool.convert_object_lcs(executor,
+                                                 basedir,
+                                                 'bulk',
+                                                 tasks,
+                                                 ready=ready)
+
+        try:
+
+            lclist = IOLoop.current().run_sync(run_job)
+            assert lclist == [x[-1] for x in tasks]
+            assert converted == ['OBJ-2', 'OBJ-3']
+            assert all(os.path.exists(x) for x in lclist)
+
+            # each CSV LC is handed out once it's in place
+            assert [ready.get_nowait() for _ in range(ready.qsize())] == lclist
+
+            # the CSV LC links are gone, but the LC bundle cache still has
+            # the converted LCs
+            os.remove(lclist[1])
+            os.remove(lclist[2])
+
+            lclist = IOLoop.current().run_sync(run_job)
+            assert converted == ['OBJ-2', 'OBJ-3']
+            with open(lclist[2],'rb') as infd:
+                assert infd.read() == b'csvlc for OBJ-3'
+
+        finally:
+            pool.shutdown()
+            executor.shutdown()
+
+
+def test_conversion_pool_links_batches(monkeypatch):
+    '''
+    This tests that a job's CSV LCs are linked into place and handed out as
+    each batch finishes instead of after the whole job is done.
+
+    '''
+
+    def fake_convert(task):
+        csvlc = task[0].replace('.pkl', '-csvlc.gz')
+        with open(csvlc,'wb') as outfd:
+            outfd.write(b'csvlc for %s' % task[1].encode())
+        return csvlc
+
+    monkeypatch.setattr(datasets, 'csvlc_convert_worker', fake_convert)
+
+    linked = []
+    orig_link = datasets.link_converted_csvlcs
+
+    def recording_link(items, results):
+        linked.append([x[1] for x in items])
+        return orig_link(items, results)
+
+    monkeypatch.setattr(datasets, 'link_converted_csvlcs', recording_link)
+
+    pool = LCConversionPool(max_workers=1, batch_size=2)
+    pool.executor.shutdown()
+    pool.executor = ThreadPoolExecutor(max_workers=1)
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        lcdir = os.path.join(basedir, 'lcs')
+        csvlcdir = os.path.join(basedir, 'csvlcs', 'test-coll')
+        os.makedirs(lcdir)
+        os.makedirs(csvlcdir)
+
+        tasks = []
+        for ind in range(5):
+            oid = 'OBJ-%s' % ind
+            orig = os.path.join(lcdir, '%s.pkl' % oid)
+            with open(orig,'wb') as outfd:
+                outfd.write(os.urandom(1000))
+            tasks.append((orig, oid, '/fake/lcformat.json', 'test_coll',
+                          os.path.join(csvlcdir, '%s-csvlc.gz' % oid)))
+
+        ready = Queue()
+
+        async def run_jobs():
+            return (
+                await pool.convert('linked',
+                                   tasks,
+                                   {},
+                                   batch_func=datasets.link_converted_csvlcs,
+                                   ready=ready),
+                await pool.convert('unlinked', tasks[:1], {})
+            )
+
+        try:
+            results, _ = IOLoop.current().run_sync(run_jobs)
+        finally:
+            pool.shutdown()
+
+        assert linked == [['OBJ-0', 'OBJ-1'], ['OBJ-2', 'OBJ-3'], ['OBJ-4']]
+        assert [ready.get_nowait() for _ in range(ready.qsize())] == (
+            [x[-1] for x in tasks]
+        )
+        for task, res in zip(tasks, results):
+            assert os.path.islink(task[-1])
+            assert os.path.realpath(task[-1]) == os.path.realpath(res)
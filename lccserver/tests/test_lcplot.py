@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_lcplot.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the lccserver.backend.lcplot module using a fake LC store.
+
+'''
+
+import os
+import os.path
+import tempfile
+
+import numpy as np
+import pytest
+
+from lccserver.backend import lcstore, lcplot
+
+
+def make_fake_lcstore(basedir):
+    '''
+    This writes a sinusoidal LC to an LC store for the 'test-coll' collection.
+
+    '''
+
+    times = np.linspace(0.0, 20.0, 2000)
+    mags = 12.0 + 0.1*np.sin(2.0*np.pi*times/1.5)
+    errs = np.full(times.size, 0.01)
+
+    return lcstore.write_lcstore(
+        os.path.join(basedir, 'test-coll', lcstore.LCSTORE_DIRNAME),
+        [('OBJ-1', None, {'rjd':times, 'aep_000':mags, 'aie_000':errs})],
+        ['rjd', 'aep_000', 'aie_000'],
+        {'rjd':'f8', 'aep_000':'f8', 'aie_000':'f8'},
+        collection='test-coll'
+    )
+
+
+def test_bin_lc():
+    '''
+    This tests binning an LC.
+
+    '''
+
+    xvals = np.array([0.05, 0.15, 0.16, 0.95])
+    yvals = np.array([1.0, 2.0, 4.0, 5.0])
+
+    binx, biny = lcplot.bin_lc(xvals, yvals, 0.1, xmin=0.0, xmax=1.0)
+
+    np.testing.assert_allclose(binx, [0.05, 0.15, 0.95])
+    np.testing.assert_allclose(biny, [1.0, 3.0, 5.0])
+
+    # tiny binsizes are widened to at most a few bins per point
+    binx, biny = lcplot.bin_lc(xvals, yvals, 1.0e-12, xmin=0.0, xmax=1.0)
+    assert lcplot.LCPLOT_MAX_BINS_PER_POINT*xvals.size == 16
+    np.testing.assert_allclose(binx, np.array([0.5, 2.5, 15.5])/16.0)
+    np.testing.assert_allclose(biny, [1.0, 3.0, 5.0])
+
+    for binsize in (0.0, -0.1, np.nan):
+        with pytest.raises(ValueError):
+            lcplot.bin_lc(xvals, yvals, binsize)
+
+
+def test_render_lcplot_cache():
+    '''
+    This tests rendering LC plots and getting them from the cache.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        make_fake_lcstore(basedir)
+        cachedir = os.path.join(basedir, 'cache')
+
+        plotparams = lcplot.lcplot_params('aep_000',
+                                          errcol='aie_000',
+                                          period=1.5,
+                                          binsize=0.02)
+
+        assert lcplot.get_cached_lcplot(basedir,
+                                        cachedir,
+                                        'test-coll',
+                                        'OBJ-1',
+                                        plotparams) is None
+
+        png = lcplot.render_lcplot(basedir,
+                                   cachedir,
+                                   'test-coll',
+                                   'OBJ-1',
+                                   'aep_000',
+                                   errcol='aie_000',
+                                   period=1.5,
+                                   binsize=0.02)
+        assert png.startswith(b'\x89PNG')
+
+        # the same plot comes from the cache now
+        assert lcplot.get_cached_lcplot(basedir,
+                                        cachedir,
+                                        'test-coll',
+                                        'OBJ-1',
+                                        plotparams) == png
+
+        # different plot parameters aren't cached yet
+        svgparams = lcplot.lcplot_params('aep_000',
+                                         timerange=(2.0, 8.0),
+                                         outformat='svg')
+        assert lcplot.get_cached_lcplot(basedir,
+                                        cachedir,
+                                        'test-coll',
+                                        'OBJ-1',
+                                        svgparams) is None
+
+        svg = lcplot.render_lcplot(basedir,
+                                   cachedir,
+                                   'test-coll',
+                                   'OBJ-1',
+                                   'aep_000',
+                                   timerange=(2.0, 8.0),
+                                   outformat='svg')
+        assert b'<svg' in svg
+
+        # unknown objects and columns can't be plotted
+        assert lcplot.render_lcplot(basedir, cachedir,
+                                    'test-coll', 'OBJ-2', 'aep_000') is None
+        assert lcplot.render_lcplot(basedir, cachedir,
+                                    'test-coll', 'OBJ-1', 'nope') is None
+        assert lcplot.render_lcplot(basedir, cachedir,
+                                    'other-coll', 'OBJ-1', 'aep_000') is None
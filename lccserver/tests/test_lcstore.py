@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_lcstore.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the lccserver.backend.lcstore module using a few fake LCs.
+
+'''
+
+import os
+import os.path
+import tempfile
+from io import BytesIO
+
+import numpy as np
+
+from lccserver.backend import lcstore
+
+
+def fake_lcdicts():
+    '''
+    This generates a few fake LCs.
+
+    '''
+
+    rng = np.random.RandomState(42)
+
+    for ind in range(5):
+
+        nrows = 100 + ind*10
+        times = np.linspace(0.0, 10.0, nrows)
+
+        # the last LC isn't sorted in time
+        if ind == 4:
+            times = times[::-1]
+
+        columns = {'rjd':times,
+                   'aim_000':rng.normal(size=nrows),
+                   'stf':np.full(nrows, ind)}
+
+        # this one has no magnitudes
+        if ind == 2:
+            del columns['aim_000']
+
+        yield 'OBJ-%s' % ind, '/fake/OBJ-%s.lc' % ind, columns
+
+
+def make_fake_lcstore(basedir):
+    '''
+    This writes the fake LCs to an LC store for the 'test-coll' collection.
+
+    '''
+
+    return lcstore.write_lcstore(
+        os.path.join(basedir, 'test-coll', lcstore.LCSTORE_DIRNAME),
+        fake_lcdicts(),
+        ['rjd', 'aim_000', 'stf'],
+        {'rjd':'f8', 'aim_000':'f8', 'stf':'i8'},
+        coldescs={'rjd':'time', 'aim_000':'mag', 'stf':'station'},
+        collection='test-coll'
+    )
+
+
+def test_lcstore_slices():
+    '''
+    This tests slicing LCs from the LC store.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        storedir = make_fake_lcstore(basedir)
+        store = lcstore.LCStore(storedir)
+
+        assert store.info['nobjects'] == 5
+        assert store.info['nrows'] == sum(100 + x*10 for x in range(5))
+
+        expected = {x[0]:x[2] for x in fake_lcdicts()}
+
+        # the full LC
+        lcslice = store.get_slice('OBJ-1')
+        assert lcslice['nrows'] == 110
+        assert sorted(lcslice['columns']) == ['aim_000', 'rjd', 'stf']
+        assert isinstance(lcslice['columns']['rjd'], np.memmap)
+        np.testing.assert_array_equal(lcslice['columns']['aim_000'],
+                                      expected['OBJ-1']['aim_000'])
+
+        # a column subset
+        lcslice = store.get_slice('OBJ-3', columns=['stf', 'nope'])
+        assert list(lcslice['columns']) == ['stf']
+        assert np.all(lcslice['columns']['stf'] == 3)
+
+        # a missing column is left out of the object's columns
+        lcslice = store.get_slice('OBJ-2')
+        assert sorted(lcslice['columns']) == ['rjd', 'stf']
+        assert np.all(np.isnan(store.column('aim_000')[210:330]))
+
+        # time ranges for sorted and unsorted LCs
+        for objectid in ('OBJ-0', 'OBJ-4'):
+
+            lcslice = store.get_slice(objectid, timerange=(2.0, 5.0))
+            times = expected[objectid]['rjd']
+            select = (times >= 2.0) & (times <= 5.0)
+
+            assert lcslice['nrows'] == select.sum()
+            np.testing.assert_array_equal(lcslice['columns']['rjd'],
+                                          times[select])
+            np.testing.assert_array_equal(lcslice['columns']['aim_000'],
+                                          expected[objectid]['aim_000'][select])
+
+        lcslice = store.get_slice('OBJ-0', timerange=(None, 1.0))
+        assert lcslice['columns']['rjd'].max() <= 1.0
+
+        # decimation
+        lcslice = store.get_slice('OBJ-0', decimate=3)
+        assert lcslice['nrows'] == 34
+        np.testing.assert_array_equal(lcslice['columns']['rjd'],
+                                      expected['OBJ-0']['rjd'][::3])
+
+        lcslice = store.get_slice('OBJ-4', maxrows=25)
+        assert lcslice['decimate'] == 6
+        assert lcslice['columns']['rjd'].size == lcslice['nrows'] <= 25
+
+        assert store.get_slice('OBJ-9') is None
+        store.close()
+
+
+def test_get_lc_slice():
+    '''
+    This tests the JSON and NPZ output of LC slices.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        make_fake_lcstore(basedir)
+
+        assert lcstore.get_lc_slice(basedir, 'other-coll', 'OBJ-0') is None
+
+        lcslice = lcstore.get_lc_slice(basedir,
+                                       'test-coll',
+                                       'OBJ-1',
+                                       columns=['rjd', 'stf'],
+                                       timerange=(0.0, 1.0))
+        assert lcslice['collection'] == 'test-coll'
+        assert lcslice['coldesc']['rjd']['desc'] == 'time'
+        assert isinstance(lcslice['columns']['rjd'], list)
+        assert lcslice['columns']['stf'][0] == 1
+
+        lcslice = lcstore.get_lc_slice(basedir,
+                                       'test-coll',
+                                       'OBJ-3',
+                                       outformat='npz')
+        with np.load(BytesIO(lcslice['npz'])) as npz:
+            assert sorted(npz.files) == ['aim_000', 'rjd', 'stf']
+            assert npz['rjd'].size == 130
+
+        # rebuilding the store is picked up by the cached reader
+        lcstore.write_lcstore(
+            os.path.join(basedir, 'test-coll', 'lcstore-new'),
+            [('OBJ-0', None, {'rjd':np.array([1.0, np.nan])})],
+            ['rjd'],
+            {'rjd':'f8'}
+        )
+        os.rename(os.path.join(basedir, 'test-coll', 'lcstore'),
+                  os.path.join(basedir, 'test-coll', 'lcstore-old'))
+        os.rename(os.path.join(basedir, 'test-coll', 'lcstore-new'),
+                  os.path.join(basedir, 'test-coll', 'lcstore'))
+
+        lcslice = lcstore.get_lc_slice(basedir, 'test-coll', 'OBJ-0')
+        assert lcslice['columns']['rjd'] == [1.0, None]
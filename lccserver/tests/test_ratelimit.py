@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_ratelimit.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the frontend's in-process rate limiter.
+
+'''
+
+from lccserver.frontend.ratelimit import RateLimiter
+
+
+def test_rate_limiter():
+    '''
+    This tests that the role request limits are enforced per key.
+
+    '''
+
+    limiter = RateLimiter()
+
+    # anonymous users get 600 requests in 60 seconds
+    for ind in range(600):
+        rate_ok, request_rate = limiter.check('token-1', 'anonymous', now=0.0)
+        assert rate_ok
+    assert request_rate == 600.0
+
+    rate_ok, request_rate = limiter.check('token-1', 'anonymous', now=0.0)
+    assert not rate_ok
+    assert request_rate == 601.0
+
+    # other keys aren't affected
+    assert limiter.check('token-2', 'anonymous', now=0.0)[0]
+
+    # the bucket refills at 10 requests per second
+    assert limiter.check('token-1', 'anonymous', now=1.0)[0]
+    results = [limiter.check('token-1', 'anonymous', now=1.0)[0]
+               for _ in range(20)]
+    assert results.count(True) == 9
+
+    # users with a higher limit have more room
+    assert limiter.check('token-1', 'authenticated', now=30.0)[0]
+
+    # locked users can't make any requests
+    assert not limiter.check('token-3', 'locked', now=0.0)[0]
+
+
+def test_rate_limiter_pruning():
+    '''
+    This tests that idle buckets are dropped when there are too many.
+
+    '''
+
+    limiter = RateLimiter(maxkeys=10, idle_expiry=60.0)
+
+    for ind in range(10):
+        limiter.check('token-%s' % ind, 'anonymous', now=0.0)
+
+    limiter.check('token-0', 'anonymous', now=100.0)
+    limiter.check('token-new', 'anonymous', now=100.0)
+
+    assert sorted(limiter.buckets) == ['token-0', 'token-new']
+
+
+def test_rate_limiter_expiry():
+    '''
+    This tests that idle buckets are dropped when the limiter is expired.
+
+    '''
+
+    limiter = RateLimiter(idle_expiry=60.0)
+
+    limiter.check('token-1', 'anonymous', now=0.0)
+    limiter.check('token-2', 'anonymous', now=50.0)
+
+    assert limiter.expire(now=100.0) == 1
+    assert sorted(limiter.buckets) == ['token-2']
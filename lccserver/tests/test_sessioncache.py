@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_sessioncache.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the frontend session cache and its invalidation.
+
+'''
+
+from datetime import datetime, timedelta
+
+from lccserver.frontend import basehandler
+from lccserver.frontend.sessioncache import SessionCache
+
+
+def fake_session(token, user_id, email, expires_in_days=7):
+    '''
+    This makes a fake session info dict like the authnzerver's.
+
+    '''
+
+    return {'session_token':token,
+            'user_id':user_id,
+            'email':email,
+            'user_role':'authenticated',
+            'expires':(datetime.utcnow() +
+                       timedelta(days=expires_in_days)).isoformat()}
+
+
+def test_session_cache():
+    '''
+    This tests adding, expiring, and invalidating cached sessions.
+
+    '''
+
+    sesscache = SessionCache(ttl=60.0, maxitems=10)
+
+    sesscache.set('token-1', fake_session('token-1', 4, 'a@example.com'))
+    sesscache.set(b'token-2', fake_session('token-2', 4, 'a@example.com'))
+    sesscache.set('token-3', fake_session('token-3', 5, 'b@example.com'))
+
+    # bytes and str tokens are the same
+    assert sesscache.get(b'token-1')['user_id'] == 4
+    assert sesscache.get('token-2')['user_id'] == 4
+
+    # changing the returned dict doesn't change the cached one
+    sesscache.get('token-3')['user_role'] = 'superuser'
+    assert sesscache.get('token-3')['user_role'] == 'authenticated'
+
+    sesscache.invalidate('token-1')
+    assert sesscache.get('token-1') is None
+    assert sesscache.get('token-2') is not None
+
+    sesscache.invalidate_user(user_id=4)
+    assert sesscache.get('token-2') is None
+    assert sesscache.get('token-3') is not None
+
+    sesscache.invalidate_user(email='b@example.com')
+    assert sesscache.get('token-3') is None
+
+    # expired sessions aren't returned
+    sesscache.set('token-4', fake_session('token-4', 6, 'c@example.com',
+                                          expires_in_days=-1))
+    assert sesscache.get('token-4') is None
+
+    sesscache.ttl = -1.0
+    sesscache.set('token-5', fake_session('token-5', 6, 'c@example.com'))
+    assert sesscache.get('token-5') is None
+
+    # expiring the cache returns the sessions that have expired
+    sesscache.ttl = 60.0
+    sesscache.set('token-6', fake_session('token-6', 6, 'c@example.com'))
+    sesscache.sessions['token-7'] = (
+        fake_session('token-7', 6, 'c@example.com', expires_in_days=-1),
+        sesscache.sessions['token-6'][1],
+        datetime.utcnow() - timedelta(days=1)
+    )
+    assert sesscache.expire() == ['token-7']
+    assert sorted(sesscache.sessions) == ['token-6']
+
+    # the oldest sessions are dropped when the cache is full
+    sesscache.ttl = 60.0
+    for ind in range(15):
+        sesscache.set('token-%s' % ind,
+                      fake_session('token-%s' % ind, ind, 'c@example.com'))
+    assert len(sesscache.sessions) <= 10
+    assert sesscache.get('token-14') is not None
+    assert sesscache.get('token-0') is None
+
+
+def test_authnzerver_request_invalidation(monkeypatch):
+    '''
+    This tests that the authnzerver requests that change sessions or users drop
+    the affected cached sessions.
+
+    '''
+
+    sesscache = SessionCache()
+    monkeypatch.setattr(basehandler, 'SESSION_CACHE', sesscache)
+
+    def fill_cache():
+        sesscache.clear()
+        sesscache.set('token-1', fake_session('token-1', 4, 'a@example.com'))
+        sesscache.set('token-2', fake_session('token-2', 4, 'a@example.com'))
+        sesscache.set('token-3', fake_session('token-3', 5, 'b@example.com'))
+
+    fill_cache()
+    basehandler.invalidate_cached_sessions('session-exists',
+                                           {'session_token':'token-1'})
+    assert len(sesscache.sessions) == 3
+
+    basehandler.invalidate_cached_sessions('session-delete',
+                                           {'session_token':'token-1'})
+    assert sorted(sesscache.sessions) == ['token-2', 'token-3']
+
+    fill_cache()
+    basehandler.invalidate_cached_sessions('user-changepass',
+                                           {'user_id':4,
+                                            'email':'a@example.com'})
+    assert sorted(sesscache.sessions) == ['token-3']
+
+    fill_cache()
+    basehandler.invalidate_cached_sessions('user-resetpass',
+                                           {'email_address':'b@example.com'})
+    assert sorted(sesscache.sessions) == ['token-1', 'token-2']
+
+    fill_cache()
+    basehandler.invalidate_cached_sessions('user-edit',
+                                           {'user_id':1,
+                                            'target_userid':5,
+                                            'update_dict':{}})
+    assert sorted(sesscache.sessions) == ['token-1', 'token-2']
+
+    # the requests in a batch are checked one by one
+    fill_cache()
+    basehandler.invalidate_cached_sessions(
+        'batch',
+        {'requests':[{'request':'user-delete',
+                      'body':{'user_id':5}},
+                     {'request':'session-delete',
+                      'body':{'session_token':'token-1'}}]}
+    )
+    assert sorted(sesscache.sessions) == ['token-2']
+
+
+def test_session_cache_generations():
+    '''
+    This tests that session info fetched before an invalidation isn't cached.
+
+    '''
+
+    sesscache = SessionCache(ttl=60.0, maxitems=10)
+
+    # a session-exists request for token-1 starts, then token-1 is invalidated
+    # while it's in flight
+    generation = sesscache.generation
+    sesscache.invalidate('token-1')
+
+    sesscache.set('token-1', fake_session('token-1', 4, 'a@example.com'),
+                  generation=generation)
+    assert sesscache.get('token-1') is None
+
+    # other sessions aren't affected
+    sesscache.set('token-2', fake_session('token-2', 4, 'a@example.com'),
+                  generation=generation)
+    assert sesscache.get('token-2') is not None
+
+    # requests started after the invalidation are cached
+    sesscache.set('token-1', fake_session('token-1', 4, 'a@example.com'),
+                  generation=sesscache.generation)
+    assert sesscache.get('token-1') is not None
+
+    # invalidating a user affects all sessions in flight
+    generation = sesscache.generation
+    sesscache.invalidate_user(user_id=5)
+    sesscache.set('token-3', fake_session('token-3', 5, 'b@example.com'),
+                  generation=generation)
+    assert sesscache.get('token-3') is None
+
+    # if there are too many invalidations to keep track of, requests started
+    # before the dropped ones aren't cached
+    generation = sesscache.generation
+    sesscache.invalidate('token-4')
+    for ind in range(10):
+        sesscache.invalidate('other-token-%s' % ind)
+    assert 'token-4' not in sesscache.invalidated
+
+    sesscache.set('token-4', fake_session('token-4', 6, 'c@example.com'),
+                  generation=generation)
+    assert sesscache.get('token-4') is None
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''test_transport.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Oct 2018
+License: MIT - see the LICENSE file for the full text.
+
+This tests the framed stream transport between the frontend and the
+authnzerver.
+
+'''
+
+import asyncio
+import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet
+import tornado.netutil
+
+from lccserver.authnzerver import handlers
+from lccserver.authnzerver.handlers import AuthStreamServer
+from lccserver.authnzerver.transport import AuthnzerverClient
+
+
+def fake_session_exists(payload):
+    '''
+    This pretends to look up a session, taking longer for some tokens.
+
+    '''
+
+    time.sleep(payload.get('delay', 0.0))
+    return {'success':True,
+            'session_info':{'session_token':payload['session_token']},
+            'messages':['session found']}
+
+
+def fake_failing_request(payload):
+    '''
+    This pretends to be a request function that breaks.
+
+    '''
+
+    raise KeyError('broken')
+
+
+def run_with_server(tmpdir, monkeypatch, test_coroutine):
+    '''
+    This runs test_coroutine with a stream server listening on a Unix socket.
+
+    '''
+
+    monkeypatch.setitem(handlers.request_functions,
+                        'session-exists',
+                        fake_session_exists)
+    monkeypatch.setitem(handlers.request_functions,
+                        'session-broken',
+                        fake_failing_request)
+
+    fernet_secret = Fernet.generate_key()
+    socket_path = os.path.join(str(tmpdir), 'authnzerver.sock')
+    executor = ThreadPoolExecutor(max_workers=8)
+
+    async def run_test():
+
+        server = AuthStreamServer('sqlite://', fernet_secret, executor)
+        server.add_socket(tornado.netutil.bind_unix_socket(socket_path))
+
+        client = AuthnzerverClient('unix://%s' % socket_path, fernet_secret)
+
+        try:
+            await test_coroutine(server, client)
+        finally:
+            client.close()
+            server.stop()
+            # let the server see that the connection closed
+            await asyncio.sleep(0.05)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_test())
+    finally:
+        loop.close()
+        executor.shutdown()
+
+
+def test_stream_requests(tmpdir, monkeypatch):
+    '''
+    This tests concurrent requests on a single stream connection.
+
+    '''
+
+    async def test_coroutine(server, client):
+
+        # the slow requests finish last, so the responses come back out of
+        # order and have to be matched to their requests by reqid
+        results = await asyncio.gather(*[
+            client.request('session-exists',
+                           {'session_token':'token-%s' % ind,
+                            'delay':0.2 if ind % 2 == 0 else 0.0})
+            for ind in range(10)
+        ])
+
+        for ind, (success, response, messages) in enumerate(results):
+            assert success is True
+            assert (response['session_info']['session_token'] ==
+                    'token-%s' % ind)
+            assert messages == ['session found']
+
+        # all of these went over the same connection
+        first_stream = client.stream
+        assert first_stream is not None
+        assert (await client.request(
+            'session-exists', {'session_token':'token-a'}
+        ))[0]
+        assert client.stream is first_stream
+
+        # failed requests don't break the connection
+        assert (await client.request('session-broken', {})) == (False,
+                                                               None,
+                                                               None)
+        assert (await client.request('no-such-request', {})) == (False,
+                                                                None,
+                                                                None)
+        assert (await client.request(
+            'session-exists', {'session_token':'token-b'}
+        ))[0]
+        assert client.stream is first_stream
+
+    run_with_server(tmpdir, monkeypatch, test_coroutine)
+
+
+def test_stream_reconnect(tmpdir, monkeypatch):
+    '''
+    This tests that the client reconnects after its connection closes and that
+    clients with the wrong key are refused.
+
+    '''
+
+    async def test_coroutine(server, client):
+
+        assert (await client.request(
+            'session-exists', {'session_token':'token-1'}
+        ))[0]
+
+        client.stream.close()
+        await asyncio.sleep(0.05)
+
+        success, response, messages = await client.request(
+            'session-exists', {'session_token':'token-2'}
+        )
+        assert success is True
+        assert response['session_info']['session_token'] == 'token-2'
+
+        bad_client = AuthnzerverClient(client.address,
+                                       Fernet.generate_key(),
+                                       timeout=1.0)
+        try:
+            assert (await bad_client.request(
+                'session-exists', {'session_token':'token-3'}
+            )) == (False, None, None)
+        finally:
+            bad_client.close()
+
+    run_with_server(tmpdir, monkeypatch, test_coroutine)